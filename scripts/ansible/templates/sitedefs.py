@@ -160,7 +160,7 @@ GEO_SMCOM_URL = ""
 GEO_BATCH = True            # Whether or not to try and lookup geocodes as part of the batch
 GEO_LIMIT = 100             # How many geocodes to lookup as part of the batch
 GEO_LOOKUP_TIMEOUT = 5      # Timeout when doing geocode lookups
-GEO_SLEEP_AFTER = 1         # Sleep for seconds after a request to throttle (nominatim has a 1/s limit)
+GEO_SLEEP_AFTER = 0         # Minimum seconds between requests to throttle, 0 to use the provider's own limit (nominatim has a 1/s limit)
 
 # Enable the database field on login and allow login to multiple databases
 MULTIPLE_DATABASES = False
@@ -1,6 +1,7 @@
 #!/usr/bin/python
 
 import al
+import lookups
 import sys
 import utils
 
@@ -37,6 +38,9 @@ LOSTANIMAL_IN = "9, 10"
 FOUNDANIMAL_IN = "11, 12"
 WAITINGLIST_IN = "13, 14, 15"
 
+# Maximum number of IDs to put in a single IN clause when loading values in bulk
+IN_CLAUSE_SIZE = 1000
+
 # Field types
 YESNO = 0
 TEXT = 1
@@ -126,22 +130,41 @@ def append_to_results(dbo, rows, linktype = "animal"):
     """
     Goes through each row in rows and adds any additional fields to the resultset.
     Requires an ID column in the rows.
+    Values are loaded in bulk, IN_CLAUSE_SIZE rows at a time, rather than
+    running a query per row.
     """
+    if len(rows) == 0: return rows
+    fields = get_field_definitions(dbo, linktype)
+    if len(fields) == 0: return rows
+    # The column name each field appears under in the results
+    names = []
+    for f in fields:
+        if f.fieldname.find("&") != -1:
+            # We've got unicode chars for the tag name - not allowed
+            names.append((f.id, "ADD" + str(f.id)))
+        else:
+            names.append((f.id, f.fieldname.upper()))
+    # Build an index of linkid -> { fieldid: value }
+    values = {}
+    links = sorted(set([ str(r.id) for r in rows if r.id is not None ]))
+    for i in range(0, len(links), IN_CLAUSE_SIZE):
+        for v in dbo.query("SELECT a.LinkID, a.AdditionalFieldID, a.Value " \
+            "FROM additional a INNER JOIN additionalfield af ON af.ID = a.AdditionalFieldID " \
+            "WHERE af.LinkType IN (%s) AND a.LinkID IN (%s)" % (clause_for_linktype(linktype), ",".join(links[i:i+IN_CLAUSE_SIZE]))):
+            if v.linkid not in values: values[v.linkid] = {}
+            values[v.linkid][v.additionalfieldid] = v.value
+    # Every row gets every field, None if it has no value
     for r in rows:
-        add = get_additional_fields(dbo, r.id, linktype)
-        for af in add:
-            if af.fieldname.find("&") != -1:
-                # We've got unicode chars for the tag name - not allowed
-                r["ADD" + str(af.id)] = af.value
-            else:
-                r[af.fieldname.upper()] = af.value
+        rv = values.get(r.id, {})
+        for fid, name in names:
+            r[name] = rv.get(fid)
     return rows
 
 def insert_field_from_form(dbo, username, post):
     """
     Creates an additional field
     """
-    return dbo.insert("additionalfield", {
+    fid = dbo.insert("additionalfield", {
         "FieldName":        post["name"],
         "FieldLabel":       post["label"],
         "ToolTip":          post["tooltip"],
@@ -154,6 +177,8 @@ def insert_field_from_form(dbo, username, post):
         "LinkType":         post.integer("link"),
         "DisplayIndex":     post.integer("displayindex")
     })
+    lookups.flush_lookup(dbo, "additionalfield")
+    return fid
 
 def update_field_from_form(dbo, username, post):
     """
@@ -174,6 +199,7 @@ def update_field_from_form(dbo, username, post):
         "LinkType":         post.integer("link"),
         "DisplayIndex":     post.integer("displayindex")
     })
+    lookups.flush_lookup(dbo, "additionalfield")
 
 def delete_field(dbo, username, fid):
     """
@@ -181,6 +207,7 @@ def delete_field(dbo, username, fid):
     """
     dbo.delete("additionalfield", fid, username)
     dbo.delete("additional", "AdditionalFieldID=%d" % fid)
+    lookups.flush_lookup(dbo, "additionalfield")
 
 def insert_additional(dbo, linktype, linkid, additionalfieldid, value):
     """ Inserts an additional field record """
@@ -21,6 +21,10 @@ from random import choice
 ASCENDING = 0
 DESCENDING = 1
 
+# The calculated columns on the animal table that change with time,
+# in the order calc_variable_animal_data returns them
+VARIABLE_ANIMAL_COLUMNS = ( "TimeOnShelter", "AgeGroup", "AgeGroupActiveMovement", "AnimalAge", "DaysOnShelter", "TotalTimeOnShelter", "TotalDaysOnShelter" )
+
 def get_animal_query(dbo):
     """
     Returns a select for animal rows with resolved lookups
@@ -251,6 +255,10 @@ def get_animal_status_query(dbo):
         "LEFT OUTER JOIN deathreason dr ON dr.ID = a.PTSReasonID " \
         "LEFT OUTER JOIN internallocation il ON il.ID = a.ShelterLocation "
 
+def get_variable_animal_data_query(dbo):
+    return "SELECT ID, DateBroughtIn, DeceasedDate, DiedOffShelter, Archived, ActiveMovementDate, " \
+        "MostRecentEntryDate, DateOfBirth, %s FROM animal" % ", ".join(VARIABLE_ANIMAL_COLUMNS)
+
 def get_animal_movement_status_query(dbo):
     return "SELECT m.ID, m.MovementType, m.MovementDate, m.ReturnDate, " \
         "mt.MovementType AS MovementTypeName, " \
@@ -963,6 +971,21 @@ def calc_days_on_shelter(dbo, animalid, a = None):
 
     return date_diff_days(mre, stop)
 
+def group_movements_by_animal(movements):
+    """
+    Groups a list of movements into a dict of animalid -> list of movements
+    for that animal, preserving the order of the original list. 
+    Batch routines use this so that each animal only has to look at its own
+    movements rather than scanning the full list.
+    """
+    groups = {}
+    for m in movements:
+        if m.animalid not in groups:
+            groups[m.animalid] = [ m ]
+        else:
+            groups[m.animalid].append(m)
+    return groups
+
 def calc_total_days_on_shelter(dbo, animalid, a = None, movements = None):
     """
     Returns the total number of days an animal has been on the shelter (counting all stays) as an int
@@ -2451,39 +2474,37 @@ def clone_animal(dbo, username, animalid):
         "MostRecentEntryDate": a.mostrecententrydate
     }, username, writeAudit=False)
     # Additional Fields
-    for af in dbo.query("SELECT * FROM additional WHERE LinkID = %d AND LinkType IN (%s)" % (animalid, additional.ANIMAL_IN)):
-        dbo.insert("additional", {
-            "LinkType":             af.linktype,
-            "LinkID":               nid,
-            "AdditionalFieldID":    af.additionalfieldid,
-            "Value":                af.value
-        }, generateID=False, writeAudit=False, setRecordVersion=False)
+    dbo.insert_many("additional", [ {
+        "LinkType":             af.linktype,
+        "LinkID":               nid,
+        "AdditionalFieldID":    af.additionalfieldid,
+        "Value":                af.value
+    } for af in dbo.query("SELECT * FROM additional WHERE LinkID = %d AND LinkType IN (%s)" % (animalid, additional.ANIMAL_IN)) ],
+        generateID=False, writeAudit=False, setRecordVersion=False)
     # Vaccinations
-    for v in dbo.query("SELECT * FROM animalvaccination WHERE AnimalID = ?", [animalid]):
-        dbo.insert("animalvaccination", {
-            "AnimalID":             nid,
-            "VaccinationID":        v.vaccinationid,
-            "DateOfVaccination":    v.dateofvaccination,
-            "DateRequired":         v.daterequired,
-            "DateExpires":          v.dateexpires,
-            "BatchNumber":          v.batchnumber,
-            "AdministeringVetID":   v.administeringvetid,
-            "Manufacturer":         v.manufacturer,
-            "Cost":                 v.cost,
-            "Comments":             v.comments
-        }, username, writeAudit=False)
+    dbo.insert_many("animalvaccination", [ {
+        "AnimalID":             nid,
+        "VaccinationID":        v.vaccinationid,
+        "DateOfVaccination":    v.dateofvaccination,
+        "DateRequired":         v.daterequired,
+        "DateExpires":          v.dateexpires,
+        "BatchNumber":          v.batchnumber,
+        "AdministeringVetID":   v.administeringvetid,
+        "Manufacturer":         v.manufacturer,
+        "Cost":                 v.cost,
+        "Comments":             v.comments
+    } for v in dbo.query("SELECT * FROM animalvaccination WHERE AnimalID = ?", [animalid]) ], username, writeAudit=False)
     # Tests
-    for t in dbo.query("SELECT * FROM animaltest WHERE AnimalID = ?", [animalid]):
-        dbo.insert("animaltest", {
-            "AnimalID":             nid,
-            "TestTypeID":           t.testtypeid,
-            "TestResultID":         t.testresultid,
-            "DateOfTest":           t.dateoftest,
-            "DateRequired":         t.daterequired,
-            "AdministeringVetID":   t.administeringvetid,
-            "Cost":                 t.cost,
-            "Comments":             t.comments
-        }, username, writeAudit=False)
+    dbo.insert_many("animaltest", [ {
+        "AnimalID":             nid,
+        "TestTypeID":           t.testtypeid,
+        "TestResultID":         t.testresultid,
+        "DateOfTest":           t.dateoftest,
+        "DateRequired":         t.daterequired,
+        "AdministeringVetID":   t.administeringvetid,
+        "Cost":                 t.cost,
+        "Comments":             t.comments
+    } for t in dbo.query("SELECT * FROM animaltest WHERE AnimalID = ?", [animalid]) ], username, writeAudit=False)
     # Medical
     for am in dbo.query("SELECT * FROM animalmedical WHERE AnimalID = ?", [animalid]):
         namid = dbo.insert("animalmedical", {
@@ -2503,35 +2524,32 @@ def clone_animal(dbo, username, animalid):
             "Status":               am.status,
             "Comments":             am.comments
         }, username, writeAudit=False)
-        for amt in dbo.query("SELECT * FROM animalmedicaltreatment WHERE AnimalMedicalID = ?", [am.id]):
-            dbo.insert("animalmedicaltreatment", {
-                "AnimalID":         nid,
-                "AnimalMedicalID":  namid,
-                "DateRequired":     amt.daterequired,
-                "DateGiven":        amt.dategiven,
-                "TreatmentNumber":  amt.treatmentnumber,
-                "TotalTreatments":  amt.totaltreatments,
-                "AdministeringVetID": amt.administeringvetid,
-                "GivenBy":          amt.givenby,
-                "Comments":         amt.comments
-            }, username, writeAudit=False)
+        dbo.insert_many("animalmedicaltreatment", [ {
+            "AnimalID":         nid,
+            "AnimalMedicalID":  namid,
+            "DateRequired":     amt.daterequired,
+            "DateGiven":        amt.dategiven,
+            "TreatmentNumber":  amt.treatmentnumber,
+            "TotalTreatments":  amt.totaltreatments,
+            "AdministeringVetID": amt.administeringvetid,
+            "GivenBy":          amt.givenby,
+            "Comments":         amt.comments
+        } for amt in dbo.query("SELECT * FROM animalmedicaltreatment WHERE AnimalMedicalID = ?", [am.id]) ], username, writeAudit=False)
     # Diet
-    for d in dbo.query("SELECT * FROM animaldiet WHERE AnimalID = ?", [animalid]):
-        dbo.insert("animaldiet", {
-            "AnimalID":             nid,
-            "DietID":               d.dietid,
-            "DateStarted":          d.datestarted,
-            "Comments":             d.comments
-        }, username, writeAudit=False)
+    dbo.insert_many("animaldiet", [ {
+        "AnimalID":             nid,
+        "DietID":               d.dietid,
+        "DateStarted":          d.datestarted,
+        "Comments":             d.comments
+    } for d in dbo.query("SELECT * FROM animaldiet WHERE AnimalID = ?", [animalid]) ], username, writeAudit=False)
     # Costs
-    for c in dbo.query("SELECT * FROM animalcost WHERE AnimalID = ?", [animalid]):
-        dbo.insert("animalcost", {
-            "AnimalID":             nid,
-            "CostTypeID":           c.costtypeid,
-            "CostDate":             c.costdate,
-            "CostAmount":           c.costamount,
-            "Description":          c.description
-        }, username, writeAudit=False)
+    dbo.insert_many("animalcost", [ {
+        "AnimalID":             nid,
+        "CostTypeID":           c.costtypeid,
+        "CostDate":             c.costdate,
+        "CostAmount":           c.costamount,
+        "Description":          c.description
+    } for c in dbo.query("SELECT * FROM animalcost WHERE AnimalID = ?", [animalid]) ], username, writeAudit=False)
     # Donations
     for dt in dbo.query("SELECT * FROM ownerdonation WHERE AnimalID = ?", [animalid]):
         dbo.insert("ownerdonation", {
@@ -2554,17 +2572,17 @@ def clone_animal(dbo, username, animalid):
             "Comments":             dt.comments
         }, username, writeAudit=False)
     # Diary
-    for di in dbo.query("SELECT * FROM diary WHERE LinkType = 1 AND LinkID = ?", [animalid]):
-        dbo.insert("diary", {
-            "LinkID":               nid,
-            "LinkType":             1,
-            "DiaryDateTime":        di.diarydatetime,
-            "DiaryForName":         di.diaryforname,
-            "Subject":              di.subject,
-            "Note":                 di.note,
-            "DateCompleted":        di.datecompleted,
-            "LinkInfo":             diary.get_link_info(dbo, 1, nid)
-        }, username, writeAudit=False)
+    linkinfo = diary.get_link_info(dbo, 1, nid)
+    dbo.insert_many("diary", [ {
+        "LinkID":               nid,
+        "LinkType":             1,
+        "DiaryDateTime":        di.diarydatetime,
+        "DiaryForName":         di.diaryforname,
+        "Subject":              di.subject,
+        "Note":                 di.note,
+        "DateCompleted":        di.datecompleted,
+        "LinkInfo":             linkinfo
+    } for di in dbo.query("SELECT * FROM diary WHERE LinkType = 1 AND LinkID = ?", [animalid]) ], username, writeAudit=False)
     # Media
     for me in dbo.query("SELECT * FROM media WHERE LinkTypeID = ? AND LinkID = ?", (media.ANIMAL, animalid)):
         ext = me.medianame
@@ -2625,14 +2643,13 @@ def clone_animal(dbo, username, animalid):
     # Log
     if configuration.clone_animal_include_logs(dbo):
         # Only clone logs if the hidden config switch is on
-        for lo in dbo.query("SELECT * FROM log WHERE LinkType = ? AND LinkID = ?", (log.ANIMAL, animalid)):
-            dbo.insert("log", {
-                "LinkID":           nid,
-                "LinkType":         log.ANIMAL,
-                "LogTypeID":        lo.logtypeid,
-                "Date":             lo.date,
-                "Comments":         lo.comments
-            }, username, writeAudit=False)
+        dbo.insert_many("log", [ {
+            "LinkID":           nid,
+            "LinkType":         log.ANIMAL,
+            "LogTypeID":        lo.logtypeid,
+            "Date":             lo.date,
+            "Comments":         lo.comments
+        } for lo in dbo.query("SELECT * FROM log WHERE LinkType = ? AND LinkID = ?", (log.ANIMAL, animalid)) ], username, writeAudit=False)
 
     audit.create(dbo, username, "animal", nid, "", audit.dump_row(dbo, "animal", nid))
     update_animal_status(dbo, nid)
@@ -3001,58 +3018,90 @@ def update_animal_check_bonds(dbo, animalid):
     if bond1 != 0: addbond(bond1, animalid)
     if bond2 != 0: addbond(bond2, animalid)
 
+def calc_variable_animal_data(dbo, animalid, a, bands = None, movements = None):
+    """
+    Returns a tuple of the variable data values for an animal in the
+    order of VARIABLE_ANIMAL_COLUMNS.
+    (int) animalid: The animal to calculate for
+    a: An animal result from get_variable_animal_data_query
+    bands: List of loaded age group bands
+    movements: List of loaded movements
+    """
+    return (
+        calc_time_on_shelter(dbo, animalid, a),
+        calc_age_group(dbo, animalid, a, bands, utils.iif(a.activemovementdate is not None, a.mostrecententrydate, None)),
+        calc_age_group(dbo, animalid, a, bands, a.activemovementdate),
+        calc_age(dbo, animalid, a),
+        calc_days_on_shelter(dbo, animalid, a),
+        calc_total_time_on_shelter(dbo, animalid, a, movements),
+        calc_total_days_on_shelter(dbo, animalid, a, movements)
+    )
+
+def variable_animal_data_changed(a, values):
+    """
+    Returns True if the variable data values (a tuple in the order of 
+    VARIABLE_ANIMAL_COLUMNS) differ from those stored on animal result a.
+    If a doesn't have the stored values, they are assumed to differ.
+    """
+    for i, c in enumerate(VARIABLE_ANIMAL_COLUMNS):
+        k = c.upper()
+        if k not in a or a[k] != values[i]: return True
+    return False
+
 def update_variable_animal_data(dbo, animalid, a = None, animalupdatebatch = None, bands = None, movements = None):
     """
     Updates the variable data animal fields,
     MostRecentEntryDate, TimeOnShelter, DaysOnShelter, AgeGroup, AnimalAge,
     TotalTimeOnShelter, TotalDaysOnShelter
     AgeGroup holds the animal's current age group, but resets to last entry when they leave the shelter.
+    Nothing is written if the values haven't changed since they were last calculated.
+    Returns True if the values changed.
     (int) animalid: The animal to update
     a: An animal result to use instead of looking it up from the id
     animalupdatebatch: A batch of update parameters
     bands: List of loaded age group bands
     movements: List of loaded movements
     """
+    if a is None:
+        a = dbo.first_row(dbo.query(get_variable_animal_data_query(dbo) + " WHERE ID = ?", [animalid]))
+        if a is None: return False
+    values = calc_variable_animal_data(dbo, animalid, a, bands, movements)
+    if not variable_animal_data_changed(a, values): return False
     if animalupdatebatch is not None:
-        animalupdatebatch.append((
-            calc_time_on_shelter(dbo, animalid, a),
-            calc_age_group(dbo, animalid, a, bands, utils.iif(a.activemovementdate is not None, a.mostrecententrydate, None)),
-            calc_age_group(dbo, animalid, a, bands, a.activemovementdate),
-            calc_age(dbo, animalid, a),
-            calc_days_on_shelter(dbo, animalid, a),
-            calc_total_time_on_shelter(dbo, animalid, a, movements),
-            calc_total_days_on_shelter(dbo, animalid, a, movements),
-            animalid
-        ))
+        animalupdatebatch.append(values + (animalid,))
     else:
-        activemovement = dbo.query_date("SELECT ActiveMovementDate FROM animal WHERE ID = ?", [animalid])
-        recententry = dbo.query_date("SELECT MostRecentEntryDate FROM animal WHERE ID = ?", [animalid])
-        agegroupto = utils.iif(activemovement is not None, recententry, None)
-        dbo.update("animal", animalid, {
-            "TimeOnShelter":        calc_time_on_shelter(dbo, animalid, a),
-            "AgeGroup":             calc_age_group(dbo, animalid, a, todate = agegroupto),
-            "AgeGroupActiveMovement": calc_age_group(dbo, animalid, a, todate = activemovement),
-            "AnimalAge":            calc_age(dbo, animalid, a),
-            "DaysOnShelter":        calc_days_on_shelter(dbo, animalid, a),
-            "TotalTimeOnShelter":   calc_total_time_on_shelter(dbo, animalid, a),
-            "TotalDaysOnShelter":   calc_total_days_on_shelter(dbo, animalid, a)
-        }, setRecordVersion=False, writeAudit=False)
+        dbo.update("animal", animalid, dict(zip(VARIABLE_ANIMAL_COLUMNS, values)), setRecordVersion=False, writeAudit=False)
+    return True
 
-def update_all_variable_animal_data(dbo):
+def update_variable_animal_data_batch(dbo, animals, movements):
     """
-    Updates variable animal data for all animals. This is a big memory heavy routine if you've
-    got a lot of animal and movement records as loads sections of both complete tables into RAM.
+    Calculates the variable data for a list of animal results (from 
+    get_variable_animal_data_query) and writes the rows that changed.
+    movements: The movements for the animals as returned by group_movements_by_animal
+    Returns the number of animals that changed.
     """
-    l = dbo.locale
-    
     animalupdatebatch = []
 
     # Load age group bands now to save repeated looped lookups
     bands = configuration.age_group_bands(dbo)
 
+    asynctask.set_progress_max(dbo, len(animals))
+    for a in animals:
+        update_variable_animal_data(dbo, a.id, a, animalupdatebatch, bands, movements.get(a.id, []))
+        asynctask.increment_progress_value(dbo)
+
+    dbo.execute_many("UPDATE animal SET %s WHERE ID = ?" % ", ".join([ "%s = ?" % c for c in VARIABLE_ANIMAL_COLUMNS ]), animalupdatebatch)
+    return len(animalupdatebatch)
+
+def update_all_variable_animal_data(dbo):
+    """
+    Updates variable animal data for all animals. This is a big memory heavy routine if you've
+    got a lot of animal and movement records as loads sections of both complete tables into RAM.
+    """
+    l = dbo.locale
+
     # Relevant fields
-    animals = dbo.query("SELECT ID, DateBroughtIn, DeceasedDate, DiedOffShelter, Archived, ActiveMovementDate, " \
-        "MostRecentEntryDate, DateOfBirth FROM animal")
+    animals = dbo.query(get_variable_animal_data_query(dbo))
 
     # Get a single lookup of movement histories for our animals
     movements = dbo.query("SELECT ad.AnimalID, ad.MovementDate, ad.ReturnDate " \
@@ -3060,22 +3109,8 @@ def update_all_variable_animal_data(dbo):
         "WHERE ad.MovementType NOT IN (2,8) AND ad.MovementDate Is Not Null AND ad.ReturnDate Is Not Null " \
         "ORDER BY AnimalID")
 
-    asynctask.set_progress_max(dbo, len(animals))
-    for a in animals:
-        update_variable_animal_data(dbo, a.id, a, animalupdatebatch, bands, movements)
-        asynctask.increment_progress_value(dbo)
-
-    dbo.execute_many("UPDATE animal SET " \
-        "TimeOnShelter = ?, " \
-        "AgeGroup = ?, " \
-        "AgeGroupActiveMovement = ?, " \
-        "AnimalAge = ?, " \
-        "DaysOnShelter = ?, " \
-        "TotalTimeOnShelter = ?, " \
-        "TotalDaysOnShelter = ? " \
-        "WHERE ID = ?", animalupdatebatch)
-
-    al.debug("updated variable data for %d animals (locale %s)" % (len(animals), l), "animal.update_all_variable_animal_data", dbo)
+    changed = update_variable_animal_data_batch(dbo, animals, group_movements_by_animal(movements))
+    al.debug("updated variable data for %d of %d animals (locale %s)" % (changed, len(animals), l), "animal.update_all_variable_animal_data", dbo)
     return "OK %d" % len(animals)
 
 def update_on_shelter_variable_animal_data(dbo):
@@ -3083,15 +3118,9 @@ def update_on_shelter_variable_animal_data(dbo):
     Updates variable animal data for all shelter animals.
     """
     l = dbo.locale
-    
-    animalupdatebatch = []
-
-    # Load age group bands now to save repeated looped lookups
-    bands = configuration.age_group_bands(dbo)
 
     # Relevant on shelter animal fields
-    animals = dbo.query("SELECT ID, DateBroughtIn, DeceasedDate, DiedOffShelter, Archived, ActiveMovementDate, " \
-        "MostRecentEntryDate, DateOfBirth FROM animal WHERE Archived = 0")
+    animals = dbo.query(get_variable_animal_data_query(dbo) + " WHERE Archived = 0")
 
     # Get a single lookup of movement histories for our on shelter animals
     movements = dbo.query("SELECT ad.AnimalID, ad.MovementDate, ad.ReturnDate " \
@@ -3101,20 +3130,8 @@ def update_on_shelter_variable_animal_data(dbo):
         "AND ad.MovementDate Is Not Null AND ad.ReturnDate Is Not Null " \
         "ORDER BY a.ID")
 
-    for a in animals:
-        update_variable_animal_data(dbo, a.id, a, animalupdatebatch, bands, movements)
-
-    dbo.execute_many("UPDATE animal SET " \
-        "TimeOnShelter = ?, " \
-        "AgeGroup = ?, " \
-        "AgeGroupActiveMovement = ?, " \
-        "AnimalAge = ?, " \
-        "DaysOnShelter = ?, " \
-        "TotalTimeOnShelter = ?, " \
-        "TotalDaysOnShelter = ? " \
-        "WHERE ID = ?", animalupdatebatch)
-
-    al.debug("updated variable data for %d animals (locale %s)" % (len(animals), l), "animal.update_on_shelter_variable_animal_data", dbo)
+    changed = update_variable_animal_data_batch(dbo, animals, group_movements_by_animal(movements))
+    al.debug("updated variable data for %d of %d animals (locale %s)" % (changed, len(animals), l), "animal.update_on_shelter_variable_animal_data", dbo)
     return "OK %d" % len(animals)
 
 def update_offshelter_young_variable_animal_data(dbo):
@@ -3126,41 +3143,22 @@ def update_offshelter_young_variable_animal_data(dbo):
     are relying on it to decide when to book in a spay/neuter.
     """
     l = dbo.locale
-    
-    animalupdatebatch = []
 
-    # Load age group bands now to save repeated looped lookups
-    bands = configuration.age_group_bands(dbo)
+    # Relevant off shelter animal fields
+    animals = dbo.query(get_variable_animal_data_query(dbo) + " WHERE DateOfBirth > ? AND DeceasedDate Is Null AND Archived = 1", [ dbo.today(offset=-274) ])
 
-    # Relevant on shelter animal fields
-    animals = dbo.query("SELECT ID, DateBroughtIn, DeceasedDate, DiedOffShelter, Archived, ActiveMovementDate, " \
-        "MostRecentEntryDate, DateOfBirth FROM animal WHERE DateOfBirth > ? AND DeceasedDate Is Null AND Archived = 1", [ dbo.today(offset=-274) ])
-
-    # Get a single lookup of movement histories for our on shelter animals
+    # Get a single lookup of movement histories for our off shelter animals
     movements = dbo.query("SELECT ad.AnimalID, ad.MovementDate, ad.ReturnDate " \
         "FROM animal a " \
         "INNER JOIN adoption ad ON a.ID = ad.AnimalID " \
-        "WHERE a.Archived = 0 AND ad.MovementType NOT IN (2,8) " \
+        "WHERE a.DateOfBirth > ? AND a.DeceasedDate Is Null AND a.Archived = 1 AND ad.MovementType NOT IN (2,8) " \
         "AND ad.MovementDate Is Not Null AND ad.ReturnDate Is Not Null " \
-        "ORDER BY a.ID")
-
-    for a in animals:
-        update_variable_animal_data(dbo, a.id, a, animalupdatebatch, bands, movements)
-
-    dbo.execute_many("UPDATE animal SET " \
-        "TimeOnShelter = ?, " \
-        "AgeGroup = ?, " \
-        "AgeGroupActiveMovement = ?, " \
-        "AnimalAge = ?, " \
-        "DaysOnShelter = ?, " \
-        "TotalTimeOnShelter = ?, " \
-        "TotalDaysOnShelter = ? " \
-        "WHERE ID = ?", animalupdatebatch)
+        "ORDER BY a.ID", [ dbo.today(offset=-274) ])
 
-    al.debug("updated variable data for %d animals (locale %s)" % (len(animals), l), "animal.update_offshelter_young_variable_animal_data", dbo)
+    changed = update_variable_animal_data_batch(dbo, animals, group_movements_by_animal(movements))
+    al.debug("updated variable data for %d of %d animals (locale %s)" % (changed, len(animals), l), "animal.update_offshelter_young_variable_animal_data", dbo)
     return "OK %d" % len(animals)
 
-
 def update_all_animal_statuses(dbo):
     """
     Updates statuses for all animals
@@ -3176,9 +3174,10 @@ def update_all_animal_statuses(dbo):
         "softrelease_on_shelter": configuration.softrelease_on_shelter(dbo)
     }
 
+    movements = group_movements_by_animal(movements)
     asynctask.set_progress_max(dbo, len(animals))
     for a in animals:
-        update_animal_status(dbo, a.id, a, movements, animalupdatebatch, diaryupdatebatch, cfg)
+        update_animal_status(dbo, a.id, a, movements.get(a.id, []), animalupdatebatch, diaryupdatebatch, cfg)
         asynctask.increment_progress_value(dbo)
 
     aff = dbo.execute_many("UPDATE animal SET " \
@@ -3217,8 +3216,9 @@ def update_foster_animal_statuses(dbo):
         "softrelease_on_shelter": configuration.softrelease_on_shelter(dbo)
     }
 
+    movements = group_movements_by_animal(movements)
     for a in animals:
-        update_animal_status(dbo, a.id, a, movements, animalupdatebatch, diaryupdatebatch, cfg)
+        update_animal_status(dbo, a.id, a, movements.get(a.id, []), animalupdatebatch, diaryupdatebatch, cfg)
 
     aff = dbo.execute_many("UPDATE animal SET " \
         "Archived = ?, " \
@@ -3255,9 +3255,10 @@ def update_on_shelter_animal_statuses(dbo):
         "softrelease_on_shelter": configuration.softrelease_on_shelter(dbo)
     }
 
+    movements = group_movements_by_animal(movements)
     asynctask.set_progress_max(dbo, len(animals))
     for a in animals:
-        update_animal_status(dbo, a.id, a, movements, animalupdatebatch, diaryupdatebatch, cfg)
+        update_animal_status(dbo, a.id, a, movements.get(a.id, []), animalupdatebatch, diaryupdatebatch, cfg)
         asynctask.increment_progress_value(dbo)
 
     aff = dbo.execute_many("UPDATE animal SET " \
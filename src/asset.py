@@ -0,0 +1,165 @@
+#!/usr/bin/python
+
+"""
+Static assets (rollup.js, x.js, x.css and i18n.js) are built once per BUILD
+and kept, along with gzip and brotli (if the brotli module is installed)
+compressed copies, in memory or in the disk cache depending on ASSET_CACHE.
+
+Each asset has an ETag made from the hash of its content and a Last-Modified
+date from its source files, so that clients holding a current copy can be
+answered with a 304. The ETag of each compressed copy is the ETag of the
+content with the encoding appended, and If-None-Match is compared on the
+content hash alone so that proxies which append their own suffix still match.
+"""
+
+import al
+import cachedisk
+import gzip
+import hashlib
+import time
+from cStringIO import StringIO
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from i18n import BUILD
+from sitedefs import ASSET_CACHE
+
+try:
+    import brotli
+except:
+    brotli = None
+
+# Assets smaller than this aren't worth compressing
+MIN_COMPRESS_SIZE = 1024
+
+# Compressed encodings we can produce, in order of preference
+ENCODINGS = [ "br", "gzip" ]
+
+# How long (seconds) an asset lives in the disk cache after it was last read
+DISK_TTL = 2592000
+
+# Assets built by this process, key -> Asset
+assets = {}
+
+class Asset(object):
+    """
+    An asset's content, its compressed variants and its validators.
+    content:      The asset as a string
+    contenttype:  The mime type to send it with
+    lastmodified: Unix time the asset's source was last changed
+    """
+
+    def __init__(self, content, contenttype, lastmodified):
+        self.contenttype = contenttype
+        self.lastmodified = int(lastmodified)
+        self.hash = hashlib.md5(content).hexdigest()
+        self.variants = { "identity": content }
+        if len(content) >= MIN_COMPRESS_SIZE:
+            for encoding in ENCODINGS:
+                compressed = compress(content, encoding)
+                if compressed is not None and len(compressed) < len(content):
+                    self.variants[encoding] = compressed
+
+    def content(self, encoding = "identity"):
+        """ Returns the asset in encoding """
+        return self.variants[encoding]
+
+    def etag(self, encoding = "identity"):
+        """ Returns the ETag header value for the asset in encoding """
+        if encoding == "identity": return "\"%s\"" % self.hash
+        return "\"%s-%s\"" % (self.hash, encoding)
+
+    def last_modified(self):
+        """ Returns the Last-Modified header value for the asset """
+        return formatdate(self.lastmodified, usegmt=True)
+
+    def select_encoding(self, acceptencoding):
+        """
+        Returns the encoding to send the asset in for an Accept-Encoding
+        request header. identity is returned if the client doesn't accept
+        any compressed encoding that we have.
+        """
+        accepts = parse_accept_encoding(acceptencoding)
+        for encoding in ENCODINGS:
+            if encoding not in self.variants: continue
+            if accepts.get(encoding, accepts.get("*", 0.0)) > 0: return encoding
+        return "identity"
+
+    def is_not_modified(self, ifnonematch = "", ifmodifiedsince = ""):
+        """
+        Returns True if the client's copy is current according to its
+        If-None-Match or, if that wasn't sent, If-Modified-Since header.
+        """
+        if ifnonematch is not None and ifnonematch.strip() != "":
+            for tag in ifnonematch.split(","):
+                tag = tag.strip()
+                if tag == "*": return True
+                if tag.startswith("W/"): tag = tag[2:]
+                if tag.strip("\"").split("-")[0] == self.hash: return True
+            return False
+        if ifmodifiedsince is not None and ifmodifiedsince.strip() != "":
+            since = parsedate_tz(ifmodifiedsince.strip())
+            if since is None: return False
+            return self.lastmodified <= mktime_tz(since)
+        return False
+
+def compress(content, encoding):
+    """ Returns content compressed with encoding or None if we can't """
+    if encoding == "gzip":
+        buf = StringIO()
+        f = gzip.GzipFile(mode="wb", fileobj=buf, compresslevel=9, mtime=0)
+        f.write(content)
+        f.close()
+        return buf.getvalue()
+    elif encoding == "br" and brotli is not None:
+        return brotli.compress(content)
+    return None
+
+def parse_accept_encoding(acceptencoding):
+    """ Returns a dictionary of encoding -> quality from an Accept-Encoding header """
+    accepts = {}
+    if acceptencoding is None: return accepts
+    for item in acceptencoding.split(","):
+        parts = item.split(";")
+        encoding = parts[0].strip().lower()
+        if encoding == "": continue
+        q = 1.0
+        for p in parts[1:]:
+            p = p.strip()
+            if p.startswith("q="):
+                try:
+                    q = float(p[2:])
+                except ValueError:
+                    q = 0.0
+        accepts[encoding] = q
+    return accepts
+
+def get_asset(key, contenttype, builder, mtime = None):
+    """
+    Returns the Asset for key, calling builder() the first time it is
+    asked for during this BUILD. builder returns a tuple of the content
+    and the unix time its source was last modified (None for now).
+    If mtime is given (the modified time of a single source file), the
+    asset is rebuilt when its source has changed since it was built.
+    """
+    a = assets.get(key)
+    if a is None and ASSET_CACHE == "disk":
+        a = cachedisk.touch(_disk_key(key), DISK_TTL / 2, DISK_TTL)
+    if a is not None and mtime is not None and a.lastmodified != int(mtime):
+        a = None
+    if a is None:
+        start = time.time()
+        content, lastmodified = builder()
+        if lastmodified is None: lastmodified = start
+        a = Asset(content, contenttype, lastmodified)
+        if ASSET_CACHE == "disk":
+            cachedisk.put(_disk_key(key), a, DISK_TTL)
+        al.debug("built %s (%s) in %0.3fs" % (key, ", ".join([ "%s %d bytes" % (k, len(v)) for k, v in sorted(a.variants.items()) ]), time.time() - start), "asset.get_asset")
+    assets[key] = a
+    return a
+
+def reset():
+    """ Discards the assets held in memory by this process """
+    assets.clear()
+
+def _disk_key(key):
+    return "asset:%s:%s" % (BUILD, key)
+
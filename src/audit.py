@@ -83,9 +83,21 @@ def dump_rows(dbo, tablename, condition):
 def create(dbo, username, tablename, linkid, parentlinks, description):
     action(dbo, ADD, username, tablename, linkid, parentlinks, description)
 
+def create_rows(dbo, username, tablename, rows):
+    """ Adds create audit records for a list of newly inserted rows in one batch """
+    actions(dbo, ADD, username, tablename, [ (r.id, get_parent_links(r, tablename), str([r])) for r in rows ])
+
 def edit(dbo, username, tablename, linkid, parentlinks, description):
     action(dbo, EDIT, username, tablename, linkid, parentlinks, description)
 
+def edit_rows(dbo, username, tablename, links, prerows, postrows):
+    """ Adds edit audit records in one batch for a list of updated rows.
+        links: A dict of ID -> parent links for the rows
+        prerows: A dict of ID -> the row before it was updated
+        postrows: A list of the rows after they were updated
+    """
+    actions(dbo, EDIT, username, tablename, [ (r.id, links.get(r.id, ""), map_diff([ prerows.get(r.id, {}) ], [ r ])) for r in postrows ])
+
 def delete(dbo, username, tablename, linkid, parentlinks, description):
     action(dbo, DELETE, username, tablename, linkid, parentlinks, description)
 
@@ -126,6 +138,22 @@ def action(dbo, action, username, tablename, linkid, parentlinks, description):
         "Description":  description
     }, generateID=False, writeAudit=False)
 
+def actions(dbo, action, username, tablename, entries):
+    """
+    Adds audit records for a list of (linkid, parentlinks, description) tuples
+    with a single insert_many
+    """
+    now = dbo.now()
+    dbo.insert_many("audittrail", [ {
+        "Action":       action,
+        "AuditDate":    now,
+        "UserName":     username,
+        "TableName":    tablename,
+        "LinkID":       linkid,
+        "ParentLinks":  parentlinks,
+        "Description":  description[0:16384]
+    } for linkid, parentlinks, description in entries ], generateID=False, writeAudit=False)
+
 def clean(dbo):
     """
     Deletes audit trail records older than three months
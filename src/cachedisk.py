@@ -3,34 +3,134 @@
 """
 Implements a python disk cache in a similar way to memcache,
 uses md5sums of the key as filenames.
+
+Entries are sharded into two levels of subdirectories by the first
+characters of their hash so no single directory gets too large.
+Each file starts with a small binary header (see HEADER) holding the
+expiry time so that remove_expired can sweep the cache without
+unpickling anything, followed by the value - raw for strings,
+pickled for everything else.
+
+Files are written to a temporary name and renamed into place, so
+readers never see a partially written entry. The modified time of a
+file is updated when it is read, which remove_expired uses to discard
+the least recently used entries when the cache is over DISK_CACHE_MAX_SIZE.
 """
 
 import al
 import cPickle as pickle
+import errno
 import hashlib
+import mmap
 import os
+import re
+import struct
+import thread
 import time
-from sitedefs import DISK_CACHE
+from sitedefs import DISK_CACHE, DISK_CACHE_MAX_SIZE
+
+# magic, format (RAW or PICKLE), expiry time
+HEADER = struct.Struct(">4sBd")
+HEADER_MAGIC = "ASDC"
+EXPIRES_OFFSET = 5
+
+RAW = 0
+PICKLE = 1
+
+# Raw values larger than this are read with mmap rather than read
+MMAP_THRESHOLD = 65536
+
+# Temporary files older than this (seconds) were abandoned by a failed write
+TEMP_FILE_AGE = 3600
+
+# Names of the files we write, an md5 hash and the suffix of a temporary file
+CACHE_FILE = re.compile(r"^([0-9a-f]{32})(\.tmp\d+\.\d+)?$")
 
 def _getfilename(key):
     """
     Calculates the filename from the key
-    (md5 hash)
+    (md5 hash, in subdirectories of the first four characters)
     """
-    if not os.path.exists(DISK_CACHE):
-        os.mkdir(DISK_CACHE)
     m = hashlib.md5()
     m.update(key)
-    fname = "%s%s%s" % (DISK_CACHE, os.path.sep, m.hexdigest())
-    return fname
+    h = m.hexdigest()
+    return os.path.join(DISK_CACHE, h[0:2], h[2:4], h)
+
+def _read_header(f):
+    """
+    Reads the header from open file f, returning a tuple of
+    format and expiry time or None if this isn't a cache file.
+    """
+    chunk = f.read(HEADER.size)
+    if len(chunk) != HEADER.size: return None
+    magic, fmt, expires = HEADER.unpack(chunk)
+    if magic != HEADER_MAGIC: return None
+    return fmt, expires
+
+def _unlink(fname):
+    """ Deletes a file, ignoring it if it does not exist """
+    try:
+        os.unlink(fname)
+    except OSError as err:
+        if err.errno != errno.ENOENT: raise
+
+def _read(key, ttlremaining = 0, newttl = 0):
+    """
+    Reads the value for key, updating its ttl if there is less than
+    ttlremaining until expiry. Returns None if the value is not found
+    or has expired.
+    """
+    fname = _getfilename(key)
+    try:
+        f = open(fname, "rb")
+    except IOError as err:
+        # No cache entry found, bail
+        if err.errno == errno.ENOENT: return None
+        raise
+    with f:
+        header = _read_header(f)
+        if header is None:
+            _unlink(fname)
+            return None
+        fmt, expires = header
+
+        # Has the entry expired?
+        now = time.time()
+        if expires < now:
+            _unlink(fname)
+            return None
+
+        # Pull the entry out
+        if fmt == RAW:
+            size = os.fstat(f.fileno()).st_size
+            if size > MMAP_THRESHOLD:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    value = mm[HEADER.size:]
+                finally:
+                    mm.close()
+            else:
+                value = f.read()
+        else:
+            value = pickle.load(f)
+
+    # Is there less than ttlremaining to expiry? If so update it to newttl
+    if expires - now < ttlremaining:
+        with open(fname, "r+b") as f:
+            f.seek(EXPIRES_OFFSET)
+            f.write(struct.pack(">d", now + newttl))
+    else:
+        # Mark the entry as recently used
+        os.utime(fname, None)
+
+    return value
 
 def delete(key):
     """
     Removes a value from our disk cache.
     """
     try:
-        fname = _getfilename(key)
-        os.unlink(fname)
+        _unlink(_getfilename(key))
     except Exception as err:
         al.error(str(err), "cachedisk.delete")
 
@@ -39,23 +139,8 @@ def get(key):
     Retrieves a value from our disk cache. Returns None if the
     value is not found or has expired.
     """
-    f = None
     try:
-        fname = _getfilename(key)
-
-        # No cache entry found, bail
-        if not os.path.exists(fname): return None
-
-        # Pull the entry out
-        with open(fname, "r") as f:
-            o = pickle.load(f)
-
-        # Has the entry expired?
-        if o["expires"] < time.time():
-            delete(key)
-            return None
-
-        return o["value"]
+        return _read(key)
     except Exception as err:
         al.error(str(err), "cachedisk.get")
         return None
@@ -65,19 +150,29 @@ def put(key, value, ttl):
     Stores a value in our disk cache with a time to live of ttl. The value
     will be removed if it is accessed past the ttl.
     """
-    f = None
     try:
         fname = _getfilename(key)
-
-        o = {
-            "expires": time.time() + ttl,
-            "value": value
-        }
-
-        # Write the entry
-        with open(fname, "w") as f:
-            pickle.dump(o, f)
-
+        if isinstance(value, str):
+            fmt = RAW
+        else:
+            fmt = PICKLE
+            value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        tempname = "%s.tmp%d.%d" % (fname, os.getpid(), thread.get_ident())
+        try:
+            f = open(tempname, "wb")
+        except IOError as err:
+            # Create the shard directory if this is the first entry in it
+            if err.errno != errno.ENOENT: raise
+            try:
+                os.makedirs(os.path.dirname(fname))
+            except OSError as err:
+                if err.errno != errno.EEXIST: raise
+            f = open(tempname, "wb")
+        # Write the entry and move it into place
+        with f:
+            f.write(HEADER.pack(HEADER_MAGIC, fmt, time.time() + ttl))
+            f.write(value)
+        os.rename(tempname, fname)
     except Exception as err:
         al.error(str(err), "cachedisk.put")
 
@@ -87,56 +182,66 @@ def touch(key, ttlremaining = 0, newttl = 0):
     This can be used to make our timed expiry cache into a sort of hybrid with LRU.
     Returns None if the value is not found or has expired.
     """
-    f = None
     try:
-        fname = _getfilename(key)
-
-        # No cache entry found, bail
-        if not os.path.exists(fname): return None
-
-        # Pull the entry out
-        with open(fname, "r") as f:
-            o = pickle.load(f)
-
-        # Has the entry expired?
-        now = time.time()
-        if o["expires"] < now:
-            delete(key)
-            return None
-
-        # Is there less than ttlremaining to expiry? If so update it to newttl
-        if o["expires"] - now < ttlremaining:
-            o["expires"] = now + newttl
-            with open(fname, "w") as f:
-                pickle.dump(o, f)
-
-        return o["value"]
+        return _read(key, ttlremaining, newttl)
     except Exception as err:
         al.error(str(err), "cachedisk.touch")
         return None
 
-def remove_expired():
+def remove_expired(maxsize = DISK_CACHE_MAX_SIZE):
     """
     Runs through the cache and deletes any files that have expired.
-    To make this process quick, we look at the raw file content to 
-    extract the expires value.
-    If the Python pickle format ever changes, this might mess us up.
-    """
-    if DISK_CACHE == "": return
-    for fname in os.listdir(DISK_CACHE):
-        if fname.startswith("."): continue
-        fpath = "%s/%s" % (DISK_CACHE, fname)
-        chunk = ""
-        with open(fpath, "rb") as f:
-            chunk = f.read(75)
-        # Look for our float expiry time
-        sp = chunk.find("F")
-        if sp == -1: 
-            # If we didn't find it, remove the file anyway - we don't know what this is
-            os.unlink(fpath)
-        else:
-            ep = chunk.find("\n", sp)
-            expires = float(chunk[sp+1:ep])
-            if time.time() > expires:
-                os.unlink(fpath)
+    If the remaining files total more than maxsize bytes (0 for no limit),
+    the least recently used are deleted until they don't.
+    Only the header of each file is read. Files that aren't named and
+    placed the way _getfilename does are left alone, apart from entries
+    in the top level from the old flat layout, which are removed.
+    """
+    if DISK_CACHE == "" or not os.path.exists(DISK_CACHE): return
+    now = time.time()
+    expired = 0
+    evicted = 0
+    entries = []
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(DISK_CACHE):
+        for fname in filenames:
+            m = CACHE_FILE.match(fname)
+            if m is None: continue
+            h = m.group(1)
+            fpath = os.path.join(dirpath, fname)
+            if dirpath == DISK_CACHE and m.group(2) is None:
+                try:
+                    _unlink(fpath)
+                    expired += 1
+                except Exception as err:
+                    al.error("%s: %s" % (fpath, err), "cachedisk.remove_expired")
+                continue
+            if dirpath != os.path.join(DISK_CACHE, h[0:2], h[2:4]): continue
+            try:
+                st = os.stat(fpath)
+                if m.group(2) is not None:
+                    if now - st.st_mtime > TEMP_FILE_AGE: _unlink(fpath)
+                    continue
+                with open(fpath, "rb") as f:
+                    header = _read_header(f)
+                # If we don't know what this is or it has expired, remove it
+                if header is None or header[1] < now:
+                    _unlink(fpath)
+                    expired += 1
+                    continue
+                entries.append((st.st_mtime, st.st_size, fpath))
+                total += st.st_size
+            except Exception as err:
+                al.error("%s: %s" % (fpath, err), "cachedisk.remove_expired")
+    if maxsize > 0 and total > maxsize:
+        entries.sort()
+        for mtime, size, fpath in entries:
+            if total <= maxsize: break
+            try:
+                _unlink(fpath)
+                total -= size
+                evicted += 1
+            except Exception as err:
+                al.error("%s: %s" % (fpath, err), "cachedisk.remove_expired")
+    al.debug("removed %d expired and %d least recently used entries, %d bytes remain" % (expired, evicted, total), "cachedisk.remove_expired")
 
@@ -1,8 +1,12 @@
 #!/usr/bin/python
 
-from sitedefs import MEMCACHED_SERVER
+from sitedefs import MEMCACHED_SERVER, CACHEMEM_BACKEND, CACHEMEM_MAX_ENTRIES, CACHEMEM_MAX_BYTES, CACHEMEM_SWEEP_INTERVAL
 
 import al
+import collections
+import itertools
+import sys
+import threading
 import time
 
 def get(key):
@@ -11,6 +15,7 @@ def get(key):
     the value isn't set
     """
     if _memcache_available(): return _memcache_get(key)
+    if CACHEMEM_BACKEND == "lru": return _lru_get(key)
     return _dict_get(key)
 
 def put(key, value, ttl):
@@ -18,6 +23,7 @@ def put(key, value, ttl):
     Sets a cache value with a ttl in seconds
     """
     if _memcache_available(): return _memcache_put(key, value, ttl)
+    if CACHEMEM_BACKEND == "lru": return _lru_put(key, value, ttl)
     return _dict_put(key, value, ttl)
 
 def increment(key):
@@ -26,6 +32,7 @@ def increment(key):
     None if the value doesn't exist.
     """
     if _memcache_available(): return _memcache_increment(key)
+    if CACHEMEM_BACKEND == "lru": return _lru_increment(key)
     return _dict_increment(key)
 
 def delete(key):
@@ -33,8 +40,17 @@ def delete(key):
     Deletes a cache value.
     """
     if _memcache_available(): return _memcache_delete(key)
+    if CACHEMEM_BACKEND == "lru": return _lru_delete(key)
     return _dict_delete(key)
 
+def get_stats():
+    """
+    Returns a dict of statistics for the memory cache in this process.
+    Only the lru backend keeps statistics.
+    """
+    if _memcache_available() or CACHEMEM_BACKEND != "lru": return {}
+    return lru_client.stats()
+
 # ==============================================
 # Dict implementation of memory cache
 # ==============================================
@@ -68,6 +84,140 @@ def _dict_delete(key):
     except KeyError:
         pass
 
+# ==============================================
+# LRU implementation of memory cache
+# ==============================================
+
+# How many items of a list or dict are measured to estimate its size
+SIZE_SAMPLE = 10
+
+class LRUCache(object):
+    """
+    A thread safe in memory cache that holds at most maxentries items
+    and approximately maxbytes of values, discarding the least recently
+    used items when either is exceeded. Expired items are removed when
+    read and by a sweep of the whole cache at most every sweepinterval
+    seconds, performed during a put.
+    """
+    def __init__(self, maxentries = CACHEMEM_MAX_ENTRIES, maxbytes = CACHEMEM_MAX_BYTES, sweepinterval = CACHEMEM_SWEEP_INTERVAL):
+        self.maxentries = maxentries
+        self.maxbytes = maxbytes
+        self.sweepinterval = sweepinterval
+        self.lock = threading.Lock()
+        self.items = collections.OrderedDict() # key -> [expires, value, size], least recently used first
+        self.bytes = 0
+        self.lastsweep = time.time()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self.lock:
+            v = self.items.pop(key, None)
+            if v is None:
+                self.misses += 1
+                return None
+            if time.time() >= v[0]:
+                self.bytes -= v[2]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            # Reinsert to mark as most recently used
+            self.items[key] = v
+            self.hits += 1
+            return v[1]
+
+    def put(self, key, value, ttl):
+        size = self._size(key, value)
+        with self.lock:
+            now = time.time()
+            old = self.items.pop(key, None)
+            if old is not None: self.bytes -= old[2]
+            if now - self.lastsweep >= self.sweepinterval: self._sweep(now)
+            self.items[key] = [now + ttl, value, size]
+            self.bytes += size
+            while len(self.items) > 1 and (len(self.items) > self.maxentries or self.bytes > self.maxbytes):
+                k, v = self.items.popitem(last=False)
+                self.bytes -= v[2]
+                self.evictions += 1
+        return True
+
+    def increment(self, key):
+        with self.lock:
+            v = self.items.get(key)
+            if v is None or time.time() >= v[0]: return None
+            v[1] += 1
+            return v[1]
+
+    def delete(self, key):
+        with self.lock:
+            v = self.items.pop(key, None)
+            if v is not None: self.bytes -= v[2]
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """ Returns a dict of statistics for this cache """
+        with self.lock:
+            hitrate = 0.0
+            if self.hits + self.misses > 0: hitrate = float(self.hits) / (self.hits + self.misses)
+            return {
+                "entries": len(self.items),
+                "bytes": self.bytes,
+                "maxentries": self.maxentries,
+                "maxbytes": self.maxbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitrate": hitrate,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
+
+    def _size(self, key, value):
+        """ Returns the approximate number of bytes an item takes up """
+        return len(key) + self._estimate(value, 0)
+
+    def _estimate(self, value, depth):
+        """
+        Estimates the size of value cheaply: strings by their length and
+        lists, tuples and dicts (such as query results) from a sample of
+        their first few items, two levels deep. Anything else by getsizeof.
+        """
+        if isinstance(value, basestring): return len(value)
+        if depth < 2 and isinstance(value, dict) and len(value) > 0:
+            sample = [ self._estimate(k, depth+1) + self._estimate(v, depth+1) for k, v in itertools.islice(value.iteritems(), SIZE_SAMPLE) ]
+        elif depth < 2 and isinstance(value, (list, tuple)) and len(value) > 0:
+            sample = [ self._estimate(x, depth+1) for x in value[0:SIZE_SAMPLE] ]
+        else:
+            return sys.getsizeof(value)
+        return sys.getsizeof(value) + sum(sample) * len(value) / len(sample)
+
+    def _sweep(self, now):
+        """ Removes all expired items. Must be called with the lock held. """
+        for k in [ k for k, v in self.items.iteritems() if now >= v[0] ]:
+            v = self.items.pop(k)
+            self.bytes -= v[2]
+            self.expirations += 1
+        self.lastsweep = now
+
+lru_client = LRUCache()
+
+def _lru_get(key):
+    return lru_client.get(key)
+
+def _lru_put(key, value, ttl):
+    return lru_client.put(key, value, ttl)
+
+def _lru_increment(key):
+    return lru_client.increment(key)
+
+def _lru_delete(key):
+    return lru_client.delete(key)
+
 # ==============================================
 # Memcache implementation of memory cache
 # ==============================================
@@ -12,6 +12,7 @@ import al
 import additional as extadditional
 import animal as extanimal
 import animalcontrol as extanimalcontrol
+import asset
 import asynctask
 import audit
 import base64
@@ -24,7 +25,7 @@ import db, dbfs, dbupdate
 import diary as extdiary
 import financial
 import html
-from i18n import _, BUILD, translate, get_version, get_display_date_format, get_currency_prefix, get_currency_symbol, get_currency_dp, get_currency_radix, get_currency_digit_grouping, get_locales, parse_date, python2display, add_minutes, add_days, subtract_days, subtract_months, first_of_month, last_of_month, monday_of_week, sunday_of_week, first_of_year, last_of_year, now, format_currency, i18nstringsjs
+from i18n import _, BUILD, locale_maps, real_locale, translate, get_version, get_display_date_format, get_currency_prefix, get_currency_symbol, get_currency_dp, get_currency_radix, get_currency_digit_grouping, get_locales, parse_date, python2display, add_minutes, add_days, subtract_days, subtract_months, first_of_month, last_of_month, monday_of_week, sunday_of_week, first_of_year, last_of_year, now, format_currency, i18nstringsjs
 import log as extlog
 import lookups as extlookups
 import lostfound as extlostfound
@@ -227,6 +228,20 @@ class ASMEndpoint(object):
         """ Virtual function: override to get the content """
         return ""
 
+    def asset(self, a, client_ttl = CACHE_ONE_YEAR):
+        """ Sends an asset.Asset, compressed if the client accepts it,
+            or a 304 if the client already has the current copy """
+        encoding = a.select_encoding(web.ctx.env.get("HTTP_ACCEPT_ENCODING", ""))
+        self.content_type(a.contenttype)
+        self.cache_control(client_ttl)
+        self.header("Vary", "Accept-Encoding")
+        self.header("ETag", a.etag(encoding))
+        self.header("Last-Modified", a.last_modified())
+        if a.is_not_modified(web.ctx.env.get("HTTP_IF_NONE_MATCH", ""), web.ctx.env.get("HTTP_IF_MODIFIED_SINCE", "")):
+            raise web.notmodified()
+        if encoding != "identity": self.header("Content-Encoding", encoding)
+        return a.content(encoding)
+
     def cache_control(self, client_ttl = 0, cache_ttl = 0):
         """ Sends a cache control header.
         client_ttl: The max-age to send for the client
@@ -441,13 +456,10 @@ class rollupjs(ASMEndpoint):
 
     def content(self, o):
         # b=build is passed as a parameter and to invalidate caching
-        self.content_type("text/javascript")
-        self.cache_control(CACHE_ONE_YEAR)
-        rollup = cachemem.get("rollup")
-        if rollup is None:
-            rollup = html.asm_rollup_scripts(PATH)
-            cachemem.put("rollup", rollup, 60)
-        return rollup
+        def build():
+            jspath = PATH + "static/js/"
+            return html.asm_rollup_scripts(PATH), max([ os.path.getmtime(jspath + x) for x in os.listdir(jspath) if x.endswith(".js") ])
+        return self.asset(asset.get_asset("rollup.js", "text/javascript", build))
 
 class configjs(ASMEndpoint):
     url = "config.js"
@@ -547,12 +559,9 @@ class css(ASMEndpoint):
         v = o.post["v"]
         csspath = PATH + "static/css/" + v
         if v.find("..") != -1: self.notfound() # prevent escaping our PATH
-        if not os.path.exists(csspath): self.notfound()
-        if v == "": self.notfound()
-        content = utils.read_binary_file(csspath)
-        self.content_type("text/css")
-        self.cache_control(CACHE_ONE_YEAR)
-        return content
+        if v == "" or not os.path.isfile(csspath): self.notfound()
+        mtime = os.path.getmtime(csspath)
+        return self.asset(asset.get_asset("x.css:%s" % v, "text/css", lambda: (utils.read_binary_file(csspath), mtime), mtime))
 
 class i18njs(ASMEndpoint):
     url = "i18n.js"
@@ -561,10 +570,9 @@ class i18njs(ASMEndpoint):
     def content(self, o):
         # k=build is passed to invalidate cache
         l = o.post["l"]
-        if l == "": l = LOCALE
-        self.content_type("text/javascript")
-        self.cache_control(CACHE_ONE_YEAR)
-        return i18nstringsjs(l)
+        if l not in locale_maps: l = LOCALE
+        l = real_locale(l)
+        return self.asset(asset.get_asset("i18n.js:%s" % l, "text/javascript", lambda: (i18nstringsjs(l), None)))
 
 class js(ASMEndpoint):
     url = "x.js"
@@ -575,12 +583,9 @@ class js(ASMEndpoint):
         v = o.post["v"]
         jspath = PATH + "static/js/" + v
         if v.find("..") != -1: self.notfound() # prevent escaping our PATH
-        if not os.path.exists(jspath): self.notfound()
-        if v == "": self.notfound()
-        content = utils.read_binary_file(jspath)
-        self.content_type("text/javascript")
-        self.cache_control(CACHE_ONE_YEAR)
-        return content
+        if v == "" or not os.path.isfile(jspath): self.notfound()
+        mtime = os.path.getmtime(jspath)
+        return self.asset(asset.get_asset("x.js:%s" % v, "text/javascript", lambda: (utils.read_binary_file(jspath), mtime), mtime))
 
 class jserror(ASMEndpoint):
     """
@@ -842,20 +847,28 @@ class main(JSONEndpoint):
     def controller(self, o):
         l = o.locale
         dbo = o.dbo
-        # If there's something wrong with the database, logout
-        if not dbo.has_structure():
-            self.redirect("logout")
-        # Database update checks
         dbmessage = ""
-        if dbupdate.check_for_updates(dbo):
-            newversion = dbupdate.perform_updates(dbo)
-            if newversion != "":
-                dbmessage = _("Updated database to version {0}", l).format(str(newversion))
-                session.configuration = configuration.get_map(dbo)
-        if dbupdate.check_for_view_seq_changes(dbo):
-            dbupdate.install_db_views(dbo)
-            dbupdate.install_db_sequences(dbo)
-            dbupdate.install_db_stored_procedures(dbo)
+        # Only check the database structure and version if this
+        # process hasn't recently seen it up to date
+        if not dbupdate.is_schema_verified(dbo):
+            # If there's something wrong with the database, logout
+            if not dbo.has_structure():
+                self.redirect("logout")
+            # Database update checks
+            uptodate = not dbupdate.check_for_updates(dbo)
+            if not uptodate:
+                newversion = dbupdate.perform_updates(dbo)
+                if newversion != "":
+                    uptodate = True
+                    dbmessage = _("Updated database to version {0}", l).format(str(newversion))
+                    session.configuration = configuration.get_map(dbo)
+            if dbupdate.check_for_view_seq_changes(dbo):
+                dbupdate.install_db_views(dbo)
+                dbupdate.install_db_sequences(dbo)
+                dbupdate.install_db_stored_procedures(dbo)
+            # Another process may hold the update lock, check again next time if so
+            if uptodate:
+                dbupdate.set_schema_verified(dbo)
         # News
         news = configuration.asm_news(dbo)
         # Welcome dialog
@@ -1210,7 +1223,8 @@ class animal(JSONEndpoint):
 
     def post_save(self, o):
         self.check(users.CHANGE_ANIMAL)
-        extanimal.update_animal_from_form(o.dbo, o.post, o.user)
+        with o.dbo.transaction():
+            extanimal.update_animal_from_form(o.dbo, o.post, o.user)
 
     def post_delete(self, o):
         self.check(users.DELETE_ANIMAL)
@@ -1630,7 +1644,8 @@ class animal_new(JSONEndpoint):
 
     def post_save(self, o):
         self.check(users.ADD_ANIMAL)
-        animalid, code = extanimal.insert_animal_from_form(o.dbo, o.post, o.user)
+        with o.dbo.transaction():
+            animalid, code = extanimal.insert_animal_from_form(o.dbo, o.post, o.user)
         return "%s %s" % (animalid, code)
 
     def post_recentnamecheck(self, o):
@@ -2604,11 +2619,13 @@ class donation(JSONEndpoint):
 
     def post_create(self, o):
         self.check(users.ADD_DONATION)
-        return "%s|%s" % (financial.insert_donation_from_form(o.dbo, o.user, o.post), o.post["receiptnumber"])
+        with o.dbo.transaction():
+            return "%s|%s" % (financial.insert_donation_from_form(o.dbo, o.user, o.post), o.post["receiptnumber"])
 
     def post_update(self, o):
         self.check(users.CHANGE_DONATION)
-        financial.update_donation_from_form(o.dbo, o.user, o.post)
+        with o.dbo.transaction():
+            financial.update_donation_from_form(o.dbo, o.user, o.post)
 
     def post_delete(self, o):
         self.check(users.DELETE_DONATION)
@@ -2643,7 +2660,8 @@ class donation_receive(JSONEndpoint):
 
     def post_create(self, o):
         self.check(users.ADD_DONATION)
-        return financial.insert_donations_from_form(o.dbo, o.user, o.post, o.post["received"], True, o.post["person"], o.post["animal"], o.post["movement"], False)
+        with o.dbo.transaction():
+            return financial.insert_donations_from_form(o.dbo, o.user, o.post, o.post["received"], True, o.post["person"], o.post["animal"], o.post["movement"], False)
 
 class foundanimal(JSONEndpoint):
     url = "foundanimal"
@@ -3522,11 +3540,12 @@ class mailmerge(JSONEndpoint):
     def post_csv(self, o):
         dbo = o.dbo
         post = o.post
-        rows, cols = extreports.execute_query(dbo, o.session.mergereport, o.user, o.session.mergeparams)
+        rows, cols = extreports.execute_query(dbo, o.session.mergereport, o.user, o.session.mergeparams, stream=True)
         self.content_type("text/csv")
         self.header("Content-Disposition", u"attachment; filename=" + utils.decode_html(o.session.mergetitle) + u".csv")
+        if LARGE_FILES_CHUNKED: self.header("Transfer-Encoding", "chunked")
         includeheader = 1 == post.boolean("includeheader")
-        return utils.csv(o.locale, rows, cols, includeheader)
+        return utils.csv_stream(o.locale, rows, cols, includeheader)
 
     def post_preview(self, o):
         dbo = o.dbo
@@ -3638,7 +3657,8 @@ class move_adopt(JSONEndpoint):
 
     def post_create(self, o):
         self.check(users.ADD_MOVEMENT)
-        return str(extmovement.insert_adoption_from_form(o.dbo, o.user, o.post))
+        with o.dbo.transaction():
+            return str(extmovement.insert_adoption_from_form(o.dbo, o.user, o.post))
 
     def post_cost(self, o):
         dbo = o.dbo
@@ -3843,7 +3863,8 @@ class move_foster(JSONEndpoint):
         return {}
 
     def post_create(self, o):
-        return str(extmovement.insert_foster_from_form(o.dbo, o.user, o.post))
+        with o.dbo.transaction():
+            return str(extmovement.insert_foster_from_form(o.dbo, o.user, o.post))
 
 class move_gendoc(JSONEndpoint):
     url = "move_gendoc"
@@ -3869,7 +3890,8 @@ class move_reclaim(JSONEndpoint):
 
     def post_create(self, o):
         self.check(users.ADD_MOVEMENT)
-        return str(extmovement.insert_reclaim_from_form(o.dbo, o.user, o.post))
+        with o.dbo.transaction():
+            return str(extmovement.insert_reclaim_from_form(o.dbo, o.user, o.post))
 
     def post_cost(self, o):
         l = o.locale
@@ -3900,7 +3922,8 @@ class move_reserve(JSONEndpoint):
         }
 
     def post_create(self, o):
-        return str(extmovement.insert_reserve_from_form(o.dbo, o.user, o.post))
+        with o.dbo.transaction():
+            return str(extmovement.insert_reserve_from_form(o.dbo, o.user, o.post))
 
 class move_retailer(JSONEndpoint):
     url = "move_retailer"
@@ -3911,7 +3934,8 @@ class move_retailer(JSONEndpoint):
         return {}
 
     def post_create(self, o):
-        return str(extmovement.insert_retailer_from_form(o.dbo, o.user, o.post))
+        with o.dbo.transaction():
+            return str(extmovement.insert_retailer_from_form(o.dbo, o.user, o.post))
 
 class move_transfer(JSONEndpoint):
     url = "move_transfer"
@@ -3922,18 +3946,21 @@ class move_transfer(JSONEndpoint):
         return {}
 
     def post_create(self, o):
-        return str(extmovement.insert_transfer_from_form(o.dbo, o.user, o.post))
+        with o.dbo.transaction():
+            return str(extmovement.insert_transfer_from_form(o.dbo, o.user, o.post))
 
 class movement(JSONEndpoint):
     url = "movement"
 
     def post_create(self, o):
         self.check(users.ADD_MOVEMENT)
-        return extmovement.insert_movement_from_form(o.dbo, o.user, o.post)
+        with o.dbo.transaction():
+            return extmovement.insert_movement_from_form(o.dbo, o.user, o.post)
 
     def post_update(self, o):
         self.check(users.CHANGE_MOVEMENT)
-        extmovement.update_movement_from_form(o.dbo, o.user, o.post)
+        with o.dbo.transaction():
+            extmovement.update_movement_from_form(o.dbo, o.user, o.post)
 
     def post_delete(self, o):
         self.check(users.DELETE_MOVEMENT)
@@ -4220,7 +4247,8 @@ class person(JSONEndpoint):
 
     def post_save(self, o):
         self.check(users.CHANGE_PERSON)
-        extperson.update_person_from_form(o.dbo, o.post, o.user)
+        with o.dbo.transaction():
+            extperson.update_person_from_form(o.dbo, o.post, o.user)
 
     def post_delete(self, o):
         self.check(users.DELETE_PERSON)
@@ -4608,7 +4636,8 @@ class person_new(JSONEndpoint):
         }
 
     def post_all(self, o):
-        return str(extperson.insert_person_from_form(o.dbo, o.post, o.user))
+        with o.dbo.transaction():
+            return str(extperson.insert_person_from_form(o.dbo, o.post, o.user))
 
 class person_rota(JSONEndpoint):
     url = "person_rota"
@@ -4837,10 +4866,11 @@ class report_export_csv(ASMEndpoint):
         title = extreports.get_title(dbo, crid)
         filename = title.replace(" ", "_").replace("\"", "").replace("'", "").lower()
         p = extreports.get_criteria_params(dbo, crid, post)
-        rows, cols = extreports.execute_query(dbo, crid, session.user, p)
+        rows, cols = extreports.execute_query(dbo, crid, session.user, p, stream=True)
         self.content_type("text/csv")
         self.header("Content-Disposition", u"attachment; filename=\"" + utils.decode_html(filename) + u".csv\"")
-        return utils.csv(o.locale, rows, cols, True)
+        if LARGE_FILES_CHUNKED: self.header("Transfer-Encoding", "chunked")
+        return utils.csv_stream(o.locale, rows, cols, True)
 
 class report_images(JSONEndpoint):
     url = "report_images"
@@ -5102,6 +5132,8 @@ class sql(JSONEndpoint):
                 else:
                     rowsaffected += dbo.execute(q)
                     configuration.db_view_seq_version(dbo, "0")
+                    dbupdate.clear_schema_verified(dbo)
+                    extlookups.flush_lookups(dbo)
             return _("{0} rows affected.", l).format(rowsaffected)
         except Exception as err:
             al.error("%s" % str(err), "code.sql", dbo)
@@ -5119,6 +5151,8 @@ class sql(JSONEndpoint):
                 else:
                     rowsaffected = dbo.execute(q)
                     configuration.db_view_seq_version(dbo, "0")
+                    dbupdate.clear_schema_verified(dbo)
+                    extlookups.flush_lookups(dbo)
                     output.append(_("{0} rows affected.", l).format(rowsaffected))
             except Exception as err:
                 al.error("%s" % str(err), "code.sql", dbo)
@@ -5709,6 +5743,7 @@ if len(sys.argv) > 2:
 # Setup the WSGI application object and session with mappings
 app = web.application(generate_routes(), globals())
 app.notfound = asm_404
+app.add_processor(web.loadhook(configuration.begin_request))
 if EMAIL_ERRORS:
     app.internalerror = asm_500_email
 session = session_manager()
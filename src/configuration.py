@@ -5,6 +5,7 @@ import audit
 import cachemem
 import i18n
 import sys
+import threading
 import utils
 from sitedefs import LOCALE, TIMEZONE, URL_NEWS
 
@@ -428,20 +429,60 @@ def csave(dbo, username, post):
     audit.edit(dbo, username, "configuration", 0, "", str(post))
     invalidate_config_cache(dbo)
 
+class ConfigMap(dict):
+    """
+    A read only map of config items. The same map is shared by every
+    caller until the config is next saved, so it must not be changed.
+    """
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("configuration map is read only")
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+    def __reduce__(self):
+        return (ConfigMap, (dict(self),))
+
+# The config maps read during the current request or batch job, so that
+# each request only fetches the map from the cache once. Holds maps,
+# a dictionary of database -> ConfigMap, and fetches, the number of times
+# get_map has gone to the cache.
+request = threading.local()
+
+def begin_request():
+    """
+    Starts a new request or batch job for this thread, discarding the
+    config maps read by the previous one. Called before every web request.
+    """
+    request.maps = {}
+    request.fetches = 0
+
+def get_fetch_count():
+    """ Returns the number of times the config map was fetched from the cache during this request """
+    return getattr(request, "fetches", 0)
+
 def get_map(dbo):
-    """ Returns a map of the config items, using a read-through cache to save database calls """
+    """ 
+    Returns a map of the config items. The map is read once per request 
+    from a read-through cache to save database calls.
+    """
+    if not hasattr(request, "maps"): begin_request()
+    cmap = request.maps.get(dbo.database)
+    if cmap is not None: return cmap
     CACHE_KEY = "%s_config" % dbo.database
+    request.fetches += 1
     cmap = cachemem.get(CACHE_KEY)
     if cmap is None:
         rows = dbo.query("SELECT ItemName, ItemValue FROM configuration ORDER BY ItemName")
         cmap = DEFAULTS.copy()
         for r in rows:
             cmap[r.itemname] = r.itemvalue
+        cmap = ConfigMap(cmap)
         cachemem.put(CACHE_KEY, cmap, 3600) # one hour cache means direct database updates show up eventually
+    request.maps[dbo.database] = cmap
     return cmap
 
 def invalidate_config_cache(dbo):
+    """ Discards the cached config map, it is read again on next use """
     cachemem.delete("%s_config" % dbo.database)
+    if hasattr(request, "maps"): request.maps.pop(dbo.database, None)
 
 def account_period_totals(dbo):
     return cboolean(dbo, "AccountPeriodTotals")
@@ -618,6 +659,12 @@ def create_cost_trx(dbo):
 def create_donation_trx(dbo):
     return cboolean(dbo, "CreateDonationTrx")
 
+def csv_import_progress(dbo, v = None):
+    if v is None:
+        return cstring(dbo, "CSVImportProgress")
+    else:
+        cset(dbo, "CSVImportProgress", v)
+
 def dbv(dbo, v = None):
     if v is None:
         return cstring(dbo, "DBV", "2870")
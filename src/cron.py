@@ -15,6 +15,7 @@ import db
 import dbfs
 import dbupdate
 import diary
+import emailqueue
 import i18n
 import lostfound
 import media
@@ -123,6 +124,10 @@ def daily(dbo):
         # Send fosterer medical reports
         ttask(movement.send_fosterer_emails, dbo)
 
+        # Send everything queued above and clear out old sent messages
+        ttask(emailqueue.process, dbo)
+        ttask(emailqueue.delete_old_emails, dbo)
+
     except:
         em = str(sys.exc_info()[0])
         al.error("FAIL: running batch tasks: %s" % em, "cron.daily", dbo, sys.exc_info())
@@ -134,16 +139,29 @@ def reports_email(dbo):
     try:
         # Email any daily reports for local time of now
         extreports.email_daily_reports(dbo, i18n.now(dbo.timezone))
+        # Send them along with anything else still waiting in the queue
+        emailqueue.process(dbo)
     except:
         em = str(sys.exc_info()[0])
         al.error("FAIL: running daily email of reports_email: %s" % em, "cron.reports_email", dbo, sys.exc_info())
 
+def email_queue(dbo):
+    """
+    Send any email waiting in the queue (eg: messages that failed and are due
+    a retry or were left behind by a process that stopped)
+    """
+    try:
+        emailqueue.process(dbo)
+    except:
+        em = str(sys.exc_info()[0])
+        al.error("FAIL: uncaught error sending the email queue: %s" % em, "cron.email_queue", dbo, sys.exc_info())
+
 def publish_3pty(dbo):
     try:
         publishers = configuration.publishers_enabled(dbo)
-        for p in publishers.split(" "):
-            if p != "html": # We do html/ftp publishing separate from others
-                publish.start_publisher(dbo, p, user="system", newthread=False)
+        # We do html/ftp publishing separate from others
+        codes = [ p for p in publishers.split(" ") if p != "html" and p != "" ]
+        if len(codes) > 0: publish.run_publishers(dbo, codes, user="system")
     except:
         em = str(sys.exc_info()[0])
         al.error("FAIL: uncaught error running third party publishers: %s" % em, "cron.publish_3pty", dbo, sys.exc_info())
@@ -243,14 +261,16 @@ def maint_db_dump_smcom(dbo):
 
 def maint_db_dump_animalcsv(dbo):
     try:
-        print(utils.csv(dbo.locale, animal.get_animal_find_advanced(dbo, { "logicallocation" : "all", "includedeceased": "true", "includenonshelter": "true" })))
+        rows = dbo.query_stream("%s ORDER BY a.AnimalName" % animal.get_animal_query(dbo), distincton="ID")
+        utils.csv_write(dbo.locale, sys.stdout, rows)
     except:
         em = str(sys.exc_info()[0])
         al.error("FAIL: uncaught error running maint_db_dump_animalcsv: %s" % em, "cron.maint_db_dump_animalcsv", dbo, sys.exc_info())
 
 def maint_db_dump_personcsv(dbo):
     try:
-        print(utils.csv(dbo.locale, person.get_person_find_simple(dbo, "", "all", True, True, 0)))
+        rows = dbo.query_stream("%s ORDER BY o.OwnerName" % person.get_person_query(dbo), distincton="ID")
+        utils.csv_write(dbo.locale, sys.stdout, rows)
     except:
         em = str(sys.exc_info()[0])
         al.error("FAIL: uncaught error running maint_db_dump_personcsv: %s" % em, "cron.maint_db_dump_personcsv", dbo, sys.exc_info())
@@ -367,6 +387,7 @@ def run(dbo, mode):
     # locale or timezone to read
     x = time.time()
     al.info("start %s" % mode, "cron.run", dbo)
+    configuration.begin_request()
     if mode == "maint_db_install":
         dbo.locale = LOCALE
         dbo.timezone = TIMEZONE
@@ -385,6 +406,8 @@ def run(dbo, mode):
         daily(dbo)
     elif mode == "reports_email":
         reports_email(dbo)
+    elif mode == "email_queue":
+        email_queue(dbo)
     elif mode == "publish_3pty":
         publish_3pty(dbo)
     elif mode == "publish_html":
@@ -494,6 +517,7 @@ def print_usage():
     print("       all - runs daily and all publish_* tasks")
     print("       daily - daily batch tasks")
     print("       reports_email - email reports with dailyemail set (run this target once per hour)")
+    print("       email_queue - send email waiting in the queue (reports_email does this too)")
     print("       publish_html - publish html/ftp")
     print("       publish_3pty - run all 3rd party publishers")
     print("       maint_animal_figures - calculate all monthly/annual figures for all time")
@@ -9,9 +9,11 @@ import collections
 import configuration
 import csv
 import datetime
+import dbms.base
 import dbupdate
 import financial
 import i18n
+import lookups
 import media
 import medical
 import movement
@@ -52,6 +54,29 @@ VALID_FIELDS = [
     "PERSONMATCHCOMMENTSCONTAIN"
 ]
 
+# How many rows are written in each transaction
+CHUNK_SIZE = 100
+
+# The table that each kind of record from a row goes in
+RECORD_TABLES = {
+    "animal":           "animal",
+    "originalowner":    "owner",
+    "person":           "owner",
+    "movement":         "adoption",
+    "donation":         "ownerdonation",
+    "vaccination":      "animalvaccination",
+    "licence":          "ownerlicence"
+}
+
+class CancelledChunk(Exception):
+    """ Rolls back a chunk of rows when the import is cancelled """
+    pass
+
+class ErrorInChunk(Exception):
+    """ Rolls back a chunk of rows when one of them had an error, as on some
+        databases its transaction can't be used after an error """
+    pass
+
 def gkc(m, f):
     """ reads field f from map m, assuming a currency amount and returning 
         an integer """
@@ -146,56 +171,122 @@ def gkynu(m, f):
     if m[f].upper().startswith("N") or m[f] == "1": return "1"
     return "2"
 
-def gkbr(dbo, m, f, speciesid, create):
-    """ reads lookup field f from map m, returning a str(int) that
-        corresponds to a lookup match for BreedName in breed.
-        if create is True, adds a row to the table if it doesn't
-        find a match and then returns str(newid)
-        speciesid is the linked species for any newly created breed
-        returns "0" if key not present, or if no match was found and create is off """
-    if f not in m: return "0"
-    lv = m[f]
-    matchid = dbo.query_int("SELECT ID FROM breed WHERE LOWER(BreedName) = ?", [ lv.strip().lower().replace("'", "`")] )
-    if matchid == 0 and create:
-        nextid = dbo.get_id("breed")
-        sql = "INSERT INTO breed (ID, SpeciesID, BreedName) VALUES (?,?,?)"
-        dbo.execute(sql, (nextid, speciesid, lv.replace("'", "`")))
-        return str(nextid)
-    return str(matchid)
-
-def gkl(dbo, m, f, table, namefield, create):
-    """ reads lookup field f from map m, returning a str(int) that
-        corresponds to a lookup match for namefield in table.
-        if create is True, adds a row to the table if it doesn't
-        find a match and then returns str(newid)
-        if the value is an empty string, (blank) is used instead.
-        returns "0" if key not present, or if no match was found and create is off """
-    if f not in m: return "0"
-    lv = m[f]
-    matchid = dbo.query_int("SELECT ID FROM %s WHERE LOWER(%s) = ?" % (table, namefield), [ lv.strip().lower().replace("'", "`") ])
-    if matchid == 0 and create:
-        if lv.strip() == "":
-            l = dbo.locale
-            lv = i18n._("(blank)", l)
-        nextid = dbo.insert(table, {
-            namefield:  lv
-        }, setRecordVersion=False, setCreated=False, writeAudit=False)
-        return str(nextid)
-    return str(matchid)
+class LookupResolver(object):
+    """
+    Resolves the lookup values in CSV rows to their IDs. Each lookup
+    table is read once into a map of lower case name -> ID.
+    While collecting, values that aren't in a table resolve to a
+    placeholder and are remembered so that create_missing can add
+    them all at once.
+    create: If True, missing values are added to their table,
+            otherwise they resolve to "0"
+    """
+    def __init__(self, dbo, create):
+        self.dbo = dbo
+        self.create = create
+        self.collecting = True
+        self.maps = {} # table -> name -> ID
+        self.missing = collections.OrderedDict() # ( table, name ) -> row to insert
+
+    def get_map(self, table, namefield):
+        """ Returns the map of lower case name -> ID for table, reading it the first time """
+        if table not in self.maps:
+            m = {}
+            for r in self.dbo.query("SELECT ID, %s AS Name FROM %s ORDER BY ID" % (namefield, table)):
+                name = utils.nulltostr(r.name).lower()
+                if name not in m: m[name] = r.id
+            self.maps[table] = m
+        return self.maps[table]
+
+    def resolve(self, table, namefield, value, create, missingrow):
+        """ Returns str(ID) for value in table. If it's missing and create is
+            True, it is added to the table from missingrow. """
+        name = value.strip().lower().replace("'", "`")
+        m = self.get_map(table, namefield)
+        if name in m: return str(m[name])
+        if not create: return "0"
+        if self.collecting:
+            if (table, name) not in self.missing: self.missing[(table, name)] = missingrow
+            return "new:%s:%s" % (table, name)
+        # A value that wasn't seen while collecting
+        m[name] = self.dbo.insert(table, self.with_species(missingrow), setRecordVersion=False, setCreated=False, writeAudit=False)
+        lookups.flush_lookup(self.dbo, table)
+        return str(m[name])
+
+    def gkl(self, m, f, table, namefield, create = True):
+        """ reads lookup field f from map m, returning a str(int) that
+            corresponds to a lookup match for namefield in table.
+            if the value is an empty string, (blank) is used instead
+            when it is added to the table.
+            returns "0" if key not present, or if no match was found and
+            create or createmissinglookups is off """
+        if f not in m: return "0"
+        lv = m[f]
+        if lv.strip() == "": lv = i18n._("(blank)", self.dbo.locale)
+        return self.resolve(table, namefield, m[f], create and self.create, { namefield: lv })
+
+    def gkbr(self, m, f, speciesid):
+        """ reads lookup field f from map m, returning a str(int) that
+            corresponds to a lookup match for BreedName in breed.
+            speciesid is the linked species for any newly created breed
+            returns "0" if key not present, or if no match was found and
+            createmissinglookups is off """
+        if f not in m: return "0"
+        lv = m[f]
+        return self.resolve("breed", "BreedName", lv, self.create, { "SpeciesID": speciesid, "BreedName": lv.replace("'", "`") })
+
+    def with_species(self, row):
+        """ Returns row with any placeholder for a new species swapped for its ID """
+        if "SpeciesID" not in row: return row
+        row = row.copy()
+        speciesid = str(row["SpeciesID"])
+        if speciesid.startswith("new:"):
+            speciesid = self.get_map("species", "SpeciesName")[speciesid.split(":", 2)[2]]
+        row["SpeciesID"] = utils.cint(speciesid)
+        return row
+
+    def create_missing(self):
+        """ Adds the values that were missing while collecting to their tables,
+            breeds last so that they can link to new species. Then stops collecting. """
+        tables = []
+        for table, name in self.missing.iterkeys():
+            if table not in tables: tables.append(table)
+        tables.sort(key=lambda t: t == "breed")
+        for table in tables:
+            names = [ name for t, name in self.missing.iterkeys() if t == table ]
+            rows = [ self.with_species(self.missing[(table, name)]) for name in names ]
+            ids = self.dbo.insert_many(table, rows, setRecordVersion=False, setCreated=False, writeAudit=False)
+            self.maps[table].update(zip(names, ids))
+            lookups.flush_lookup(self.dbo, table)
+            al.debug("created %d missing %s values" % (len(ids), table), "csvimport.LookupResolver", self.dbo)
+        self.missing.clear()
+        self.collecting = False
 
 def create_additional_fields(dbo, row, errors, rowno, csvkey = "ANIMALADDITIONAL", linktype = "animal", linkid = 0):
     # Identify any additional fields that may have been specified with
     # ANIMALADDITIONAL<fieldname>
+    values = []
     for a in additional.get_field_definitions(dbo, linktype):
         v = gks(row, csvkey + str(a.fieldname).upper())
         if v != "":
+            values.append({
+                "LinkType":             a.linktype,
+                "LinkID":               linkid,
+                "AdditionalFieldID":    a.id,
+                "Value":                v
+            })
+    try:
+        dbo.insert_many("additional", values, generateID=False)
+    except Exception as e:
+        # Insert them one at a time instead so that one bad value only
+        # loses its own field. Not inside a transaction, as the error
+        # may have aborted it, that's left to the transaction's owner.
+        if dbo.get_transaction() is not None:
+            errors.append( (rowno, str(row), str(e)) )
+            raise ErrorInChunk()
+        for v in values:
             try:
-                dbo.insert("additional", {
-                    "LinkType":             a.linktype,
-                    "LinkID":               linkid,
-                    "AdditionalFieldID":    a.id,
-                    "Value":                v
-                }, generateID=False)
+                dbo.insert("additional", v, generateID=False)
             except Exception as e:
                 errors.append( (rowno, str(row), str(e)) )
 
@@ -208,6 +299,7 @@ def row_error(errors, rowtype, rowno, row, e, dbo, exinfo):
     row: The row data itself
     e: The exception thrown
     exinfo: execution info for logging
+    Inside a chunk's transaction, raises ErrorInChunk to stop the chunk.
     """
     errmsg = str(e)
     if type(e) == utils.ASMValidationError: errmsg = e.getMsg()
@@ -216,12 +308,40 @@ def row_error(errors, rowtype, rowno, row, e, dbo, exinfo):
         row["ANIMALIMAGE"] = "data:,"
     al.error("row %d %s: (%s): %s" % (rowno, rowtype, str(row), errmsg), "csvimport.row_error", dbo, exinfo)
     errors.append( (rowno, str(row), errmsg) )
+    if dbo.get_transaction() is not None: raise ErrorInChunk()
+
+def csv_reader(csvdata, encoding):
+    """ Returns a reader for the rows of csvdata """
+    if encoding == "utf8":
+        return utils.UnicodeCSVReader(StringIO(csvdata))
+    else:
+        return utils.UnicodeCSVReader(StringIO(csvdata), encoding=encoding)
+
+def csv_rows(csvdata, encoding, cols):
+    """ Generates a map of column -> value for each row of csvdata after the header """
+    reader = csv_reader(csvdata, encoding)
+    for row in reader:
+        break
+    for row in reader:
+        currow = {}
+        for i, col in enumerate(row):
+            if i >= len(cols): continue # skip if we run out of cols
+            currow[cols[i]] = col
+        yield currow
 
 def csvimport(dbo, csvdata, encoding = "utf8", createmissinglookups = False, cleartables = False, checkduplicates = False):
     """
     Imports the csvdata.
     createmissinglookups: If a lookup value is given that's not in our data, add it
     cleartables: Clear down the animal, owner and adoption tables before import
+    The file is read twice without holding all its rows. The first pass 
+    resolves the lookup values the rows use, adding any that are missing
+    together. The second writes the rows CHUNK_SIZE at a time, each chunk in
+    its own transaction, and records how many rows have been committed in 
+    the CSVImportProgress config item so that importing the same file again 
+    after a failure or cancel resumes from where it stopped.
+    Images are retrieved before a chunk's transaction and attached once it
+    has been committed, as neither is undone if it's rolled back.
     """
 
     # Convert line endings to standard unix lf to prevent
@@ -229,15 +349,9 @@ def csvimport(dbo, csvdata, encoding = "utf8", createmissinglookups = False, cle
     csvdata = csvdata.replace("\r\n", "\n")
     csvdata = csvdata.replace("\r", "\n")
 
-    reader = None
-    if encoding == "utf8":
-        reader = utils.UnicodeCSVReader(StringIO(csvdata))
-    else:
-        reader = utils.UnicodeCSVReader(StringIO(csvdata), encoding=encoding)
-
     # Make sure we have a valid header
     cols = None
-    for row in reader:
+    for row in csv_reader(csvdata, encoding):
         cols = row
         break
     if cols is None:
@@ -332,67 +446,39 @@ def csvimport(dbo, csvdata, encoding = "utf8", createmissinglookups = False, cle
     if haslicence and not (haspersonlastname or haspersonname):
         asynctask.set_last_error(dbo, "Your CSV file has license fields, but no person to apply the license to")
 
-    # Read the whole CSV file into a list of maps. Note, the
-    # reader has a cursor at the second row already because
-    # we read the header in the first row above
-    data = []
-    for row in reader:
-        currow = {}
-        for i, col in enumerate(row):
-            if i >= len(cols): continue # skip if we run out of cols
-            currow[cols[i]] = col
-        data.append(currow)
-
-    al.debug("reading CSV data, found %d rows" % len(data), "csvimport.csvimport", dbo)
-
-    # If we're clearing down tables first, do it now
-    if cleartables:
-        al.warn("Resetting the database by removing all non-lookup data", "csvimport.csvimport", dbo)
-        dbupdate.reset_db(dbo)
-
-    # Now that we've read them in, go through all the rows
-    # and start importing.
-    errors = []
-    rowno = 1
-    asynctask.set_progress_max(dbo, len(data))
-    for row in data:
-
-        al.debug("import csv: row %d of %d" % (rowno, len(data)), "csvimport.csvimport", dbo)
-        asynctask.increment_progress_value(dbo)
-
-        # Should we stop?
-        if asynctask.get_cancel(dbo): break
+    def prepare(row):
+        """ Returns a dict of the form data for each kind of record in row """
+        f = {}
 
         # Do we have animal data to read?
-        animalid = 0
         if hasanimal and gks(row, "ANIMALNAME") != "":
             a = {}
             a["animalname"] = gks(row, "ANIMALNAME")
             a["sheltercode"] = gks(row, "ANIMALCODE")
             a["shortcode"] = gks(row, "ANIMALCODE")
-            if gks(row, "ANIMALSEX") == "": 
+            if gks(row, "ANIMALSEX") == "":
                 a["sex"] = "2" # Default unknown if not set
             else:
                 a["sex"] = gks(row, "ANIMALSEX").lower().startswith("m") and "1" or "0"
-            a["basecolour"] = gkl(dbo, row, "ANIMALCOLOR", "basecolour", "BaseColour", createmissinglookups)
+            a["basecolour"] = lk.gkl(row, "ANIMALCOLOR", "basecolour", "BaseColour")
             if a["basecolour"] == "0":
                 a["basecolour"] = str(configuration.default_colour(dbo))
-            a["species"] = gkl(dbo, row, "ANIMALSPECIES", "species", "SpeciesName", createmissinglookups)
+            a["species"] = lk.gkl(row, "ANIMALSPECIES", "species", "SpeciesName")
             if a["species"] == "0":
                 a["species"] = str(configuration.default_species(dbo))
-            a["animaltype"] = gkl(dbo, row, "ANIMALTYPE", "animaltype", "AnimalType", createmissinglookups)
+            a["animaltype"] = lk.gkl(row, "ANIMALTYPE", "animaltype", "AnimalType")
             if a["animaltype"] == "0":
                 a["animaltype"] = str(configuration.default_type(dbo))
-            a["breed1"] = gkbr(dbo, row, "ANIMALBREED1", a["species"], createmissinglookups)
+            a["breed1"] = lk.gkbr(row, "ANIMALBREED1", a["species"])
             if a["breed1"] == "0":
                 a["breed1"] = str(configuration.default_breed(dbo))
-            a["breed2"] = gkbr(dbo, row, "ANIMALBREED2", a["species"], createmissinglookups)
+            a["breed2"] = lk.gkbr(row, "ANIMALBREED2", a["species"])
             if a["breed2"] != "0" and a["breed2"] != a["breed1"]:
                 a["crossbreed"] = "on"
-            a["size"] = gkl(dbo, row, "ANIMALSIZE", "lksize", "Size", False)
-            if gks(row, "ANIMALSIZE") == "": 
+            a["size"] = lk.gkl(row, "ANIMALSIZE", "lksize", "Size", False)
+            if gks(row, "ANIMALSIZE") == "":
                 a["size"] = str(configuration.default_size(dbo))
-            a["internallocation"] = gkl(dbo, row, "ANIMALLOCATION", "internallocation", "LocationName", createmissinglookups)
+            a["internallocation"] = lk.gkl(row, "ANIMALLOCATION", "internallocation", "LocationName")
             if a["internallocation"] == "0":
                 a["internallocation"] = str(configuration.default_location(dbo))
             a["unit"] = gks(row, "ANIMALUNIT")
@@ -419,23 +505,7 @@ def csvimport(dbo, csvdata, encoding = "utf8", createmissinglookups = False, cle
             a["microchipnumber"] = gks(row, "ANIMALMICROCHIP")
             if a["microchipnumber"] != "": a["microchipped"] = "on"
             a["microchipdate"] = gkd(dbo, row, "ANIMALMICROCHIPDATE")
-            # image data if any was supplied
-            imagedata = gks(row, "ANIMALIMAGE")
-            if imagedata.startswith("http"):
-                # It's a URL, get the image from the remote server
-                r = utils.get_image_url(imagedata, timeout=5000)
-                if r["status"] == 200:
-                    al.debug("retrieved image from %s (%s bytes)" % (imagedata, len(r["response"])), "csvimport.csvimport", dbo)
-                    imagedata = "data:image/jpeg;base64,%s" % base64.b64encode(r["response"])
-                else:
-                    row_error(errors, "animal", rowno, row, "error reading image from '%s': %s" % (imagedata, r), dbo, sys.exc_info())
-                    continue
-            elif imagedata.startswith("data:image"):
-                # It's a base64 encoded data URI - do nothing as attach_file requires it
-                pass
-            else:
-                # We don't know what it is, don't try and do anything with it
-                imagedata = ""
+            f["animal"] = a
             # If an original owner is specified, create a person record
             # for them and attach it to the animal as original owner
             if gks(row, "ORIGINALOWNERLASTNAME") != "":
@@ -448,45 +518,18 @@ def csvimport(dbo, csvdata, encoding = "utf8", createmissinglookups = False, cle
                 p["town"] = gks(row, "ORIGINALOWNERCITY")
                 p["county"] = gks(row, "ORIGINALOWNERSTATE")
                 p["postcode"] = gks(row, "ORIGINALOWNERZIPCODE")
-                p["jurisdiction"] = gkl(dbo, row, "ORIGINALOWNERJURISDICTION", "jurisdiction", "JurisdictionName", createmissinglookups)
+                p["jurisdiction"] = lk.gkl(row, "ORIGINALOWNERJURISDICTION", "jurisdiction", "JurisdictionName")
                 p["hometelephone"] = gks(row, "ORIGINALOWNERHOMEPHONE")
                 p["worktelephone"] = gks(row, "ORIGINALOWNERWORKPHONE")
                 p["mobiletelephone"] = gks(row, "ORIGINALOWNERCELLPHONE")
                 p["emailaddress"] = gks(row, "ORIGINALOWNEREMAIL")
-                try:
-                    if checkduplicates:
-                        dups = person.get_person_similar(dbo, p["emailaddress"], p["surname"], p["forenames"], p["address"])
-                        if len(dups) > 0:
-                            a["originalowner"] = str(dups[0]["ID"])
-                    if "originalowner" not in a:
-                        ooid = person.insert_person_from_form(dbo, utils.PostedData(p, dbo.locale), "import", geocode=False)
-                        a["originalowner"] = str(ooid)
-                        # Identify an ORIGINALOWNERADDITIONAL additional fields and create them
-                        create_additional_fields(dbo, row, errors, rowno, "ORIGINALOWNERADDITIONAL", "person", ooid)
-                except Exception as e:
-                    row_error(errors, "originalowner", rowno, row, e, dbo, sys.exc_info())
-            try:
-                if checkduplicates:
-                    dup = animal.get_animal_sheltercode(dbo, a["sheltercode"])
-                    if dup is not None:
-                        animalid = dup["ID"]
-                if animalid == 0:
-                    animalid, newcode = animal.insert_animal_from_form(dbo, utils.PostedData(a, dbo.locale), "import")
-                    # Identify any ANIMALADDITIONAL additional fields and create them
-                    create_additional_fields(dbo, row, errors, rowno, "ANIMALADDITIONAL", "animal", animalid)
-                # If we have some image data, add it to the animal
-                if len(imagedata) > 0:
-                    imagepost = utils.PostedData({ "filename": "image.jpg", "filetype": "image/jpeg", "filedata": imagedata }, dbo.locale)
-                    media.attach_file_from_form(dbo, "import", media.ANIMAL, animalid, imagepost)
-            except Exception as e:
-                row_error(errors, "animal", rowno, row, e, dbo, sys.exc_info())
+                f["originalowner"] = p
 
         # Person data?
-        personid = 0
         if hasperson and (gks(row, "PERSONLASTNAME") != "" or gks(row, "PERSONNAME") != ""):
             p = {}
             p["ownertype"] = gks(row, "PERSONCLASS")
-            if p["ownertype"] != "1" and p["ownertype"] != "2": 
+            if p["ownertype"] != "1" and p["ownertype"] != "2":
                 p["ownertype"] = "1"
             p["title"] = gks(row, "PERSONTITLE")
             p["initials"] = gks(row, "PERSONINITIALS")
@@ -505,7 +548,7 @@ def csvimport(dbo, csvdata, encoding = "utf8", createmissinglookups = False, cle
             p["town"] = gks(row, "PERSONCITY")
             p["county"] = gks(row, "PERSONSTATE")
             p["postcode"] = gks(row, "PERSONZIPCODE")
-            p["jurisdiction"] = gkl(dbo, row, "PERSONJURISDICTION", "jurisdiction", "JurisdictionName", createmissinglookups)
+            p["jurisdiction"] = lk.gkl(row, "PERSONJURISDICTION", "jurisdiction", "JurisdictionName")
             p["hometelephone"] = gks(row, "PERSONHOMEPHONE")
             p["worktelephone"] = gks(row, "PERSONWORKPHONE")
             p["mobiletelephone"] = gks(row, "PERSONCELLPHONE")
@@ -524,45 +567,24 @@ def csvimport(dbo, csvdata, encoding = "utf8", createmissinglookups = False, cle
                 if "PERSONMATCHADDED" in cols: p["matchadded"] = gkd(dbo, row, "PERSONMATCHADDED")
                 if "PERSONMATCHEXPIRES" in cols: p["matchexpires"] = gkd(dbo, row, "PERSONMATCHEXPIRES")
                 if "PERSONMATCHSEX" in cols: p["matchsex"] = gks(row, "PERSONMATCHSEX").lower().startswith("m") and "1" or "0"
-                if "PERSONMATCHSIZE" in cols: p["matchsize"] = gkl(dbo, row, "PERSONMATCHSIZE", "lksize", "Size", False)
-                if "PERSONMATCHCOLOR" in cols: p["matchcolour"] = gkl(dbo, row, "PERSONMATCHCOLOR", "basecolour", "BaseColour", createmissinglookups)
+                if "PERSONMATCHSIZE" in cols: p["matchsize"] = lk.gkl(row, "PERSONMATCHSIZE", "lksize", "Size", False)
+                if "PERSONMATCHCOLOR" in cols: p["matchcolour"] = lk.gkl(row, "PERSONMATCHCOLOR", "basecolour", "BaseColour")
                 if "PERSONMATCHAGEFROM" in cols: p["matchagefrom"] = gks(row, "PERSONMATCHAGEFROM")
                 if "PERSONMATCHAGETO" in cols: p["matchageto"] = gks(row, "PERSONMATCHAGETO")
-                if "PERSONMATCHTYPE" in cols: p["matchanimaltype"] = gkl(dbo, row, "PERSONMATCHTYPE", "animaltype", "AnimalType", createmissinglookups)
-                if "PERSONMATCHSPECIES" in cols: p["matchspecies"] = gkl(dbo, row, "PERSONMATCHSPECIES", "species", "SpeciesName", createmissinglookups)
-                if "PERSONMATCHBREED1" in cols: p["matchbreed"] = gkbr(dbo, row, "PERSONMATCHBREED1", p["matchspecies"], createmissinglookups)
-                if "PERSONMATCHBREED2" in cols: p["matchbreed2"] = gkbr(dbo, row, "PERSONMATCHBREED2", p["matchspecies"], createmissinglookups)
+                if "PERSONMATCHTYPE" in cols: p["matchanimaltype"] = lk.gkl(row, "PERSONMATCHTYPE", "animaltype", "AnimalType")
+                if "PERSONMATCHSPECIES" in cols: p["matchspecies"] = lk.gkl(row, "PERSONMATCHSPECIES", "species", "SpeciesName")
+                if "PERSONMATCHBREED1" in cols: p["matchbreed"] = lk.gkbr(row, "PERSONMATCHBREED1", p.get("matchspecies", "0"))
+                if "PERSONMATCHBREED2" in cols: p["matchbreed2"] = lk.gkbr(row, "PERSONMATCHBREED2", p.get("matchspecies", "0"))
                 if "PERSONMATCHGOODWITHCATS" in cols: p["matchgoodwithcats"] = gkynu(row, "PERSONMATCHGOODWITHCATS")
                 if "PERSONMATCHGOODWITHDOGS" in cols: p["matchgoodwithdogs"] = gkynu(row, "PERSONMATCHGOODWITHDOGS")
                 if "PERSONMATCHGOODWITHCHILDREN" in cols: p["matchgoodwithchildren"] = gkynu(row, "PERSONMATCHGOODWITHCHILDREN")
                 if "PERSONMATCHHOUSETRAINED" in cols: p["matchhousetrained"] = gkynu(row, "PERSONMATCHHOUSETRAINED")
                 if "PERSONMATCHCOMMENTSCONTAIN" in cols: p["matchcommentscontain"] = gks(row, "PERSONMATCHCOMMENTSCONTAIN")
-            try:
-                if checkduplicates:
-                    dups = person.get_person_similar(dbo, p["emailaddress"], p["surname"], p["forenames"], p["address"])
-                    if len(dups) > 0:
-                        personid = dups[0].ID
-                        # Merge flags and any extra details
-                        person.merge_flags(dbo, "import", personid, flags)
-                        person.merge_gdpr_flags(dbo, "import", personid, p["gdprcontactoptin"])
-                        # If we deduplicated on the email address, and address details are
-                        # present, assume that they are newer than the ones we had and update them
-                        # (we do this by setting force=True parameter to merge_person_details,
-                        # otherwise we do a regular merge which only fills in any blanks)
-                        person.merge_person_details(dbo, "import", personid, p, force=dups[0].EMAILADDRESS == p["emailaddress"])
-                if personid == 0:
-                    personid = person.insert_person_from_form(dbo, utils.PostedData(p, dbo.locale), "import", geocode=False)
-                    # Identify any PERSONADDITIONAL additional fields and create them
-                    create_additional_fields(dbo, row, errors, rowno, "PERSONADDITIONAL", "person", personid)
-            except Exception as e:
-                row_error(errors, "person", rowno, row, e, dbo, sys.exc_info())
+            f["person"] = p
 
         # Movement to tie animal/person together?
-        movementid = 0
-        if hasmovement and personid != 0 and animalid != 0 and gks(row, "MOVEMENTDATE") != "":
+        if hasmovement and "person" in f and "animal" in f and gks(row, "MOVEMENTDATE") != "":
             m = {}
-            m["person"] = str(personid)
-            m["animal"] = str(animalid)
             movetype = gks(row, "MOVEMENTTYPE")
             if movetype == "": movetype = "1" # Default to adoption if not supplied
             m["type"] = str(movetype)
@@ -570,38 +592,27 @@ def csvimport(dbo, csvdata, encoding = "utf8", createmissinglookups = False, cle
             m["returndate"] = gkd(dbo, row, "MOVEMENTRETURNDATE")
             m["comments"] = gks(row, "MOVEMENTCOMMENTS")
             m["returncategory"] = str(configuration.default_entry_reason(dbo))
-            try:
-                movementid = movement.insert_movement_from_form(dbo, "import", utils.PostedData(m, dbo.locale))
-            except Exception as e:
-                row_error(errors, "movement", rowno, row, e, dbo, sys.exc_info())
+            f["movement"] = m
 
         # Donation?
-        if hasdonation and personid != 0 and gkc(row, "DONATIONAMOUNT") != 0:
+        if hasdonation and "person" in f and gkc(row, "DONATIONAMOUNT") != 0:
             d = {}
-            d["person"] = str(personid)
-            d["animal"] = str(animalid)
-            d["movement"] = str(movementid)
             d["amount"] = str(gkc(row, "DONATIONAMOUNT"))
             d["comments"] = gks(row, "DONATIONCOMMENTS")
             d["received"] = gkd(dbo, row, "DONATIONDATE", True)
             d["chequenumber"] = gks(row, "DONATIONCHECKNUMBER")
-            d["type"] = gkl(dbo, row, "DONATIONTYPE", "donationtype", "DonationName", createmissinglookups)
+            d["type"] = lk.gkl(row, "DONATIONTYPE", "donationtype", "DonationName")
             if d["type"] == "0":
                 d["type"] = str(configuration.default_donation_type(dbo))
-            d["payment"] = gkl(dbo, row, "DONATIONPAYMENT", "donationpayment", "PaymentName", createmissinglookups)
+            d["payment"] = lk.gkl(row, "DONATIONPAYMENT", "donationpayment", "PaymentName")
             if d["payment"] == "0":
                 d["payment"] = "1"
-            try:
-                financial.insert_donation_from_form(dbo, "import", utils.PostedData(d, dbo.locale))
-            except Exception as e:
-                row_error(errors, "payment", rowno, row, e, dbo, sys.exc_info())
-            if movementid != 0: movement.update_movement_donation(dbo, movementid)
+            f["donation"] = d
 
         # Vaccination?
-        if hasvacc and animalid != 0 and gks(row, "VACCINATIONDUEDATE") != "":
+        if hasvacc and "animal" in f and gks(row, "VACCINATIONDUEDATE") != "":
             v = {}
-            v["animal"] = str(animalid)
-            v["type"] = gkl(dbo, row, "VACCINATIONTYPE", "vaccinationtype", "VaccinationType", createmissinglookups)
+            v["type"] = lk.gkl(row, "VACCINATIONTYPE", "vaccinationtype", "VaccinationType")
             if v["type"] == "0":
                 v["type"] = str(configuration.default_vaccination_type(dbo))
             v["required"] = gkd(dbo, row, "VACCINATIONDUEDATE", True)
@@ -610,46 +621,271 @@ def csvimport(dbo, csvdata, encoding = "utf8", createmissinglookups = False, cle
             v["batchnumber"] = gks(row, "VACCINATIONBATCHNUMBER")
             v["manufacturer"] = gks(row, "VACCINATIONMANUFACTURER")
             v["comments"] = gks(row, "VACCINATIONCOMMENTS")
-            try:
-                medical.insert_vaccination_from_form(dbo, "import", utils.PostedData(v, dbo.locale))
-            except Exception as e:
-                row_error(errors, "vaccination", rowno, row, e, dbo, sys.exc_info())
+            f["vaccination"] = v
 
         # Medical?
-        if hasmed and animalid != 0 and gks(row, "MEDICALGIVENDATE") != "" and gks(row, "MEDICALNAME") != "":
+        if hasmed and "animal" in f and gks(row, "MEDICALGIVENDATE") != "" and gks(row, "MEDICALNAME") != "":
             m = {}
-            m["animal"] = str(animalid)
             m["treatmentname"] = gks(row, "MEDICALNAME")
             m["dosage"] = gks(row, "MEDICALDOSAGE")
             m["startdate"] = gkd(dbo, row, "MEDICALGIVENDATE")
             m["comments"] = gks(row, "MEDICALCOMMENTS")
             m["singlemulti"] = "0" # single treatment
             m["status"] = "2" # completed
-            try:
-                medical.insert_regimen_from_form(dbo, "import", utils.PostedData(m, dbo.locale))
-            except Exception as e:
-                row_error(errors, "medical", rowno, row, e, dbo, sys.exc_info())
+            f["medical"] = m
 
         # License?
-        if haslicence and personid != 0 and gks(row, "LICENSENUMBER") != "":
+        if haslicence and "person" in f and gks(row, "LICENSENUMBER") != "":
             l = {}
-            l["person"] = str(personid)
-            l["animal"] = str(animalid)
-            l["type"] = gkl(dbo, row, "LICENSETYPE", "licencetype", "LicenceTypeName", createmissinglookups)
+            l["type"] = lk.gkl(row, "LICENSETYPE", "licencetype", "LicenceTypeName")
             if l["type"] == "0": l["type"] = 1
             l["number"] = gks(row, "LICENSENUMBER")
             l["fee"] = str(gkc(row, "LICENSEFEE"))
             l["issuedate"] = gkd(dbo, row, "LICENSEISSUEDATE")
             l["expirydate"] = gkd(dbo, row, "LICENSEEXPIRESDATE")
             l["comments"] = gks(row, "LICENSECOMMENTS")
+            f["licence"] = l
+
+        return f
+
+    def get_image(rowno, row, errors):
+        """ Returns the image data for row as a data URI, retrieving it if it's
+            a URL. Returns "" if there isn't any or None if it couldn't be retrieved. """
+        imagedata = gks(row, "ANIMALIMAGE")
+        if imagedata.startswith("http"):
+            # It's a URL, get the image from the remote server
+            r = utils.get_image_url(imagedata, timeout=5000)
+            if r["status"] == 200:
+                al.debug("retrieved image from %s (%s bytes)" % (imagedata, len(r["response"])), "csvimport.csvimport", dbo)
+                return "data:image/jpeg;base64,%s" % base64.b64encode(r["response"])
+            row_error(errors, "animal", rowno, row, "error reading image from '%s': %s" % (imagedata, r), dbo, sys.exc_info())
+            return None
+        elif imagedata.startswith("data:image"):
+            # It's a base64 encoded data URI - do nothing as attach_file requires it
+            return imagedata
+        # We don't know what it is, don't try and do anything with it
+        return ""
+
+    def attach_image(rowno, row, animalid, imagedata, errors):
+        """ Adds the image data for row to the animal """
+        try:
+            imagepost = utils.PostedData({ "filename": "image.jpg", "filetype": "image/jpeg", "filedata": imagedata }, dbo.locale)
+            media.attach_file_from_form(dbo, "import", media.ANIMAL, animalid, imagepost)
+        except Exception as e:
+            row_error(errors, "animal", rowno, row, e, dbo, sys.exc_info())
+
+    def write(rowno, row, f, imagedata, errors, images = None):
+        """ Creates the records for row from its form data f and image data
+            from get_image. If images is a list, the image is added to it as
+            ( rowno, row, animalid, imagedata ) for the caller to attach
+            instead of being attached now. """
+
+        animalid = 0
+        if "animal" in f:
+            a = f["animal"]
+            # The image couldn't be retrieved, skip the row
+            if imagedata is None: return
+            if "originalowner" in f:
+                p = f["originalowner"]
+                try:
+                    if checkduplicates:
+                        dups = person.get_person_similar(dbo, p["emailaddress"], p["surname"], p["forenames"], p["address"])
+                        if len(dups) > 0:
+                            a["originalowner"] = str(dups[0]["ID"])
+                    if "originalowner" not in a:
+                        ooid = person.insert_person_from_form(dbo, utils.PostedData(p, dbo.locale), "import", geocode=False)
+                        a["originalowner"] = str(ooid)
+                        # Identify an ORIGINALOWNERADDITIONAL additional fields and create them
+                        create_additional_fields(dbo, row, errors, rowno, "ORIGINALOWNERADDITIONAL", "person", ooid)
+                except ErrorInChunk:
+                    raise
+                except Exception as e:
+                    row_error(errors, "originalowner", rowno, row, e, dbo, sys.exc_info())
+            try:
+                if checkduplicates:
+                    dup = animal.get_animal_sheltercode(dbo, a["sheltercode"])
+                    if dup is not None:
+                        animalid = dup["ID"]
+                if animalid == 0:
+                    animalid, newcode = animal.insert_animal_from_form(dbo, utils.PostedData(a, dbo.locale), "import")
+                    # Identify any ANIMALADDITIONAL additional fields and create them
+                    create_additional_fields(dbo, row, errors, rowno, "ANIMALADDITIONAL", "animal", animalid)
+            except ErrorInChunk:
+                raise
+            except Exception as e:
+                row_error(errors, "animal", rowno, row, e, dbo, sys.exc_info())
+            # If we have some image data, add it to the animal
+            if animalid != 0 and len(imagedata) > 0:
+                if images is not None:
+                    images.append( (rowno, row, animalid, imagedata) )
+                else:
+                    attach_image(rowno, row, animalid, imagedata, errors)
+
+        personid = 0
+        if "person" in f:
+            p = f["person"]
+            try:
+                if checkduplicates:
+                    dups = person.get_person_similar(dbo, p["emailaddress"], p["surname"], p["forenames"], p["address"])
+                    if len(dups) > 0:
+                        personid = dups[0].ID
+                        # Merge flags and any extra details
+                        person.merge_flags(dbo, "import", personid, p["flags"])
+                        person.merge_gdpr_flags(dbo, "import", personid, p["gdprcontactoptin"])
+                        # If we deduplicated on the email address, and address details are
+                        # present, assume that they are newer than the ones we had and update them
+                        # (we do this by setting force=True parameter to merge_person_details,
+                        # otherwise we do a regular merge which only fills in any blanks)
+                        person.merge_person_details(dbo, "import", personid, p, force=dups[0].EMAILADDRESS == p["emailaddress"])
+                if personid == 0:
+                    personid = person.insert_person_from_form(dbo, utils.PostedData(p, dbo.locale), "import", geocode=False)
+                    # Identify any PERSONADDITIONAL additional fields and create them
+                    create_additional_fields(dbo, row, errors, rowno, "PERSONADDITIONAL", "person", personid)
+            except ErrorInChunk:
+                raise
+            except Exception as e:
+                row_error(errors, "person", rowno, row, e, dbo, sys.exc_info())
+
+        movementid = 0
+        if "movement" in f and personid != 0 and animalid != 0:
+            m = f["movement"]
+            m["person"] = str(personid)
+            m["animal"] = str(animalid)
+            try:
+                movementid = movement.insert_movement_from_form(dbo, "import", utils.PostedData(m, dbo.locale))
+            except Exception as e:
+                row_error(errors, "movement", rowno, row, e, dbo, sys.exc_info())
+
+        if "donation" in f and personid != 0:
+            d = f["donation"]
+            d["person"] = str(personid)
+            d["animal"] = str(animalid)
+            d["movement"] = str(movementid)
+            try:
+                financial.insert_donation_from_form(dbo, "import", utils.PostedData(d, dbo.locale))
+            except Exception as e:
+                row_error(errors, "payment", rowno, row, e, dbo, sys.exc_info())
+            if movementid != 0: movement.update_movement_donation(dbo, movementid)
+
+        if "vaccination" in f and animalid != 0:
+            v = f["vaccination"]
+            v["animal"] = str(animalid)
+            try:
+                medical.insert_vaccination_from_form(dbo, "import", utils.PostedData(v, dbo.locale))
+            except Exception as e:
+                row_error(errors, "vaccination", rowno, row, e, dbo, sys.exc_info())
+
+        if "medical" in f and animalid != 0:
+            m = f["medical"]
+            m["animal"] = str(animalid)
+            try:
+                medical.insert_regimen_from_form(dbo, "import", utils.PostedData(m, dbo.locale))
+            except Exception as e:
+                row_error(errors, "medical", rowno, row, e, dbo, sys.exc_info())
+
+        if "licence" in f and personid != 0:
+            l = f["licence"]
+            l["person"] = str(personid)
+            l["animal"] = str(animalid)
             try:
                 financial.insert_licence_from_form(dbo, "import", utils.PostedData(l, dbo.locale))
             except Exception as e:
                 row_error(errors, "license", rowno, row, e, dbo, sys.exc_info())
 
-        rowno += 1
+    def write_chunk(chunk, errors):
+        """
+        Writes a list of ( rowno, row ) in one transaction, with the IDs of
+        the main records for them allocated together. The rows' images are
+        retrieved first and attached after the transaction is committed.
+        If a row has an error, or a statement failed and the transaction
+        was rolled back when it ended, the chunk is written again a row at
+        a time, as each row can partly succeed.
+        Returns False if the import was cancelled part way through the chunk.
+        """
+        forms = [ prepare(row) for rowno, row in chunk ]
+        imagedata = []
+        for (rowno, row), f in zip(chunk, forms):
+            if "animal" in f:
+                imagedata.append(get_image(rowno, row, errors))
+            else:
+                imagedata.append("")
+        progress = asynctask.get_progress_value(dbo)
+        images = []
+        try:
+            with dbo.transaction():
+                counts = {}
+                for f in forms:
+                    for kind in f.iterkeys():
+                        if kind in RECORD_TABLES: counts[RECORD_TABLES[kind]] = counts.get(RECORD_TABLES[kind], 0) + 1
+                for table, count in counts.iteritems():
+                    dbo.reserve_ids(table, count)
+                for (rowno, row), f, data in zip(chunk, forms, imagedata):
+                    if asynctask.get_cancel(dbo): raise CancelledChunk()
+                    # Errors are recorded when the rows are written again
+                    write(rowno, row, f, data, [], images)
+                    asynctask.increment_progress_value(dbo)
+                configuration.csv_import_progress(dbo, "%s:%d" % (filehash, chunk[-1][0]))
+            for rowno, row, animalid, data in images:
+                attach_image(rowno, row, animalid, data, errors)
+            return True
+        except CancelledChunk:
+            return False
+        except (ErrorInChunk, dbms.base.TransactionFailedError):
+            al.warn("rows %d-%d had errors, writing them again one at a time" % (chunk[0][0], chunk[-1][0]), "csvimport.csvimport", dbo)
+            asynctask.set_progress_value(dbo, progress)
+        for (rowno, row), data in zip(chunk, imagedata):
+            if asynctask.get_cancel(dbo): return False
+            write(rowno, row, prepare(row), data, errors)
+            configuration.csv_import_progress(dbo, "%s:%d" % (filehash, rowno))
+            asynctask.increment_progress_value(dbo)
+        return True
 
-    h = [ "<p>%d success, %d errors</p><table>" % (len(data) - len(errors), len(errors)) ]
+    # First pass, count the rows and find the lookup values they use,
+    # adding any that are missing
+    lk = LookupResolver(dbo, createmissinglookups)
+    total = 0
+    for row in csv_rows(csvdata, encoding, cols):
+        prepare(row)
+        total += 1
+    al.debug("reading CSV data, found %d rows" % total, "csvimport.csvimport", dbo)
+
+    # If we're clearing down tables first, do it now
+    if cleartables:
+        al.warn("Resetting the database by removing all non-lookup data", "csvimport.csvimport", dbo)
+        dbupdate.reset_db(dbo)
+
+    lk.create_missing()
+
+    # If this file was being imported before and didn't finish, carry on
+    # after the last row that was committed
+    filehash = utils.md5_hash(csvdata)
+    resumefrom = 0
+    progress = configuration.csv_import_progress(dbo).split(":")
+    if not cleartables and len(progress) == 2 and progress[0] == filehash:
+        resumefrom = utils.cint(progress[1])
+        al.info("resuming import of CSV file after row %d" % resumefrom, "csvimport.csvimport", dbo)
+
+    # Second pass, write the rows in chunks
+    errors = []
+    asynctask.set_progress_max(dbo, total)
+    asynctask.set_progress_value(dbo, resumefrom)
+    chunk = []
+    cancelled = False
+    for rowno, row in enumerate(csv_rows(csvdata, encoding, cols), 1):
+        if rowno <= resumefrom: continue
+        chunk.append( (rowno, row) )
+        if len(chunk) == CHUNK_SIZE:
+            cancelled = not write_chunk(chunk, errors)
+            chunk = []
+            if cancelled: break
+    if not cancelled and len(chunk) > 0:
+        cancelled = not write_chunk(chunk, errors)
+    if not cancelled:
+        configuration.csv_import_progress(dbo, "")
+
+    h = [ "<p>%d success, %d errors</p><table>" % (total - resumefrom - len(errors), len(errors)) ]
+    if resumefrom > 0:
+        h.insert(0, "<p>Resumed after row %d</p>" % resumefrom)
     for rowno, row, err in errors:
         h.append("<tr><td>%s</td><td>%s</td><td>%s</td></tr>" % (rowno, row, err))
     h.append("</table>")
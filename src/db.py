@@ -1,6 +1,7 @@
 #!/usr/bin/python
 
 import dbms.hsqldb, dbms.mysql, dbms.postgresql, dbms.sqlite, dbms.db2
+import dbms.pool
 import smcom
 
 from sitedefs import DB_TYPE, MULTIPLE_DATABASES, MULTIPLE_DATABASES_MAP, MULTIPLE_DATABASES_TYPE
@@ -33,6 +34,10 @@ def get_database(alias = ""):
         dbo = get_dbo()
     return dbo
 
+def get_pool_stats():
+    """ Returns a list of statistics for the connection pools in this process """
+    return dbms.pool.get_stats()
+
 def _get_multiple_database_info(alias):
     """ Gets the Database object for the alias in our map MULTIPLE_DATABASES_MAP. """
     if alias not in MULTIPLE_DATABASES_MAP:
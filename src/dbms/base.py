@@ -3,13 +3,16 @@
 import al
 import audit
 import cachemem
+import copy
 import datetime
 import i18n
+import pool
 import sys
+import threading
 import time
 import utils
 
-from sitedefs import DB_TYPE, DB_HOST, DB_PORT, DB_USERNAME, DB_PASSWORD, DB_NAME, DB_HAS_ASM2_PK_TABLE, DB_DECODE_HTML_ENTITIES, DB_EXEC_LOG, DB_EXPLAIN_QUERIES, DB_TIME_QUERIES, DB_TIME_LOG_OVER, DB_TIMEOUT, CACHE_COMMON_QUERIES
+from sitedefs import DB_TYPE, DB_HOST, DB_PORT, DB_USERNAME, DB_PASSWORD, DB_NAME, DB_HAS_ASM2_PK_TABLE, DB_DECODE_HTML_ENTITIES, DB_EXEC_LOG, DB_EXPLAIN_QUERIES, DB_TIME_QUERIES, DB_TIME_LOG_OVER, DB_TIMEOUT, DB_POOL_SIZE, DB_STREAM_BATCH_SIZE, DB_BULK_BATCH_SIZE, CACHE_COMMON_QUERIES
 
 class ResultRow(dict):
     """
@@ -99,6 +102,50 @@ class QueryBuilder(object):
     def params(self):
         return self.values
 
+# Open transactions for the current thread, id(dbo) -> Transaction
+transactions = threading.local()
+
+class TransactionFailedError(Exception):
+    """ Raised when a transaction is committed after one of its statements
+        failed, as the work has been rolled back instead """
+    pass
+
+class Transaction(object):
+    """
+    A unit of work on a Database. Use via Database.transaction() as 
+    a context manager:
+
+    with dbo.transaction():
+        dbo.insert(...)
+        dbo.update(...)
+
+    All statements inside the block share a single connection and
+    are committed together when the block exits, or rolled back if
+    it raises an exception. Nested transactions on the same dbo join
+    the outermost one. If a statement fails or a nested transaction is
+    rolled back, the whole transaction is marked as failed and will be
+    rolled back when it ends, even if the exception was caught.
+    """
+    connection = None
+    depth = 0
+    failed = False
+
+    def __init__(self, dbo):
+        self.dbo = dbo
+        self.state = {}
+        self.reserved = {} # table -> IDs allocated by Database.reserve_ids and not yet used
+
+    def __enter__(self):
+        self.dbo.transaction_begin(self)
+        return self.dbo
+
+    def __exit__(self, exctype, excvalue, tb):
+        if exctype is None:
+            self.dbo.transaction_commit()
+        else:
+            self.dbo.transaction_rollback()
+        return False
+
 class Database(object):
     """
     Object that handles all interactions with the database.
@@ -122,6 +169,9 @@ class Database(object):
     is_large_db = False
     timeout = DB_TIMEOUT
     connection = None
+    pool_size = DB_POOL_SIZE
+    max_params = 32767 # The most substitution parameters we send in one statement
+    like_ignores_case = False # True if LIKE comparisons are case insensitive
 
     type_shorttext = "VARCHAR(1024)"
     type_longtext = "TEXT"
@@ -134,14 +184,71 @@ class Database(object):
         """ Virtual: Connect to the database and return the connection """
         pass
 
+    def clone(self):
+        """ Returns a copy of this dbo for another thread to use. The copy 
+            doesn't share any cached connection (see cursor_open), so
+            its statements use the pool or their own connections. """
+        dbo = copy.copy(self)
+        dbo.connection = None
+        return dbo
+
+    def connection_check(self, c):
+        """ Health check for a pooled connection that has been idle. 
+            Should throw an exception if the connection is unusable.
+        """
+        s = c.cursor()
+        try:
+            s.execute("SELECT 1")
+            s.fetchall()
+        finally:
+            s.close()
+
+    def connection_commit(self, c):
+        """ Commits connection c, unless it belongs to an open transaction,
+            which commits everything when it ends. """
+        tx = self.get_transaction()
+        if tx is not None and tx.connection is c: return
+        c.commit()
+
+    def connection_rollback(self, c):
+        """ Rolls back connection c, unless it belongs to an open transaction,
+            which rolls back everything if the exception reaches it. """
+        tx = self.get_transaction()
+        if tx is not None and tx.connection is c:
+            tx.failed = True
+            return
+        c.rollback()
+
+    def connection_state(self, c):
+        """ Returns a dict that persists for the lifetime of connection c,
+            so that subclasses can remember session settings they have
+            applied to pooled connections. Unpooled connections get a fresh
+            dict every time (or one for the life of a transaction).
+        """
+        tx = self.get_transaction()
+        if tx is not None and tx.connection is c:
+            return tx.state
+        if self.connection is None and self.pool_size > 0:
+            return pool.get_pool(self).get_state(c)
+        return {}
+
     def cursor_open(self):
         """ Returns a tuple containing an open connection and cursor.
             If the dbo object contains an active connection, we'll just use
             that to get a cursor to save time.
+            If pooling is on (pool_size > 0), the connection is checked out
+            from the pool for this dbo's connection info.
         """
-        if self.connection is not None:
+        tx = self.get_transaction()
+        if tx is not None and tx.connection is not None:
+            c = tx.connection
+            s = c.cursor()
+        elif self.connection is not None:
             c = self.connection
             s = self.connection.cursor()
+        elif self.pool_size > 0:
+            c = pool.get_pool(self).checkout(self)
+            s = c.cursor()
         else:
             c = self.connect()
             s = c.cursor()
@@ -151,17 +258,31 @@ class Database(object):
         """ Closes a connection and cursor pair. If self.connection exists, then
             c must be it, so don't close it. Connection caching in this object
             is done by processes called via cron.py as they do not use pooling.
+            Pooled connections are returned to the pool instead of closed.
+            The connection for an open transaction is left open until it ends.
         """
         try:
             s.close()
         except:
             pass
+        tx = self.get_transaction()
+        if tx is not None and tx.connection is c:
+            return
         if self.connection is None:
+            if self.pool_size > 0 and pool.get_pool(self).checkin(c): 
+                return
             try:
                 c.close()
             except:
                 pass
 
+    def cursor_stream(self, c, shared):
+        """ Virtual: Returns a cursor on connection c for reading a large
+            resultset a batch at a time (a server side cursor if the driver has one).
+            shared is True if other queries may run on c while the cursor is open.
+        """
+        return c.cursor()
+
     def ddl_add_column(self, table, column, coltype):
         return "ALTER TABLE %s ADD %s %s" % (table, column, coltype)
 
@@ -282,8 +403,7 @@ class Database(object):
             else:
                 s.execute(sql)
             rv = s.rowcount
-            c.commit()
-            self.cursor_close(c, s)
+            self.connection_commit(c)
             self._log_sql(sql, params)
             return rv
         except Exception as err:
@@ -292,7 +412,7 @@ class Database(object):
             try:
                 # An error can leave a connection in unusable state, 
                 # rollback any attempted changes.
-                c.rollback()
+                self.connection_rollback(c)
             except:
                 pass
             raise err
@@ -326,8 +446,7 @@ class Database(object):
             sql = self.switch_param_placeholder(sql)
             s.executemany(sql, params)
             rv = s.rowcount
-            c.commit()
-            self.cursor_close(c, s)
+            self.connection_commit(c)
             return rv
         except Exception as err:
             al.error(str(err), "Database.execute_many", self, sys.exc_info())
@@ -335,7 +454,7 @@ class Database(object):
             try:
                 # An error can leave a connection in unusable state, 
                 # rollback any attempted changes.
-                c.rollback()
+                self.connection_rollback(c)
             except:
                 pass
             raise err
@@ -352,6 +471,8 @@ class Database(object):
 
     def get_id(self, table):
         """ Returns the next ID for a table """
+        reserved = self.take_reserved_ids(table, 1)
+        if len(reserved) > 0: return reserved[0]
         nextid = self.get_id_max(table)
         self.update_asm2_primarykey(table, nextid)
         al.debug("get_id: %s -> %d (max)" % (table, nextid), "Database.get_id", self)
@@ -361,6 +482,39 @@ class Database(object):
         """ Returns the next ID for a table using MAX(ID) """
         return self.query_int("SELECT MAX(ID) FROM %s" % table) + 1
 
+    def get_ids(self, table, count):
+        """ Returns a list of the next count IDs for a table """
+        reserved = self.take_reserved_ids(table, count)
+        count -= len(reserved)
+        if count == 0: return reserved
+        nextid = self.get_id_max(table)
+        self.update_asm2_primarykey(table, nextid + count - 1)
+        al.debug("get_ids: %s -> %d-%d (max)" % (table, nextid, nextid + count - 1), "Database.get_ids", self)
+        return reserved + range(nextid, nextid + count)
+
+    def reserve_ids(self, table, count):
+        """ Allocates the next count IDs for a table together with get_ids and
+            keeps them for the open transaction, get_id and get_ids hand them out
+            before allocating any more. Reserved IDs that haven't been used when 
+            the transaction ends are discarded. Does nothing outside a transaction.
+        """
+        tx = self.get_transaction()
+        if tx is None or count <= 0: return
+        tx.reserved[table] = self.get_ids(table, count)
+
+    def take_reserved_ids(self, table, count):
+        """ Removes and returns up to count of the IDs reserved for a table by reserve_ids """
+        tx = self.get_transaction()
+        if tx is None or len(tx.reserved.get(table, [])) == 0: return []
+        reserved = tx.reserved[table]
+        ids = reserved[0:count]
+        del reserved[0:count]
+        return ids
+
+    def get_transaction(self):
+        """ Returns the open Transaction for this dbo in the current thread or None """
+        return getattr(transactions, "open", {}).get(id(self))
+
     def get_query_builder(self):
         return QueryBuilder(self)
 
@@ -378,7 +532,8 @@ class Database(object):
     def has_structure(self):
         """ Returns True if the current DB has an animal table """
         try:
-            self.execute("select count(*) from animal")
+            # Selects no rows, so costs the same however big the table is
+            self.query("SELECT ID FROM animal WHERE 1=0")
             return True
         except:
             return False
@@ -412,6 +567,48 @@ class Database(object):
             audit.create(self, user, table, iid, audit.get_parent_links(values, table), audit.dump_row(self, table, iid))
         return iid
 
+    def insert_many(self, table, rows, user="", generateID=True, setOverrideDBLock=False, setRecordVersion=True, setCreated=True, writeAudit=True, batchsize=DB_BULK_BATCH_SIZE):
+        """ Inserts many rows into a table in one transaction. 
+            The IDs for all the rows are allocated together, rows with the same 
+            columns are sent batchsize at a time as multi-row INSERT statements
+            and the audit records are written in bulk afterwards.
+            rows: A list of dicts of column names with values
+            The other arguments are as for insert
+            Returns a list of the IDs of the inserted records, in the same order as rows
+        """
+        if len(rows) == 0: return []
+        ids = [ 0 ] * len(rows)
+        if generateID:
+            ids = self.get_ids(table, len(rows))
+        now = self.now()
+        recordversion = self.get_recordversion()
+        groups = {}
+        for i, values in enumerate(rows):
+            if user != "" and setCreated:
+                values["CreatedBy"] = user
+                values["LastChangedBy"] = user
+                values["CreatedDate"] = now
+                values["LastChangedDate"] = now
+                if setRecordVersion: values["RecordVersion"] = recordversion
+            if generateID:
+                values["ID"] = ids[i]
+            elif "ID" in values:
+                ids[i] = values["ID"]
+            values = self.encode_str_before_write(values)
+            cols = tuple(sorted(values.iterkeys()))
+            groups.setdefault(cols, []).append([ values[k] for k in cols ])
+        with self.transaction():
+            for cols, params in groups.iteritems():
+                perstatement = max(1, min(batchsize, self.max_params / len(cols)))
+                placeholders = "(%s)" % ",".join("?" * len(cols))
+                for start in range(0, len(params), perstatement):
+                    chunk = params[start:start+perstatement]
+                    sql = "INSERT INTO %s (%s) VALUES %s" % ( table, ",".join(cols), ",".join([ placeholders ] * len(chunk)) )
+                    self.execute(sql, [ v for p in chunk for v in p ], override_lock=setOverrideDBLock)
+            if writeAudit and user != "":
+                audit.create_rows(self, user, table, self.query_rows(table, [ x for x in ids if x != 0 ]))
+        return ids
+
     def update(self, table, where, values, user="", setOverrideDBLock=False, setRecordVersion=True, setLastChanged=True, writeAudit=True):
         """ Updates a row in a table.
             table: The table to update
@@ -441,6 +638,40 @@ class Database(object):
             audit.edit(self, user, table, iid, audit.get_parent_links(values, table), audit.map_diff(preaudit, postaudit))
         return rows_affected
 
+    def update_many(self, table, rows, user="", setOverrideDBLock=False, setRecordVersion=True, setLastChanged=True, writeAudit=True):
+        """ Updates many rows in a table by ID in one transaction.
+            Rows that set the same columns are sent together with executemany
+            and the audit records are written in bulk afterwards.
+            rows: A list of ( ID, dict of column names with values ) tuples
+            The other arguments are as for update
+            returns the number of rows updated
+        """
+        if len(rows) == 0: return 0
+        now = self.now()
+        recordversion = self.get_recordversion()
+        groups = {}
+        links = {}
+        for iid, values in rows:
+            if user != "" and setLastChanged:
+                values["LastChangedBy"] = user
+                values["LastChangedDate"] = now
+                if setRecordVersion: values["RecordVersion"] = recordversion
+            values = self.encode_str_before_write(values)
+            cols = tuple(sorted(values.iterkeys()))
+            groups.setdefault(cols, []).append([ values[k] for k in cols ] + [ iid ])
+            links[iid] = audit.get_parent_links(values, table)
+        audited = writeAudit and user != ""
+        if audited: 
+            preaudit = dict( (r.id, r) for r in self.query_rows(table, links.keys()) )
+        rows_affected = 0
+        with self.transaction():
+            for cols, params in groups.iteritems():
+                sql = "UPDATE %s SET %s WHERE ID=?" % ( table, ",".join( ["%s=?" % x for x in cols] ) )
+                rows_affected += self.execute_many(sql, params, override_lock=setOverrideDBLock) or 0
+            if audited:
+                audit.edit_rows(self, user, table, links, preaudit, self.query_rows(table, links.keys()))
+        return rows_affected
+
     def delete(self, table, where, user="", writeAudit=True):
         """ Deletes row ID=iid from table 
             table: The table to delete from
@@ -532,7 +763,7 @@ class Database(object):
                 s.execute(sql, params)
             else:
                 s.execute(sql)
-            c.commit()
+            self.connection_commit(c)
             d = s.fetchall()
             l = []
             cols = []
@@ -554,7 +785,6 @@ class Database(object):
                         l.append(rowmap)
                 else:
                     l.append(rowmap)
-            self.cursor_close(c, s)
             if DB_TIME_QUERIES:
                 tt = time.time() - start
                 if tt > DB_TIME_LOG_OVER:
@@ -563,6 +793,12 @@ class Database(object):
         except Exception as err:
             al.error(str(err), "Database.query", self, sys.exc_info())
             al.error("failing sql: %s %s" % (sql, params), "Database.query", self)
+            try:
+                # An error can leave a pooled connection in an unusable 
+                # state, rollback so it can be reused.
+                self.connection_rollback(c)
+            except:
+                pass
             raise err
         finally:
             try:
@@ -601,16 +837,21 @@ class Database(object):
                 s.execute(sql, params)
             else:
                 s.execute(sql)
-            c.commit()
+            self.connection_commit(c)
             # Build a list of the column names
             cn = []
             for col in s.description:
                 cn.append(col[0].upper())
-            self.cursor_close(c, s)
             return cn
         except Exception as err:
             al.error(str(err), "Database.query_columns", self, sys.exc_info())
             al.error("failing sql: %s %s" % (sql, params), "Database.query_columns", self)
+            try:
+                # An error can leave a pooled connection in an unusable 
+                # state, rollback so it can be reused.
+                self.connection_rollback(c)
+            except:
+                pass
             raise err
         finally:
             try:
@@ -631,42 +872,11 @@ class Database(object):
         return "\n".join(o)
 
     def query_generator(self, sql, params=None):
-        """ Runs the query given and returns the resultset as a list of dictionaries. 
+        """ Runs the query given and returns the resultset as a generator of dictionaries. 
             All fieldnames are uppercased when returned. 
-            generator function version that uses a forward cursor.
+            Kept for compatibility, see query_stream.
         """
-        try:
-            c, s = self.cursor_open()
-            # Run the query and retrieve all rows
-            if params:
-                sql = self.switch_param_placeholder(sql)
-                s.execute(sql, params)
-            else:
-                s.execute(sql)
-            c.commit()
-            cols = []
-            # Get the list of column names
-            for i in s.description:
-                cols.append(i[0].upper())
-            row = s.fetchone()
-            while row:
-                # Intialise a map for each row
-                rowmap = {}
-                for i in range(0, len(row)):
-                    v = self.encode_str_after_read(row[i])
-                    rowmap[cols[i]] = v
-                yield rowmap
-                row = s.fetchone()
-            self.cursor_close(c, s)
-        except Exception as err:
-            al.error(str(err), "Database.query_generator", self, sys.exc_info())
-            al.error("failing sql: %s %s" % (sql, params), "Database.query_generator", self)
-            raise err
-        finally:
-            try:
-                self.cursor_close(c, s)
-            except:
-                pass
+        return self.query_stream(sql, params)
 
     def query_named_params(self, sql, params, age=0):
         """ Allows use of :named :params in a query (must terminate with space, comma or right parentheses). params should be a dict. 
@@ -699,6 +909,16 @@ class Database(object):
         """ Returns the complete table row with ID=iid """
         return self.query("SELECT * FROM %s WHERE ID=%s" % (table, iid))
 
+    def query_rows(self, table, ids):
+        """ Returns the complete table rows with IDs in the list ids,
+            querying max_params IDs at a time """
+        rows = []
+        ids = [ int(x) for x in ids ]
+        for start in range(0, len(ids), self.max_params):
+            chunk = ids[start:start+self.max_params]
+            rows += self.query("SELECT * FROM %s WHERE ID IN (%s)" % (table, ",".join([ str(x) for x in chunk ])))
+        return rows
+
     def query_to_insert_sql(self, sql, table, escapeCR = ""):
         """
         Generator function that Writes an INSERT query for the list of rows 
@@ -708,6 +928,79 @@ class Database(object):
         for r in self.query_generator(sql):
             yield self.row_to_insert_sql(table, r, escapeCR)
 
+    def query_stream(self, sql, params=None, distincton="", batchsize=DB_STREAM_BATCH_SIZE):
+        """ Runs the query given and returns a generator of ResultRow objects,
+            so that large resultsets can be processed without holding them in memory.
+            Rows are fetched batchsize at a time, using a server side cursor where
+            the database supports it. The connection is held until the generator
+            is exhausted or closed.
+            All fieldnames are uppercased when returned.
+            distincton: If set and the field exists, ignores any dups for this field (see query)
+        """
+        c = None
+        s = None
+        completed = False
+        try:
+            c, s = self.cursor_open()
+            tx = self.get_transaction()
+            shared = self.connection is not None or (tx is not None and tx.connection is c)
+            s.close()
+            s = self.cursor_stream(c, shared)
+            # Run the query
+            if params:
+                sql = self.switch_param_placeholder(sql)
+                s.execute(sql, params)
+            else:
+                s.execute(sql)
+            # Some server side cursors don't have a description until the first fetch
+            rows = s.fetchmany(batchsize)
+            if s.description is not None:
+                cols = []
+                # Get the list of column names
+                for i in s.description:
+                    cols.append(i[0].upper())
+                seendistinct = set()
+                while len(rows) > 0:
+                    for row in rows:
+                        rowmap = ResultRow()
+                        for i in range(0, len(row)):
+                            rowmap[cols[i]] = self.encode_str_after_read(row[i])
+                        # If a distinct on value has been set, skip duplicates
+                        if distincton != "" and distincton in rowmap:
+                            distinctval = rowmap[distincton]
+                            if distinctval in seendistinct: continue
+                            seendistinct.add(distinctval)
+                        yield rowmap
+                    rows = s.fetchmany(batchsize)
+            completed = True
+        except GeneratorExit:
+            # The caller stopped reading early
+            completed = True
+            raise
+        except Exception as err:
+            al.error(str(err), "Database.query_stream", self, sys.exc_info())
+            al.error("failing sql: %s %s" % (sql, params), "Database.query_stream", self)
+            raise err
+        finally:
+            if c is not None:
+                try:
+                    if s is not None: s.close()
+                except:
+                    pass
+                try:
+                    if completed:
+                        self.connection_commit(c)
+                    else:
+                        # An error can leave a pooled connection in an unusable 
+                        # state, rollback so it can be reused.
+                        self.connection_rollback(c)
+                except:
+                    pass
+                try:
+                    self.cursor_close(c, s)
+                except:
+                    pass
+
     def query_tuple(self, sql, params=None, limit=0):
         """ Runs the query given and returns the resultset
             as a tuple of tuples.
@@ -724,12 +1017,17 @@ class Database(object):
             else:
                 s.execute(sql)
             d = s.fetchall()
-            c.commit()
-            self.cursor_close(c, s)
+            self.connection_commit(c)
             return d
         except Exception as err:
             al.error(str(err), "Database.query_tuple", self, sys.exc_info())
             al.error("failing sql: %s %s" % (sql, params), "Database.query_tuple", self)
+            try:
+                # An error can leave a pooled connection in an unusable 
+                # state, rollback so it can be reused.
+                self.connection_rollback(c)
+            except:
+                pass
             raise err
         finally:
             try:
@@ -753,16 +1051,21 @@ class Database(object):
             else:
                 s.execute(sql)
             d = s.fetchall()
-            c.commit()
+            self.connection_commit(c)
             # Build a list of the column names
             cn = []
             for col in s.description:
                 cn.append(col[0].upper())
-            self.cursor_close(c, s)
             return (d, cn)
         except Exception as err:
             al.error(str(err), "Database.query_tuple_columns", self, sys.exc_info())
             al.error("failing sql: %s %s" % (sql, params), "Database.query_tuple_columns", self)
+            try:
+                # An error can leave a pooled connection in an unusable 
+                # state, rollback so it can be reused.
+                self.connection_rollback(c)
+            except:
+                pass
             raise err
         finally:
             try:
@@ -919,6 +1222,65 @@ class Database(object):
         """
         return sql.replace("?", "%s")
 
+    def transaction(self):
+        """ Returns a context manager that runs everything inside it
+            in a single transaction. See Transaction """
+        return Transaction(self)
+
+    def transaction_begin(self, newtx = None):
+        """ Starts a transaction for this dbo in the current thread, or
+            joins the one already open. Returns the open Transaction. """
+        tx = self.get_transaction()
+        if tx is None:
+            if not hasattr(transactions, "open"): transactions.open = {}
+            tx = newtx or Transaction(self)
+            c, s = self.cursor_open()
+            try:
+                s.close()
+            except:
+                pass
+            tx.connection = c
+            transactions.open[id(self)] = tx
+        tx.depth += 1
+        return tx
+
+    def transaction_commit(self):
+        """ Ends the current transaction level, committing if it is the outermost """
+        self.transaction_end(True)
+
+    def transaction_rollback(self):
+        """ Ends the current transaction level, rolling back if it is the outermost """
+        self.transaction_end(False)
+
+    def transaction_end(self, commit):
+        """ Ends the current transaction level. The outermost level commits or
+            rolls back. Raises TransactionFailedError if commit was requested
+            but the transaction failed and has been rolled back. """
+        tx = self.get_transaction()
+        if tx is None: return
+        tx.depth -= 1
+        if not commit: tx.failed = True
+        if tx.depth > 0: return
+        del transactions.open[id(self)]
+        c = tx.connection
+        try:
+            if commit and not tx.failed:
+                c.commit()
+            else:
+                c.rollback()
+                if commit:
+                    raise TransactionFailedError("transaction rolled back after an earlier error")
+        except Exception as err:
+            al.error(str(err), "Database.transaction_end", self, sys.exc_info())
+            try:
+                c.rollback()
+            except:
+                pass
+            raise err
+        finally:
+            # Release the connection as if it were a normal cursor pair
+            self.cursor_close(c, None)
+
     def unescape(self, s):
         """ unescapes query values """
         if s is None: return ""
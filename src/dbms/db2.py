@@ -37,6 +37,15 @@ class DatabaseDB2(Database):
     def connect(self):
         return ibm_db_dbi.connect("DSN=%s; HOSTNAME=%s; PORT=%s" % (self.database, self.host, self.port), user=self.username, password=self.password)
 
+    def connection_check(self, c):
+        """ Overridden as DB2 needs a table to select from """
+        s = c.cursor()
+        try:
+            s.execute("SELECT 1 FROM SYSIBM.SYSDUMMY1")
+            s.fetchall()
+        finally:
+            s.close()
+
     def ddl_add_index(self, name, table, column, unique = False, partial = False):
         u = ""
         if unique: u = "UNIQUE "
@@ -78,11 +87,18 @@ class DatabaseDB2(Database):
     def get_id(self, table):
         """ Returns the next ID for a table using sequences
         """
+        reserved = self.take_reserved_ids(table, 1)
+        if len(reserved) > 0: return reserved[0]
         nextid = self.query_int("VALUES NEXT VALUE FOR seq_%s" % table)
         al.debug("get_id: %s -> %d (sequence)" % (table, nextid), "DatabaseDB2.get_id", self)
         self.update_asm2_primarykey(table, nextid)
         return nextid
 
+    def get_ids(self, table, count):
+        """ Returns a list of the next count IDs for a table from its sequence
+        """
+        return [ self.get_id(table) for i in range(0, count) ]
+
     def query_explain(self, sql, params=None):
         """
         Runs an EXPLAIN query
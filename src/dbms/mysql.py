@@ -5,6 +5,7 @@ from base import Database
 
 try:
     import MySQLdb
+    import MySQLdb.cursors
 except:
     pass
 
@@ -15,6 +16,7 @@ class DatabaseMySQL(Database):
     type_datetime = "DATETIME"
     type_integer = "INTEGER"
     type_float = "DOUBLE"
+    like_ignores_case = True # with the default case insensitive collations
 
     def connect(self):
         if self.password != "":
@@ -23,12 +25,25 @@ class DatabaseMySQL(Database):
             return MySQLdb.connect(host=self.host, port=self.port, user=self.username, db=self.database, charset="utf8", use_unicode=True)
 
     def cursor_open(self):
-        """ Overridden to apply timeout """
+        """ Overridden to apply timeout (only once for pooled connections) """
         c, s = Database.cursor_open(self)
-        if self.timeout > 0: 
+        state = self.connection_state(c)
+        if self.timeout > 0 and state.get("timeout") != self.timeout: 
             s.execute("SET SESSION max_execution_time=%d" % self.timeout)
+            state["timeout"] = self.timeout
         return c, s
 
+    def connection_check(self, c):
+        """ Overridden to use the driver's ping """
+        c.ping()
+
+    def cursor_stream(self, c, shared):
+        """ Overridden to use an unbuffered cursor. MySQL can't run other
+            queries on the connection until it has been read to the end, 
+            so a shared connection gets a normal buffered cursor. """
+        if shared: return c.cursor()
+        return c.cursor(MySQLdb.cursors.SSCursor)
+
     def ddl_add_index(self, name, table, column, unique = False, partial = False):
         u = ""
         if unique: u = "UNIQUE "
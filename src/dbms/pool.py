@@ -0,0 +1,252 @@
+#!/usr/bin/python
+
+import al
+import threading
+import time
+
+from sitedefs import DB_POOL_CHECK_AFTER, DB_POOL_IDLE_TIMEOUT, DB_POOL_WAIT_TIMEOUT
+
+class PoolTimeoutError(Exception):
+    """ Raised when no connection becomes available within the wait timeout """
+    pass
+
+class ConnectionPool(object):
+    """
+    A thread safe pool of open connections to a single database.
+    Connections are checked out by Database.cursor_open and returned
+    by Database.cursor_close.
+    maxsize: The most connections (idle and in use) we will hold open
+    idletimeout: Idle connections older than this (seconds) are closed
+    checkafter: Connections idle for longer than this (seconds) are pinged
+                before being handed out again.
+    waittimeout: How long (seconds) to wait for a connection to be
+                 returned when maxsize are in use before giving up.
+    """
+    def __init__(self, key, maxsize, idletimeout = DB_POOL_IDLE_TIMEOUT, checkafter = DB_POOL_CHECK_AFTER, waittimeout = DB_POOL_WAIT_TIMEOUT):
+        self.key = key
+        self.maxsize = maxsize
+        self.idletimeout = idletimeout
+        self.checkafter = checkafter
+        self.waittimeout = waittimeout
+        self.cond = threading.Condition(threading.Lock())
+        self.idle = [] # list of [lastused, connection], most recently returned at the end
+        self.inuse = {} # id(connection) -> connection
+        self.opening = 0 # slots reserved by threads currently opening a new connection
+        self.state = {} # id(connection) -> dict of per-connection settings (eg: applied timeouts)
+        self.checkouts = 0
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.waittime = 0.0
+        self.evictions = 0
+        self.failedchecks = 0
+        self.timeouts = 0
+
+    def checkout(self, dbo):
+        """
+        Returns an open connection for dbo, reusing an idle one if
+        we have it, opening a new one if we are under maxsize or
+        waiting for one to be returned.
+        """
+        start = time.time()
+        waited = False
+        c = None
+        self.cond.acquire()
+        try:
+            while True:
+                self._evict_idle()
+                if len(self.idle) > 0:
+                    lastused, c = self.idle.pop()
+                    self.inuse[id(c)] = c
+                    break
+                if len(self.inuse) + self.opening < self.maxsize:
+                    # Reserve our slot while we connect outside the lock
+                    self.opening += 1
+                    break
+                remaining = self.waittimeout - (time.time() - start)
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeoutError("timed out after %ss waiting for a connection to %s" % (self.waittimeout, self._describe()))
+                waited = True
+                self.cond.wait(remaining)
+            self.checkouts += 1
+            if waited:
+                self.waits += 1
+                self.waittime += time.time() - start
+        finally:
+            self.cond.release()
+        if c is None:
+            return self._open(dbo)
+        if time.time() - lastused < self.checkafter or self._check(dbo, c):
+            self._count("hits")
+            return c
+        # The connection failed its health check, throw it away
+        # and open a new one in its place
+        self.cond.acquire()
+        try:
+            del self.inuse[id(c)]
+            self.opening += 1
+            self.failedchecks += 1
+        finally:
+            self.cond.release()
+        self._discard(c)
+        return self._open(dbo)
+
+    def checkin(self, c):
+        """
+        Returns connection c to the pool. Returns False if c
+        did not come from this pool.
+        """
+        self.cond.acquire()
+        try:
+            if id(c) not in self.inuse: return False
+            del self.inuse[id(c)]
+            self.cond.notify()
+            if len(self.inuse) + len(self.idle) < self.maxsize:
+                self.idle.append([time.time(), c])
+                return True
+        finally:
+            self.cond.release()
+        # The pool has shrunk or been closed since c was checked out
+        self._discard(c)
+        return True
+
+    def discard(self, c):
+        """ Removes connection c from the pool and closes it """
+        self.cond.acquire()
+        try:
+            if id(c) not in self.inuse: return False
+            del self.inuse[id(c)]
+            self.cond.notify()
+        finally:
+            self.cond.release()
+        self._discard(c)
+        return True
+
+    def owns(self, c):
+        """ Returns True if connection c is currently checked out of this pool """
+        return id(c) in self.inuse
+
+    def get_state(self, c):
+        """ Returns the dict of per-connection settings for c """
+        return self.state.setdefault(id(c), {})
+
+    def close_all(self):
+        """ Closes all idle connections (in use connections are closed as they are returned) """
+        self.cond.acquire()
+        try:
+            idle = self.idle
+            self.idle = []
+            self.maxsize = 0
+        finally:
+            self.cond.release()
+        for lastused, c in idle:
+            self._discard(c)
+
+    def stats(self):
+        """ Returns a dict of statistics for this pool """
+        hitrate = 0.0
+        if self.checkouts > 0: hitrate = float(self.hits) / self.checkouts
+        avgwait = 0.0
+        if self.waits > 0: avgwait = self.waittime / self.waits
+        return {
+            "key": self._describe(),
+            "maxsize": self.maxsize,
+            "idle": len(self.idle),
+            "inuse": len(self.inuse) + self.opening,
+            "checkouts": self.checkouts,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitrate": hitrate,
+            "waits": self.waits,
+            "waittime": self.waittime,
+            "avgwait": avgwait,
+            "evictions": self.evictions,
+            "failedchecks": self.failedchecks,
+            "timeouts": self.timeouts
+        }
+
+    def _check(self, dbo, c):
+        """ Health check for an idle connection, returns True if it's usable """
+        try:
+            dbo.connection_check(c)
+            return True
+        except Exception as err:
+            al.warn("discarding pooled connection: %s" % err, "ConnectionPool._check", dbo)
+            return False
+
+    def _describe(self):
+        return "%s:%s:%s:%s:%s" % self.key
+
+    def _discard(self, c):
+        self.state.pop(id(c), None)
+        try:
+            c.close()
+        except:
+            pass
+
+    def _evict_idle(self):
+        """ Closes any idle connections past the idle timeout. Must be called with the lock held. """
+        cutoff = time.time() - self.idletimeout
+        while len(self.idle) > 0 and self.idle[0][0] < cutoff:
+            lastused, c = self.idle.pop(0)
+            self.evictions += 1
+            self._discard(c)
+
+    def _count(self, counter):
+        """ Increments one of our statistics counters """
+        self.cond.acquire()
+        try:
+            setattr(self, counter, getattr(self, counter) + 1)
+        finally:
+            self.cond.release()
+
+    def _open(self, dbo):
+        """ Opens a new connection to fill the slot reserved by checkout """
+        try:
+            c = dbo.connect()
+        except:
+            self.cond.acquire()
+            try:
+                self.opening -= 1
+                self.cond.notify()
+            finally:
+                self.cond.release()
+            raise
+        self.cond.acquire()
+        try:
+            self.opening -= 1
+            self.inuse[id(c)] = c
+            self.misses += 1
+        finally:
+            self.cond.release()
+        return c
+
+pools = {}
+pools_lock = threading.Lock()
+
+def get_key(dbo):
+    """ Returns the pool key for a dbo """
+    return (dbo.dbtype, dbo.host, dbo.port, dbo.database, dbo.username)
+
+def get_pool(dbo):
+    """ Returns the pool for dbo's connection info, creating it if necessary """
+    key = get_key(dbo)
+    p = pools.get(key)
+    if p is not None: return p
+    with pools_lock:
+        if key not in pools:
+            pools[key] = ConnectionPool(key, dbo.pool_size)
+        return pools[key]
+
+def close_all():
+    """ Closes idle connections in all pools and forgets them """
+    with pools_lock:
+        for p in pools.values():
+            p.close_all()
+        pools.clear()
+
+def get_stats():
+    """ Returns a list of statistics dicts for every pool in this process """
+    return [ p.stats() for p in pools.values() ]
+
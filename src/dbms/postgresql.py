@@ -1,6 +1,7 @@
 #!/usr/bin/python
 
 import al
+import itertools
 from base import Database
 
 try:
@@ -10,6 +11,8 @@ try:
 except:
     pass
 
+stream_counter = itertools.count(1)
+
 class DatabasePostgreSQL(Database):
     type_shorttext = "VARCHAR(1024)"
     type_longtext = "TEXT"
@@ -23,13 +26,25 @@ class DatabasePostgreSQL(Database):
         c.set_client_encoding("UTF8")
         return c
 
+    def connection_check(self, c):
+        """ Overridden to also reject connections psycopg2 knows are closed """
+        if c.closed: raise Exception("connection is closed")
+        Database.connection_check(self, c)
+
     def cursor_open(self):
-        """ Overridden to apply timeout """
+        """ Overridden to apply timeout (only once for pooled connections) """
         c, s = Database.cursor_open(self)
-        if self.timeout > 0:
+        state = self.connection_state(c)
+        if self.timeout > 0 and state.get("timeout") != self.timeout:
             s.execute("SET statement_timeout=%d" % self.timeout)
+            state["timeout"] = self.timeout
         return c, s
 
+    def cursor_stream(self, c, shared):
+        """ Overridden to use a named (server side) cursor. WITH HOLD keeps
+            it open if something else commits on the connection while we read. """
+        return c.cursor(name="asm_stream_%d" % next(stream_counter), withhold=shared)
+
     def ddl_add_index(self, name, table, column, unique = False, partial = False):
         u = ""
         if unique: u = "UNIQUE "
@@ -60,11 +75,25 @@ class DatabasePostgreSQL(Database):
     def get_id(self, table):
         """ Returns the next ID for a table using Postgres sequences
         """
+        reserved = self.take_reserved_ids(table, 1)
+        if len(reserved) > 0: return reserved[0]
         nextid = self.query_int("SELECT nextval('seq_%s')" % table)
         self.update_asm2_primarykey(table, nextid)
         al.debug("get_id: %s -> %d (sequence)" % (table, nextid), "DatabasePostgreSQL.get_id", self)
         return nextid
 
+    def get_ids(self, table, count):
+        """ Returns a list of the next count IDs for a table, taking them
+            from the Postgres sequence in one query
+        """
+        reserved = self.take_reserved_ids(table, count)
+        count -= len(reserved)
+        if count == 0: return reserved
+        ids = [ r[0] for r in self.query_tuple("SELECT nextval('seq_%s') FROM generate_series(1, %d)" % (table, count)) ]
+        self.update_asm2_primarykey(table, max(ids))
+        al.debug("get_ids: %s -> %d ids (sequence)" % (table, count), "DatabasePostgreSQL.get_ids", self)
+        return reserved + ids
+
     def install_stored_procedures(self):
         """ Extra PG report procedures to cast a value to date and integer while ignoring errors """
         self.execute_dbupdate(\
@@ -14,9 +14,12 @@ class DatabaseSQLite3(Database):
     type_datetime = "TIMESTAMP"
     type_integer = "INTEGER"
     type_float = "REAL"
+    max_params = 999 # SQLITE_MAX_VARIABLE_NUMBER for versions before 3.32
+    like_ignores_case = True # for ASCII characters
    
     def connect(self):
-        return sqlite3.connect(self.database, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+        # Pooled connections are handed to one thread at a time, but not always the same one
+        return sqlite3.connect(self.database, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES, check_same_thread=self.pool_size == 0)
 
     def sql_greatest(self, items):
         """ SQLite does not have a GREATEST() function, MAX() should be used instead """
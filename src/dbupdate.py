@@ -2,8 +2,8 @@
 
 import al
 import animal, animalcontrol, financial, lostfound, medical, movement, onlineform, person, waitinglist
-import configuration, db, dbfs, smcom, utils
-import os, sys, base64
+import configuration, db, dbfs, lookups, smcom, template, utils
+import os, sys, base64, time
 from i18n import _
 
 VERSIONS = ( 
@@ -24,11 +24,18 @@ VERSIONS = (
     34002, 34003, 34004, 34005, 34006, 34007, 34008, 34009, 34010, 34011, 34012,
     34013, 34014, 34015, 34016, 34017, 34018, 34019, 34020, 34021, 34022, 34100,
     34101, 34102, 34103, 34104, 34105, 34106, 34107, 34108, 34109, 34110, 34111,
-    34112, 34200, 34201, 34202
+    34112, 34200, 34201, 34202, 34203
 )
 
 LATEST_VERSION = VERSIONS[-1]
 
+# Databases this process has checked are fully installed and up to date,
+# database -> (version, time checked)
+schema_verified = {}
+
+# How long (seconds) before a verified database is checked again
+SCHEMA_VERIFIED_TTL = 300
+
 # All ASM3 tables
 TABLES = ( "accounts", "accountsrole", "accountstrx", "additional", "additionalfield",
     "adoption", "animal", "animalcontrol", "animalcontrolanimal", "animalcontrolrole", "animalcost", 
@@ -39,7 +46,7 @@ TABLES = ( "accounts", "accountsrole", "accountstrx", "additional", "additionalf
     "basecolour", "breed", "citationtype", "clinicappointment", "clinicinvoiceitem", "configuration", 
     "costtype", "customreport", "customreportrole", "dbfs", "deathreason", "deletion", "diary", 
     "diarytaskdetail", "diarytaskhead", "diet", "donationpayment", "donationtype", 
-    "entryreason", "incidentcompleted", "incidenttype", "internallocation", "jurisdiction", "licencetype", "lkanimalflags", "lkcoattype", 
+    "emailqueue", "entryreason", "incidentcompleted", "incidenttype", "internallocation", "jurisdiction", "licencetype", "lkanimalflags", "lkcoattype", 
     "lkownerflags", "lksaccounttype", "lksclinicstatus", "lksdiarylink", "lksdonationfreq", "lksex", 
     "lksfieldlink", "lksfieldtype", "lksize", "lksloglink", "lksmedialink", "lksmediatype", "lksmovementtype", "lksposneg", "lksrotatype", 
     "lksyesno", "lksynun", "lkurgency", "lkworktype", "log", "logtype", "media", "medicalprofile", "messages", "onlineform", 
@@ -913,6 +920,25 @@ def sql_structure(dbo):
         fstr("PaymentDescription", True),
         fint("IsRetired", True) ), False)
 
+    sql += table("emailqueue", (
+        fid(),
+        fdate("QueueDateTime"),
+        fstr("ReplyTo"),
+        flongstr("ToAddress", False),
+        flongstr("CCAddress"),
+        flongstr("BCCAddress"),
+        flongstr("Subject"),
+        flongstr("Body"),
+        fstr("ContentType"),
+        fint("Status"),
+        fint("Attempts"),
+        fdate("NextAttemptDateTime"),
+        fdate("ClaimedUntil", True),
+        fdate("SentDateTime", True),
+        flongstr("LastError") ), False)
+    sql += index("emailqueue_Status", "emailqueue", "Status,NextAttemptDateTime")
+    sql += index("emailqueue_QueueDateTime", "emailqueue", "QueueDateTime")
+
     sql += table("entryreason", (
         fid(),
         fstr("ReasonName"),
@@ -2350,6 +2376,7 @@ def install_db_views(dbo):
 
     # Set us upto date to stop race condition/other clients trying to install
     configuration.db_view_seq_version(dbo, str(LATEST_VERSION))
+    clear_schema_verified(dbo)
     create_view("v_adoption", movement.get_movement_query(dbo))
     create_view("v_animal", animal.get_animal_query(dbo))
     create_view("v_animalcontrol", animalcontrol.get_animalcontrol_query(dbo))
@@ -2453,6 +2480,7 @@ def install_default_templates(dbo, removeFirst = False):
         al.info("removing templates from templatehtml and templatedocument", "dbupdate.install_default_templates", dbo)
         dbo.execute_dbupdate("DELETE FROM templatedocument")
         dbo.execute_dbupdate("DELETE FROM templatehtml")
+        template.flush_document_templates(dbo)
     al.info("creating default templates", "dbupdate.install_default_templates", dbo)
     add_html_template_from_files("animalview")
     add_html_template_from_files("animalviewadoptable")
@@ -2502,6 +2530,7 @@ def install(dbo):
     install_db_stored_procedures(dbo)
     install_default_templates(dbo)
     install_default_onlineforms(dbo)
+    lookups.flush_lookups(dbo)
 
 def dump(dbo, includeConfig = True, includeDBFS = True, includeCustomReport = True, \
         includeNonASM2 = True, includeUsers = True, includeLKS = True, deleteDBV = False, deleteFirst = True, deleteViewSeq = False, \
@@ -2706,6 +2735,23 @@ def check_for_updates(dbo):
     dbv = int(configuration.dbv(dbo))
     return dbv < LATEST_VERSION
 
+def is_schema_verified(dbo):
+    """
+    Returns True if this process has checked within the last
+    SCHEMA_VERIFIED_TTL seconds that the database has its structure,
+    is on LATEST_VERSION and has views and sequences for it. 
+    """
+    v = schema_verified.get(dbo.database)
+    return v is not None and v[0] == LATEST_VERSION and time.time() - v[1] < SCHEMA_VERIFIED_TTL
+
+def set_schema_verified(dbo):
+    """ Records that the database has been checked and is up to date """
+    schema_verified[dbo.database] = (LATEST_VERSION, time.time())
+
+def clear_schema_verified(dbo):
+    """ Forgets that the database was checked, so it will be checked again """
+    schema_verified.pop(dbo.database, None)
+
 def check_for_view_seq_changes(dbo):
     """
     Checks to see whether we need to recreate our views and
@@ -2736,6 +2782,7 @@ def perform_updates(dbo):
     """
     # Lock the database - fail silently if we couldn't lock it
     if not configuration.db_lock(dbo): return ""
+    clear_schema_verified(dbo)
 
     try:
         # Go through our updates to see if any need running
@@ -2751,6 +2798,8 @@ def perform_updates(dbo):
                 # Update the version
                 configuration.dbv(dbo, str(v))
                 ver = v
+                # The update may have changed lookup data
+                lookups.flush_lookups(dbo)
         
         # Return the new db version
         configuration.db_unlock(dbo)
@@ -5024,3 +5073,24 @@ def update_34202(dbo):
     add_index(dbo, "animaltransport_TransportReference", "animaltransport", "TransportReference")
     dbo.execute_dbupdate("UPDATE animaltransport SET TransportReference=''")
 
+def update_34203(dbo):
+    # Add emailqueue table
+    fields = ",".join([
+        dbo.ddl_add_table_column("ID", dbo.type_integer, False, pk=True),
+        dbo.ddl_add_table_column("QueueDateTime", dbo.type_datetime, False),
+        dbo.ddl_add_table_column("ReplyTo", dbo.type_shorttext, False),
+        dbo.ddl_add_table_column("ToAddress", dbo.type_longtext, False),
+        dbo.ddl_add_table_column("CCAddress", dbo.type_longtext, True),
+        dbo.ddl_add_table_column("BCCAddress", dbo.type_longtext, True),
+        dbo.ddl_add_table_column("Subject", dbo.type_longtext, True),
+        dbo.ddl_add_table_column("Body", dbo.type_longtext, True),
+        dbo.ddl_add_table_column("ContentType", dbo.type_shorttext, False),
+        dbo.ddl_add_table_column("Status", dbo.type_integer, False),
+        dbo.ddl_add_table_column("Attempts", dbo.type_integer, False),
+        dbo.ddl_add_table_column("NextAttemptDateTime", dbo.type_datetime, False),
+        dbo.ddl_add_table_column("ClaimedUntil", dbo.type_datetime, True),
+        dbo.ddl_add_table_column("SentDateTime", dbo.type_datetime, True),
+        dbo.ddl_add_table_column("LastError", dbo.type_longtext, True) ])
+    dbo.execute_dbupdate( dbo.ddl_add_table("emailqueue", fields) )
+    add_index(dbo, "emailqueue_Status", "emailqueue", "Status,NextAttemptDateTime")
+    add_index(dbo, "emailqueue_QueueDateTime", "emailqueue", "QueueDateTime")
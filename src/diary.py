@@ -3,6 +3,7 @@
 import al
 import animal
 import configuration
+import emailqueue
 import i18n
 import lostfound
 import person
@@ -56,8 +57,8 @@ def email_uncompleted_upto_today(dbo):
                     totalforuser += 1
             if totalforuser > 0:
                 al.debug("got %d notes for user %s" % (totalforuser, u.username), "diary.email_uncompleted_upto_today", dbo)
-                utils.send_email(dbo, configuration.email(dbo), u.emailaddress, "", "", 
-                    i18n._("Diary notes for: {0}", l).format(i18n.python2display(l, dbo.now())), s, exceptions=False)
+                emailqueue.queue_email(dbo, configuration.email(dbo), u.emailaddress, "", "", 
+                    i18n._("Diary notes for: {0}", l).format(i18n.python2display(l, dbo.now())), s)
 
 def user_role_where_clause(dbo, user = "", includecreatedby = True):
     """
@@ -343,7 +344,11 @@ def execute_diary_task(dbo, username, tasktype, taskid, linkid, selecteddate):
     linktype = ANIMAL
     if tasktype == "ANIMAL": 
         linktype = ANIMAL
-        tags = wordprocessor.animal_tags(dbo, animal.get_animal(dbo, int(linkid)))
+        usedtags = set()
+        for d in dtd:
+            usedtags.update(wordprocessor.get_used_tags(fix(d["SUBJECT"])))
+            usedtags.update(wordprocessor.get_used_tags(fix(d["NOTE"])))
+        tags = wordprocessor.animal_tags(dbo, animal.get_animal(dbo, int(linkid)), usedtags=usedtags)
     elif tasktype == "PERSON": 
         linktype = PERSON
         tags = wordprocessor.person_tags(dbo, person.get_person(dbo, int(linkid)))
@@ -0,0 +1,158 @@
+#!/usr/bin/python
+
+"""
+A queue of outgoing email, kept in the emailqueue table of each database
+so that it survives the process that created it.
+
+Batches of email (mail merges, diary notes, report and fosterer emails)
+are added to the queue with queue_email and sent by process, which keeps
+one SMTP session open for all of them, sends at most EMAIL_QUEUE_RATE
+messages a second and retries failed messages with an increasing delay.
+Messages are claimed before they are sent so that two processes sending
+the queue at the same time won't send the same message twice.
+"""
+
+import al
+import asynctask
+import datetime
+import smtplib
+import threading
+import time
+import utils
+
+from sitedefs import EMAIL_QUEUE_RATE, EMAIL_QUEUE_MAX_ATTEMPTS, EMAIL_QUEUE_RETRY_DELAY, EMAIL_QUEUE_KEEP_DAYS
+
+# Status values for messages in the queue
+QUEUED = 0
+SENT = 1
+FAILED = 2
+
+# How many messages we read from the queue at a time
+BATCH_SIZE = 100
+
+# How long (seconds) a claimed message belongs to the process that claimed it
+CLAIM_TIMEOUT = 600
+
+# Databases being sent by this process
+processing = set()
+processing_lock = threading.Lock()
+
+def queue_email(dbo, replyadd, toadd, ccadd = "", bccadd = "", subject = "", body = "", contenttype = "plain"):
+    """
+    Adds an email to the queue, see utils.send_email for the arguments.
+    Returns the ID of the queued message.
+    """
+    return dbo.insert("emailqueue", {
+        "QueueDateTime":        dbo.now(),
+        "ReplyTo":              replyadd,
+        "ToAddress":            toadd,
+        "CCAddress":            ccadd,
+        "BCCAddress":           bccadd,
+        "Subject":              subject,
+        "Body":                 body,
+        "ContentType":          contenttype,
+        "Status":               QUEUED,
+        "Attempts":             0,
+        "NextAttemptDateTime":  dbo.now(),
+        "LastError":            ""
+    }, setOverrideDBLock=True, writeAudit=False)
+
+def get_queue_count(dbo):
+    """ Returns the number of messages waiting to be sent """
+    return dbo.query_int("SELECT COUNT(*) FROM emailqueue WHERE Status = ?", [QUEUED])
+
+def claim(dbo, mid):
+    """ Claims message mid for sending, returns False if someone else has it """
+    now = dbo.now()
+    return dbo.execute("UPDATE emailqueue SET ClaimedUntil = ? WHERE ID = ? AND Status = ? " \
+        "AND (ClaimedUntil Is Null OR ClaimedUntil < ?)",
+        ( now + datetime.timedelta(seconds=CLAIM_TIMEOUT), mid, QUEUED, now ), override_lock=True) == 1
+
+def sent(dbo, mid):
+    """ Marks message mid as sent """
+    dbo.execute("UPDATE emailqueue SET Status = ?, SentDateTime = ?, ClaimedUntil = Null, Attempts = Attempts + 1 WHERE ID = ?",
+        ( SENT, dbo.now(), mid ), override_lock=True)
+
+def failed(dbo, m, err):
+    """
+    Records that sending message row m failed with err. It is tried
+    again later unless the server refused it outright or it has
+    been tried EMAIL_QUEUE_MAX_ATTEMPTS times.
+    """
+    attempts = m.attempts + 1
+    status = QUEUED
+    if attempts >= EMAIL_QUEUE_MAX_ATTEMPTS or isinstance(err, (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused)):
+        status = FAILED
+    nextattempt = dbo.now() + datetime.timedelta(seconds=EMAIL_QUEUE_RETRY_DELAY * (2 ** (attempts - 1)))
+    dbo.execute("UPDATE emailqueue SET Status = ?, Attempts = ?, NextAttemptDateTime = ?, ClaimedUntil = Null, LastError = ? WHERE ID = ?",
+        ( status, attempts, nextattempt, utils.truncate(str(err), 1000), m.id ), override_lock=True)
+    al.error("failed sending queued email %d to %s (attempt %d): %s" % (m.id, m.toaddress, attempts, err), "emailqueue.failed", dbo)
+
+def process(dbo, progress = False):
+    """
+    Sends the messages in the queue that are due over one SMTP session.
+    If progress is set, progress is reported through asynctask and we
+    stop if the task is cancelled (unsent messages stay in the queue).
+    Does nothing if this process is already sending for the database.
+    Returns the number of messages sent.
+    """
+    with processing_lock:
+        if dbo.database in processing: return 0
+        processing.add(dbo.database)
+    sender = utils.EmailSender(dbo)
+    total = 0
+    try:
+        due = "Status = %d AND NextAttemptDateTime <= ? AND (ClaimedUntil Is Null OR ClaimedUntil < ?)" % QUEUED
+        if progress:
+            asynctask.set_progress_max(dbo, max(dbo.query_int("SELECT COUNT(*) FROM emailqueue WHERE %s" % due, ( dbo.now(), dbo.now() )), 1))
+        interval = 0.0
+        if EMAIL_QUEUE_RATE > 0: interval = 1.0 / EMAIL_QUEUE_RATE
+        nextsend = 0.0
+        lastid = 0
+        while True:
+            rows = dbo.query("SELECT * FROM emailqueue WHERE %s AND ID > ? ORDER BY ID %s" % (due, dbo.sql_limit(BATCH_SIZE)),
+                ( dbo.now(), dbo.now(), lastid ))
+            if len(rows) == 0: break
+            for m in rows:
+                lastid = m.id
+                if progress and asynctask.get_cancel(dbo):
+                    al.info("sending cancelled, %d messages left in the queue" % get_queue_count(dbo), "emailqueue.process", dbo)
+                    return total
+                if not claim(dbo, m.id): continue
+                wait = nextsend - time.time()
+                if wait > 0: time.sleep(wait)
+                nextsend = time.time() + interval
+                try:
+                    fromadd, tolist, msg = utils.build_email(dbo, m.replyto, m.toaddress, m.ccaddress, m.bccaddress, m.subject, m.body, m.contenttype)
+                    sender.send(fromadd, tolist, msg, m.bccaddress)
+                    sent(dbo, m.id)
+                    total += 1
+                except Exception as err:
+                    failed(dbo, m, err)
+                if progress: asynctask.increment_progress_value(dbo)
+        return total
+    finally:
+        sender.close()
+        with processing_lock:
+            processing.discard(dbo.database)
+        if total > 0: al.info("sent %d queued emails" % total, "emailqueue.process", dbo)
+
+def process_async(dbo, taskname = ""):
+    """
+    Sends the queue in the background. If taskname is given and no other
+    task is running for the database, the sending runs as an asynctask
+    with that name so its progress can be watched.
+    """
+    if taskname != "" and not asynctask.is_task_running(dbo):
+        asynctask.function_task(dbo, taskname, process, dbo, True)
+    else:
+        t = threading.Thread(target=process, args=(dbo,))
+        t.daemon = True
+        t.start()
+
+def delete_old_emails(dbo):
+    """ Removes sent and failed messages older than EMAIL_QUEUE_KEEP_DAYS """
+    count = dbo.execute("DELETE FROM emailqueue WHERE Status <> ? AND QueueDateTime < ?",
+        ( QUEUED, dbo.today(offset=EMAIL_QUEUE_KEEP_DAYS * -1) ))
+    al.debug("removed %d old messages from the email queue" % count, "emailqueue.delete_old_emails", dbo)
+
@@ -5,19 +5,47 @@
 """
 
 import al
-import cachemem
+import cachedisk
 import configuration
 import json
 import i18n
+import Queue
 import threading
 import time
 import utils
-from sitedefs import BASE_URL, GEO_PROVIDER, GEO_PROVIDER_KEY, GEO_LOOKUP_TIMEOUT, GEO_SLEEP_AFTER, GEO_SMCOM_URL
+from sitedefs import BASE_URL, GEO_BATCH_WORKERS, GEO_CACHE_TTL, GEO_PROVIDER, GEO_PROVIDER_KEY, GEO_LOOKUP_TIMEOUT, GEO_SLEEP_AFTER, GEO_SMCOM_URL
 
 GEO_NOMINATIM_URL = "https://nominatim.openstreetmap.org/search?format=json&street={street}&city={city}&state={state}&postalcode={zipcode}&country={country}"
 GEO_GOOGLE_URL = "https://maps.googleapis.com/maps/api/geocode/json?address={q}&sensor=false&key={key}"
 
-lat_long_lock = threading.Lock()
+# The most requests per second each provider's usage policy allows
+PROVIDER_RATES = { "nominatim": 1.0, "google": 50.0, "smcom": 10.0 }
+
+# How long to cache addresses that the provider could not find
+GEO_CACHE_NOT_FOUND_TTL = 86400
+
+limiters = {}
+limiters_lock = threading.Lock()
+
+class RateLimiter(object):
+    """
+    Spaces out calls to a provider so that they start at least
+    interval seconds apart, however many threads are making them.
+    Callers reserve the next free slot and wait for it outside
+    the lock, so waiting doesn't block other threads from queuing.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.nextslot = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """ Blocks until it's this caller's turn to call the provider """
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.nextslot)
+            self.nextslot = slot + self.interval
+        if slot > now: time.sleep(slot - now)
 
 class GeoProvider(object):
     """ Geocoding provider base class """
@@ -148,6 +176,8 @@ class Smcom(GeoProvider):
             return "0,0,%s" % h
 
 
+PROVIDERS = { "nominatim": Nominatim, "google": Google, "smcom": Smcom }
+
 def address_hash(address, town, county, postcode, country):
     """ Produces a hash of the address to include with latlon values """
     addrhash = "%s%s%s%s%s" % (address, town, county, postcode, country)
@@ -155,64 +185,126 @@ def address_hash(address, town, county, postcode, country):
     if len(addrhash) > 220: addrhash = addrhash[0:220]
     return addrhash
 
-def get_lat_long(dbo, address, town, county, postcode, country = ""):
+def get_cache_key(address, town, county, postcode, country):
+    """ Returns the key for an address in the geocode cache. Addresses that
+        only differ in case, spacing or punctuation share the same key. """
+    return "geo:" + utils.md5_hash(address_hash(address, town, county, postcode, country).lower())
+
+def get_limiter(provider):
+    """ Returns the rate limiter shared by all requests to provider """
+    with limiters_lock:
+        if provider not in limiters:
+            interval = GEO_SLEEP_AFTER
+            if interval <= 0: interval = 1.0 / PROVIDER_RATES.get(provider, 1.0)
+            limiters[provider] = RateLimiter(interval)
+        return limiters[provider]
+
+def get_default_country(dbo):
+    """ Returns the country set with the shelter details in settings, 
+        or the country from the user's locale if there isn't one """
+    country = configuration.organisation_country(dbo)
+    if country == "": country = i18n.get_country(dbo.locale)
+    return country
+
+def lookup(dbo, provider, address, town, county, postcode, country):
     """
-    Looks up a latitude and longitude from an address using the set geocoding provider 
-    and returns them as lat,long,hash
-    If no results were found, a zero lat and long are returned so that
-    we know not to try and look this up again until the address hash changes.
+    Returns a lat,long,hash value for an address from provider.
+    The geocode cache on disk is shared by all databases and checked 
+    first, only addresses that aren't in it are looked up with the
+    provider, waiting for the provider's rate limiter.
+    Returns None if the lookup failed.
     """
-
-    if address.strip() == "":
-        return None
-
     try:
-        # Synchronise this process to a single thread to prevent
-        # abusing our geo provider
-        lat_long_lock.acquire()
-
-        # Use the country passed. If no country was passed, check
-        # if one has been set with the shelter details in settings,
-        # otherwise use the country from the user's locale.
-        if country is None or country == "": 
-            country = configuration.organisation_country(dbo)
-            if country == "": country = i18n.get_country(dbo.locale)
-
-        g = None
-        if GEO_PROVIDER == "nominatim":
-            g = Nominatim(dbo, address, town, county, postcode, country)
-        elif GEO_PROVIDER == "google":
-            g = Google(dbo, address, town, county, postcode, country)
-        elif GEO_PROVIDER == "smcom":
-            g = Smcom(dbo, address, town, county, postcode, country)
-        else:
-            al.error("unrecognised geo provider: %s" % GEO_PROVIDER, "geo.get_lat_long", dbo)
+        if provider not in PROVIDERS:
+            al.error("unrecognised geo provider: %s" % provider, "geo.lookup", dbo)
             return None
+        g = PROVIDERS[provider](dbo, address, town, county, postcode, country)
 
-        # Check the cache in case we already requested this address
-        cachekey = "nom:" + g.q
-        v = cachemem.get(cachekey)
+        # The cache holds lat,long and the hash of this address is added to it
+        cachekey = get_cache_key(address, town, county, postcode, country)
+        v = cachedisk.get(cachekey)
         if v is not None:
-            al.debug("cache hit for address: %s = %s" % (cachekey, v), "geo.get_lat_long", dbo)
-            return v
+            al.debug("cache hit for address: %s = %s" % (g.q, v), "geo.lookup", dbo)
+            return "%s,%s" % (v, g.address_hash())
 
         # Call the service to get the data
+        get_limiter(provider).wait()
         g.search()
 
         # Parse the response to a lat/long value
         latlon = g.parse()
-        cachemem.put(cachekey, latlon, 86400)
-
-        if GEO_SLEEP_AFTER > 0:
-            time.sleep(GEO_SLEEP_AFTER)
-
+        v = ",".join(latlon.split(",")[0:2])
+        cachedisk.put(cachekey, v, v == "0,0" and GEO_CACHE_NOT_FOUND_TTL or GEO_CACHE_TTL)
         return latlon
 
     except Exception as err:
-        al.error(str(err), "geo.get_lat_long", dbo)
+        al.error(str(err), "geo.lookup", dbo)
+        return None
+
+def get_lat_long(dbo, address, town, county, postcode, country = ""):
+    """
+    Looks up a latitude and longitude from an address using the set geocoding provider 
+    and returns them as lat,long,hash
+    If no results were found, a zero lat and long are returned so that
+    we know not to try and look this up again until the address hash changes.
+    """
+
+    if address.strip() == "":
         return None
 
-    finally:
-        lat_long_lock.release()
+    # Use the country passed. If no country was passed, check
+    # if one has been set with the shelter details in settings,
+    # otherwise use the country from the user's locale.
+    if country is None or country == "": 
+        country = get_default_country(dbo)
 
+    return lookup(dbo, GEO_PROVIDER, address, town, county, postcode, country)
+
+def get_lat_longs(dbo, addresses, provider = GEO_PROVIDER, workers = GEO_BATCH_WORKERS):
+    """
+    Looks up the latitude and longitude for a list of addresses, 
+    each a tuple of (address, town, county, postcode, country).
+    Returns a list of lat,long,hash values in the same order, with
+    None for blank addresses and lookups that failed.
+    Addresses that share a cache key are only looked up once, the rest
+    are shared between worker threads that all wait on the provider's
+    rate limiter, so the provider's quota is never exceeded.
+    """
+    defaultcountry = None
+    pending = {} # cache key -> address to lookup
+    keys = []
+    for address, town, county, postcode, country in addresses:
+        if address is None or address.strip() == "":
+            keys.append(None)
+            continue
+        if country is None or country == "":
+            if defaultcountry is None: defaultcountry = get_default_country(dbo)
+            country = defaultcountry
+        key = get_cache_key(address, town, county, postcode, country)
+        keys.append(key)
+        if key not in pending: pending[key] = (address, town, county, postcode, country)
+    results = {}
+    q = Queue.Queue()
+    for key in pending.iterkeys():
+        q.put(key)
+    def worker():
+        while True:
+            try:
+                key = q.get_nowait()
+            except Queue.Empty:
+                return
+            results[key] = lookup(dbo, provider, *pending[key])
+    threads = [ threading.Thread(target=worker) for i in range(max(1, min(workers, len(pending)))) ]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    al.debug("looked up %d geocodes for %d addresses with %d threads" % (len(pending), len(addresses), len(threads)), "geo.get_lat_longs", dbo)
+    # Add the hash for each address to the lat,long looked up for its key
+    rv = []
+    for a, key in zip(addresses, keys):
+        if key is None or results[key] is None:
+            rv.append(None)
+        else:
+            # GeoProvider.address_hash leaves out the country
+            rv.append("%s,%s" % (",".join(results[key].split(",")[0:2]), address_hash(a[0], a[1], a[2], a[3], "")))
+    return rv
 
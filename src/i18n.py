@@ -1,13 +1,13 @@
 #!/usr/bin/python
 
 import datetime
+import hashlib
 import json
+import marshal
+import os
 import time
 import utils
 
-# flake8: noqa - we have a lot of locales and this is convenient
-from locales import *
-
 VERSION = "42u [Sun 14 Apr 09:48:49 BST 2019]"
 BUILD = "04140948"
 
@@ -134,9 +134,6 @@ locale_maps = {
     "tr":       ( "Turkish", "Turkey", DMY, "TL", PLURAL_ENGLISH, CURRENCY_PREFIX, 2, ",", " " )
 }
 
-def _(english, locale = "en"):
-    return translate(english, locale)
-
 def real_locale(locale = "en"):
     # Treat some locales as pointers to other locales with out the
     # need for a full translation:
@@ -168,39 +165,91 @@ def real_locale(locale = "en"):
         locale = "es"
     return locale
 
+# The folder holding the locale_*.py translation modules and their compiled catalogues
+LOCALES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "locales")
+
+# Bump if the compiled catalogue format changes
+CATALOGUE_FORMAT = 1
+
+# Loaded catalogues, locale -> dict of English phrase to translation.
+# Locales that share a real locale share the same dict and English is empty.
+catalogues = { "en": {} }
+
+def get_catalogue_filename(locale):
+    """ Returns the filename of the compiled catalogue for a real locale """
+    return os.path.join(LOCALES_DIR, "locale_%s.cat" % locale)
+
+def get_catalogue_source(locale):
+    """ Returns the contents of the translation module for a real locale or None if there isn't one """
+    if not locale or not locale.replace("_", "").isalpha(): return None
+    fname = os.path.join(LOCALES_DIR, "locale_%s.py" % locale)
+    if not os.path.exists(fname): return None
+    with open(fname, "rb") as f:
+        return f.read()
+
+def compile_catalogue(locale):
+    """
+    Builds the catalogue for a real locale from its translation module, 
+    leaving out untranslated phrases, and writes it to its compiled 
+    catalogue file. Returns the catalogue.
+    """
+    source = get_catalogue_source(locale)
+    if source is None: return {}
+    module = {}
+    exec compile(source, "locale_%s.py" % locale, "exec") in module
+    cat = {}
+    for k, v in module["val"].iteritems():
+        if k == "" or v is None or v == "" or v.startswith("??") or v.startswith("(??"): continue
+        cat[k] = v
+    try:
+        tempname = "%s.%d" % (get_catalogue_filename(locale), os.getpid())
+        with open(tempname, "wb") as f:
+            marshal.dump((CATALOGUE_FORMAT, hashlib.md5(source).hexdigest(), cat), f)
+        os.rename(tempname, get_catalogue_filename(locale))
+    except (IOError, OSError):
+        # We can't write to the locales folder, we'll just build it again next time
+        pass
+    return cat
+
+def compile_catalogues():
+    """ Compiles the catalogues for all of our translation modules (run as part of the build) """
+    for fname in sorted(os.listdir(LOCALES_DIR)):
+        if fname.startswith("locale_") and fname.endswith(".py"):
+            compile_catalogue(fname[7:-3])
+
+def load_catalogue(locale):
+    """
+    Returns the catalogue for a locale, reading it from its compiled 
+    catalogue file, or building it if that's missing or out of date.
+    """
+    rl = real_locale(locale)
+    cat = catalogues.get(rl)
+    if cat is None:
+        cat = {}
+        source = get_catalogue_source(rl)
+        if source is not None:
+            try:
+                with open(get_catalogue_filename(rl), "rb") as f:
+                    fmt, checksum, cat = marshal.load(f)
+                if fmt != CATALOGUE_FORMAT or checksum != hashlib.md5(source).hexdigest(): cat = None
+            except (IOError, EOFError, ValueError, TypeError):
+                cat = None
+            if cat is None: cat = compile_catalogue(rl)
+        catalogues[rl] = cat
+    catalogues[locale] = cat
+    return cat
+
 def translate(english, locale = "en"):
     """
     Returns a translation string for an English phrase in
-    the locale given.
+    the locale given, or the English phrase if there isn't one.
     """
-    locale = real_locale(locale)
-
-    # If we're dealing with English, then just
-    # return the English phrase. I hate that I'm doing
-    # this, but I'm going with the accepted standard of
-    # US English being default even though we invented
-    # the bloody language.
-    if locale == "en":
-        return english
-
-    # Otherwise, look up the phrase in the correct
-    # module for our locale.
     try:
-        lang = globals()["locale_" + locale]
-    except:
-        # The module doesn't exist for the locale, fall
-        # back to plain English translation
-        return english
-
-    # If the string isn't in our locale dictionary, fall back to English
-    if english not in lang.val: return english
+        return catalogues[locale].get(english, english)
+    except KeyError:
+        return load_catalogue(locale).get(english, english)
 
-    # If the value hasn't been translated, fall back to English
-    s = lang.val[english]
-    if s is None or s == "" or s.startswith("??") or s.startswith("(??"):
-        return english
-    else:
-        return lang.val[english]
+_ = translate
 
 def ntranslate(number, translations, locale = "en"):
     """ Translates a phrase that deals with a number of something
@@ -668,12 +717,7 @@ def i18nstringsjs(l):
     """
     Returns a javascript format file containing the language file
     """
-    langs = "{}"
-    try:
-        lang = globals()["locale_" + real_locale(l)]
-        langs = json.dumps(lang.val)
-    except:
-        pass
+    langs = json.dumps(load_catalogue(l))
     s = "i18n_lang = " + langs + ";\n"
     s += """
 (function($) {
@@ -2,9 +2,12 @@
 
 import configuration
 import financial
+import random
 import re
+import time
 import utils
 from i18n import _
+from sitedefs import CACHE_COMMON_QUERIES
 
 # Look up tables map
 # tablename : ( tablelabel, namefield, namelabel, descfield, hasspecies, haspfspecies, haspfbreed, hasapcolour, hasdefaultcost, hasunits, hassite, canadd, candelete, canretire,(foreignkeys) )
@@ -68,6 +71,20 @@ LOOKUP_CANDELETE = 12
 LOOKUP_CANRETIRE = 13
 LOOKUP_FOREIGNKEYS = 14
 
+# Lookup tables that are not in LOOKUP_TABLES and can only be changed by a database update
+LOOKUP_STATIC_TABLES = ( "lksdonationfreq", "lksfieldlink", "lksfieldtype" )
+
+# Lookup query results held by this process, (database, sql) -> (versions, rows)
+lookup_rows = {}
+# ID to name indexes held by this process, (database, table, namefield) -> (version, index)
+lookup_names = {}
+LOOKUP_CACHE_SIZE = 500
+
+# Lookup table versions are kept in the configuration table so that
+# every process sees a change at once. Each table has its own item
+# and this one is changed by flush_lookups to invalidate them all.
+LOOKUP_VERSION = "LookupVersion"
+
 # Database of microchip manufacturer prefixes. locales is a space separated list of
 # locales the pattern is valid for (blank is all locales)
 MICROCHIP_MANUFACTURERS = [
@@ -824,112 +841,105 @@ def delete_message(dbo, mid):
     dbo.delete("messages", mid)
 
 def get_account_types(dbo):
-    return dbo.query("SELECT * FROM lksaccounttype ORDER BY AccountType")
+    return query_lookup(dbo, "SELECT * FROM lksaccounttype ORDER BY AccountType", [ "lksaccounttype" ])
 
 def get_additionalfield_links(dbo):
-    return dbo.query("SELECT * FROM lksfieldlink ORDER BY LinkType")
+    return query_lookup(dbo, "SELECT * FROM lksfieldlink ORDER BY LinkType", [ "lksfieldlink" ])
 
 def get_additionalfield_types(dbo):
-    return dbo.query("SELECT * FROM lksfieldtype ORDER BY FieldType")
+    return query_lookup(dbo, "SELECT * FROM lksfieldtype ORDER BY FieldType", [ "lksfieldtype" ])
 
 def get_animal_flags(dbo):
-    return dbo.query("SELECT * FROM lkanimalflags ORDER BY Flag")
+    return query_lookup(dbo, "SELECT * FROM lkanimalflags ORDER BY Flag", [ "lkanimalflags" ])
 
 def get_animal_types(dbo):
-    return dbo.query("SELECT * FROM animaltype ORDER BY AnimalType")
+    return query_lookup(dbo, "SELECT * FROM animaltype ORDER BY AnimalType", [ "animaltype" ])
 
 def get_animaltype_name(dbo, aid):
-    if id is None: return ""
-    return dbo.query_string("SELECT AnimalType FROM animaltype WHERE ID = ?", [aid])
+    return get_lookup_name(dbo, "animaltype", "AnimalType", aid)
 
 def get_basecolours(dbo):
-    return dbo.query("SELECT * FROM basecolour ORDER BY BaseColour")
+    return query_lookup(dbo, "SELECT * FROM basecolour ORDER BY BaseColour", [ "basecolour" ])
 
 def get_basecolour_name(dbo, cid):
-    if id is None: return ""
-    return dbo.query_string("SELECT BaseColour FROM basecolour WHERE ID = ?", [cid])
+    return get_lookup_name(dbo, "basecolour", "BaseColour", cid)
 
 def get_breeds(dbo):
-    return dbo.query("SELECT * FROM breed ORDER BY BreedName")
+    return query_lookup(dbo, "SELECT * FROM breed ORDER BY BreedName", [ "breed" ])
 
 def get_breeds_by_species(dbo):
-    return dbo.query("SELECT breed.*, species.SpeciesName FROM breed " \
+    return query_lookup(dbo, "SELECT breed.*, species.SpeciesName FROM breed " \
         "LEFT OUTER JOIN species ON breed.SpeciesID = species.ID " \
-        "ORDER BY species.SpeciesName, breed.BreedName")
+        "ORDER BY species.SpeciesName, breed.BreedName", [ "breed", "species" ])
 
 def get_breed_name(dbo, bid):
-    if id is None: return ""
-    return dbo.query_string("SELECT BreedName FROM breed WHERE ID = ?", [bid])
+    return get_lookup_name(dbo, "breed", "BreedName", bid)
 
 def get_citation_types(dbo):
-    return dbo.query("SELECT * FROM citationtype ORDER BY CitationName")
+    return query_lookup(dbo, "SELECT * FROM citationtype ORDER BY CitationName", [ "citationtype" ])
 
 def get_clinic_statuses(dbo):
-    return dbo.query("SELECT * FROM lksclinicstatus ORDER BY ID")
+    return query_lookup(dbo, "SELECT * FROM lksclinicstatus ORDER BY ID", [ "lksclinicstatus" ])
 
 def get_coattypes(dbo):
-    return dbo.query("SELECT * FROM lkcoattype ORDER BY CoatType")
+    return query_lookup(dbo, "SELECT * FROM lkcoattype ORDER BY CoatType", [ "lkcoattype" ])
 
 def get_costtypes(dbo):
-    return dbo.query("SELECT * FROM costtype ORDER BY CostTypeName")
+    return query_lookup(dbo, "SELECT * FROM costtype ORDER BY CostTypeName", [ "costtype" ])
 
 def get_coattype_name(dbo, cid):
-    if id is None: return ""
-    return dbo.query_string("SELECT CoatTypeName FROM lkcoattype WHERE ID = ?", [cid])
+    return get_lookup_name(dbo, "lkcoattype", "CoatType", cid)
 
 def get_deathreasons(dbo):
-    return dbo.query("SELECT * FROM deathreason ORDER BY ReasonName")
+    return query_lookup(dbo, "SELECT * FROM deathreason ORDER BY ReasonName", [ "deathreason" ])
 
 def get_deathreason_name(dbo, rid):
-    if id is None: return ""
-    return dbo.query_string("SELECT ReasonName FROM deathreason WHERE ID = ?", [rid])
+    return get_lookup_name(dbo, "deathreason", "ReasonName", rid)
 
 def get_diets(dbo):
-    return dbo.query("SELECT * FROM diet ORDER BY DietName")
+    return query_lookup(dbo, "SELECT * FROM diet ORDER BY DietName", [ "diet" ])
 
 def get_donation_default(dbo, donationtypeid):
     return dbo.query_int("SELECT DefaultCost FROM donationtype WHERE ID = ?", [donationtypeid])
 
 def get_donation_frequencies(dbo):
-    return dbo.query("SELECT * FROM lksdonationfreq ORDER BY ID")
+    return query_lookup(dbo, "SELECT * FROM lksdonationfreq ORDER BY ID", [ "lksdonationfreq" ])
 
 def get_donation_types(dbo):
-    return dbo.query("SELECT * FROM donationtype ORDER BY DonationName")
+    return query_lookup(dbo, "SELECT * FROM donationtype ORDER BY DonationName", [ "donationtype" ])
 
 def get_donationtype_name(dbo, did):
-    if did is None: return ""
-    return dbo.query_string("SELECT DonationName FROM donationtype WHERE ID = ?", [did])
+    return get_lookup_name(dbo, "donationtype", "DonationName", did)
 
 def get_entryreasons(dbo):
-    return dbo.query("SELECT * FROM entryreason ORDER BY ReasonName")
+    return query_lookup(dbo, "SELECT * FROM entryreason ORDER BY ReasonName", [ "entryreason" ])
 
 def get_entryreason_name(dbo, rid):
-    if rid is None: return ""
-    return dbo.query_string("SELECT ReasonName FROM entryreason WHERE ID = ?", [rid])
+    return get_lookup_name(dbo, "entryreason", "ReasonName", rid)
 
 def get_incident_completed_types(dbo):
-    return dbo.query("SELECT * FROM incidentcompleted ORDER BY CompletedName")
+    return query_lookup(dbo, "SELECT * FROM incidentcompleted ORDER BY CompletedName", [ "incidentcompleted" ])
 
 def get_incident_types(dbo):
-    return dbo.query("SELECT * FROM incidenttype ORDER BY IncidentName")
+    return query_lookup(dbo, "SELECT * FROM incidenttype ORDER BY IncidentName", [ "incidenttype" ])
 
 def get_internal_locations(dbo, locationfilter = "", siteid = 0):
-    clauses = []
-    if locationfilter != "": clauses.append("ID IN (%s)" % locationfilter)
-    if siteid != 0: clauses.append("SiteID = %s" % siteid)
-    c = " AND ".join(clauses)
-    if c != "": c = "WHERE %s" % c
-    return dbo.query("SELECT * FROM internallocation %s ORDER BY LocationName" % c)
+    rows = query_lookup(dbo, "SELECT * FROM internallocation ORDER BY LocationName", [ "internallocation" ])
+    if locationfilter != "": 
+        ids = set([ utils.cint(x) for x in locationfilter.split(",") ])
+        rows = [ r for r in rows if r.id in ids ]
+    if siteid != 0: 
+        rows = [ r for r in rows if r.siteid == siteid ]
+    return rows
 
 def get_internallocation_name(dbo, lid):
-    if lid is None: return ""
-    return dbo.query_string("SELECT LocationName FROM internallocation WHERE ID = ?", [lid])
+    return get_lookup_name(dbo, "internallocation", "LocationName", lid)
 
 def get_jurisdictions(dbo):
-    return dbo.query("SELECT * FROM jurisdiction ORDER BY JurisdictionName")
+    return query_lookup(dbo, "SELECT * FROM jurisdiction ORDER BY JurisdictionName", [ "jurisdiction" ])
 
 def get_licence_types(dbo):
-    return dbo.query("SELECT * FROM licencetype ORDER BY LicenceTypeName")
+    return query_lookup(dbo, "SELECT * FROM licencetype ORDER BY LicenceTypeName", [ "licencetype" ])
 
 def get_messages(dbo, user, roles, superuser):
     """
@@ -955,81 +965,153 @@ def get_messages(dbo, user, roles, superuser):
     return rv
 
 def get_log_types(dbo):
-    return dbo.query("SELECT * FROM logtype ORDER BY LogTypeName")
+    return query_lookup(dbo, "SELECT * FROM logtype ORDER BY LogTypeName", [ "logtype" ])
 
 def get_logtype_name(dbo, tid):
-    if tid is None: return ""
-    return dbo.query_string("SELECT LogTypeName FROM logtype WHERE ID = ?", [tid])
+    return get_lookup_name(dbo, "logtype", "LogTypeName", tid)
 
 def get_lookup(dbo, tablename, namefield):
     if tablename == "breed":
-        return dbo.query("SELECT b.*, s.SpeciesName FROM breed b LEFT OUTER JOIN species s ON s.ID = b.SpeciesID ORDER BY b.BreedName")
-    return dbo.query("SELECT * FROM %s ORDER BY %s" % ( tablename, namefield ))
+        return query_lookup(dbo, "SELECT b.*, s.SpeciesName FROM breed b LEFT OUTER JOIN species s ON s.ID = b.SpeciesID ORDER BY b.BreedName", [ "breed", "species" ])
+    return query_lookup(dbo, "SELECT * FROM %s ORDER BY %s" % ( tablename, namefield ), [ tablename ])
+
+def get_lookup_versions(dbo, tables):
+    """
+    Returns the current versions of the lookup tables in the list tables
+    for this database, with the version for all tables at the end.
+    A table's version changes whenever it is written to by insert_lookup,
+    update_lookup, update_lookup_retired or delete_lookup and is used to 
+    check whether cached rows and names for the table are still current.
+    The versions are read from the configuration table every time rather
+    than through the config cache, so that a change made by any process
+    is seen at once.
+    """
+    names = [ "%s.%s" % (LOOKUP_VERSION, t) for t in tables ] + [ LOOKUP_VERSION ]
+    versions = {}
+    for r in dbo.query("SELECT ItemName, ItemValue FROM configuration WHERE ItemName IN (%s)" % ",".join("?" * len(names)), names):
+        versions[r.itemname] = r.itemvalue
+    return [ versions.get(n, "") for n in names ]
+
+def new_lookup_version(dbo, key):
+    """ Stores a new version in configuration item key """
+    configuration.cset(dbo, key, "%f.%d" % (time.time(), random.randint(0, 1000000)), ignoreDBLock = True, invalidateConfigCache = False)
+
+def flush_lookup(dbo, tablename):
+    """ Issues a new version of lookup table tablename, invalidating cached rows and names """
+    new_lookup_version(dbo, "%s.%s" % (LOOKUP_VERSION, tablename))
+
+def flush_lookups(dbo):
+    """ Invalidates cached rows and names for all lookup tables (eg: after a database update) """
+    new_lookup_version(dbo, LOOKUP_VERSION)
+
+def query_lookup(dbo, sql, tables):
+    """
+    Returns the rows for sql, a query of lookup tables, from the lookup cache
+    if none of the tables it reads have changed since it was last run.
+    tables: The list of lookup tables the query reads from
+    Each call returns copies of the rows, so they can be safely modified.
+    """
+    if not CACHE_COMMON_QUERIES: return dbo.query(sql)
+    key = (dbo.database, sql)
+    versions = get_lookup_versions(dbo, tables)
+    cached = lookup_rows.get(key)
+    if cached is not None and cached[0] == versions:
+        rows = cached[1]
+    else:
+        rows = dbo.query(sql)
+        if len(lookup_rows) >= LOOKUP_CACHE_SIZE: lookup_rows.clear()
+        lookup_rows[key] = (versions, rows)
+    return [ r.copy() for r in rows ]
+
+def get_lookup_name(dbo, tablename, namefield, iid):
+    """
+    Returns the value of namefield for the row in lookup table tablename 
+    with ID iid, or an empty string if there isn't one. Names are
+    resolved from an index of the whole table held in the lookup cache.
+    """
+    if iid is None: return ""
+    if not CACHE_COMMON_QUERIES: 
+        return dbo.query_string("SELECT %s FROM %s WHERE ID = ?" % (namefield, tablename), [iid])
+    key = (dbo.database, tablename, namefield)
+    version = get_lookup_versions(dbo, [ tablename ])
+    cached = lookup_names.get(key)
+    if cached is not None and cached[0] == version:
+        names = cached[1]
+    else:
+        names = {}
+        for r in dbo.query("SELECT ID, %s AS Name FROM %s" % (namefield, tablename)):
+            if r.name is not None: names[r.id] = str(r.name)
+        if len(lookup_names) >= LOOKUP_CACHE_SIZE: lookup_names.clear()
+        lookup_names[key] = (version, names)
+    return names.get(utils.cint(iid), "")
 
 def insert_lookup(dbo, lookup, name, desc="", speciesid=0, pfbreed="", pfspecies="", apcolour="", units="", site=1, defaultcost=0, retired=0):
     t = LOOKUP_TABLES[lookup]
-    nid = 0
-    if lookup == "basecolour":
-        return dbo.insert("basecolour", {
-            "BaseColour":               name,
-            "BaseColourDescription":    desc,
-            "AdoptAPetColour":          apcolour,
-            "IsRetired":                retired
-        })
-    elif lookup == "breed":
-        return dbo.insert("breed", {
-            "BreedName":        name,
-            "BreedDescription": desc,
-            "PetFinderBreed":   pfbreed,
-            "SpeciesID":        speciesid,
-            "IsRetired":        retired
-        })
-    elif lookup == "internallocation":
-        return dbo.insert("internallocation", {
-            "LocationName":         name,
-            "LocationDescription":  desc,
-            "Units":                units,
-            "SiteID":               site,
-            "IsRetired":            retired
-        })
-    elif lookup == "species":
-        return dbo.insert("species", {
-            "SpeciesName":          name,
-            "SpeciesDescription":   desc,
-            "PetFinderSpecies":     pfspecies,
-            "IsRetired":            retired
-        })
-    elif lookup == "donationtype" or lookup == "costtype" or lookup == "testtype" or lookup == "voucher" or lookup == "vaccinationtype" \
-        or lookup == "traptype" or lookup == "licencetype" or lookup == "citationtype":
-        nid = dbo.insert(lookup, {
-            t[LOOKUP_NAMEFIELD]:    name,
-            t[LOOKUP_DESCFIELD]:    desc,
-            "DefaultCost":          defaultcost,
-            "IsRetired":            retired
-        })
-        # Create a matching account if we have a donation type
-        if lookup == "donationtype" and configuration.create_donation_trx(dbo):
-            financial.insert_account_from_donationtype(dbo, nid, name, desc)
-        # Same goes for cost type
-        if lookup == "costtype" and configuration.create_cost_trx(dbo):
-            financial.insert_account_from_costtype(dbo, nid, name, desc)
-        return nid
-    elif lookup == "lkownerflags" or lookup == "lkanimalflags":
-        return dbo.insert(lookup, {
-            t[LOOKUP_NAMEFIELD]:    name.replace(",", " ").replace("|", " ") # sanitise bad values for flags
-        })
-    elif t[LOOKUP_DESCFIELD] == "":
-        # No description
-        if t[LOOKUP_CANRETIRE] == 1:
-            return dbo.insert(lookup, { t[LOOKUP_NAMEFIELD]: name, "IsRetired": retired })    
-        else:
-            return dbo.insert(lookup, { t[LOOKUP_NAMEFIELD]: name })    
-    else:
-        # Name/Description
-        if t[LOOKUP_CANRETIRE] == 1:
-            return dbo.insert(lookup, { t[LOOKUP_NAMEFIELD]: name, t[LOOKUP_DESCFIELD]: desc, "IsRetired": retired })    
+    try:
+        nid = 0
+        if lookup == "basecolour":
+            return dbo.insert("basecolour", {
+                "BaseColour":               name,
+                "BaseColourDescription":    desc,
+                "AdoptAPetColour":          apcolour,
+                "IsRetired":                retired
+            })
+        elif lookup == "breed":
+            return dbo.insert("breed", {
+                "BreedName":        name,
+                "BreedDescription": desc,
+                "PetFinderBreed":   pfbreed,
+                "SpeciesID":        speciesid,
+                "IsRetired":        retired
+            })
+        elif lookup == "internallocation":
+            return dbo.insert("internallocation", {
+                "LocationName":         name,
+                "LocationDescription":  desc,
+                "Units":                units,
+                "SiteID":               site,
+                "IsRetired":            retired
+            })
+        elif lookup == "species":
+            return dbo.insert("species", {
+                "SpeciesName":          name,
+                "SpeciesDescription":   desc,
+                "PetFinderSpecies":     pfspecies,
+                "IsRetired":            retired
+            })
+        elif lookup == "donationtype" or lookup == "costtype" or lookup == "testtype" or lookup == "voucher" or lookup == "vaccinationtype" \
+            or lookup == "traptype" or lookup == "licencetype" or lookup == "citationtype":
+            nid = dbo.insert(lookup, {
+                t[LOOKUP_NAMEFIELD]:    name,
+                t[LOOKUP_DESCFIELD]:    desc,
+                "DefaultCost":          defaultcost,
+                "IsRetired":            retired
+            })
+            # Create a matching account if we have a donation type
+            if lookup == "donationtype" and configuration.create_donation_trx(dbo):
+                financial.insert_account_from_donationtype(dbo, nid, name, desc)
+            # Same goes for cost type
+            if lookup == "costtype" and configuration.create_cost_trx(dbo):
+                financial.insert_account_from_costtype(dbo, nid, name, desc)
+            return nid
+        elif lookup == "lkownerflags" or lookup == "lkanimalflags":
+            return dbo.insert(lookup, {
+                t[LOOKUP_NAMEFIELD]:    name.replace(",", " ").replace("|", " ") # sanitise bad values for flags
+            })
+        elif t[LOOKUP_DESCFIELD] == "":
+            # No description
+            if t[LOOKUP_CANRETIRE] == 1:
+                return dbo.insert(lookup, { t[LOOKUP_NAMEFIELD]: name, "IsRetired": retired })    
+            else:
+                return dbo.insert(lookup, { t[LOOKUP_NAMEFIELD]: name })    
         else:
-            return dbo.insert(lookup, { t[LOOKUP_NAMEFIELD]: name, t[LOOKUP_DESCFIELD]: desc })    
+            # Name/Description
+            if t[LOOKUP_CANRETIRE] == 1:
+                return dbo.insert(lookup, { t[LOOKUP_NAMEFIELD]: name, t[LOOKUP_DESCFIELD]: desc, "IsRetired": retired })    
+            else:
+                return dbo.insert(lookup, { t[LOOKUP_NAMEFIELD]: name, t[LOOKUP_DESCFIELD]: desc })    
+    finally:
+        flush_lookup(dbo, lookup)
 
 def update_lookup(dbo, iid, lookup, name, desc="", speciesid=0, pfbreed="", pfspecies="", apcolour="", units="", site=1, defaultcost=0, retired=0):
     t = LOOKUP_TABLES[lookup]
@@ -1092,10 +1174,12 @@ def update_lookup(dbo, iid, lookup, name, desc="", speciesid=0, pfbreed="", pfsp
             dbo.update(lookup, iid, { t[LOOKUP_NAMEFIELD]: name, t[LOOKUP_DESCFIELD]: desc, "IsRetired": retired })
         else:
             dbo.update(lookup, iid, { t[LOOKUP_NAMEFIELD]: name, t[LOOKUP_DESCFIELD]: desc })
+    flush_lookup(dbo, lookup)
 
 def update_lookup_retired(dbo, lookup, iid, retired):
     """ Updates lookup item with ID=iid, setting IsRetired=retired """
     dbo.update(lookup, iid, { "IsRetired": retired })
+    flush_lookup(dbo, lookup)
 
 def delete_lookup(dbo, lookup, iid):
     l = dbo.locale
@@ -1105,6 +1189,7 @@ def delete_lookup(dbo, lookup, iid):
         if 0 < dbo.query_int("SELECT COUNT(*) FROM %s WHERE %s = %s" % (table, field, iid)):
             raise utils.ASMValidationError(_("This item is referred to in the database ({0}) and cannot be deleted until it is no longer in use.", l).format(fv))
     dbo.delete(lookup, iid)
+    flush_lookup(dbo, lookup)
 
 def get_microchip_manufacturer(l, chipno):
     """
@@ -1126,100 +1211,93 @@ def get_microchip_manufacturer(l, chipno):
     return mf
 
 def get_movementtype_name(dbo, mid):
-    if mid is None: return ""
-    return dbo.query_string("SELECT MovementType FROM lksmovementtype WHERE ID = ?", [mid])
+    return get_lookup_name(dbo, "lksmovementtype", "MovementType", mid)
 
 def get_movement_types(dbo):
-    return dbo.query("SELECT * FROM lksmovementtype ORDER BY ID")
+    return query_lookup(dbo, "SELECT * FROM lksmovementtype ORDER BY ID", [ "lksmovementtype" ])
 
 def get_payment_types(dbo):
-    return dbo.query("SELECT * FROM donationpayment ORDER BY PaymentName")
+    return query_lookup(dbo, "SELECT * FROM donationpayment ORDER BY PaymentName", [ "donationpayment" ])
 
 def get_person_flags(dbo):
-    return dbo.query("SELECT * FROM lkownerflags ORDER BY Flag")
+    return query_lookup(dbo, "SELECT * FROM lkownerflags ORDER BY Flag", [ "lkownerflags" ])
 
 def get_pickup_locations(dbo):
-    return dbo.query("SELECT * FROM pickuplocation ORDER BY LocationName")
+    return query_lookup(dbo, "SELECT * FROM pickuplocation ORDER BY LocationName", [ "pickuplocation" ])
 
 def get_posneg(dbo):
-    return dbo.query("SELECT * FROM lksposneg ORDER BY Name")
+    return query_lookup(dbo, "SELECT * FROM lksposneg ORDER BY Name", [ "lksposneg" ])
 
 def get_reservation_statuses(dbo):
-    return dbo.query("SELECT * FROM reservationstatus ORDER BY StatusName")
+    return query_lookup(dbo, "SELECT * FROM reservationstatus ORDER BY StatusName", [ "reservationstatus" ])
 
 def get_rota_types(dbo):
-    return dbo.query("SELECT * FROM lksrotatype ORDER BY ID")
+    return query_lookup(dbo, "SELECT * FROM lksrotatype ORDER BY ID", [ "lksrotatype" ])
 
 def get_sex_name(dbo, sid):
-    if id is None: return ""
-    return dbo.query_string("SELECT Sex FROM lksex WHERE ID = ?", [sid])
+    return get_lookup_name(dbo, "lksex", "Sex", sid)
 
 def get_sexes(dbo):
-    return dbo.query("SELECT * FROM lksex ORDER BY Sex")
+    return query_lookup(dbo, "SELECT * FROM lksex ORDER BY Sex", [ "lksex" ])
 
 def get_sites(dbo):
-    return dbo.query("SELECT * FROM site ORDER BY SiteName")
+    return query_lookup(dbo, "SELECT * FROM site ORDER BY SiteName", [ "site" ])
 
 def get_site_name(dbo, sid):
-    if sid is None: return ""
-    return dbo.query_string("SELECT SiteName FROM site WHERE ID = ?", [sid])
+    return get_lookup_name(dbo, "site", "SiteName", sid)
 
 def get_size_name(dbo, sid):
-    if sid is None: return ""
-    return dbo.query_string("SELECT Size FROM lksize WHERE ID = ?", [sid])
+    return get_lookup_name(dbo, "lksize", "Size", sid)
 
 def get_species(dbo):
-    return dbo.query("SELECT * FROM species ORDER BY SpeciesName")
+    return query_lookup(dbo, "SELECT * FROM species ORDER BY SpeciesName", [ "species" ])
 
 def get_species_name(dbo, sid):
-    if id is None: return ""
-    return dbo.query_string("SELECT SpeciesName FROM species WHERE ID = ?", [sid])
+    return get_lookup_name(dbo, "species", "SpeciesName", sid)
 
 def get_sizes(dbo):
-    return dbo.query("SELECT * FROM lksize ORDER BY Size")
+    return query_lookup(dbo, "SELECT * FROM lksize ORDER BY Size", [ "lksize" ])
 
 def get_stock_locations(dbo):
-    return dbo.query("SELECT * FROM stocklocation ORDER BY LocationName")
+    return query_lookup(dbo, "SELECT * FROM stocklocation ORDER BY LocationName", [ "stocklocation" ])
 
 def get_stock_location_name(dbo, slid):
-    if slid is None: return ""
-    return dbo.query_string("SELECT LocationName FROM stocklocation WHERE ID = ?", [slid])
+    return get_lookup_name(dbo, "stocklocation", "LocationName", slid)
 
 def get_stock_usage_types(dbo):
-    return dbo.query("SELECT * FROM stockusagetype ORDER BY UsageTypeName")
+    return query_lookup(dbo, "SELECT * FROM stockusagetype ORDER BY UsageTypeName", [ "stockusagetype" ])
 
 def get_trap_types(dbo):
-    return dbo.query("SELECT * FROM traptype ORDER BY TrapTypeName")
+    return query_lookup(dbo, "SELECT * FROM traptype ORDER BY TrapTypeName", [ "traptype" ])
 
 def get_urgencies(dbo):
-    return dbo.query("SELECT * FROM lkurgency ORDER BY ID")
+    return query_lookup(dbo, "SELECT * FROM lkurgency ORDER BY ID", [ "lkurgency" ])
 
 def get_urgency_name(dbo, uid):
-    if id is None: return ""
-    return dbo.query_string("SELECT Urgency FROM lkurgency WHERE ID = ?", [uid])
+    return get_lookup_name(dbo, "lkurgency", "Urgency", uid)
 
 def get_test_types(dbo):
-    return dbo.query("SELECT * FROM testtype ORDER BY TestName")
+    return query_lookup(dbo, "SELECT * FROM testtype ORDER BY TestName", [ "testtype" ])
 
 def get_test_results(dbo):
-    return dbo.query("SELECT * FROM testresult ORDER BY ResultName")
+    return query_lookup(dbo, "SELECT * FROM testresult ORDER BY ResultName", [ "testresult" ])
 
 def get_transport_types(dbo):
-    return dbo.query("SELECT * FROM transporttype ORDER BY TransportTypeName")
+    return query_lookup(dbo, "SELECT * FROM transporttype ORDER BY TransportTypeName", [ "transporttype" ])
 
 def get_vaccination_types(dbo):
-    return dbo.query("SELECT * FROM vaccinationtype ORDER BY VaccinationType")
+    return query_lookup(dbo, "SELECT * FROM vaccinationtype ORDER BY VaccinationType", [ "vaccinationtype" ])
 
 def get_voucher_types(dbo):
-    return dbo.query("SELECT * FROM voucher ORDER BY VoucherName")
+    return query_lookup(dbo, "SELECT * FROM voucher ORDER BY VoucherName", [ "voucher" ])
 
 def get_work_types(dbo):
-    return dbo.query("SELECT * FROM lkworktype ORDER BY WorkType")
+    return query_lookup(dbo, "SELECT * FROM lkworktype ORDER BY WorkType", [ "lkworktype" ])
 
 def get_yesno(dbo):
-    return dbo.query("SELECT * FROM lksyesno ORDER BY Name")
+    return query_lookup(dbo, "SELECT * FROM lksyesno ORDER BY Name", [ "lksyesno" ])
 
 def get_ynun(dbo):
-    return dbo.query("SELECT * FROM lksynun ORDER BY Name")
+    return query_lookup(dbo, "SELECT * FROM lksynun ORDER BY Name", [ "lksynun" ])
 
 
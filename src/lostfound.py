@@ -4,15 +4,17 @@ import additional
 import al
 import animal
 import asynctask
+import bisect
 import configuration
 import dbfs
 import diary
 import log
 import media
 import reports
+import time
 import utils
 import waitinglist
-from i18n import _, date_diff_days, now, subtract_years, python2display
+from i18n import _, now, subtract_years, python2display
 
 class LostFoundMatch:
     dbo = None
@@ -309,18 +311,138 @@ def words(str1, str2, maxpoints):
     Evalutes words in string 1 for appearances in string 2
     Returns the number of points for 1 to 2 as a percentage of maxpoints
     """
-    if str1 is None: str1 = ""
-    if str2 is None: str2 = ""
-    str1 = str1.replace(",", " ").replace("\n", " ").lower().strip()
-    str2 = str2.replace(",", " ").replace("\n", " ").lower().strip()
+    return words_points(split_words(str1), set(split_words(str2)), maxpoints)
+
+def split_words(s):
+    """ Returns the list of words in s as words compares them """
+    if s is None: s = ""
+    return s.replace(",", " ").replace("\n", " ").lower().strip().split(" ")
+
+def words_points(s1words, s2words, maxpoints):
+    """ words for the list of words in string 1 and the set of words in string 2 """
     matches = 0
-    s1words = str1.split(" ")
-    s2words = str2.split(" ")
     for w in s1words:
         if w in s2words: 
             matches += 1
     return int((float(matches) / float(len(s1words))) * float(maxpoints))
 
+# Postcodes up to this long have all their substrings indexed
+POSTCODE_INDEX_LENGTH = 12
+
+# Kinds of MatchIndex term
+EQUALS = 0
+WORDS = 1
+POSTCODE = 2
+WITHIN2WEEKS = 3
+
+ONE_DAY = 60 * 60 * 24
+
+class MatchIndex(object):
+    """
+    The found or shelter animals that lost animals are compared against,
+    indexed by the values that score points so that a lost animal's points
+    against every row can be added up from the rows that share each value, 
+    rather than comparing the lost animal with every row in turn.
+    rows:  The found or shelter animals
+    terms: A list of ( kind, lost column, columns, points ) tuples, for 
+           how points are scored:
+           EQUALS:       the lost column equals any of columns
+           WORDS:        words(lost column, columns[0], points)
+           POSTCODE:     the lost column is found in columns[0]
+           WITHIN2WEEKS: date_diff_days(lost column, columns[0]) <= 14
+    floor: The fewest points a match can have
+    The points are exactly the ones that comparing every pair would give.
+    """
+    def __init__(self, rows, terms, floor):
+        self.rows = rows
+        self.terms = terms
+        self.floor = floor
+        self.indexes = [] # per term
+        for kind, lcol, cols, points in terms:
+            index = {}
+            if kind == EQUALS:
+                for i, r in enumerate(rows):
+                    for c in cols: index.setdefault(r[c], set()).add(i)
+            elif kind == WORDS:
+                for i, r in enumerate(rows):
+                    for w in set(split_words(r[cols[0]])): index.setdefault(w, set()).add(i)
+            elif kind == POSTCODE:
+                index["long"] = []
+                for i, r in enumerate(rows):
+                    pc = utils.nulltostr(r[cols[0]])
+                    if len(pc) > POSTCODE_INDEX_LENGTH: 
+                        index["long"].append( (pc, i) )
+                        continue
+                    for start in range(0, len(pc)):
+                        for end in range(start + 1, len(pc) + 1):
+                            index.setdefault(pc[start:end], set()).add(i)
+            elif kind == WITHIN2WEEKS:
+                # Rows with a date that can't be compared always score, the
+                # others are sorted by unix time
+                index["always"] = []
+                index["dated"] = []
+                for i, r in enumerate(rows):
+                    ux = unixtime(r[cols[0]])
+                    if ux is None: index["always"].append(i)
+                    else: index["dated"].append( (ux, i) )
+                index["dated"].sort()
+                index["times"] = [ dux for dux, di in index["dated"] ]
+            self.indexes.append(index)
+
+    def scored(self, t, la):
+        """ Returns a list of ( rows, points ) that lost animal la scores for term t """
+        kind, lcol, cols, points = self.terms[t]
+        index = self.indexes[t]
+        allrows = xrange(0, len(self.rows))
+        if kind == EQUALS:
+            return [ ( index.get(la[lcol], ()), points ) ]
+        elif kind == WORDS:
+            lwords = split_words(la[lcol])
+            counts = {}
+            for w in lwords:
+                for i in index.get(w, ()):
+                    counts[i] = counts.get(i, 0) + 1
+            bycount = {}
+            for i, c in counts.iteritems():
+                bycount.setdefault(c, []).append(i)
+            return [ ( rows, int((float(c) / float(len(lwords))) * float(points)) ) for c, rows in bycount.iteritems() ]
+        elif kind == POSTCODE:
+            pc = la[lcol]
+            if pc is None: return []
+            if pc == "": return [ ( allrows, points ) ]
+            return [ ( index.get(pc, ()), points ), ( [ i for x, i in index["long"] if x.find(pc) != -1 ], points ) ]
+        elif kind == WITHIN2WEEKS:
+            ux1 = unixtime(la[lcol])
+            if ux1 is None: return [ ( allrows, points ) ]
+            # Rows more than a day inside 14 days score without checking, 
+            # the ones either side of the boundary are checked exactly 
+            dated, times = index["dated"], index["times"]
+            sure = bisect.bisect_left(times, ux1 + 14 * ONE_DAY)
+            edge = bisect.bisect_right(times, ux1 + 16 * ONE_DAY)
+            rows = [ i for ux2, i in dated[0:sure] ]
+            rows.extend([ i for ux2, i in dated[sure:edge] if int((ux2 - ux1) / 60 / 60 / 24) <= 14 ])
+            return [ ( index["always"], points ), ( rows, points ) ]
+
+    def matches(self, la):
+        """ Returns a list of ( row, points ) for the rows that lost animal la scores 
+            at least floor points against, in the order of rows """
+        total = [ 0 ] * len(self.rows)
+        for t in range(0, len(self.terms)):
+            if self.terms[t][3] == 0: continue
+            for rows, points in self.scored(t, la):
+                for i in rows:
+                    total[i] += points
+        floor = self.floor
+        return [ (self.rows[i], points) for i, points in enumerate(total) if points >= floor ]
+
+def unixtime(d):
+    """ Returns the unix time date_diff_days uses for d, or None if date_diff_days can't use it """
+    if d is None: return None
+    try:
+        return time.mktime(d.timetuple())
+    except:
+        return None
+
 def match(dbo, lostanimalid = 0, foundanimalid = 0, animalid = 0, limit = 0):
     """
     Performs a lost and found match by going through all lost animals
@@ -384,6 +506,30 @@ def match(dbo, lostanimalid = 0, foundanimalid = 0, animalid = 0, limit = 0):
         else:
             shelteranimals = dbo.query(animal.get_animal_query(dbo) + " WHERE a.ID = ?", [animalid])
 
+    foundindex = MatchIndex(foundanimals, (
+        ( EQUALS, "ANIMALTYPEID", ( "ANIMALTYPEID", ), matchspecies ),
+        ( EQUALS, "BREEDID", ( "BREEDID", ), matchbreed ),
+        ( EQUALS, "AGEGROUP", ( "AGEGROUP", ), matchage ),
+        ( EQUALS, "SEX", ( "SEX", ), matchsex ),
+        ( WORDS, "AREALOST", ( "AREAFOUND", ), matcharealost ),
+        ( WORDS, "DISTFEAT", ( "DISTFEAT", ), matchfeatures ),
+        ( EQUALS, "AREAPOSTCODE", ( "AREAPOSTCODE", ), matchpostcode ),
+        ( EQUALS, "BASECOLOURID", ( "BASECOLOURID", ), matchcolour ),
+        ( WITHIN2WEEKS, "DATELOST", ( "DATEFOUND", ), matchdatewithin2weeks )
+    ), matchpointfloor)
+    if includeshelter:
+        shelterindex = MatchIndex(shelteranimals, (
+            ( EQUALS, "ANIMALTYPEID", ( "SPECIESID", ), matchspecies ),
+            ( EQUALS, "BREEDID", ( "BREEDID", "BREED2ID" ), matchbreed ),
+            ( EQUALS, "BASECOLOURID", ( "BASECOLOURID", ), matchcolour ),
+            ( EQUALS, "AGEGROUP", ( "AGEGROUP", ), matchage ),
+            ( EQUALS, "SEX", ( "SEX", ), matchsex ),
+            ( WORDS, "AREALOST", ( "ORIGINALOWNERADDRESS", ), matcharealost ),
+            ( WORDS, "DISTFEAT", ( "MARKINGS", ), matchfeatures ),
+            ( POSTCODE, "AREAPOSTCODE", ( "ORIGINALOWNERPOSTCODE", ), matchpostcode ),
+            ( WITHIN2WEEKS, "DATELOST", ( "DATEBROUGHTIN", ), matchdatewithin2weeks )
+        ), matchpointfloor)
+
     asynctask.set_progress_max(dbo, len(lostanimals))
     for la in lostanimals:
         asynctask.increment_progress_value(dbo)
@@ -393,17 +539,7 @@ def match(dbo, lostanimalid = 0, foundanimalid = 0, animalid = 0, limit = 0):
         # Found animals (if an animal id has been given don't
         # check found animals)
         if animalid == 0:
-            for fa in foundanimals:
-                matchpoints = 0
-                if la["ANIMALTYPEID"] == fa["ANIMALTYPEID"]: matchpoints += matchspecies
-                if la["BREEDID"] == fa["BREEDID"]: matchpoints += matchbreed
-                if la["AGEGROUP"] == fa["AGEGROUP"]: matchpoints += matchage
-                if la["SEX"] == fa["SEX"]: matchpoints += matchsex
-                matchpoints += words(la["AREALOST"], fa["AREAFOUND"], matcharealost)
-                matchpoints += words(la["DISTFEAT"], fa["DISTFEAT"], matchfeatures)
-                if la["AREAPOSTCODE"] == fa["AREAPOSTCODE"]: matchpoints += matchpostcode
-                if la["BASECOLOURID"] == fa["BASECOLOURID"]: matchpoints += matchcolour
-                if date_diff_days(la["DATELOST"], fa["DATEFOUND"]) <= 14: matchpoints += matchdatewithin2weeks
+            for fa, matchpoints in foundindex.matches(la):
                 if matchpoints > matchmax: matchpoints = matchmax
                 if matchpoints >= matchpointfloor:
                     m = LostFoundMatch(dbo)
@@ -449,17 +585,7 @@ def match(dbo, lostanimalid = 0, foundanimalid = 0, animalid = 0, limit = 0):
 
         # Shelter animals
         if includeshelter:
-            for a in shelteranimals:
-                matchpoints = 0
-                if la["ANIMALTYPEID"] == a["SPECIESID"]: matchpoints += matchspecies
-                if la["BREEDID"] == a["BREEDID"] or la["BREEDID"] == a["BREED2ID"]: matchpoints += matchbreed
-                if la["BASECOLOURID"] == a["BASECOLOURID"]: matchpoints += matchcolour
-                if la["AGEGROUP"] == a["AGEGROUP"]: matchpoints += matchage
-                if la["SEX"] == a["SEX"]: matchpoints += matchsex
-                matchpoints += words(la["AREALOST"], a["ORIGINALOWNERADDRESS"], matcharealost)
-                matchpoints += words(la["DISTFEAT"], a["MARKINGS"], matchfeatures)
-                if utils.nulltostr(a["ORIGINALOWNERPOSTCODE"]).find(la["AREAPOSTCODE"]) != -1: matchpoints += matchpostcode
-                if date_diff_days(la["DATELOST"], a["DATEBROUGHTIN"]) <= 14: matchpoints += matchdatewithin2weeks
+            for a, matchpoints in shelterindex.matches(la):
                 if matchpoints > matchmax: matchpoints = matchmax
                 if matchpoints >= matchpointfloor:
                     m = LostFoundMatch(dbo)
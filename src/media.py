@@ -4,6 +4,7 @@ import al
 import animal
 import audit
 import base64
+import cachedisk
 import configuration
 import datetime
 import dbfs
@@ -14,7 +15,7 @@ import tempfile
 import utils
 import zipfile
 from cStringIO import StringIO
-from sitedefs import SCALE_PDF_DURING_ATTACH, SCALE_PDF_CMD
+from sitedefs import SCALE_PDF_DURING_ATTACH, SCALE_PDF_CMD, CACHE_MEDIA_DERIVATIVES
 
 ANIMAL = 0
 LOSTANIMAL = 1
@@ -27,6 +28,17 @@ MEDIATYPE_FILE = 0
 MEDIATYPE_DOCUMENT_LINK = 1
 MEDIATYPE_VIDEO_LINK = 2
 
+THUMBNAIL_SIZE = "150x150"
+
+# The scaled sizes we keep derivatives of, so that they can be
+# removed when the original changes. Thumbnails are the only scaled
+# images get_image_file_data serves, add any other size served through
+# get_image_derivative here.
+DERIVATIVE_SIZES = [ THUMBNAIL_SIZE ]
+
+# How long derivatives live in the disk cache since they were last used
+DERIVATIVE_TTL = 86400 * 30
+
 def mime_type(filename):
     """
     Returns the mime type for a file with the given name
@@ -159,7 +171,7 @@ def get_image_file_data(dbo, mode, iid, seq = 0, justdate = False):
     def thumb_mrec(mm):
         if len(mm) == 0: return thumb_nopic()
         if justdate: return mm[0].DATE
-        return (mm[0].DATE, scale_thumbnail(dbfs.get_string(dbo, mm[0].MEDIANAME)))
+        return (mm[0].DATE, get_image_derivative(dbo, mm[0], THUMBNAIL_SIZE))
 
     if mode == "animal":
         if seq == 0:
@@ -202,6 +214,38 @@ def get_image_file_data(dbo, mode, iid, seq = 0, justdate = False):
     else:
         return nopic()
 
+def get_derivative_key(dbo, mr, resizespec):
+    """
+    Returns the disk cache key for a scaled derivative of media row mr.
+    The ID and DATE of the media record identify the version of the
+    image, so any change to the record gives a new key.
+    """
+    return "media_derivative:%s:%s:%s:%s" % (dbo.database, mr.ID, mr.DATE, resizespec)
+
+def get_image_derivative(dbo, mr, resizespec):
+    """
+    Returns the image data for media row mr scaled to resizespec (WxH).
+    Each size is generated once per version of the media record and
+    then served from the disk cache without decoding the original again.
+    """
+    if not CACHE_MEDIA_DERIVATIVES:
+        return scale_image(dbfs.get_string(dbo, mr.MEDIANAME), resizespec)
+    key = get_derivative_key(dbo, mr, resizespec)
+    imagedata = cachedisk.touch(key, DERIVATIVE_TTL / 2, DERIVATIVE_TTL)
+    if imagedata is not None: return imagedata
+    imagedata = scale_image(dbfs.get_string(dbo, mr.MEDIANAME), resizespec)
+    cachedisk.put(key, imagedata, DERIVATIVE_TTL)
+    return imagedata
+
+def delete_image_derivatives(dbo, mr):
+    """
+    Removes any stored derivatives for the current version of media row mr.
+    Older versions are unreachable once the DATE changes and expire by themselves.
+    """
+    if not CACHE_MEDIA_DERIVATIVES: return
+    for resizespec in DERIVATIVE_SIZES:
+        cachedisk.delete(get_derivative_key(dbo, mr, resizespec))
+
 def get_dbfs_path(linkid, linktype):
     path = "/animal/%d" % int(linkid)
     if linktype == PERSON:
@@ -531,6 +575,8 @@ def update_file_content(dbo, username, mid, content):
     """
     Updates the dbfs content for the file pointed to by id
     """
+    mr = dbo.first_row(get_media_by_id(dbo, mid))
+    if mr: delete_image_derivatives(dbo, mr)
     dbfs.replace_string(dbo, content, get_name_for_id(dbo, mid))
     dbo.update("media", mid, { "Date": dbo.now(), "MediaSize": len(content) }, username, setLastChanged=False)
 
@@ -548,6 +594,7 @@ def delete_media(dbo, username, mid):
     """
     mr = dbo.first_row(dbo.query("SELECT * FROM media WHERE ID=?", [mid]))
     if not mr: return
+    delete_image_derivatives(dbo, mr)
     try:
         dbfs.delete(dbo, mr.MEDIANAME)
     except Exception as err:
@@ -581,6 +628,7 @@ def rotate_media(dbo, username, mid, clockwise = True):
     path = get_dbfs_path(mr.LINKID, mr.LINKTYPEID)
     imagedata = dbfs.get_string(dbo, mn, path)
     imagedata = rotate_image(imagedata, clockwise)
+    delete_image_derivatives(dbo, mr)
     # Store it back in the dbfs and add an entry to the audit trail
     dbfs.put_string(dbo, mn, path, imagedata)
     # Update the date stamp on the media record
@@ -688,7 +736,7 @@ def scale_thumbnail(imagedata):
     Scales the given imagedata down to slightly larger than our thumbnail size 
     (150px on the longest side)
     """
-    return scale_image(imagedata, "150x150")
+    return scale_image(imagedata, THUMBNAIL_SIZE)
 
 def scale_image_file(inimage, outimage, resizespec):
     """
@@ -714,7 +762,7 @@ def scale_thumbnail_file(inimage, outimage):
     """
     Scales the given image to a thumbnail
     """
-    scale_image_file(inimage, outimage, "150x150")
+    scale_image_file(inimage, outimage, THUMBNAIL_SIZE)
 
 def scale_pdf(filedata):
     """
@@ -3,6 +3,7 @@
 import al
 import animal
 import configuration
+import emailqueue
 import financial
 import medical
 import i18n
@@ -404,6 +405,7 @@ def update_movement_from_form(dbo, username, post):
     """
     validate_movement_form_data(dbo, post)
     movementid = post.integer("movementid")
+    oldanimalid = dbo.query_int("SELECT AnimalID FROM adoption WHERE ID = ?", [movementid])
 
     dbo.update("adoption", movementid, {
         "AdoptionNumber":               post["adoptionno"],
@@ -430,6 +432,10 @@ def update_movement_from_form(dbo, username, post):
 
     animal.update_animal_status(dbo, post.integer("animal"))
     animal.update_variable_animal_data(dbo, post.integer("animal"))
+    # If the movement was moved to another animal, the old one needs updating too
+    if oldanimalid != 0 and oldanimalid != post.integer("animal"):
+        animal.update_animal_status(dbo, oldanimalid)
+        animal.update_variable_animal_data(dbo, oldanimalid)
     update_movement_donation(dbo, movementid)
 
 def delete_movement(dbo, username, mid):
@@ -454,6 +460,7 @@ def return_movement(dbo, movementid, animalid = 0, returndate = None):
     if animalid == 0: animalid = dbo.query_int("SELECT AnimalID FROM adoption WHERE ID = ?", [movementid])
     dbo.update("adoption", movementid, { "ReturnDate": returndate })
     animal.update_animal_status(dbo, animalid)
+    animal.update_variable_animal_data(dbo, animalid)
 
 def insert_adoption_from_form(dbo, username, post, creating = [], create_payments = True):
     """
@@ -962,6 +969,6 @@ def send_fosterer_emails(dbo):
 
         # Email is complete, send to the fosterer (assuming there were some animals to send)
         if len(animals) > 0:
-            utils.send_email(dbo, configuration.email(dbo), f.EMAILADDRESS, subject = i18n._("Fosterer Medical Report", l), body = "\n".join(lines), exceptions=False)
+            emailqueue.queue_email(dbo, configuration.email(dbo), f.EMAILADDRESS, subject = i18n._("Fosterer Medical Report", l), body = "\n".join(lines))
 
 
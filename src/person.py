@@ -4,6 +4,7 @@ import additional
 import al
 import animal
 import asynctask
+import bisect
 import configuration
 import datetime
 import dbfs
@@ -11,6 +12,7 @@ import diary
 import geo
 import log
 import media
+import re
 import reports
 import users
 import utils
@@ -1176,6 +1178,104 @@ def send_email_from_form(dbo, username, post):
         log.add_log(dbo, username, log.PERSON, post.integer("personid"), logtype, utils.html_email_to_plain(body))
     return rv
 
+# Animals that can be matched to people looking for an animal
+LOOKINGFOR_AVAILABLE = "a.Archived=0 AND a.IsNotAvailableForAdoption=0 AND a.HasActiveReserve=0 AND a.CrueltyCase=0 AND a.DeceasedDate Is Null"
+
+# owner match column -> animal columns it must equal (-1 in the owner column matches anything)
+LOOKINGFOR_EQUALS = (
+    ( "MATCHANIMALTYPE", ( "ANIMALTYPEID", ) ),
+    ( "MATCHSPECIES", ( "SPECIESID", ) ),
+    ( "MATCHBREED", ( "BREEDID", "BREED2ID" ) ),
+    ( "MATCHSEX", ( "SEX", ) ),
+    ( "MATCHSIZE", ( "SIZE", ) ),
+    ( "MATCHCOLOUR", ( "BASECOLOURID", ) )
+)
+
+# owner match column -> animal flag that must be 0 (yes) when the owner column is 0
+LOOKINGFOR_FLAGS = (
+    ( "MATCHGOODWITHCHILDREN", "ISGOODWITHCHILDREN" ),
+    ( "MATCHGOODWITHCATS", "ISGOODWITHCATS" ),
+    ( "MATCHGOODWITHDOGS", "ISGOODWITHDOGS" ),
+    ( "MATCHHOUSETRAINED", "ISHOUSETRAINED" )
+)
+
+class LookingForMatcher(object):
+    """
+    Matches the "looking for" profiles of people against the animals
+    available for adoption. The animals are read once and indexed by 
+    each criterion a profile can have, so that every profile is
+    evaluated in memory by intersecting sets of animals.
+    Matches are returned in the same order as the animals were read, 
+    most recently changed first.
+    """
+    def __init__(self, dbo):
+        self.dbo = dbo
+        self.now = now(dbo.timezone)
+        self.animals = dbo.query(animal.get_animal_query(dbo) + " WHERE " + LOOKINGFOR_AVAILABLE + " ORDER BY a.LastChangedDate DESC")
+        self.all = set(range(0, len(self.animals)))
+        self.equals = {} # match column -> value -> set of positions in self.animals
+        self.flags = {} # match column -> set of positions of animals with the flag set to yes
+        self.dobs = [] # sorted ( dateofbirth, position )
+        self.words = {} # word from the comments -> set of positions
+        self.withcomments = set() # positions of animals with either comments field not null
+        for mcol, acols in LOOKINGFOR_EQUALS:
+            index = self.equals[mcol] = {}
+            for i, a in enumerate(self.animals):
+                for acol in acols:
+                    if a[acol] is not None: index.setdefault(a[acol], set()).add(i)
+        for mcol, acol in LOOKINGFOR_FLAGS:
+            self.flags[mcol] = set([ i for i, a in enumerate(self.animals) if a[acol] == 0 ])
+        for i, a in enumerate(self.animals):
+            if a.DATEOFBIRTH is not None: self.dobs.append( (a.DATEOFBIRTH, i) )
+            for f in ( a.ANIMALCOMMENTS, a.HIDDENANIMALDETAILS ):
+                if f is None: continue
+                self.withcomments.add(i)
+                for w in f.split():
+                    self.words.setdefault(w, set()).add(i)
+        self.dobs.sort()
+
+    def born_between(self, fromdate, todate):
+        """ Returns the set of animals born between fromdate and todate inclusive """
+        start = bisect.bisect_left(self.dobs, (fromdate, -1))
+        end = bisect.bisect_right(self.dobs, (todate, len(self.animals)))
+        return set([ i for d, i in self.dobs[start:end] ])
+
+    def comments_contain(self, word):
+        """ Returns the set of animals whose comments or hidden details are
+            LIKE '%word%', as the query used to do: % and _ in word are wildcards
+            and case only matters if it does for LIKE on this database.
+            A word without wildcards or whitespace can only be found inside one
+            of the words of the comments, so only the distinct words need searching. """
+        if word == "": return self.withcomments
+        pattern = ".*".join([ ".".join([ re.escape(x) for x in part.split("_") ]) for part in word.split("%") ])
+        pattern = re.compile(pattern, re.DOTALL | (self.dbo.like_ignores_case and re.IGNORECASE or 0))
+        if word.find("%") != -1 or word.find("_") != -1 or len(word.split()) != 1:
+            return set([ i for i, a in enumerate(self.animals) if 
+                (a.ANIMALCOMMENTS is not None and pattern.search(a.ANIMALCOMMENTS)) or 
+                (a.HIDDENANIMALDETAILS is not None and pattern.search(a.HIDDENANIMALDETAILS)) ])
+        found = set()
+        for w, positions in self.words.iteritems():
+            if pattern.search(w): found |= positions
+        return found
+
+    def match(self, p):
+        """ Returns the list of animals matching person row p's profile """
+        sets = []
+        for mcol, acols in LOOKINGFOR_EQUALS:
+            if p[mcol] != -1: sets.append(self.equals[mcol].get(p[mcol], set()))
+        for mcol, acol in LOOKINGFOR_FLAGS:
+            if p[mcol] == 0: sets.append(self.flags[mcol])
+        if p.MATCHAGEFROM >= 0 and p.MATCHAGETO > 0:
+            sets.append(self.born_between(subtract_years(self.now, p.MATCHAGETO), subtract_years(self.now, p.MATCHAGEFROM)))
+        if p.MATCHCOMMENTSCONTAIN is not None and p.MATCHCOMMENTSCONTAIN != "":
+            for w in str(p.MATCHCOMMENTSCONTAIN).split(" "):
+                sets.append(self.comments_contain(w))
+        matches = self.all
+        for x in sorted(sets, key=len):
+            matches = matches & x
+            if len(matches) == 0: return []
+        return [ self.animals[i] for i in sorted(matches) ]
+
 def lookingfor_report(dbo, username = "system", personid = 0, limit = 0):
     """
     Generates the person looking for report
@@ -1227,61 +1327,26 @@ def lookingfor_report(dbo, username = "system", personid = 0, limit = 0):
 
     totalmatches = 0
     asynctask.set_progress_max(dbo, len(people))
+    matcher = LookingForMatcher(dbo)
     for p in people:
         asynctask.increment_progress_value(dbo)
-        ands = [ "a.Archived=0", "a.IsNotAvailableForAdoption=0", "a.HasActiveReserve=0", "a.CrueltyCase=0", "a.DeceasedDate Is Null" ]
-        v = [] # query values
         c = [] # readable criteria
-        if p.MATCHANIMALTYPE != -1: 
-            ands.append("a.AnimalTypeID=?")
-            v.append(p.MATCHANIMALTYPE)
-            c.append(p.MATCHANIMALTYPENAME)
-        if p.MATCHSPECIES != -1: 
-            ands.append("a.SpeciesID=?")
-            v.append(p.MATCHSPECIES)
-            c.append(p.MATCHSPECIESNAME)
-        if p.MATCHBREED != -1: 
-            ands.append("(a.BreedID=? OR a.Breed2ID=?)")
-            v.append(p.MATCHBREED)
-            v.append(p.MATCHBREED)
-            c.append(p.MATCHBREEDNAME)
-        if p.MATCHSEX != -1: 
-            ands.append("a.Sex=?")
-            v.append(p.MATCHSEX)
-            c.append(p.MATCHSEXNAME)
-        if p.MATCHSIZE != -1: 
-            ands.append("a.Size=?")
-            v.append(p.MATCHSIZE)
-            c.append(p.MATCHSIZENAME)
-        if p.MATCHCOLOUR != -1: 
-            ands.append("a.BaseColourID=?")
-            v.append(p.MATCHCOLOUR)
-            c.append(p.MATCHCOLOURNAME)
-        if p.MATCHGOODWITHCHILDREN == 0: 
-            ands.append("a.IsGoodWithChildren=0")
-            c.append(_("Good with kids", l))
-        if p.MATCHGOODWITHCATS == 0: 
-            ands.append("a.IsGoodWithCats=0")
-            c.append(_("Good with cats", l))
-        if p.MATCHGOODWITHDOGS == 0: 
-            ands.append("a.IsGoodWithDogs=0")
-            c.append(_("Good with dogs", l))
-        if p.MATCHHOUSETRAINED == 0: 
-            ands.append("a.IsHouseTrained=0")
-            c.append(_("Housetrained", l))
+        if p.MATCHANIMALTYPE != -1: c.append(p.MATCHANIMALTYPENAME)
+        if p.MATCHSPECIES != -1: c.append(p.MATCHSPECIESNAME)
+        if p.MATCHBREED != -1: c.append(p.MATCHBREEDNAME)
+        if p.MATCHSEX != -1: c.append(p.MATCHSEXNAME)
+        if p.MATCHSIZE != -1: c.append(p.MATCHSIZENAME)
+        if p.MATCHCOLOUR != -1: c.append(p.MATCHCOLOURNAME)
+        if p.MATCHGOODWITHCHILDREN == 0: c.append(_("Good with kids", l))
+        if p.MATCHGOODWITHCATS == 0: c.append(_("Good with cats", l))
+        if p.MATCHGOODWITHDOGS == 0: c.append(_("Good with dogs", l))
+        if p.MATCHHOUSETRAINED == 0: c.append(_("Housetrained", l))
         if p.MATCHAGEFROM >= 0 and p.MATCHAGETO > 0: 
-            ands.append("a.DateOfBirth BETWEEN ? AND ?")
-            v.append(subtract_years(now(dbo.timezone), p.MATCHAGETO))
-            v.append(subtract_years(now(dbo.timezone), p.MATCHAGEFROM))
             c.append(_("Age", l) + (" %0.2f - %0.2f" % (p.MATCHAGEFROM, p.MATCHAGETO)))
         if p.MATCHCOMMENTSCONTAIN is not None and p.MATCHCOMMENTSCONTAIN != "":
-            for w in str(p.MATCHCOMMENTSCONTAIN).split(" "):
-                ands.append("(a.AnimalComments LIKE ? OR a.HiddenAnimalDetails LIKE ?)")
-                v.append("%%%s%%" % w)
-                v.append("%%%s%%" % w)
             c.append(_("Comments Contain", l) + ": " + p.MATCHCOMMENTSCONTAIN)
 
-        animals = dbo.query(animal.get_animal_query(dbo) + " WHERE " + " AND ".join(ands) + " ORDER BY a.LastChangedDate DESC", v)
+        animals = matcher.match(p)
 
         # Output owner info
         h.append("<h2>%s (%s) %s %s</h2>" % (p.OWNERNAME, p.OWNERADDRESS, p.HOMETELEPHONE, p.MOBILETELEPHONE))
@@ -1318,7 +1383,7 @@ def lookingfor_report(dbo, username = "system", personid = 0, limit = 0):
 
             # Add an entry to ownerlookingfor for other reports
             if personid == 0:
-                batch.append( ( a.ID, p.ID, summary ) )
+                batch.append({ "AnimalID": a.ID, "OwnerID": p.ID, "MatchSummary": summary })
 
             totalmatches += 1
             if limit > 0 and totalmatches >= limit:
@@ -1338,9 +1403,9 @@ def lookingfor_report(dbo, username = "system", personid = 0, limit = 0):
 
     # Update ownerlookingfor table
     if personid == 0:
-        dbo.execute("DELETE FROM ownerlookingfor")
-        if len(batch) > 0:
-            dbo.execute_many("INSERT INTO ownerlookingfor (AnimalID, OwnerID, MatchSummary) VALUES (?,?,?)", batch)
+        with dbo.transaction():
+            dbo.execute("DELETE FROM ownerlookingfor")
+            dbo.insert_many("ownerlookingfor", batch, generateID=False, writeAudit=False)
 
     return "".join(h)
 
@@ -1357,16 +1422,16 @@ def update_missing_geocodes(dbo):
     We limit this to LIMIT geocode requests per call so that databases with
     a lot of historical data don't end up tying up the daily
     batch for a long time, they'll just slowly complete over time.
+    People at the same address share one lookup and addresses already 
+    in the geocode cache don't need one (see geo.get_lat_longs).
     """
     if not GEO_BATCH:
         al.warn("GEO_BATCH is False, skipping", "update_missing_geocodes", dbo)
         return
     people = dbo.query("SELECT ID, OwnerAddress, OwnerTown, OwnerCounty, OwnerPostcode " \
         "FROM owner WHERE LatLong Is Null OR LatLong = '' ORDER BY CreatedDate DESC", limit=GEO_LIMIT)
-    batch = []
-    for p in people:
-        latlong = geo.get_lat_long(dbo, p.OWNERADDRESS, p.OWNERTOWN, p.OWNERCOUNTY, p.OWNERPOSTCODE)
-        batch.append((latlong, p.ID))
+    latlongs = geo.get_lat_longs(dbo, [ (p.OWNERADDRESS, p.OWNERTOWN, p.OWNERCOUNTY, p.OWNERPOSTCODE, "") for p in people ])
+    batch = [ (latlong, p.ID) for latlong, p in zip(latlongs, people) ]
     dbo.execute_many("UPDATE owner SET LatLong = ? WHERE ID = ?", batch)
     al.debug("updated %d person geocodes" % len(batch), "person.update_missing_geocodes", dbo)
 
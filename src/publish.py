@@ -5,12 +5,22 @@
 """
 
 import al
+import asynctask
 import collections
 import configuration
+import i18n
+import sys
+import threading
+import time
 
 import publishers.adoptapet, publishers.anibaseuk, publishers.foundanimals, publishers.helpinglostpets, publishers.html, publishers.maddiesfund, publishers.petfinder, publishers.petlink, publishers.petrescue, publishers.petslocateduk, publishers.pettracuk, publishers.rescuegroups, publishers.smarttag, publishers.vetenvoy
 
-from publishers.base import PublishCriteria
+from publishers.base import AnimalDataSnapshot, PublishCriteria
+from sitedefs import PUBLISH_MAX_WORKERS, PUBLISH_TIMEOUT
+
+# How long (seconds) a publisher that has been asked to stop after timing 
+# out has to finish before we stop waiting for it
+PUBLISH_STOP_GRACE = 60
 
 PUBLISHER_LIST = collections.OrderedDict()
 PUBLISHER_LIST["html"] = {
@@ -122,8 +132,113 @@ def start_publisher(dbo, code, user = "", newthread = True):
         p = PUBLISHER_LIST[code]["class"](dbo, pc)
 
     if newthread:
-        p.start()
+        t = threading.Thread(target=run_publisher, args=(p,))
+        t.daemon = p.daemon
+        t.start()
     else:
+        run_publisher(p)
+
+def run_publisher(p):
+    """ Runs publisher p, releasing what it holds even if it fails or returns early """
+    try:
         p.run()
+    finally:
+        p.release()
+
+def run_publishers(dbo, codes, user = "system", maxworkers = PUBLISH_MAX_WORKERS, timeout = PUBLISH_TIMEOUT):
+    """
+    Runs the third party publishers with codes for a database at the same
+    time, at most maxworkers at once, and waits for them to finish. 
+    The adoptable animal data is read once and shared between them.
+    A publisher still running after timeout seconds is asked to stop.
+    Each publisher writes its own publishlog entry as usual, and a summary 
+    of the run is written to publishlog under the name "3pty".
+    The asynctask lock for the database is held for the whole run, with
+    progress counting the publishers that have finished. The publishers
+    run pooled, so they leave the lock and progress alone, and each
+    gets its own copy of dbo so that they don't share a connection.
+    Returns a dict of code -> outcome (completed, failed, timedout or abandoned)
+    """
+    pc = PublishCriteria(configuration.publisher_presets(dbo))
+    if asynctask.is_task_running(dbo):
+        al.warn("a publisher is already running, not starting %s" % codes, "publish.run_publishers", dbo)
+        return {}
+    snapshot = AnimalDataSnapshot(dbo.clone(), pc)
+    started = i18n.now(dbo.timezone)
+    pending = []
+    for code in codes:
+        if code == "html" or code not in PUBLISHER_LIST:
+            al.error("invalid publisher code '%s'" % code, "publish.run_publishers", dbo)
+            continue
+        p = PUBLISHER_LIST[code]["class"](dbo.clone(), pc)
+        p.animalData = snapshot
+        p.pooled = True
+        pending.append((code, p))
+    publishers = list(pending)
+    # One more than the publishers so the task still counts as running
+    # when the last one finishes, until reset at the end of the run
+    asynctask.set_task_name(dbo, "3pty")
+    asynctask.set_progress_max(dbo, len(publishers) + 1)
+    asynctask.set_progress_value(dbo, 0)
+    asynctask.set_cancel(dbo, False)
+
+    outcomes = {}
+    def run_one(code, p):
+        try:
+            run_publisher(p)
+            outcomes[code] = "completed"
+        except Exception as err:
+            outcomes[code] = "failed"
+            al.error("publisher %s failed: %s" % (code, err), "publish.run_publishers", dbo, sys.exc_info())
 
+    running = [] # [ code, publisher, thread, started ]
+    timings = {}
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < max(maxworkers, 1):
+                code, p = pending.pop(0)
+                t = threading.Thread(target=run_one, args=(code, p))
+                t.daemon = True
+                t.start()
+                running.append([ code, p, t, time.time() ])
+            running[0][2].join(0.1)
+            for r in running[:]:
+                code, p, t, tstart = r
+                elapsed = time.time() - tstart
+                if not t.is_alive():
+                    running.remove(r)
+                    timings[code] = elapsed
+                    asynctask.set_progress_value(dbo, len(timings))
+                elif elapsed > timeout + PUBLISH_STOP_GRACE:
+                    # It didn't stop when asked, give up on it and free its slot
+                    al.error("publisher %s did not stop after %d seconds, abandoning it" % (code, elapsed), "publish.run_publishers", dbo)
+                    running.remove(r)
+                    outcomes[code] = "abandoned"
+                    timings[code] = elapsed
+                    asynctask.set_progress_value(dbo, len(timings))
+                elif elapsed > timeout and not p.stopRequested:
+                    al.warn("publisher %s timed out after %d seconds, asking it to stop" % (code, timeout), "publish.run_publishers", dbo)
+                    p.stopRequested = True
+    finally:
+        asynctask.reset(dbo)
 
+    # Aggregate the results into a single log for the run
+    log = []
+    successes = 0
+    alerts = 0
+    for code, p in publishers:
+        if p.stopRequested and outcomes.get(code) == "completed": outcomes[code] = "timedout"
+        outcome = outcomes.get(code, "abandoned")
+        successes += p.successes
+        alerts += p.alerts
+        if outcome != "completed": alerts += 1
+        log.append("%s: %s in %ds, %d successes, %d alerts" % (code, outcome, timings.get(code, 0), p.successes, p.alerts))
+        if p.lastError != "": log.append("%s: %s" % (code, p.lastError))
+    dbo.insert("publishlog", {
+        "PublishDateTime":      started,
+        "Name":                 "3pty",
+        "Success":              successes,
+        "Alerts":               alerts,
+        "*LogData":             "\n".join(log)
+    })
+    return outcomes
@@ -11,7 +11,9 @@ import glob
 import i18n
 import media
 import movement
+import multiprocessing
 import os
+import Queue
 import shutil
 import sys
 import tempfile
@@ -19,7 +21,10 @@ import threading
 import utils
 import wordprocessor
 
-from sitedefs import MULTIPLE_DATABASES_PUBLISH_DIR, MULTIPLE_DATABASES_PUBLISH_FTP
+from sitedefs import MULTIPLE_DATABASES_PUBLISH_DIR, MULTIPLE_DATABASES_PUBLISH_FTP, PUBLISH_FTP_CONNECTIONS, PUBLISH_IMAGE_PROCESSES
+
+# Where the manifests of images uploaded by each FTP publisher are kept in the dbfs
+IMAGE_MANIFEST_PATH = "/publish"
 
 def quietcallback(x):
     """ ftplib callback that does nothing instead of dumping to stdout """
@@ -354,6 +359,40 @@ def is_animal_adoptable(dbo, a):
     if len(p.internalLocations) > 0 and a.ACTIVEMOVEMENTTYPE == 0 and str(a.SHELTERLOCATION) not in p.internalLocations: return False
     return True
 
+def get_scale_spec(scalesize):
+    """
+    Returns the resize spec for the scaleImages publish criteria,
+    translating our old ASM2 fixed numbers (see AbstractPublisher.scaleImage).
+    Returns an empty string for no scaling.
+    """
+    if scalesize == "" or scalesize == "1": return ""
+    elif scalesize == "2": return "320x200"
+    elif scalesize == "3": return "640x400"
+    elif scalesize == "4": return "800x600"
+    elif scalesize == "5": return "1024x768"
+    elif scalesize == "6": return "300x300"
+    elif scalesize == "7": return "95x95"
+    return scalesize
+
+def scale_publish_image(imagefile, scalespec, thumbnail, thumbnailspec):
+    """
+    Scales imagefile in place to scalespec (if set) and then generates 
+    thumbnail from it (if set). This runs in the image scaling processes, 
+    so errors are returned as a list of messages rather than logged.
+    """
+    errors = []
+    if scalespec != "":
+        try:
+            media.scale_image_file(imagefile, imagefile, scalespec)
+        except Exception as err:
+            errors.append("Failed scaling image: %s" % err)
+    if thumbnail != "":
+        try:
+            media.scale_image_file(imagefile, thumbnail, thumbnailspec)
+        except Exception as err:
+            errors.append("Failed scaling thumbnail: %s" % err)
+    return errors
+
 class PublishCriteria(object):
     """
     Class containing publishing criteria. Has functions to 
@@ -503,12 +542,35 @@ class PublishCriteria(object):
         if self.publishDirectory is not None: s += " publishdirectory=" + self.publishDirectory
         return s.strip()
 
+class AnimalDataSnapshot(object):
+    """
+    The adoptable animal data for a database, built once and shared by
+    publishers running together (see publish.run_publishers) so that 
+    they don't each run the query. Every publisher gets its own copy
+    of the rows, so nothing one publisher does to them can affect another.
+    """
+    def __init__(self, dbo, pc):
+        self.dbo = dbo
+        self.pc = pc
+        self.lock = threading.Lock()
+        self.rows = {} # include_additional_fields -> rows
+
+    def get(self, includeAdditionalFields=False):
+        """ Returns a copy of the animal data, building it on first use """
+        with self.lock:
+            if includeAdditionalFields not in self.rows:
+                self.rows[includeAdditionalFields] = get_animal_data(self.dbo, self.pc, include_additional_fields=includeAdditionalFields)
+            rows = self.rows[includeAdditionalFields]
+        return [ r.copy() for r in rows ]
+
 class AbstractPublisher(threading.Thread):
     """
     Base class for all publishers
     """
     dbo = None
     pc = None
+    animalData = None # AnimalDataSnapshot if set, otherwise animals are read by getMatchingAnimals
+    stopRequested = False
     totalAnimals = 0
     publisherName = ""
     publisherKey = ""
@@ -520,6 +582,7 @@ class AbstractPublisher(threading.Thread):
     locale = "en"
     lastError = ""
     logBuffer = []
+    pooled = False # True when publish.run_publishers is running this publisher, which holds the task lock and progress for the run
 
     def __init__(self, dbo, publishCriteria):
         threading.Thread.__init__(self)
@@ -590,13 +653,14 @@ class AbstractPublisher(threading.Thread):
         this database. If the ignoreLock publishCriteria option has been
         set, always returns false.
         """
-        if self.pc.ignoreLock: return False
+        if self.pc.ignoreLock or self.pooled: return False
         return asynctask.is_task_running(self.dbo)
 
     def updatePublisherProgress(self, progress):
         """
         Updates the publisher progress in the database
         """
+        if self.pooled: return
         asynctask.set_task_name(self.dbo, self.publisherName)
         asynctask.set_progress_max(self.dbo, 100)
         asynctask.set_progress_value(self.dbo, progress)
@@ -614,7 +678,7 @@ class AbstractPublisher(threading.Thread):
         """
         Replace any $$Tag$$ tags in s, using animal a
         """
-        tags = wordprocessor.animal_tags_publisher(self.dbo, a)
+        tags = wordprocessor.animal_tags_publisher(self.dbo, a, usedtags=wordprocessor.get_used_tags(s, True, "$$", "$$"))
         return wordprocessor.substitute_tags(s, tags, True, "$$", "$$")
 
     def resetPublisherProgress(self):
@@ -622,12 +686,14 @@ class AbstractPublisher(threading.Thread):
         Resets the publisher progress and stops blocking for other 
         publishers
         """
+        if self.pooled: return
         asynctask.reset(self.dbo)
 
     def setPublisherComplete(self):
         """
         Mark the current publisher as complete
         """
+        if self.pooled: return
         asynctask.set_progress_value(self.dbo, 100)
 
     def getProgress(self, i, n):
@@ -642,12 +708,13 @@ class AbstractPublisher(threading.Thread):
         """
         Returns True if we need to stop publishing
         """
-        return asynctask.get_cancel(self.dbo)
+        return self.stopRequested or asynctask.get_cancel(self.dbo)
 
     def setStartPublishing(self):
         """
         Clears the stop publishing flag so we can carry on publishing.
         """
+        if self.pooled: return
         asynctask.set_cancel(self.dbo, False)
 
     def setLastError(self, msg):
@@ -666,6 +733,13 @@ class AbstractPublisher(threading.Thread):
         if save_log: self.saveLog()
         self.setPublisherComplete()
 
+    def release(self):
+        """
+        Called by publish.run_publisher once run has returned, whether or
+        not it called cleanup, to free anything the publisher still holds.
+        """
+        pass
+
     def makePublishDirectory(self):
         """
         Creates a temporary publish directory if one isn't set, or uses
@@ -838,7 +912,10 @@ class AbstractPublisher(threading.Thread):
         self.dbo.execute_many("INSERT INTO animalpublished (AnimalID, PublishedTo, SentDate, Extra) VALUES (?,?,?,?)", batch)
 
     def getMatchingAnimals(self, includeAdditionalFields=False):
-        a = get_animal_data(self.dbo, self.pc, include_additional_fields=includeAdditionalFields)
+        if self.animalData is not None:
+            a = self.animalData.get(includeAdditionalFields)
+        else:
+            a = get_animal_data(self.dbo, self.pc, include_additional_fields=includeAdditionalFields)
         self.log("Got %d matching animals for publishing." % len(a))
         return a
 
@@ -932,21 +1009,273 @@ class AbstractPublisher(threading.Thread):
         6 = 300x300
         7 = 95x95
         """
-        sizespec = ""
-        if scalesize == "" or scalesize == "1": return image
-        elif scalesize == "2": sizespec = "320x200"
-        elif scalesize == "3": sizespec = "640x400"
-        elif scalesize == "4": sizespec = "800x600"
-        elif scalesize == "5": sizespec = "1024x768"
-        elif scalesize == "6": sizespec = "300x300"
-        elif scalesize == "7": sizespec = "95x95"
-        else: sizespec = scalesize
+        sizespec = get_scale_spec(scalesize)
+        if sizespec == "": return image
         self.log("scaling %s to %s" % ( image, scalesize ))
         try:
             return media.scale_image_file(image, image, sizespec)
         except Exception as err:
             self.logError("Failed scaling image: %s" % err, sys.exc_info())
 
+class ImageUploadPipeline(object):
+    """
+    Retrieves, scales and uploads the images for an FTPPublisher in
+    stages that overlap: a thread reads the images from the dbfs, a pool 
+    of processes scales them and a few threads upload them, each over 
+    its own FTP connection. Publishers add images with add() as they go 
+    and call finish() to wait for them all once they're done.
+    Images uploaded by an earlier run that haven't changed since (by the
+    media name, date and size and the scaling options) are skipped, using
+    a manifest kept in the dbfs rather than listing the remote folder.
+    """
+    def __init__(self, publisher, connections = PUBLISH_FTP_CONNECTIONS, processes = PUBLISH_IMAGE_PROCESSES):
+        self.publisher = publisher
+        self.dbo = publisher.dbo
+        self.fetchdbo = publisher.dbo.clone() # the fetch thread's own, so it doesn't share a cached connection with the publisher
+        self.pc = publisher.pc
+        self.connections = 0
+        if self.pc.uploadDirectly: self.connections = max(connections, 1)
+        self.processes = processes
+        self.scalespec = get_scale_spec(str(self.pc.scaleImages))
+        self.fetchq = Queue.Queue()
+        self.uploadq = Queue.Queue()
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(threading.Lock())
+        self.pending = 0 # images added and not yet uploaded (or failed)
+        self.threads = []
+        self.pool = None
+        self.started = False
+        self.cancelled = False
+        self.signatures = None # medianame -> signature of the image
+        self.manifestname = "%s_images.json" % publisher.publisherKey
+        self.manifest = self.loadManifest() # remote directory/name -> [ animal id, signature ]
+        self.knownRemote = self.manifest is not None # True if the manifest covers everything on the server
+        if self.manifest is None and self.pc.uploadDirectly: self.manifest = {}
+        self.uploaded = 0
+        self.skipped = 0
+
+    def loadManifest(self):
+        """
+        Reads the manifest of images uploaded by previous runs. Returns None
+        if there isn't one or it was for another server, in which case we
+        know nothing about what's on the server.
+        """
+        if not self.pc.uploadDirectly: return None
+        try:
+            s = dbfs.get_string(self.dbo, self.manifestname, IMAGE_MANIFEST_PATH)
+            if s == "": return None
+            m = utils.json_parse(s)
+            if m["host"] != self.publisher.ftphost or m["root"] != self.publisher.ftproot: return None
+            return m["images"]
+        except Exception as err:
+            self.publisher.log("Ignoring unreadable image manifest: %s" % err)
+            return None
+
+    def saveManifest(self):
+        """ Stores the manifest of uploaded images for the next run """
+        if self.manifest is None: return
+        try:
+            dbfs.put_string(self.dbo, self.manifestname, IMAGE_MANIFEST_PATH, utils.json({ 
+                "host": self.publisher.ftphost, "root": self.publisher.ftproot, "images": self.manifest }))
+        except Exception as err:
+            self.publisher.logError("Failed saving image manifest: %s" % err, sys.exc_info())
+
+    def signature(self, medianame):
+        """
+        Returns a string that changes when the image with medianame
+        or the way we scale it changes.
+        """
+        if self.signatures is None:
+            self.signatures = {}
+            for m in self.dbo.query("SELECT MediaName, Date, MediaSize FROM media WHERE LinkTypeID = ? " \
+                "AND (LOWER(MediaName) LIKE '%%.jpg' OR LOWER(MediaName) LIKE '%%.jpeg')", [media.ANIMAL]):
+                self.signatures[m.medianame] = "%s:%s:%s" % (m.medianame, m.date, m.mediasize)
+        return "%s:%s:%s:%s" % (self.signatures.get(medianame, medianame), self.pc.scaleImages, self.pc.thumbnails, self.pc.thumbnailSize)
+
+    def start(self):
+        """ Starts the stage threads and scaling processes """
+        self.started = True
+        if self.processes > 0 and (self.scalespec != "" or self.pc.thumbnails):
+            self.pool = multiprocessing.Pool(self.processes)
+        for i in range(0, self.connections):
+            t = threading.Thread(target=self.uploadWorker)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+        self.fetcher = threading.Thread(target=self.fetchWorker)
+        self.fetcher.daemon = True
+        self.fetcher.start()
+
+    def add(self, animalid, medianame, imagename):
+        """
+        Queues the image medianame for animalid to be retrieved, scaled and 
+        uploaded to the current FTP directory as imagename, unless it's already 
+        there and unchanged.
+        """
+        key = "%s/%s" % (self.publisher.currentDir, imagename)
+        sig = self.signature(medianame)
+        if not self.pc.forceReupload and self.manifest is not None and self.manifest.get(key) == [ animalid, sig ]:
+            self.publisher.log("%s: skipping, unchanged since last upload" % imagename)
+            self.skipped += 1
+            return
+        if not self.started: self.start()
+        with self.idle:
+            self.pending += 1
+        thumbnail = ""
+        if self.pc.thumbnails: thumbnail = os.path.join(self.publisher.publishDir, "tn_" + imagename)
+        self.fetchq.put({
+            "animalid":     animalid,
+            "medianame":    medianame,
+            "imagename":    imagename,
+            "imagefile":    os.path.join(self.publisher.publishDir, imagename),
+            "thumbnail":    thumbnail,
+            "directory":    self.publisher.currentDir,
+            "key":          key,
+            "signature":    sig
+        })
+
+    def forget(self, animalid):
+        """
+        Removes the images we uploaded for animalid from the manifest and 
+        returns their remote directory/names. Returns None if we don't know
+        what's on the server because we don't have a manifest from a previous run.
+        """
+        if self.manifest is None: return None
+        with self.lock:
+            keys = [ k for k, v in self.manifest.iteritems() if v[0] == animalid ]
+            for k in keys:
+                del self.manifest[k]
+        if not self.knownRemote: return None
+        return keys
+
+    def forgetAll(self):
+        """ Call when all the images on the server have been deleted """
+        with self.lock:
+            if self.pc.uploadDirectly: 
+                self.manifest = {}
+                self.knownRemote = True
+
+    def done(self):
+        """ Called when we've finished with an image, whatever happened to it """
+        with self.idle:
+            self.pending -= 1
+            if self.pending == 0: self.idle.notify_all()
+
+    def drain(self):
+        """
+        Waits until all the images added so far have been uploaded, 
+        or the publisher is asked to stop.
+        """
+        with self.idle:
+            while self.pending > 0 and not self.publisher.shouldStopPublishing():
+                self.idle.wait(1)
+
+    def finish(self, cancel = False):
+        """
+        Waits for the queued images to be uploaded (or if cancel is set, 
+        for the ones in progress), then stores the manifest.
+        """
+        if self.started:
+            self.cancelled = cancel
+            self.fetchq.put(None)
+            self.fetcher.join()
+            for t in self.threads:
+                t.join()
+        self.saveManifest()
+        self.publisher.log("Images: %d uploaded, %d unchanged" % (self.uploaded, self.skipped))
+
+    def fetchWorker(self):
+        """ Retrieves queued images from the dbfs and passes them on for scaling """
+        while True:
+            job = self.fetchq.get()
+            if job is None: break
+            if self.cancelled: 
+                self.done()
+                continue
+            try:
+                dbfs.get_file(self.fetchdbo, job["medianame"], "", job["imagefile"])
+                self.publisher.log("Retrieved image: %d::%s::%s" % ( job["animalid"], job["medianame"], job["imagename"] ))
+            except Exception as err:
+                self.publisher.logError("Failed retrieving image %s: %s" % (job["medianame"], err), sys.exc_info())
+                self.done()
+                continue
+            args = ( job["imagefile"], self.scalespec, job["thumbnail"], self.pc.thumbnailSize )
+            if self.scalespec == "" and job["thumbnail"] == "":
+                self.scaled(job, [])
+            elif self.pool is not None:
+                self.pool.apply_async(scale_publish_image, args, callback=lambda errors, job=job: self.scaled(job, errors))
+            else:
+                self.scaled(job, scale_publish_image(*args))
+        # Wait for the scaling to finish, then tell the uploaders there's nothing else coming
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        for t in self.threads:
+            self.uploadq.put(None)
+
+    def scaled(self, job, errors):
+        """ Called when an image has been scaled to pass it on for upload """
+        for e in errors:
+            self.publisher.logError("%s: %s" % (job["imagename"], e))
+        if self.connections > 0: 
+            self.uploadq.put(job)
+        else:
+            self.done()
+
+    def uploadWorker(self):
+        """ Uploads scaled images over a connection of its own """
+        socket = None
+        directory = None
+        while True:
+            job = self.uploadq.get()
+            if job is None: break
+            try:
+                if not self.cancelled: socket, directory = self.uploadJob(job, socket, directory)
+            finally:
+                self.done()
+        if socket is not None: self.closeConnection(socket)
+
+    def uploadJob(self, job, socket, directory):
+        """
+        Uploads the files for job over socket, which is connected to directory,
+        reconnecting if necessary. Returns the socket and directory to use next time.
+        """
+        files = [ job["imagefile"] ]
+        if job["thumbnail"] != "": files.append(job["thumbnail"])
+        files = [ f for f in files if os.path.exists(f) ]
+        if len(files) == 0: return socket, directory
+        # Try each upload twice, reconnecting in between
+        for attempt in (1, 2):
+            try:
+                if socket is None or directory != job["directory"]:
+                    if socket is not None: self.closeConnection(socket)
+                    socket = self.publisher.openFTPConnection()
+                    if job["directory"] != "" and job["directory"] != self.publisher.ftproot:
+                        socket.cwd(job["directory"])
+                    directory = job["directory"]
+                for f in files:
+                    self.publisher.log("Uploading: %s" % os.path.basename(f))
+                    with open(f, "rb") as fh:
+                        socket.storbinary("STOR %s" % os.path.basename(f), fh, callback=quietcallback)
+                with self.lock:
+                    if self.manifest is not None: self.manifest[job["key"]] = [ job["animalid"], job["signature"] ]
+                    self.uploaded += 1
+                break
+            except Exception as err:
+                if socket is not None: self.closeConnection(socket)
+                socket = None
+                if attempt == 2:
+                    self.publisher.logError("Failed uploading %s: %s" % (job["imagename"], err), sys.exc_info())
+                else:
+                    self.publisher.log("Failed uploading %s (%s), reconnecting" % (job["imagename"], err))
+        return socket, directory
+
+    def closeConnection(self, socket):
+        try:
+            socket.quit()
+        except:
+            pass
+
 class FTPPublisher(AbstractPublisher):
     """
     Base class for publishers that rely on FTP
@@ -960,6 +1289,7 @@ class FTPPublisher(AbstractPublisher):
     currentDir = ""
     passive = True
     existingImageList = None
+    imagePipeline = None
 
     def __init__(self, dbo, publishCriteria, ftphost, ftpuser, ftppassword, ftpport = 21, ftproot = "", passive = True):
         AbstractPublisher.__init__(self, dbo, publishCriteria)
@@ -1008,6 +1338,18 @@ class FTPPublisher(AbstractPublisher):
             self.logError("Failed opening FTP socket (%s->%s): %s" % (self.dbo.database, self.ftphost, err), sys.exc_info())
             return False
 
+    def openFTPConnection(self):
+        """
+        Opens and returns a new FTP connection to the server in 
+        the root FTP directory (used for uploading images).
+        """
+        s = ftplib.FTP(host=self.ftphost, timeout=15)
+        s.login(self.ftpuser, self.ftppassword)
+        s.set_pasv(self.passive)
+        if self.ftproot is not None and self.ftproot != "":
+            s.cwd(self.ftproot)
+        return s
+
     def closeFTPSocket(self):
         if not self.pc.uploadDirectly: return
         try:
@@ -1047,6 +1389,8 @@ class FTPPublisher(AbstractPublisher):
         if filename.find(os.sep) != -1: filename = filename[filename.rfind(os.sep) + 1:]
         if not self.pc.uploadDirectly: return
         if not os.path.exists(os.path.join(self.publishDir, filename)): return
+        # Make sure the images queued so far are there before anything that refers to them
+        if self.imagePipeline is not None and not self.isImage(filename): self.imagePipeline.drain()
         self.log("Uploading: %s" % filename)
         try:
             if self.pc.checkSocket: self.checkFTPSocket()
@@ -1115,6 +1459,7 @@ class FTPPublisher(AbstractPublisher):
         except Exception as err:
             self.logError("warning: failed removing %s from filesystem: %s" % (oldfiles, err), sys.exc_info())
         if not self.pc.uploadDirectly: return
+        self.getImagePipeline().forgetAll()
         try:
             for f in self.socket.nlst("*.jpg"):
                 self.socket.delete(f)
@@ -1125,41 +1470,51 @@ class FTPPublisher(AbstractPublisher):
         """
         Call when the publisher has completed to tidy up.
         """
+        self.finishImageUploads()
         self.closeFTPSocket()
         self.deletePublishDirectory()
         if save_log: self.saveLog()
         self.setPublisherComplete()
 
+    def release(self):
+        """
+        Stops the image upload threads and scaling processes if run returned
+        without calling cleanup. Images still waiting to be uploaded are dropped.
+        """
+        if self.imagePipeline is None: return
+        try:
+            self.imagePipeline.finish(cancel=True)
+        except Exception as err:
+            self.logError("Failed stopping image uploads: %s" % err, sys.exc_info())
+        self.imagePipeline = None
+
+    def getImagePipeline(self):
+        """ Returns the pipeline that uploads our images, creating it if necessary """
+        if self.imagePipeline is None:
+            self.imagePipeline = ImageUploadPipeline(self)
+        return self.imagePipeline
+
+    def finishImageUploads(self):
+        """
+        Waits for the images queued by uploadImage to be uploaded.
+        Called by cleanup, publishers only need to call it themselves 
+        if they use the images in the publish folder before then.
+        """
+        if self.imagePipeline is None: return
+        try:
+            self.imagePipeline.finish(cancel=self.shouldStopPublishing())
+        except Exception as err:
+            self.logError("Failed finishing image uploads: %s" % err, sys.exc_info())
+        self.imagePipeline = None
+
     def uploadImage(self, a, medianame, imagename):
         """
-        Retrieves image with medianame from the DBFS to the publish
-        folder and uploads it via FTP with imagename
+        Queues image with medianame to be retrieved from the DBFS to the 
+        publish folder, scaled and uploaded via FTP with imagename. 
+        Images that are already on the server and unchanged are skipped.
         """
         try:
-            # Check if the image is already on the server if 
-            # forceReupload is off and the animal doesn't
-            # have any recently changed images
-            if not self.pc.forceReupload and a["RECENTLYCHANGEDIMAGES"] == 0:
-                if self.existingImageList is None:
-                    self.existingImageList = self.lsdir()
-                elif imagename in self.existingImageList:
-                    self.log("%s: skipping, already on server" % imagename)
-                    return
-            imagefile = os.path.join(self.publishDir, imagename)
-            thumbnail = os.path.join(self.publishDir, "tn_" + imagename)
-            dbfs.get_file(self.dbo, medianame, "", imagefile)
-            self.log("Retrieved image: %d::%s::%s" % ( a["ID"], medianame, imagename ))
-            # If scaling is on, do it
-            if self.pc.scaleImages > 1:
-                self.scaleImage(imagefile, self.pc.scaleImages)
-            # If thumbnails are on, do it
-            if self.pc.thumbnails:
-                self.generateThumbnail(imagefile, thumbnail)
-            # Upload
-            if self.pc.uploadDirectly:
-                self.upload(imagefile)
-                if self.pc.thumbnails:
-                    self.upload(thumbnail)
+            self.getImagePipeline().add(a["ID"], medianame, imagename)
         except Exception as err:
             self.logError("Failed uploading image %s: %s" % (medianame, err), sys.exc_info())
             return 0
@@ -1195,12 +1550,22 @@ class FTPPublisher(AbstractPublisher):
         # some recently changed images, remove all the images
         # for this animal before doing anything.
         if self.pc.forceReupload or a["RECENTLYCHANGEDIMAGES"] > 0:
-            if self.existingImageList is None:
-                self.existingImageList = self.lsdir()
-            for ei in self.existingImageList:
-                if ei.startswith(animalcode):
+            uploaded = self.getImagePipeline().forget(a["ID"])
+            if uploaded is not None:
+                # We know what we uploaded for this animal from the manifest
+                for key in uploaded:
+                    directory, ei = key.rsplit("/", 1)
+                    if directory != self.currentDir: continue
                     self.log("delete: %s" % ei)
                     self.delete(ei)
+                    if self.pc.thumbnails: self.delete("tn_" + ei)
+            else:
+                if self.existingImageList is None:
+                    self.existingImageList = self.lsdir()
+                for ei in self.existingImageList:
+                    if ei.startswith(animalcode):
+                        self.log("delete: %s" % ei)
+                        self.delete(ei)
         # Save it to the publish directory
         totalimages = 1
         self.uploadImage(a, animalweb, imagename)
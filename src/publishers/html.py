@@ -74,6 +74,7 @@ def animals_to_page(dbo, animals, style="", speciesid=0, animaltypeid=0, locatio
     foot = wordprocessor.substitute_tags(foot, org_tags, True, "$$", "$$")
     # Run through each animal and generate body sections
     bodies = []
+    usedtags = wordprocessor.get_used_tags(body, True, "$$", "$$")
     for a in animals:
         if speciesid > 0 and a.SPECIESID != speciesid: continue
         if animaltypeid > 0 and a.ANIMALTYPEID != animaltypeid: continue
@@ -84,7 +85,7 @@ def animals_to_page(dbo, animals, style="", speciesid=0, animaltypeid=0, locatio
         else:
             a.WEBSITEMEDIANAME = "%s?method=animal_image&animalid=%d" % (SERVICE_URL, a.ID)
         # Generate tags for this row
-        tags = wordprocessor.animal_tags_publisher(dbo, a)
+        tags = wordprocessor.animal_tags_publisher(dbo, a, usedtags=usedtags)
         tags = wordprocessor.append_tags(tags, org_tags)
         # Add extra tags for websitemedianame2-8 if they exist
         if a.WEBSITEIMAGECOUNT > 1: tags["WEBMEDIAFILENAME2"] = "%s&seq=2" % a.WEBSITEMEDIANAME
@@ -124,7 +125,7 @@ def get_animal_view(dbo, animalid):
     else:
         a.WEBSITEMEDIANAME = "%s?method=animal_image&animalid=%d" % (SERVICE_URL, animalid)
     s = head + body + foot
-    tags = wordprocessor.animal_tags_publisher(dbo, a)
+    tags = wordprocessor.animal_tags_publisher(dbo, a, usedtags=wordprocessor.get_used_tags(s, True, "$$", "$$"))
     tags = wordprocessor.append_tags(tags, wordprocessor.org_tags(dbo, "system"))
     # Add extra tags for websitemedianame2-10 if they exist
     for x in range(2, 11):
@@ -279,7 +280,7 @@ class HTMLPublisher(FTPPublisher):
         """
         Substitutes any tags in the body for animal data
         """
-        tags = wordprocessor.animal_tags_publisher(self.dbo, a)
+        tags = wordprocessor.animal_tags_publisher(self.dbo, a, usedtags=wordprocessor.get_used_tags(searchin, True, "$$", "$$"))
         tags["TotalAnimals"] = str(self.totalAnimals)
         tags["IMAGE"] = str(a["WEBSITEMEDIANAME"])
         # Note: WEBSITEMEDIANOTES becomes ANIMALCOMMENTS in get_animal_data when publisher_use_comments is on
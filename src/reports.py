@@ -3,10 +3,13 @@
 import animal
 import configuration
 import dbupdate
+import emailqueue
 import i18n
+import itertools
 import lookups
 import html
 import person
+import re
 import template
 import users
 import utils
@@ -15,6 +18,23 @@ from sitedefs import BASE_URL, QR_IMG_SRC, URL_REPORTS
 HEADER = 0
 FOOTER = 1
 
+# Header/footer calculation keys that need all the rows in the report
+ALL_ROW_KEYS = re.compile(r"\{(sum|count|avg|pct|min|max|first|last|subreport)\.", re.IGNORECASE)
+
+# Characters that denote a field token has ended
+FIELD_TOKEN_END = (" ", "\n", "\r", ",", "<", ">", "&" , "[", "]", "{", "}", ".", "$", "*", ":", ";", "!", "%", "^", "(", ")", "@", "~", "/", "\\", "'", "\"", "|")
+
+# Placeholder substituted for fields when compiling a block, the field index goes between the markers
+SLOT = "\x00%d\x00"
+SLOT_SPLIT = re.compile("\x00(\d+)\x00")
+
+# Compiled report templates, (database, customreport ID) -> (html, ReportTemplate)
+report_templates = {}
+REPORT_TEMPLATE_CACHE_SIZE = 200
+
+# The most column sets a template compiles its blocks for
+REPORT_BLOCK_CACHE_SIZE = 50
+
 DEFAULT_REPORT_HEADER = """
 <!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN" "http://www.w3.org/TR/html4/strict.dtd">
 <html>
@@ -545,7 +565,7 @@ def email_daily_reports(dbo, now = None):
         body = execute(dbo, r.ID, "dailyemail")
         # Only send if there's data on the report
         if body.find(i18n._("No data to show on the report.", l)) == -1:
-            utils.send_email(dbo, configuration.email(dbo), emails, "", "", r.TITLE, body, "html", exceptions=False)
+            emailqueue.queue_email(dbo, configuration.email(dbo), emails, "", "", r.TITLE, body, "html")
 
 def execute_title(dbo, title, username = "system", params = None):
     """
@@ -560,6 +580,13 @@ def execute_title(dbo, title, username = "system", params = None):
     else:
         return execute(dbo, crid, username, params)
 
+def uses_all_rows(text):
+    """
+    Returns True if a report header/footer block contains calculations
+    (eg: {SUM.field}) that need every row of the report.
+    """
+    return ALL_ROW_KEYS.search(text) is not None
+
 def execute(dbo, customreportid, username = "system", params = None):
     """
     Executes a custom report by its ID. 'params' is a tuple of 
@@ -571,16 +598,17 @@ def execute(dbo, customreportid, username = "system", params = None):
     r = Report(dbo)
     return r.Execute(customreportid, username, params)
 
-def execute_query(dbo, customreportid, username = "system", params = None):
+def execute_query(dbo, customreportid, username = "system", params = None, stream = False):
     """
     Executes a custom report query by its ID. 'params' is a tuple of 
     parameters. username is the name of the user running the 
     report. See the Report._SubstituteSQLParameters function for
     more info. Return value is the list of rows from the query and
     a list of columns.
+    stream: If True, the rows are returned as a generator (see dbo.query_stream)
     """
     r = Report(dbo)
-    return r.ExecuteQuery(customreportid, username, params)
+    return r.ExecuteQuery(customreportid, username, params, stream)
 
 def execute_sql(dbo, title, sql, html, headerfooter = True, username = "system"):
     """
@@ -600,6 +628,191 @@ def execute_sql(dbo, title, sql, html, headerfooter = True, username = "system")
     r.omitHeaderFooter = headerfooter
     return r.Execute(0, username)
 
+def replace_fields(s, k, v):
+    """
+    Replaces field tokens in HTML for real fields. 
+    Escapes curly braces and dollars for HTML entities as they can blow 
+    up the parser after substitution.
+    s is the html string, k is the fieldname, v is the value
+    """
+    lc = s.lower()
+    tok = lc.find("$")
+    while tok != -1:
+        aftertok = lc[tok+1+len(k):tok+1+len(k)+1]
+        if lc[tok+1:tok+1+len(k)] == k.lower() and aftertok in FIELD_TOKEN_END:
+            foundtok = s[tok+1:tok+1+len(k)]
+            v = escape_field_value(v)
+            s = s.replace("$" + foundtok + aftertok, v + aftertok)
+            lc = s.lower()
+        tok = lc.find("$", tok+1) 
+    return s
+
+def escape_field_value(v):
+    """ Escapes the characters in a field value that would be parsed as tokens """
+    return v.replace("{", "&#123;").replace("}", "&#125;").replace("$", "&#36;")
+
+def compile_block(text, keys):
+    """
+    Compiles a block of report html for rows with fields keys (in the
+    order they are iterated). Returns a ReportBlock or None if the block
+    can't be compiled.
+    The block is compiled by replacing the fields in it with placeholders
+    exactly as replace_fields would with real values. Where the result
+    could depend on the values (a value straight after a $ or a field
+    token, where it could complete or extend a token), None is returned
+    and the block has to be substituted row by row.
+    """
+    if text.find("\x00") != -1: return None
+    for i, k in enumerate(keys):
+        text = replace_fields(text, k, SLOT % i)
+    parts = SLOT_SPLIT.split(text)
+    segments = parts[0::2]
+    fields = [ keys[int(x)] for x in parts[1::2] ]
+    lkeys = [ "$" + k.lower() for k in keys ]
+    for seg in segments[:-1]:
+        lseg = seg.lower()
+        if lseg.endswith("$"): return None
+        for k in lkeys:
+            if lseg.endswith(k): return None
+    return ReportBlock(segments, fields)
+
+class ReportBlock:
+    """
+    A block of report html (the body, a header or footer) compiled for
+    the columns of a resultset into the static text between its field
+    tokens, so that it can be rendered for a row in a single pass.
+    """
+    def __init__(self, segments, fields):
+        self.segments = segments # static text, one more than fields
+        self.fields = fields     # the field in each slot between segments
+        self.unique = list(set(fields))
+
+    def render(self, r, display):
+        """
+        Renders the block for row r, display is the function
+        to get the display value of a field (k, v)
+        """
+        values = dict([ (f, escape_field_value(display(f, r[f]))) for f in self.unique ])
+        out = [ self.segments[0] ]
+        for i, f in enumerate(self.fields):
+            out.append(values[f])
+            out.append(self.segments[i+1])
+        return "".join(out)
+
+class ReportTemplate:
+    """
+    The html of a report parsed into its blocks. If the html is
+    invalid, error holds the message to show instead of the report.
+    The field tokens in each block are compiled on demand for each 
+    set of columns (see get_block).
+    """
+    def __init__(self, html):
+        self.htmlheader = None
+        self.htmlfooter = None
+        self.header = ""
+        self.body = ""
+        self.footer = ""
+        self.nodata = ""
+        self.groups = [] # tuples of fieldname, header, footer
+        self.error = ""
+        self.streamable = False
+        self.blocks = {}
+        self._Parse(html)
+
+    def _Parse(self, html):
+        htmlheaderstart = html.find("$$HTMLHEADER")
+        htmlheaderend = html.find("HTMLHEADER$$")
+        if htmlheaderstart != -1 and htmlheaderend != -1:
+            self.htmlheader = html[htmlheaderstart+12:htmlheaderend]
+
+        htmlfooterstart = html.find("$$HTMLFOOTER")
+        htmlfooterend = html.find("HTMLFOOTER$$")
+        if htmlfooterstart != -1 and htmlfooterend != -1:
+            self.htmlfooter = html[htmlfooterstart+12:htmlfooterend]
+
+        headerstart = html.find("$$HEADER")
+        headerend = html.find("HEADER$$", headerstart)
+        if headerstart == -1 or headerend == -1:
+            self.error = "The header block of your report is invalid."
+            return
+        self.header = html[headerstart+8:headerend]
+
+        bodystart = html.find("$$BODY")
+        bodyend = html.find("BODY$$")
+        if bodystart == -1 or bodyend == -1:
+            self.error = "The body block of your report is invalid."
+            return
+        self.body = html[bodystart+6:bodyend]
+
+        footerstart = html.find("$$FOOTER")
+        footerend = html.find("FOOTER$$", footerstart)
+        if footerstart == -1 or footerend == -1:
+            self.error = "The footer block of your report is invalid."
+            return
+        self.footer = html[footerstart+8:footerend]
+
+        # Optional NODATA block
+        nodatastart = html.find("$$NODATA")
+        nodataend = html.find("NODATA$$")
+        if nodatastart != -1 and nodataend != -1:
+            self.nodata = html[nodatastart+8:nodataend]
+
+        # Parse all groups from the HTML
+        groupstart = html.find("$$GROUP_")
+        while groupstart != -1:
+            groupend = html.find("GROUP$$", groupstart)
+            if groupend == -1:
+                self.error = "A group block of your report is invalid (missing GROUP$$ closing tag)"
+                return
+
+            ghtml = html[groupstart:groupend]
+            ghstart = ghtml.find("$$HEAD")
+            if ghstart == -1:
+                self.error = "A group block of your report is invalid (no group $$HEAD)"
+                return
+
+            ghstart += 6
+            ghend = ghtml.find("$$FOOT", ghstart)
+            if ghend == -1:
+                self.error = "A group block of your report is invalid (no group $$FOOT)"
+                return
+
+            self.groups.append( (ghtml[8:ghstart-6].strip().upper(), ghtml[ghstart:ghend], ghtml[ghend+6:]) )
+            groupstart = html.find("$$GROUP_", groupend)
+
+        # If there are no groups or calculations in the header/footer, 
+        # only one row is needed at a time, so the results can be streamed
+        self.streamable = len(self.groups) == 0 and not uses_all_rows(self.header) and not uses_all_rows(self.footer)
+
+    def get_block(self, text, r):
+        """
+        Returns text (one of our blocks) compiled for the columns of row r,
+        or None if it has to be substituted row by row.
+        """
+        key = (text, tuple(r.iterkeys()))
+        if key in self.blocks: return self.blocks[key]
+        if len(self.blocks) >= REPORT_BLOCK_CACHE_SIZE: self.blocks.clear()
+        block = compile_block(text, key[1])
+        self.blocks[key] = block
+        return block
+
+def get_report_template(dbo, customreportid, html):
+    """
+    Returns the ReportTemplate for a custom report's html. Templates
+    are cached by report ID and only parsed again if the html changes.
+    A customreportid of 0 (html that doesn't belong to a stored report)
+    is parsed every time.
+    """
+    if customreportid == 0: return ReportTemplate(html)
+    key = (dbo.database, customreportid)
+    cached = report_templates.get(key)
+    if cached is not None and cached[0] == html:
+        return cached[1]
+    t = ReportTemplate(html)
+    if len(report_templates) >= REPORT_TEMPLATE_CACHE_SIZE: report_templates.clear()
+    report_templates[key] = (html, t)
+    return t
+
 class GroupDescriptor:
     """
     Contains info on report groups
@@ -626,10 +839,12 @@ class Report:
     omitCriteria = False
     omitHeaderFooter = False
     isSubReport = False
-    output = ""
+    compiled = None
+    output = None
     
     def __init__(self, dbo):
         self.dbo = dbo
+        self.output = []
 
     def _ReadReport(self, reportId):
         """
@@ -686,8 +901,13 @@ class Report:
             return s
 
     def _Append(self, s):
-        self.output += str(s)
-        return self.output
+        self.output.append(str(s))
+
+    def _Output(self):
+        """ Returns everything output so far as a string """
+        s = "".join(self.output)
+        self.output = [ s ]
+        return s
 
     def _p(self, s):
         self._Append("<p>%s</p>" % s)
@@ -697,24 +917,23 @@ class Report:
 
     def _ReplaceFields(self, s, k, v):
         """
-        Replaces field tokens in HTML for real fields. 
-        Escapes curly braces and dollars for HTML entities as they can blow 
-        up the parser after substitution.
+        Replaces field tokens in HTML for real fields (see replace_fields)
         s is the html string, k is the fieldname, v is the value
         """
-        # Characters that denote a field token has ended
-        validend = (" ", "\n", "\r", ",", "<", ">", "&" , "[", "]", "{", "}", ".", "$", "*", ":", ";", "!", "%", "^", "(", ")", "@", "~", "/", "\\", "'", "\"", "|")
-        lc = s.lower()
-        tok = lc.find("$")
-        while tok != -1:
-            aftertok = lc[tok+1+len(k):tok+1+len(k)+1]
-            if lc[tok+1:tok+1+len(k)] == k.lower() and aftertok in validend:
-                foundtok = s[tok+1:tok+1+len(k)]
-                v = v.replace("{", "&#123;").replace("}", "&#125;")
-                v = v.replace("$", "&#36;")
-                s = s.replace("$" + foundtok + aftertok, v + aftertok)
-                lc = s.lower()
-            tok = lc.find("$", tok+1) 
+        return replace_fields(s, k, v)
+
+    def _SubstituteFields(self, s, r):
+        """
+        Substitutes all the fields from row r in html string s,
+        using the compiled block for s if there is one.
+        """
+        block = None
+        if self.compiled is not None:
+            block = self.compiled.get_block(s, r)
+        if block is not None:
+            return block.render(r, self._DisplayValue)
+        for k, v in r.iteritems():
+            s = self._ReplaceFields(s, k, self._DisplayValue(k, v))
         return s
         
     def _DisplayValue(self, k, v):
@@ -757,11 +976,11 @@ class Report:
 
         # Replace any fields in the block based on the last row
         # in the group
-        for k, v in rs[gd.lastGroupEndPosition].iteritems():
-            out = self._ReplaceFields(out, k, self._DisplayValue(k, v))
+        out = self._SubstituteFields(out, rs[gd.lastGroupEndPosition])
 
         # Replace any of our special header/footer tokens
-        out = self._SubstituteTemplateHeaderFooter(out)
+        if out.find("$$") != -1:
+            out = self._SubstituteTemplateHeaderFooter(out)
 
         # Find calculation keys in our block
         startkey = out.find("{")
@@ -1243,9 +1462,10 @@ class Report:
         They should all be strings and will be literally replaced.
         Return value is the HTML output of the report.
         """
+        self.reportId = reportId
         self.user = username
         self.params = params
-        self.output = ""
+        self.output = []
 
         # Attempt to read our report if an ID was specified
         if reportId != 0: 
@@ -1266,16 +1486,18 @@ class Report:
         else:
             self._GenerateReport()
 
-        return self.output
+        return self._Output()
 
-    def ExecuteQuery(self, reportId = 0, username = "system", params = None):
+    def ExecuteQuery(self, reportId = 0, username = "system", params = None, stream = False):
         """
         Executes the query portion of a report only and then returns
         the query results and column order.
+        If stream is True, the results are a generator of rows
+        rather than a list.
         """
         self.user = username
         self.params = params
-        self.output = ""
+        self.output = []
 
         # Attempt to read our report if an ID was specified
         if reportId != 0: 
@@ -1293,9 +1515,13 @@ class Report:
         rs = None
         cols = None
         try:
-            rs = self.dbo.query(self.sql)
+            if stream:
+                rs = self.dbo.query_stream(self.sql)
+            else:
+                rs = self.dbo.query(self.sql)
             cols = self.dbo.query_columns(self.sql)
         except Exception as e:
+            rs = None
             self._p(e)
         return (rs, cols)
 
@@ -1321,7 +1547,7 @@ class Report:
         except Exception as e:
             self._p(e)
             self._Append("</body></html>")
-            return self.output
+            return self._Output()
 
         # Output any criteria given at the top of the chart
         self.OutputCriteria()
@@ -1330,7 +1556,7 @@ class Report:
         if len(rs) == 0:
             self._p(i18n._("No data.", l))
             self._Append("</body></html>")
-            return self.output
+            return self._Output()
 
         self._Append("""<script type="text/javascript">
             $(function() {
@@ -1403,7 +1629,8 @@ class Report:
                 self._Append("{ label: '%s', \n" % label(k))
                 self._Append("data: [%s], \n%s\n },\n" % (",".join(v), mode))
             # Remove trailing comma
-            self.output = self.output[0:len(self.output)-1]
+            out = self._Output()
+            self.output = [ out[0:len(out)-1] ]
             self._Append("""\n], {
                 xaxis: {
                     tickDecimals: 0 
@@ -1423,7 +1650,7 @@ class Report:
             </script>
             </body>
             </html>""")
-        return self.output
+        return self._Output()
 
     def _GenerateMap(self):
         """
@@ -1441,7 +1668,7 @@ class Report:
         except Exception as e:
             self._p(e)
             self._Append("</body></html>")
-            return self.output
+            return self._Output()
 
         # Output any criteria given at the top of the chart
         self.OutputCriteria()
@@ -1450,13 +1677,13 @@ class Report:
         if len(rs) == 0:
             self._p(i18n._("No data.", l))
             self._Append("</body></html>")
-            return self.output
+            return self._Output()
 
         # Check we have two columns
         if len(rs[0]) != 2:
             self._p("Map query should have two columns.")
             self._Append("</body></html>")
-            return self.output
+            return self._Output()
 
         self._Append('<div id="embeddedmap" style="z-index: 1; width: 100%%; height: 600px; color: #000" />\n')
         self._Append("<script type='text/javascript'>\n" \
@@ -1474,106 +1701,186 @@ class Report:
             </script>
             </body>
             </html>""")
-        return self.output
+        return self._Output()
 
-    def _GenerateReport(self):
+    def _OutputBody(self, cbody, r):
         """
-        Does the work of generating the report content
+        Outputs the body block, 'cbody' is the text of the block
+        and 'r' is the row of results being looked at
         """
+        # Make a temp string to hold the body block 
+        # while we substitute fields for tags
+        tempbody = self._SubstituteFields(cbody, r)
 
-        # String indexes within report html string to where 
-        # tokens begin and end
-        headerstart = 0
-        headerend = 0
-        bodystart = 0
-        bodyend = 0
-        footerstart = 0
-        footerend = 0
-        groupstart = 0
-        groupend = 0
-
-        tempbody = ""
-        cheader = ""
-        cbody = ""
-        cfooter = ""
+        # Deal with any non-field/calculation keys
+        startkey = tempbody.find("{")
+        while startkey != -1:
+            endkey = tempbody.find("}", startkey)
+            if endkey == -1: endkey = len(tempbody)-1
+            key = tempbody[startkey+1:endkey]
+            value = ""
+            valid = False
 
-        l = self.dbo.locale
+            # {SQL.sql}
+            if key.lower().startswith("sql."):
+                valid = True
+                asql = key[4:]
+                if asql.lower().startswith("select"):
+                    # Select - return first row/column
+                    try:
+                        value = self.dbo.query_string(asql)
+                    except Exception as e:
+                        value = str(e)
+                else:
+                    # Action query, run it
+                    try:
+                        value = ""
+                        self.dbo.execute(asql)
+                    except Exception as e:
+                        value = str(e)
 
-        htmlheader = self._ReadHeader()
-        htmlheaderstart = self.html.find("$$HTMLHEADER")
-        htmlheaderend = self.html.find("HTMLHEADER$$")
-        if htmlheaderstart != -1 and htmlheaderend != -1:
-            htmlheader = self.html[htmlheaderstart+12:htmlheaderend]
+            # {IMAGE.animalid[.seq]} - substitutes a link to the image
+            # page to direct the browser to retrieve an image. seq is
+            # optional and includes image number X for the animal. If
+            # seq is not given, the preferred image is used.
+            if key.lower().startswith("image."):
+                valid = True
+                fields = key.lower().split(".")
+                if len(fields) < 2:
+                    self._p("Invalid IMAGE tag, requires 2 components: %s" % key)
+                    valid = False
+                    startkey = tempbody.find("{", startkey+1)
+                    continue
+                animalid = fields[1]
+                seq = ""
+                if len(fields) > 2: seq = "&seq=" + fields[2]
+                value = "image?db=%s&mode=animal&id=%s%s" % (self.dbo.database, animalid, seq)
 
-        htmlfooter = self._ReadFooter()
-        htmlfooterstart = self.html.find("$$HTMLFOOTER")
-        htmlfooterend = self.html.find("HTMLFOOTER$$")
-        if htmlfooterstart != -1 and htmlfooterend != -1:
-            htmlfooter = self.html[htmlfooterstart+12:htmlfooterend]
+            # {CHIPMANUFACTURER.chipno} - substitutes the microchip
+            # manufacturer for the chip number specified
+            if key.lower().startswith("chipmanufacturer."):
+                valid = True
+                fields = key.lower().split(".")
+                chipno = fields[1]
+                value = lookups.get_microchip_manufacturer(self.dbo.locale, chipno)
 
-        # Start the report off with the HTML header
-        self._Append(htmlheader)
+            # {QR.animalid[.size]} - substitutes a link to the
+            # google charting api to generate a QR code that
+            # links back to an animal's record.
+            if key.lower().startswith("qr."):
+                valid = True
+                fields = key.lower().split(".")
+                if len(fields) < 2:
+                    self._p("Invalid QR tag, requires 2 components: %s" % key)
+                    valid = False
+                    startkey = tempbody.find("{", startkey+1)
+                    continue
+                animalid = fields[1]
+                size = "150x150"
+                if len(fields) > 2: size = fields[2]
+                url = BASE_URL + "/animal?id=%s" % animalid
+                value = QR_IMG_SRC % { "url": url, "size": size }
 
-        headerstart = self.html.find("$$HEADER")
-        headerend = self.html.find("HEADER$$", headerstart)
-        if headerstart == -1 or headerend == -1:
-            self._p("The header block of your report is invalid.")
-            return
-        cheader = self.html[headerstart+8:headerend]
+            # {SUBREPORT.[title].[parentField]} - embed a subreport
+            if key.lower().startswith("subreport."):
+                valid = True
+                fields = key.lower().split(".")
+                if len(fields) < 2:
+                    self._p("Invalid SUBREPORT tag, requires minimum 2 components: %s" % key)
+                    valid = False
+                    startkey = tempbody.find("{", startkey+1)
+                    continue
+                
+                # Get custom report ID from title
+                crid = self.dbo.query_int("SELECT ID FROM customreport WHERE LOWER(Title) LIKE ?", [fields[1]])
+                if crid == 0:
+                    self._p("Custom report '" + fields[1] + "' doesn't exist.")
+                    valid = False
+                    startkey = tempbody.find("{", startkey+1)
+                    continue
 
-        bodystart = self.html.find("$$BODY")
-        bodyend = self.html.find("BODY$$")
+                # Create our list of parameters from the fields passed
+                # to the subreport key. They are accessed as PARENTARGX
+                # The first one is also passed as PARENTKEY for compatibility
+                # with older reports.
+                subparams = []
+                for x in range(2, len(fields)):
+                    fieldname = fields[x].upper()
+                    fieldvalue = ""
+                    if fieldname not in r:
+                        self._p("Subreport field '" + fields[x] + "' doesn't exist.")
+                        valid = False
+                    else:
+                        fieldvalue = str(r[fieldname])
+                    if x == 2:
+                        subparams.append(("PARENTKEY", "No question parentkey", fieldvalue, fieldvalue))
+                    subparams.append(("PARENTARG%d" % (x-1), "No question parentarg", fieldvalue, fieldvalue ))
 
-        if bodystart == -1 or bodyend == -1:
-            self._p("The body block of your report is invalid.")
-            return
-        cbody = self.html[bodystart+6:bodyend]
+                # Get the content from it
+                sr = Report(self.dbo)
+                value = sr.Execute(crid, self.user, subparams)
 
-        footerstart = self.html.find("$$FOOTER")
-        footerend = self.html.find("FOOTER$$", footerstart)
+            if valid:
+                tempbody = tempbody[0:startkey] + value + tempbody[endkey+1:]
 
-        if footerstart == -1 or footerend == -1:
-            self._p("The footer block of your report is invalid.")
-            return
-        cfooter = self.html[footerstart+8:footerend]
+            # next key
+            startkey = tempbody.find("{", startkey+1)
 
-        # Optional NODATA block
-        nodata = ""
-        nodatastart = self.html.find("$$NODATA")
-        nodataend = self.html.find("NODATA$$")
-        if nodatastart != -1 and nodataend != -1:
-            nodata = self.html[nodatastart+8:nodataend]
+        # Add the substituted body block to our report
+        self._Append(tempbody)
 
-        # Parse all groups from the HTML
-        groups = []
-        groupstart = self.html.find("$$GROUP_")
+    def _GenerateStreamedReport(self, cheader, cbody, cfooter, rows):
+        """
+        Outputs the header, body and footer for a report without groups
+        from an iterable of rows. The header and footer take their field
+        values from the last row, so the body is output first and
+        the header put in front of it when we have the last row.
+        """
+        preamble = self.output
+        self.output = []
+        lastrow = None
+        for r in rows:
+            self._OutputBody(cbody, r)
+            lastrow = r
+        body = self.output
+        self.output = preamble
+        self._SubstituteHeaderFooter(HEADER, cheader, [ lastrow ])
+        self.output.extend(body)
+        self._SubstituteHeaderFooter(FOOTER, cfooter, [ lastrow ])
 
-        while groupstart != -1:
-            groupend = self.html.find("GROUP$$", groupstart)
+    def _GenerateReport(self):
+        """
+        Does the work of generating the report content
+        """
 
-            if groupend == -1:
-                self._p("A group block of your report is invalid (missing GROUP$$ closing tag)")
-                return
+        l = self.dbo.locale
+        t = get_report_template(self.dbo, self.reportId, self.html)
+        self.compiled = t
 
-            ghtml = self.html[groupstart:groupend]
-            ghstart = ghtml.find("$$HEAD")
-            if ghstart == -1:
-                self._p("A group block of your report is invalid (no group $$HEAD)")
-                return
+        htmlheader = t.htmlheader
+        if htmlheader is None: htmlheader = self._ReadHeader()
+        htmlfooter = t.htmlfooter
+        if htmlfooter is None: htmlfooter = self._ReadFooter()
 
-            ghstart += 6
-            ghend = ghtml.find("$$FOOT", ghstart)
+        # Start the report off with the HTML header
+        self._Append(htmlheader)
 
-            if ghend == -1:
-                self._p("A group block of your report is invalid (no group $$FOOT)")
-                return
+        if t.error != "":
+            self._p(t.error)
+            return
+
+        cheader = t.header
+        cbody = t.body
+        cfooter = t.footer
+        nodata = t.nodata
 
+        groups = []
+        for fieldname, header, footer in t.groups:
             gd = GroupDescriptor()
-            gd.header = ghtml[ghstart:ghend]
-            gd.footer = ghtml[ghend+6:]
-            gd.fieldName = ghtml[8:ghstart-6].strip().upper()
+            gd.fieldName = fieldname
+            gd.header = header
+            gd.footer = footer
             groups.append(gd)
-            groupstart = self.html.find("$$GROUP_", groupend)
 
         # Scan the ORDER BY clause to make sure the order
         # matches the grouping levels.  
@@ -1602,18 +1909,30 @@ class Report:
         # Output any criteria given at the top of the report
         self.OutputCriteria()
 
+        # If there are no groups or calculations in the header/footer, 
+        # only one row is needed at a time, so we can stream the results
+        # rather than reading them all into memory.
+        stream = t.streamable
+
         # Run the query
         rs = None
+        firstrow = None
         try:
-            rs = self.dbo.query(self.sql)
+            if stream:
+                rs = self.dbo.query_stream(self.sql)
+                firstrow = next(rs, None)
+                if firstrow is None: rs = []
+            else:
+                rs = self.dbo.query(self.sql)
         except Exception as e:
+            rs = None
             self._p(e)
 
         first_record = True
 
         # If there are no records, show a message to say so
         # but only if it's not a subreport
-        if rs is None or len(rs) == 0:
+        if rs is None or (not stream and len(rs) == 0) or (stream and firstrow is None):
             if not self.isSubReport:
                 if nodata == "":
                     self._p(i18n._("No data to show on the report.", l))
@@ -1623,6 +1942,11 @@ class Report:
                 self._Append(nodata)
             return
 
+        if stream:
+            self._GenerateStreamedReport(cheader, cbody, cfooter, itertools.chain([firstrow], rs))
+            self._Append(htmlfooter)
+            return
+
         # Add the header to the report
         self._SubstituteHeaderFooter(HEADER, cheader, rs)
 
@@ -1682,12 +2006,6 @@ class Report:
 
             first_record = False
 
-            # Make a temp string to hold the body block 
-            # while we substitute fields for tags
-            tempbody = cbody
-            for k, v in rs[row].iteritems():
-                tempbody = self._ReplaceFields(tempbody, k, self._DisplayValue(k, v))
-
             # Update the last value for each group
             for gd in groups:
                 try:
@@ -1695,122 +2013,8 @@ class Report:
                 except Exception as e:
                     self._p(e)
 
-            # Deal with any non-field/calculation keys
-            startkey = tempbody.find("{")
-            while startkey != -1:
-                endkey = tempbody.find("}", startkey)
-                if endkey == -1: endkey = len(tempbody)-1
-                key = tempbody[startkey+1:endkey]
-                value = ""
-                valid = False
-
-                # {SQL.sql}
-                if key.lower().startswith("sql."):
-                    valid = True
-                    asql = key[4:]
-                    if asql.lower().startswith("select"):
-                        # Select - return first row/column
-                        try:
-                            value = self.dbo.query_string(asql)
-                        except Exception as e:
-                            value = str(e)
-                    else:
-                        # Action query, run it
-                        try:
-                            value = ""
-                            self.dbo.execute(asql)
-                        except Exception as e:
-                            value = str(e)
-
-                # {IMAGE.animalid[.seq]} - substitutes a link to the image
-                # page to direct the browser to retrieve an image. seq is
-                # optional and includes image number X for the animal. If
-                # seq is not given, the preferred image is used.
-                if key.lower().startswith("image."):
-                    valid = True
-                    fields = key.lower().split(".")
-                    if len(fields) < 2:
-                        self._p("Invalid IMAGE tag, requires 2 components: %s" % key)
-                        valid = False
-                        startkey = tempbody.find("{", startkey+1)
-                        continue
-                    animalid = fields[1]
-                    seq = ""
-                    if len(fields) > 2: seq = "&seq=" + fields[2]
-                    value = "image?db=%s&mode=animal&id=%s%s" % (self.dbo.database, animalid, seq)
-
-                # {CHIPMANUFACTURER.chipno} - substitutes the microchip
-                # manufacturer for the chip number specified
-                if key.lower().startswith("chipmanufacturer."):
-                    valid = True
-                    fields = key.lower().split(".")
-                    chipno = fields[1]
-                    value = lookups.get_microchip_manufacturer(self.dbo.locale, chipno)
-
-                # {QR.animalid[.size]} - substitutes a link to the
-                # google charting api to generate a QR code that
-                # links back to an animal's record.
-                if key.lower().startswith("qr."):
-                    valid = True
-                    fields = key.lower().split(".")
-                    if len(fields) < 2:
-                        self._p("Invalid QR tag, requires 2 components: %s" % key)
-                        valid = False
-                        startkey = tempbody.find("{", startkey+1)
-                        continue
-                    animalid = fields[1]
-                    size = "150x150"
-                    if len(fields) > 2: size = fields[2]
-                    url = BASE_URL + "/animal?id=%s" % animalid
-                    value = QR_IMG_SRC % { "url": url, "size": size }
-
-                # {SUBREPORT.[title].[parentField]} - embed a subreport
-                if key.lower().startswith("subreport."):
-                    valid = True
-                    fields = key.lower().split(".")
-                    if len(fields) < 2:
-                        self._p("Invalid SUBREPORT tag, requires minimum 2 components: %s" % key)
-                        valid = False
-                        startkey = tempbody.find("{", startkey+1)
-                        continue
-                    
-                    # Get custom report ID from title
-                    crid = self.dbo.query_int("SELECT ID FROM customreport WHERE LOWER(Title) LIKE ?", [fields[1]])
-                    if crid == 0:
-                        self._p("Custom report '" + fields[1] + "' doesn't exist.")
-                        valid = False
-                        startkey = tempbody.find("{", startkey+1)
-                        continue
-
-                    # Create our list of parameters from the fields passed
-                    # to the subreport key. They are accessed as PARENTARGX
-                    # The first one is also passed as PARENTKEY for compatibility
-                    # with older reports.
-                    subparams = []
-                    for x in range(2, len(fields)):
-                        fieldname = fields[x].upper()
-                        fieldvalue = ""
-                        if fieldname not in rs[row]:
-                            self._p("Subreport field '" + fields[x] + "' doesn't exist.")
-                            valid = False
-                        else:
-                            fieldvalue = str(rs[row][fieldname])
-                        if x == 2:
-                            subparams.append(("PARENTKEY", "No question parentkey", fieldvalue, fieldvalue))
-                        subparams.append(("PARENTARG%d" % (x-1), "No question parentarg", fieldvalue, fieldvalue ))
-
-                    # Get the content from it
-                    r = Report(self.dbo)
-                    value = r.Execute(crid, self.user, subparams)
-
-                if valid:
-                    tempbody = tempbody[0:startkey] + value + tempbody[endkey+1:]
-
-                # next key
-                startkey = tempbody.find("{", startkey+1)
-
-            # Add the substituted body block to our report
-            self._Append(tempbody)
+            # Add the body block for this row
+            self._OutputBody(cbody, rs[row])
 
         # Add the final group footers if there are any
         row = len(rs) - 1
@@ -248,8 +248,10 @@ def handler(post, path, remoteip, referer, querystring):
 
     # Do any database updates need doing in this db?
     dbo.installpath = path
-    if dbupdate.check_for_updates(dbo):
-        dbupdate.perform_updates(dbo)
+    if not dbupdate.is_schema_verified(dbo):
+        # Another process may hold the update lock, check again next time if so
+        if not dbupdate.check_for_updates(dbo) or dbupdate.perform_updates(dbo) != "":
+            dbupdate.set_schema_verified(dbo)
 
     # Does the method require us to authenticate? If so, do it.
     user = None
@@ -419,8 +421,8 @@ def handler(post, path, remoteip, referer, querystring):
         users.check_permission_map(l, user["SUPERUSER"], securitymap, users.VIEW_REPORT)
         crid = reports.get_id(dbo, title)
         p = reports.get_criteria_params(dbo, crid, post)
-        rows, cols = reports.execute_query(dbo, crid, username, p)
-        mcsv = utils.csv(l, rows, cols, True)
+        rows, cols = reports.execute_query(dbo, crid, username, p, stream=True)
+        mcsv = "".join(utils.csv_stream(l, rows, cols, True))
         return set_cached_response(cache_key, "text/csv", 600, 600, mcsv)
 
     elif method == "jsonp_recent_changes":
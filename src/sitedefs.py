@@ -61,6 +61,11 @@ def get_integer(k, dv = 0):
     if v == "": return dv
     return int(v)
 
+def get_float(k, dv = 0.0):
+    v = get_string(k)
+    if v == "": return dv
+    return float(v)
+
 def get_dict(k, dv = {}):
     v = get_string(k)
     if v == "": return dv
@@ -130,6 +135,30 @@ DB_TIME_LOG_OVER = get_integer("db_time_log_over", 0)
 # Time out queries that take longer than this (ms) to run
 DB_TIMEOUT = get_integer("db_timeout", 0)
 
+# Keep a pool of open connections per database in each process 
+# rather than connecting for every query. This is the maximum number
+# of connections the pool will hold open for each database (0 to disable).
+DB_POOL_SIZE = get_integer("db_pool_size", 0)
+
+# Close pooled connections that have been idle for longer than this (seconds)
+DB_POOL_IDLE_TIMEOUT = get_integer("db_pool_idle_timeout", 300)
+
+# Check pooled connections that have been idle for longer than this (seconds) 
+# are still alive before handing them out again
+DB_POOL_CHECK_AFTER = get_integer("db_pool_check_after", 30)
+
+# How long to wait (seconds) for a pooled connection to become free
+# when all of them are in use before giving up
+DB_POOL_WAIT_TIMEOUT = get_integer("db_pool_wait_timeout", 30)
+
+# The number of rows fetched from the database at a time when
+# streaming large resultsets (reports, CSV exports)
+DB_STREAM_BATCH_SIZE = get_integer("db_stream_batch_size", 500)
+
+# The most rows sent in one multi-row INSERT statement by 
+# Database.insert_many (imports and batch jobs)
+DB_BULK_BATCH_SIZE = get_integer("db_bulk_batch_size", 500)
+
 # URLs for ASM services
 URL_NEWS = get_string("url_news", "https://sheltermanager.com/repo/asm_news.html")
 URL_REPORTS = get_string("url_reports", "https://sheltermanager.com/repo/reports.txt")
@@ -149,6 +178,17 @@ SESSION_DEBUG = get_boolean("session_debug", False)
 #MEMCACHED_SERVER = "127.0.0.1:11211"
 MEMCACHED_SERVER = get_string("memcached_server", "")
 
+# If memcache is not being used, the type of in memory cache to use.
+# lru - a cache bounded by CACHEMEM_MAX_ENTRIES and CACHEMEM_MAX_BYTES
+#       that discards the least recently used items first.
+# dict - an unbounded dictionary, expired items are only removed when read.
+CACHEMEM_BACKEND = get_string("cachemem_backend", "lru")
+CACHEMEM_MAX_ENTRIES = get_integer("cachemem_max_entries", 10000)
+CACHEMEM_MAX_BYTES = get_integer("cachemem_max_bytes", 67108864)
+
+# How often (seconds) the lru memory cache removes all expired items
+CACHEMEM_SWEEP_INTERVAL = get_integer("cachemem_sweep_interval", 60)
+
 # Where to store media files.
 # database - media files are base64 encoded in the dbfs.content db column
 # file - media files are stored in a folder 
@@ -166,6 +206,17 @@ DBFS_S3_BUCKET = get_string("dbfs_s3_bucket", "")
 # as the application will not attempt to create it.
 DISK_CACHE = get_string("disk_cache", "/tmp/asm_disk_cache")
 
+# The most space (bytes) the disk cache can take up, 0 for no limit.
+# When cron removes expired entries, the least recently used entries
+# are also removed until the cache is within this size.
+DISK_CACHE_MAX_SIZE = get_integer("disk_cache_max_size", 1073741824)
+
+# Where the static assets served by rollup.js, x.js, x.css and i18n.js
+# are kept with their compressed copies once they have been built.
+# memory - in the memory of each process
+# disk - in the disk cache so all processes share them
+ASSET_CACHE = get_string("asset_cache", "memory")
+
 # Cache results of the most common, less important queries for
 # a short period (60 seconds) in the disk cache to help performance. 
 # These queries include shelterview animals and main screen links) 
@@ -175,6 +226,10 @@ CACHE_COMMON_QUERIES = get_boolean("cache_common_queries", False)
 # to their max-age headers in the disk cache
 CACHE_SERVICE_RESPONSES = get_boolean("cache_service_responses", False)
 
+# Keep scaled versions of images (eg: thumbnails) in the disk cache
+# so they are only generated once for each version of a media record
+CACHE_MEDIA_DERIVATIVES = get_boolean("cache_media_derivatives", True)
+
 # If EMAIL_ERRORS is set to True, all errors from the site
 # are emailed to ADMIN_EMAIL and the user is given a generic
 # error page. If set to False, debug information is output.
@@ -228,7 +283,9 @@ GEO_SMCOM_URL = get_string("geo_smcom_url", "")
 GEO_BATCH = get_boolean("geo_batch", False)             # Whether or not to try and lookup geocodes as part of the batch
 GEO_LIMIT = get_integer("geo_limit", 100)               # How many geocodes to lookup as part of the batch
 GEO_LOOKUP_TIMEOUT = get_integer("geo_lookup_timeout", 5) # Timeout in seconds when doing geocode lookups
-GEO_SLEEP_AFTER = get_integer("geo_sleep_after", 1)     # Sleep for seconds after a request to throttle (nominatim has a 1/s limit)
+GEO_SLEEP_AFTER = get_float("geo_sleep_after", 0)       # Minimum seconds between requests to the provider to throttle, 0 to use the provider's own limit (nominatim has a 1/s limit)
+GEO_BATCH_WORKERS = get_integer("geo_batch_workers", 4) # How many threads to lookup geocodes with as part of the batch
+GEO_CACHE_TTL = get_integer("geo_cache_ttl", 7776000)   # How long (seconds) to keep geocodes in the disk cache, shared by all databases
 
 # Enable the database field on login and allow login to multiple databases
 MULTIPLE_DATABASES = get_boolean("multiple_databases", False)
@@ -236,6 +293,17 @@ MULTIPLE_DATABASES_TYPE = get_string("multiple_databases_type", "map")
 # { "alias": { "dbtype": "MYSQL", "host": "localhost", "port": 3306, "username": "root", "password": "root", "database": "asm" } }
 MULTIPLE_DATABASES_MAP = get_dict("multiple_databases_map")
 
+# The most third party publishers to run at the same time for a 
+# database during the batch, and how long (seconds) each one can run
+# before it is asked to stop.
+PUBLISH_MAX_WORKERS = get_integer("publish_max_workers", 4)
+PUBLISH_TIMEOUT = get_integer("publish_timeout", 3600)
+
+# How many FTP connections a publisher uploads images over at the same
+# time and how many processes scale them (0 to scale in the publisher)
+PUBLISH_FTP_CONNECTIONS = get_integer("publish_ftp_connections", 3)
+PUBLISH_IMAGE_PROCESSES = get_integer("publish_image_processes", 2)
+
 # FTP hosts and URLs for third party publishing services
 ADOPTAPET_FTP_HOST = get_string("adoptapet_ftp_host", "autoupload.adoptapet.com")
 ANIBASE_BASE_URL = get_string("anibase_base_url", "")
@@ -314,6 +382,16 @@ SMTP_SERVER = get_dict("smtp_server", { "sendmail": True })
 # {alias} database alias
 FROM_ADDRESS = get_string("from_address", "you@yourdomain.com")
 
+# Batches of email (mail merges, diary notes, report and fosterer emails)
+# go through the email queue. The most messages to send a second over one
+# SMTP session (0 for no limit), how many times to try a message and how
+# long (seconds) to wait before the first retry (doubled for each retry after)
+# and how many days to keep sent and failed messages in the queue.
+EMAIL_QUEUE_RATE = get_integer("email_queue_rate", 10)
+EMAIL_QUEUE_MAX_ATTEMPTS = get_integer("email_queue_max_attempts", 5)
+EMAIL_QUEUE_RETRY_DELAY = get_integer("email_queue_retry_delay", 60)
+EMAIL_QUEUE_KEEP_DAYS = get_integer("email_queue_keep_days", 7)
+
 # URLs to access manuals and help documentation
 MANUAL_HTML_URL = get_string("manual_html_url", "static/pages/manual/index.html")
 MANUAL_FAQ_URL = get_string("manual_faq_url", "static/pages/manual/faq.html")
@@ -3,8 +3,15 @@
 import audit
 import base64
 import configuration
+import random
+import time
 import utils
 
+# Decoded document template content held by this process,
+# (database, template id) -> (version, content)
+document_templates = {}
+DOCUMENT_TEMPLATE_CACHE_SIZE = 200
+
 def get_html_template(dbo, name):
     """ Returns a tuple of the header, body and footer values for template name """
     rows = dbo.query("SELECT * FROM templatehtml WHERE Name = ?", [name])
@@ -47,9 +54,32 @@ def get_document_templates(dbo):
         where = " WHERE Name LIKE '%.html' "
     return dbo.query("SELECT ID, Name, Path FROM templatedocument %s ORDER BY Path, Name" % where)
 
+def get_document_template_version(dbo):
+    """
+    Returns the current version of the document templates for this database.
+    The version changes whenever a template is updated, renamed or deleted
+    and is used to check whether cached content (and anything derived from
+    it, such as parsed tags) is still current.
+    It's read from the configuration table every time rather than through
+    the config cache, so that a change made by any process is seen at once.
+    """
+    return dbo.query_string("SELECT ItemValue FROM configuration WHERE ItemName = ?", ["DocumentTemplateVersion"])
+
+def flush_document_templates(dbo):
+    """ Issues a new document template version, invalidating cached content """
+    configuration.cset(dbo, "DocumentTemplateVersion", "%f.%d" % (time.time(), random.randint(0, 1000000)), ignoreDBLock = True)
+
 def get_document_template_content(dbo, dtid):
     """ Returns the document template content for a given ID """
-    return base64.b64decode( dbo.query_string("SELECT Content FROM templatedocument WHERE ID = ?", [dtid]) )
+    key = (dbo.database, dtid)
+    version = get_document_template_version(dbo)
+    cached = document_templates.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    content = base64.b64decode( dbo.query_string("SELECT Content FROM templatedocument WHERE ID = ?", [dtid]) )
+    if len(document_templates) >= DOCUMENT_TEMPLATE_CACHE_SIZE: document_templates.clear()
+    document_templates[key] = (version, content)
+    return content
 
 def get_document_template_name(dbo, dtid):
     """ Returns the name for a document template with an ID """
@@ -100,6 +130,7 @@ def delete_document_template(dbo, username, dtid):
     """
     name = get_document_template_name(dbo, dtid)
     dbo.delete("templatedocument", dtid, username, writeAudit=False)
+    flush_document_templates(dbo)
     audit.delete(dbo, username, "templatedocument", dtid, "", "delete template %d (%s)" % (dtid, name))
 
 def rename_document_template(dbo, username, dtid, newname):
@@ -110,6 +141,7 @@ def rename_document_template(dbo, username, dtid, newname):
     dbo.update("templatedocument", dtid, {
         "Name":     newname
     })
+    flush_document_templates(dbo)
     audit.edit(dbo, username, "templatedocument", dtid, "", "rename %d to %s" % (dtid, newname))
 
 def update_document_template_content(dbo, dtid, content):
@@ -117,6 +149,7 @@ def update_document_template_content(dbo, dtid, content):
     dbo.update("templatedocument", dtid, {
         "Content":  base64.b64encode(content)
     })
+    flush_document_templates(dbo)
 
 def sanitise_path(path):
     """ Strips disallowed chars from new paths """
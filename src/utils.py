@@ -6,8 +6,10 @@ import configuration
 import csv as extcsv
 import datetime
 import decimal
+import emailqueue
 import hashlib
 import htmlentitydefs
+import itertools
 import json as extjson
 import os
 import re
@@ -16,7 +18,6 @@ import smtplib
 import subprocess
 import sys
 import tempfile
-import thread
 import urllib2
 import users
 import web
@@ -780,16 +781,32 @@ def csv(l, rows, cols = None, includeheader = True):
     order.
     """
     if rows is None or len(rows) == 0: return ""
+    return "".join(csv_stream(l, rows, cols, includeheader))
+
+def csv_stream(l, rows, cols = None, includeheader = True, chunkrows = 100):
+    """
+    Generator version of csv that consumes any iterable of resultset 
+    rows (eg: the generator from dbo.query_stream) and yields the 
+    CSV file in chunks of chunkrows rows, so that neither the rows
+    nor the output need to be held in memory. If cols is not
+    supplied, the keys of the first row are used.
+    """
+    if rows is None: return
+    rows = iter(rows)
+    try:
+        first = next(rows)
+    except StopIteration:
+        return
     strio = StringIO()
     out = UnicodeCSVWriter(strio)
     if cols is None:
         cols = []
-        for k, v in rows[0].iteritems():
+        for k, v in first.iteritems():
             cols.append(k)
         cols = sorted(cols)
     if includeheader: 
         out.writerow(cols)
-    for r in rows:
+    for i, r in enumerate(itertools.chain([first], rows)):
         rd = []
         for c in cols:
             if is_currency(c):
@@ -808,7 +825,20 @@ def csv(l, rows, cols = None, includeheader = True):
             else:
                 rd.append(decode_html(r[c]))
         out.writerow(rd)
-    return strio.getvalue()
+        if (i + 1) % chunkrows == 0:
+            yield strio.getvalue()
+            strio.seek(0)
+            strio.truncate(0)
+    if strio.tell() > 0:
+        yield strio.getvalue()
+
+def csv_write(l, f, rows, cols = None, includeheader = True):
+    """
+    Writes a CSV file from an iterable of resultset rows to file object f
+    as it is generated (see csv_stream).
+    """
+    for chunk in csv_stream(l, rows, cols, includeheader):
+        f.write(chunk)
 
 def fix_relative_document_uris(s, baseurl, account = "" ):
     """
@@ -1026,65 +1056,54 @@ def html_email_to_plain(s):
     s = strip_html_tags(s)
     return s
 
-def send_email(dbo, replyadd, toadd, ccadd = "", bccadd = "", subject = "", body = "", contenttype = "plain", attachmentdata = None, attachmentfname = "", exceptions = True):
-    """
-    Sends an email.
-    fromadd is a single email address
-    toadd is a comma/semi-colon separated list of email addresses 
-    ccadd is a comma/semi-colon separated list of email addresses
-    bccadd is a comma/semi-colon separated list of email addresses
-    subject, body are strings
-    contenttype is either "plain" or "html"
-    attachmentdata: If an attachment should be added, the unencoded data
-    attachmentfname: If an attachment should be added, the file name to give it
-    exceptions: If True, throws exceptions due to sending problems
-    returns True on success
+def parse_email_address(s):
+    """ Returns a tuple of description and address for an email address """
+    s = s.strip()
+    fp = s.find("<")
+    ep = s.find(">")
+    description = s
+    address = s
+    if fp != -1 and ep != -1:
+        description = s[0:fp].strip()
+        address = s[fp+1:ep].strip()
+    return (description, address)
+
+def add_email_header(msg, header, value):
+    """
+    Adds a header to the message, expands any HTML entities
+    and re-encodes as utf-8 before adding to the message if necessary.
+    If the message doesn't contain HTML entities, then it is just
+    added normally as 7-bit ascii
+    """
+    value = value.replace("\n", "") # line breaks are not allowed in headers
+    if value.find("&#") != -1:
+        # Is this an address field? If so, parse the addresses and 
+        # encode the descriptions
+        if header in ("To", "From", "Cc", "Bcc", "Bounces-To", "Reply-To"):
+            addresses = value.split(",")
+            newval = ""
+            for a in addresses:
+                description, address = parse_email_address(a)
+                if newval != "": newval += ", "
+                newval += "\"%s\" <%s>" % (Header(decode_html(description).encode("utf-8"), "utf-8"), address)
+            msg[header] = newval
+        else:
+            h = Header(decode_html(value).encode("utf-8"), "utf-8")
+            msg[header] = h
+    else:
+        msg[header] = value
 
-    For HTML emails, a plaintext part is converted and added. If the HTML
-    does not have html/body tags, they are also added.
+def build_email(dbo, replyadd, toadd, ccadd = "", bccadd = "", subject = "", body = "", contenttype = "plain", attachmentdata = None, attachmentfname = ""):
+    """
+    Builds an email message, see send_email for the arguments.
+    Returns a tuple of the from address, the list of addresses
+    to send it to and the message.
     """
-    def parse_email(s):
-        # Returns a tuple of description and address
-        s = s.strip()
-        fp = s.find("<")
-        ep = s.find(">")
-        description = s
-        address = s
-        if fp != -1 and ep != -1:
-            description = s[0:fp].strip()
-            address = s[fp+1:ep].strip()
-        return (description, address)
-
     def strip_email(s):
         # Just returns the address portion of an email
-        description, address = parse_email(s)
+        description, address = parse_email_address(s)
         return address
 
-    def add_header(msg, header, value):
-        """
-        Adds a header to the message, expands any HTML entities
-        and re-encodes as utf-8 before adding to the message if necessary.
-        If the message doesn't contain HTML entities, then it is just
-        added normally as 7-bit ascii
-        """
-        value = value.replace("\n", "") # line breaks are not allowed in headers
-        if value.find("&#") != -1:
-            # Is this an address field? If so, parse the addresses and 
-            # encode the descriptions
-            if header in ("To", "From", "Cc", "Bcc", "Bounces-To", "Reply-To"):
-                addresses = value.split(",")
-                newval = ""
-                for a in addresses:
-                    description, address = parse_email(a)
-                    if newval != "": newval += ", "
-                    newval += "\"%s\" <%s>" % (Header(decode_html(description).encode("utf-8"), "utf-8"), address)
-                msg[header] = newval
-            else:
-                h = Header(decode_html(value).encode("utf-8"), "utf-8")
-                msg[header] = h
-        else:
-            msg[header] = value
-
     # If the email is plain text, but contains HTML escape characters, 
     # switch it to being an html message instead and make sure line 
     # breaks are retained
@@ -1110,16 +1129,16 @@ def send_email(dbo, replyadd, toadd, ccadd = "", bccadd = "", subject = "", body
 
     # Construct the mime message
     msg = MIMEMultipart("mixed")
-    add_header(msg, "Message-ID", make_msgid())
-    add_header(msg, "Date", formatdate())
-    add_header(msg, "X-Mailer", "Animal Shelter Manager %s" % VERSION)
+    add_email_header(msg, "Message-ID", make_msgid())
+    add_email_header(msg, "Date", formatdate())
+    add_email_header(msg, "X-Mailer", "Animal Shelter Manager %s" % VERSION)
     subject = truncate(subject, 69) # limit subject to 78 chars - "Subject: "
-    add_header(msg, "Subject", subject)
-    add_header(msg, "From", fromadd)
-    add_header(msg, "Reply-To", replyadd)
-    add_header(msg, "Bounces-To", replyadd)
-    add_header(msg, "To", toadd)
-    if ccadd != "": add_header(msg, "Cc", ccadd)
+    add_email_header(msg, "Subject", subject)
+    add_email_header(msg, "From", fromadd)
+    add_email_header(msg, "Reply-To", replyadd)
+    add_email_header(msg, "Bounces-To", replyadd)
+    add_email_header(msg, "To", toadd)
+    if ccadd != "": add_email_header(msg, "Cc", ccadd)
 
     # Create an alternative part with plain text and html messages
     msgbody = MIMEMultipart("alternative")
@@ -1155,65 +1174,132 @@ def send_email(dbo, replyadd, toadd, ccadd = "", bccadd = "", subject = "", body
     al.debug("from: %s, reply-to: %s, to: %s, subject: %s, body: %s" % \
         (fromadd, replyadd, str(tolist), subject, body), "utils.send_email", dbo)
     
-    # Load the server config over default vars
-    sendmail = True
-    host = ""
-    port = 25
-    username = ""
-    password = ""
-    usetls = False
-    if SMTP_SERVER is not None:
-        if "sendmail" in SMTP_SERVER: sendmail = SMTP_SERVER["sendmail"]
-        if "host" in SMTP_SERVER: host = SMTP_SERVER["host"]
-        if "port" in SMTP_SERVER: port = SMTP_SERVER["port"]
-        if "username" in SMTP_SERVER: username = SMTP_SERVER["username"]
-        if "password" in SMTP_SERVER: password = SMTP_SERVER["password"]
-        if "usetls" in SMTP_SERVER: usetls = SMTP_SERVER["usetls"]
-        if "headers" in SMTP_SERVER: 
-            for k, v in SMTP_SERVER["headers"].iteritems():
-                add_header(msg, k, v)
-     
-    # Use sendmail or SMTP for the transport depending on config
-    if sendmail:
-        try:
+    # Add any extra headers from the server config
+    if SMTP_SERVER is not None and "headers" in SMTP_SERVER:
+        for k, v in SMTP_SERVER["headers"].iteritems():
+            add_email_header(msg, k, v)
+
+    return (fromadd, tolist, msg)
+
+class EmailSender(object):
+    """
+    Sends messages built by build_email with sendmail or SMTP, depending 
+    on the SMTP_SERVER config. The SMTP session is opened for the first 
+    message and kept open for the rest until close is called, so send 
+    batches of email with one sender.
+    """
+    def __init__(self, dbo):
+        self.dbo = dbo
+        self.smtp = None
+        # Load the server config over default vars
+        self.sendmail = True
+        self.host = ""
+        self.port = 25
+        self.username = ""
+        self.password = ""
+        self.usetls = False
+        if SMTP_SERVER is not None:
+            if "sendmail" in SMTP_SERVER: self.sendmail = SMTP_SERVER["sendmail"]
+            if "host" in SMTP_SERVER: self.host = SMTP_SERVER["host"]
+            if "port" in SMTP_SERVER: self.port = SMTP_SERVER["port"]
+            if "username" in SMTP_SERVER: self.username = SMTP_SERVER["username"]
+            if "password" in SMTP_SERVER: self.password = SMTP_SERVER["password"]
+            if "usetls" in SMTP_SERVER: self.usetls = SMTP_SERVER["usetls"]
+        self.transport = self.sendmail and "sendmail" or "smtp"
+
+    def send(self, fromadd, tolist, msg, bccadd = ""):
+        """ Sends a message, raising an exception if it fails """
+        if self.sendmail:
             if bccadd != "": 
                 # sendmail -t processes and removes Bcc header, where SMTP has all recipients (including Bcc) in tolist
-                add_header(msg, "Bcc", bccadd) 
+                add_email_header(msg, "Bcc", bccadd) 
             p = subprocess.Popen(["/usr/sbin/sendmail", "-t", "-oi"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
             stdoutdata, stderrdata = p.communicate(msg.as_string())
             if p.returncode != 0: raise Exception("%s %s" % (stdoutdata, stderrdata))
-        except Exception as err:
-            al.error("sendmail: %s" % str(err), "utils.send_email", dbo)
-            if exceptions: raise ASMError(str(err))
-    else:
+            return
         try:
-            smtp = smtplib.SMTP(host, port)
-            if usetls:
+            self.connect().sendmail(fromadd, tolist, msg.as_string())
+        except smtplib.SMTPServerDisconnected:
+            # The server timed out our session, start a new one
+            self.smtp = None
+            self.connect().sendmail(fromadd, tolist, msg.as_string())
+        except smtplib.SMTPException:
+            # The server refused the message, but the session is still good
+            raise
+        except:
+            # Anything else (eg: a network error), don't reuse the session
+            self.close()
+            raise
+
+    def connect(self):
+        """ Returns the SMTP session, opening it if necessary """
+        if self.smtp is None:
+            smtp = smtplib.SMTP(self.host, self.port)
+            if self.usetls:
                 smtp.starttls()
-            if password.strip() != "":
-                smtp.login(username, password)
-            smtp.sendmail(fromadd, tolist, msg.as_string())
-        except Exception as err:
-            al.error("smtp: %s" % str(err), "utils.send_email", dbo)
-            if exceptions: raise ASMError(str(err))
+            if self.password.strip() != "":
+                smtp.login(self.username, self.password)
+            self.smtp = smtp
+        return self.smtp
+
+    def close(self):
+        """ Ends the SMTP session if we have one """
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except:
+                pass
+            self.smtp = None
+
+def send_email(dbo, replyadd, toadd, ccadd = "", bccadd = "", subject = "", body = "", contenttype = "plain", attachmentdata = None, attachmentfname = "", exceptions = True):
+    """
+    Sends an email.
+    fromadd is a single email address
+    toadd is a comma/semi-colon separated list of email addresses 
+    ccadd is a comma/semi-colon separated list of email addresses
+    bccadd is a comma/semi-colon separated list of email addresses
+    subject, body are strings
+    contenttype is either "plain" or "html"
+    attachmentdata: If an attachment should be added, the unencoded data
+    attachmentfname: If an attachment should be added, the file name to give it
+    exceptions: If True, throws exceptions due to sending problems
+    returns True on success
+
+    For HTML emails, a plaintext part is converted and added. If the HTML
+    does not have html/body tags, they are also added.
+    Batches of email should be sent through the email queue instead (see emailqueue.py).
+    """
+    fromadd, tolist, msg = build_email(dbo, replyadd, toadd, ccadd, bccadd, subject, body, contenttype, attachmentdata, attachmentfname)
+    sender = EmailSender(dbo)
+    try:
+        sender.send(fromadd, tolist, msg, bccadd)
+        return True
+    except Exception as err:
+        al.error("%s: %s" % (sender.transport, str(err)), "utils.send_email", dbo)
+        if exceptions: raise ASMError(str(err))
+        return False
+    finally:
+        sender.close()
 
 def send_bulk_email(dbo, fromadd, subject, body, rows, contenttype):
     """
-    Sends a set of bulk emails asynchronously.
+    Sends a set of bulk emails asynchronously by adding them
+    to the email queue and starting it.
     fromadd is an RFC821 address
     subject and body are strings. Either can contain <<TAGS>>
     rows is a list of dictionaries of tag tokens with real values to substitute
     contenttype is either "plain" or "html"
     """
-    def do_send():
-        for r in rows:
-            ssubject = substitute_tags(subject, r, False, opener = "<<", closer = ">>")
-            sbody = substitute_tags(body, r)
-            toadd = r["EMAILADDRESS"]
-            if toadd is None or toadd.strip() == "": continue
-            al.debug("sending bulk email: to=%s, subject=%s" % (toadd, ssubject), "utils.send_bulk_email", dbo)
-            send_email(dbo, fromadd, toadd, "", "", ssubject, sbody, contenttype, exceptions=False)
-    thread.start_new_thread(do_send, ())
+    queued = 0
+    for r in rows:
+        ssubject = substitute_tags(subject, r, False, opener = "<<", closer = ">>")
+        sbody = substitute_tags(body, r)
+        toadd = r["EMAILADDRESS"]
+        if toadd is None or toadd.strip() == "": continue
+        al.debug("queueing bulk email: to=%s, subject=%s" % (toadd, ssubject), "utils.send_bulk_email", dbo)
+        emailqueue.queue_email(dbo, fromadd, toadd, "", "", ssubject, sbody, contenttype)
+        queued += 1
+    if queued > 0: emailqueue.process_async(dbo, _("Send {0} emails", dbo.locale).format(queued))
 
 def send_user_email(dbo, sendinguser, user, subject, body):
     """
@@ -123,22 +123,39 @@ def additional_field_tags(dbo, fields, prefix = ""):
         tags[prefix + af["FIELDNAME"].upper()] = val
     return tags
 
-def animal_tags_publisher(dbo, a, includeAdditional=True):
+def animal_tags_publisher(dbo, a, includeAdditional=True, usedtags=None):
     """
     Convenience method for getting animal tags when used by a publisher - 
     very little apart from additional fields are required and we can save
     database calls for each animal.
     """
     return animal_tags(dbo, a, includeAdditional=includeAdditional, includeCosts=False, includeDiet=True, \
-        includeDonations=False, includeFutureOwner=False, includeIsVaccinated=True, includeLogs=False, includeMedical=False, includeTransport=False)
+        includeDonations=False, includeFutureOwner=False, includeIsVaccinated=True, includeLogs=False, includeMedical=False, includeTransport=False, \
+        usedtags=usedtags)
 
 def animal_tags(dbo, a, includeAdditional=True, includeCosts=True, includeDiet=True, includeDonations=True, \
-        includeFutureOwner=True, includeIsVaccinated=True, includeLogs=True, includeMedical=True, includeTransport=True):
+        includeFutureOwner=True, includeIsVaccinated=True, includeLogs=True, includeMedical=True, includeTransport=True, usedtags=None):
     """
     Generates a list of tags from an animal result (the deep type from
     calling animal.get_animal)
     includeAdoptionStatus in particular is expensive. If you don't need some of the tags, you can not include them.
+    usedtags: If supplied, a set of the tags a template uses (see get_used_tags). Groups of 
+        tags that need extra queries are only generated if the template uses one of them.
     """
+    def uses(prefixes):
+        """ Returns True if the template uses a tag starting with one of prefixes """
+        if usedtags is None: return True
+        prefixes = tuple(prefixes)
+        for t in usedtags:
+            if t.startswith(prefixes): return True
+        return False
+    def uses_additional(prefixes):
+        """ Returns True if the template uses an additional field, with one of prefixes """
+        if usedtags is None: return True
+        for f in lookups.query_lookup(dbo, "SELECT FieldName FROM additionalfield", [ "additionalfield" ]):
+            for p in prefixes:
+                if p + utils.nulltostr(f.FIELDNAME).upper() in usedtags: return True
+        return False
     l = dbo.locale
     qr = QR_IMG_SRC % { "url": BASE_URL + "/animal?id=%d" % a["ID"], "size": "150x150" }
     animalage = a["ANIMALAGE"]
@@ -443,7 +460,7 @@ def animal_tags(dbo, a, includeAdditional=True, includeCosts=True, includeDiet=T
                 tags["MOSTRECENTENTRYCATEGORY"] = latest["RETURNEDREASONNAME"]
 
     # Additional fields
-    if includeAdditional:
+    if includeAdditional and uses_additional(("", "ORIGINALOWNER", "BROUGHTINBY", "CURRENTOWNER")):
         tags.update(additional_field_tags(dbo, additional.get_additional_fields(dbo, a["ID"], "animal")))
         if a["ORIGINALOWNERID"] and a["ORIGINALOWNERID"] > 0:
             tags.update(additional_field_tags(dbo, additional.get_additional_fields(dbo, a["ORIGINALOWNERID"], "person"), "ORIGINALOWNER"))
@@ -453,7 +470,7 @@ def animal_tags(dbo, a, includeAdditional=True, includeCosts=True, includeDiet=T
             tags.update(additional_field_tags(dbo, additional.get_additional_fields(dbo, a["CURRENTOWNERID"], "person"), "CURRENTOWNER"))
 
     # Is vaccinated indicator
-    if includeIsVaccinated:    
+    if includeIsVaccinated and uses(["ANIMALISVACCINATED"]):
         tags["ANIMALISVACCINATED"] = utils.iif(medical.get_vaccinated(dbo, a["ID"]), _("Yes", l), _("No", l))
 
     if includeMedical:
@@ -481,7 +498,7 @@ def animal_tags(dbo, a, includeAdditional=True, includeCosts=True, includeDiet=T
             "VACCINATIONADMINISTERINGVETZIPCODE":   "ADMINISTERINGVETPOSTCODE",
             "VACCINATIONADMINISTERINGVETEMAIL":     "ADMINISTERINGVETEMAIL"
         }
-        tags.update(table_tags(dbo, d, medical.get_vaccinations(dbo, a["ID"], not iic), "VACCINATIONTYPE", "DATEREQUIRED", "DATEOFVACCINATION"))
+        if uses(d): tags.update(table_tags(dbo, d, medical.get_vaccinations(dbo, a["ID"], not iic), "VACCINATIONTYPE", "DATEREQUIRED", "DATEOFVACCINATION"))
 
         # Tests
         d = {
@@ -505,7 +522,7 @@ def animal_tags(dbo, a, includeAdditional=True, includeCosts=True, includeDiet=T
             "TESTADMINISTERINGVETEMAIL":     "ADMINISTERINGVETEMAIL"
 
         }
-        tags.update(table_tags(dbo, d, medical.get_tests(dbo, a["ID"], not iic), "TESTNAME", "DATEREQUIRED", "DATEOFTEST"))
+        if uses(d): tags.update(table_tags(dbo, d, medical.get_tests(dbo, a["ID"], not iic), "TESTNAME", "DATEREQUIRED", "DATEOFTEST"))
 
         # Medical
         d = {
@@ -522,7 +539,7 @@ def animal_tags(dbo, a, includeAdditional=True, includeCosts=True, includeDiet=T
             "MEDICALLASTTREATMENTGIVEN": "d:LASTTREATMENTGIVEN",
             "MEDICALCOST":              "c:COST"
         }
-        tags.update(table_tags(dbo, d, medical.get_regimens(dbo, a["ID"], not iic), "TREATMENTNAME", "NEXTTREATMENTDUE", "LASTTREATMENTGIVEN"))
+        if uses(d): tags.update(table_tags(dbo, d, medical.get_regimens(dbo, a["ID"], not iic), "TREATMENTNAME", "NEXTTREATMENTDUE", "LASTTREATMENTGIVEN"))
 
     # Diet
     if includeDiet:
@@ -532,7 +549,7 @@ def animal_tags(dbo, a, includeAdditional=True, includeCosts=True, includeDiet=T
             "DIETDATESTARTED":          "d:DATESTARTED",
             "DIETCOMMENTS":             "COMMENTS"
         }
-        tags.update(table_tags(dbo, d, animal.get_diets(dbo, a["ID"]), "DIETNAME", "DATESTARTED", "DATESTARTED"))
+        if uses(d): tags.update(table_tags(dbo, d, animal.get_diets(dbo, a["ID"]), "DIETNAME", "DATESTARTED", "DATESTARTED"))
 
     # Donations
     if includeDonations:
@@ -559,7 +576,7 @@ def animal_tags(dbo, a, includeAdditional=True, includeCosts=True, includeDiet=T
             "PAYMENTVATAMOUNT":         "c:VATAMOUNT",
             "PAYMENTTAXAMOUNT":         "c:VATAMOUNT"
         }
-        tags.update(table_tags(dbo, d, financial.get_animal_donations(dbo, a["ID"]), "DONATIONNAME", "DATEDUE", "DATE"))
+        if uses(d): tags.update(table_tags(dbo, d, financial.get_animal_donations(dbo, a["ID"]), "DONATIONNAME", "DATEDUE", "DATE"))
 
     # Transport
     if includeTransport:
@@ -601,7 +618,7 @@ def animal_tags(dbo, a, includeAdditional=True, includeCosts=True, includeDiet=T
             "TRANSPORTCOSTPAIDDATE":    "d:COSTPAIDDATE",
             "TRANSPORTCOMMENTS":        "COMMENTS"
         }
-        tags.update(table_tags(dbo, d, movement.get_animal_transports(dbo, a["ID"]), "TRANSPORTTYPENAME", "PICKUPDATETIME", "DROPOFFDATETIME"))
+        if uses(d): tags.update(table_tags(dbo, d, movement.get_animal_transports(dbo, a["ID"]), "TRANSPORTTYPENAME", "PICKUPDATETIME", "DROPOFFDATETIME"))
 
     # Costs
     if includeCosts:
@@ -612,28 +629,29 @@ def animal_tags(dbo, a, includeAdditional=True, includeCosts=True, includeDiet=T
             "COSTAMOUNT":               "c:COSTAMOUNT",
             "COSTDESCRIPTION":          "DESCRIPTION"
         }
-        tags.update(table_tags(dbo, d, animal.get_costs(dbo, a["ID"]), "COSTTYPENAME", "COSTDATE", "COSTPAIDDATE"))
+        if uses(d): tags.update(table_tags(dbo, d, animal.get_costs(dbo, a["ID"]), "COSTTYPENAME", "COSTDATE", "COSTPAIDDATE"))
 
         # Cost totals
-        totalvaccinations = dbo.query_int("SELECT SUM(Cost) FROM animalvaccination WHERE AnimalID = ?", [a["ID"]])
-        totaltransports = dbo.query_int("SELECT SUM(Cost) FROM animaltransport WHERE AnimalID = ?", [a["ID"]])
-        totaltests = dbo.query_int("SELECT SUM(Cost) FROM animaltest WHERE AnimalID = ?", [a["ID"]])
-        totalmedicals = dbo.query_int("SELECT SUM(Cost) FROM animalmedical WHERE AnimalID = ?", [a["ID"]])
-        totallines = dbo.query_int("SELECT SUM(CostAmount) FROM animalcost WHERE AnimalID = ?", [a["ID"]])
-        totalcosts = totalvaccinations + totaltransports + totaltests + totalmedicals + totallines
-        dailyboardingcost = a["DAILYBOARDINGCOST"] or 0
-        daysonshelter = a["DAYSONSHELTER"] or 0
-        costtags = {
-            "TOTALVACCINATIONCOSTS": format_currency_no_symbol(l, totalvaccinations),
-            "TOTALTRANSPORTCOSTS": format_currency_no_symbol(l, totaltransports),
-            "TOTALTESTCOSTS": format_currency_no_symbol(l, totaltests),
-            "TOTALMEDICALCOSTS": format_currency_no_symbol(l, totalmedicals),
-            "TOTALLINECOSTS": format_currency_no_symbol(l, totallines),
-            "DAILYBOARDINGCOST": format_currency_no_symbol(l, dailyboardingcost),
-            "CURRENTBOARDINGCOST": format_currency_no_symbol(l, dailyboardingcost * daysonshelter),
-            "TOTALCOSTS": format_currency_no_symbol(l, dailyboardingcost * daysonshelter + totalcosts)
-        }
-        tags = append_tags(tags, costtags)
+        if uses(["TOTAL", "DAILYBOARDINGCOST", "CURRENTBOARDINGCOST"]):
+            totalvaccinations = dbo.query_int("SELECT SUM(Cost) FROM animalvaccination WHERE AnimalID = ?", [a["ID"]])
+            totaltransports = dbo.query_int("SELECT SUM(Cost) FROM animaltransport WHERE AnimalID = ?", [a["ID"]])
+            totaltests = dbo.query_int("SELECT SUM(Cost) FROM animaltest WHERE AnimalID = ?", [a["ID"]])
+            totalmedicals = dbo.query_int("SELECT SUM(Cost) FROM animalmedical WHERE AnimalID = ?", [a["ID"]])
+            totallines = dbo.query_int("SELECT SUM(CostAmount) FROM animalcost WHERE AnimalID = ?", [a["ID"]])
+            totalcosts = totalvaccinations + totaltransports + totaltests + totalmedicals + totallines
+            dailyboardingcost = a["DAILYBOARDINGCOST"] or 0
+            daysonshelter = a["DAYSONSHELTER"] or 0
+            costtags = {
+                "TOTALVACCINATIONCOSTS": format_currency_no_symbol(l, totalvaccinations),
+                "TOTALTRANSPORTCOSTS": format_currency_no_symbol(l, totaltransports),
+                "TOTALTESTCOSTS": format_currency_no_symbol(l, totaltests),
+                "TOTALMEDICALCOSTS": format_currency_no_symbol(l, totalmedicals),
+                "TOTALLINECOSTS": format_currency_no_symbol(l, totallines),
+                "DAILYBOARDINGCOST": format_currency_no_symbol(l, dailyboardingcost),
+                "CURRENTBOARDINGCOST": format_currency_no_symbol(l, dailyboardingcost * daysonshelter),
+                "TOTALCOSTS": format_currency_no_symbol(l, dailyboardingcost * daysonshelter + totalcosts)
+            }
+            tags = append_tags(tags, costtags)
 
     if includeLogs:
         # Logs
@@ -643,7 +661,7 @@ def animal_tags(dbo, a, includeAdditional=True, includeCosts=True, includeDiet=T
             "LOGCOMMENTS":              "COMMENTS",
             "LOGCREATEDBY":             "CREATEDBY"
         }
-        tags.update(table_tags(dbo, d, log.get_logs(dbo, log.ANIMAL, a["ID"], 0, log.ASCENDING), "LOGTYPENAME", "DATE", "DATE"))
+        if uses(d): tags.update(table_tags(dbo, d, log.get_logs(dbo, log.ANIMAL, a["ID"], 0, log.ASCENDING), "LOGTYPENAME", "DATE", "DATE"))
 
     return tags
 
@@ -1347,44 +1365,185 @@ def substitute_tags_plain(searchin, tags):
     """
     return substitute_tags(searchin, tags, False, "<<", ">>")
 
+class TagTemplate(object):
+    """
+    A document tokenised once for tag substitution, so that it can be
+    rendered for many sets of tags with a single join.
+    literals: The text between tags. There is always one more literal than tags.
+    tags: The upper cased names of the tags in order.
+    ends: The position in source just after the closer of each tag.
+    """
+    def __init__(self, source, use_xml_escaping = True, opener = "&lt;&lt;", closer = "&gt;&gt;"):
+        if not use_xml_escaping:
+            opener = opener.replace("&lt;", "<").replace("&gt;", ">")
+            closer = closer.replace("&lt;", "<").replace("&gt;", ">")
+        self.source = source
+        self.use_xml_escaping = use_xml_escaping
+        self.opener = opener
+        self.closer = closer
+        self.literals = []
+        self.tags = []
+        self.ends = []
+        pos = 0
+        sp = source.find(opener)
+        while sp != -1:
+            ep = source.find(closer, sp + len(opener))
+            if ep == -1:
+                # No end marker for this tag, stop processing
+                break
+            self.literals.append(source[pos:sp])
+            self.tags.append(source[sp + len(opener):ep].upper())
+            pos = ep + len(closer)
+            self.ends.append(pos)
+            sp = source.find(opener, pos)
+        self.literals.append(source[pos:])
+
+    def render(self, tags):
+        """
+        Returns the document with the dictionary of tags in "tags" substituted.
+        """
+        # Substituted values are searched again for tags (including one started by the
+        # end of the value and finished by the text after it). That's rare enough to 
+        # hand over to substitute_tags_rescan from that point when it happens.
+        n = len(self.opener) - 1
+        first = self.opener[0]
+        out = [ self.literals[0] ]
+        for i, tag in enumerate(self.tags):
+            newval = tag_value(tags, tag, self.use_xml_escaping)
+            if first in newval and (newval.find(self.opener) != -1 or \
+                (n > 0 and (newval[-n:] + self.source[self.ends[i]:self.ends[i] + n]).find(self.opener) != -1)):
+                out.append(substitute_tags_rescan(newval + self.source[self.ends[i]:], tags, self.use_xml_escaping, self.opener, self.closer))
+                return "".join(out)
+            out.append(newval)
+            out.append(self.literals[i + 1])
+        return "".join(out)
+
+# Recently tokenised documents, so that substitute_tags called repeatedly with the 
+# same document (mail merges, bulk email, publishing) only tokenises it once.
+tag_templates = {}
+TAG_TEMPLATE_CACHE_SIZE = 100
+
+def tag_value(tags, tag, use_xml_escaping = True):
+    """
+    Returns the output value for tag from the dictionary of tags in "tags".
+    """
+    if tag not in tags: return ""
+    newval = tags[tag]
+    if newval is None: return "None"
+    newval = str(newval)
+    # Escape xml entities unless the replacement tag is an image
+    # or it contains HTML entities or <br tags
+    if use_xml_escaping:
+        lowerval = newval.lower()
+        if not lowerval.startswith("<img") and \
+           lowerval.find("&#") == -1 and \
+           lowerval.find("<br/>") == -1:
+            newval = newval.replace("&", "&amp;")
+            newval = newval.replace("<", "&lt;")
+            newval = newval.replace(">", "&gt;")
+    return newval
+
 def substitute_tags(searchin, tags, use_xml_escaping = True, opener = "&lt;&lt;", closer = "&gt;&gt;"):
     """
     Substitutes the dictionary of tags in "tags" for any found
     in "searchin". opener and closer denote the start of a tag,
     if use_xml_escaping is set to true, then tags are XML escaped when
     output and opener/closer are escaped.
+    searchin can also be a TagTemplate.
+    """
+    if isinstance(searchin, TagTemplate):
+        return searchin.render(tags)
+    return get_tag_template(searchin, use_xml_escaping, opener, closer).render(tags)
+
+def get_tag_template(searchin, use_xml_escaping = True, opener = "&lt;&lt;", closer = "&gt;&gt;"):
+    """
+    Returns the TagTemplate for searchin, tokenising it if we haven't recently.
+    """
+    key = (searchin, use_xml_escaping, opener, closer)
+    t = tag_templates.get(key)
+    if t is None:
+        t = TagTemplate(searchin, use_xml_escaping, opener, closer)
+        if len(tag_templates) >= TAG_TEMPLATE_CACHE_SIZE: tag_templates.clear()
+        tag_templates[key] = t
+    return t
+
+def get_used_tags(searchin, use_xml_escaping = True, opener = "&lt;&lt;", closer = "&gt;&gt;"):
     """
-    if not use_xml_escaping:
-        opener = opener.replace("&lt;", "<").replace("&gt;", ">")
-        closer = closer.replace("&lt;", "<").replace("&gt;", ">")
+    Returns a set of the (upper cased) tags used in searchin,
+    suitable for passing as usedtags to the *_tags functions.
+    """
+    return set(get_tag_template(searchin, use_xml_escaping, opener, closer).tags)
 
+def substitute_tags_rescan(searchin, tags, use_xml_escaping = True, opener = "<<", closer = ">>"):
+    """
+    Substitutes tags by rebuilding the document after each one and searching
+    again from the start of the value, so tags inside substituted values
+    are also replaced. opener and closer must already be unescaped.
+    """
     s = searchin
     sp = s.find(opener)
     while sp != -1:
         ep = s.find(closer, sp + len(opener))
         if ep != -1:
             matchtag = s[sp + len(opener):ep].upper()
-            newval = ""
-            if matchtag in tags:
-                newval = tags[matchtag]
-                if newval is not None:
-                    newval = str(newval)
-                    # Escape xml entities unless the replacement tag is an image
-                    # or it contains HTML entities or <br tags
-                    if use_xml_escaping and \
-                       not newval.lower().startswith("<img") and \
-                       not newval.lower().find("&#") != -1 and \
-                       not newval.lower().find("<br/>") != -1:
-                        newval = newval.replace("&", "&amp;")
-                        newval = newval.replace("<", "&lt;")
-                        newval = newval.replace(">", "&gt;")
-            s = s[0:sp] + str(newval) + s[ep + len(closer):]
+            s = s[0:sp] + tag_value(tags, matchtag, use_xml_escaping) + s[ep + len(closer):]
             sp = s.find(opener, sp)
         else:
             # No end marker for this tag, stop processing
             break
     return s
 
+# Parsed document templates held by this process,
+# (database, template id) -> (version, template name, parsed template)
+document_templates = {}
+
+def get_document_template(dbo, templateid):
+    """
+    Returns a tuple of the name and parsed form of a document template.
+    For html templates, the parsed form is a TagTemplate. For odt templates, 
+    it's a list of (filename, file size, data) for the files in the zip, where
+    data is a TagTemplate for content.xml.
+    Parsed templates are cached until the template version changes.
+    """
+    key = (dbo.database, templateid)
+    version = template.get_document_template_version(dbo)
+    cached = document_templates.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1], cached[2]
+    templatedata = template.get_document_template_content(dbo, templateid)
+    templatename = template.get_document_template_name(dbo, templateid)
+    parsed = None
+    if templatename.endswith(".html"):
+        # Translate any user signature placeholder
+        templatedata = templatedata.replace("signature:user", "&lt;&lt;UserSignatureSrc&gt;&gt;")
+        parsed = TagTemplate(templatedata)
+    elif templatename.endswith(".odt"):
+        try:
+            zf = zipfile.ZipFile(StringIO(templatedata), "r")
+            parsed = []
+            for info in zf.infolist():
+                data = zf.open(info.filename).read()
+                if info.filename == "content.xml": data = TagTemplate(data)
+                parsed.append((info.filename, info.file_size, data))
+            zf.close()
+        except Exception as zderr:
+            raise utils.ASMError("Failed generating odt document: %s" % str(zderr))
+    if len(document_templates) >= template.DOCUMENT_TEMPLATE_CACHE_SIZE: document_templates.clear()
+    document_templates[key] = (version, templatename, parsed)
+    return templatename, parsed
+
+def get_document_template_tags(dbo, templateid):
+    """
+    Returns a set of the (upper cased) tags used in a document template.
+    """
+    templatename, parsed = get_document_template(dbo, templateid)
+    if templatename.endswith(".html"):
+        return set(parsed.tags)
+    elif templatename.endswith(".odt"):
+        for filename, filesize, data in parsed:
+            if filename == "content.xml": return set(data.tags)
+    return set()
+
 def substitute_template(dbo, templateid, tags, imdata = None):
     """
     Reads the template specified by id "template" and substitutes
@@ -1392,31 +1551,23 @@ def substitute_template(dbo, templateid, tags, imdata = None):
     imdata is the preferred image for the record and since html uses
     URLs, only applies to ODT templates.
     """
-    templatedata = template.get_document_template_content(dbo, templateid)
-    templatename = template.get_document_template_name(dbo, templateid)
+    templatename, parsed = get_document_template(dbo, templateid)
     if templatename.endswith(".html"):
-        # Translate any user signature placeholder
-        templatedata = templatedata.replace("signature:user", "&lt;&lt;UserSignatureSrc&gt;&gt;")
-        return substitute_tags(templatedata, tags)
+        return parsed.render(tags)
     elif templatename.endswith(".odt"):
         try:
-            odt = StringIO(templatedata)
-            zf = zipfile.ZipFile(odt, "r")
-            # Load the content.xml file and substitute the tags
-            content = zf.open("content.xml").read()
-            content = substitute_tags(content, tags)
             # Write the replacement file
             zo = StringIO()
             zfo = zipfile.ZipFile(zo, "w", zipfile.ZIP_DEFLATED)
-            for info in zf.infolist():
-                if info.filename == "content.xml":
-                    zfo.writestr("content.xml", content)
-                elif imdata is not None and (info.file_size == 2897 or info.file_size == 7701):
+            for filename, filesize, data in parsed:
+                if filename == "content.xml":
+                    # Substitute the tags in the content.xml file
+                    zfo.writestr("content.xml", data.render(tags))
+                elif imdata is not None and (filesize == 2897 or filesize == 7701):
                     # If the image is the old placeholder.jpg or our default nopic.jpg, substitute for the record image
-                    zfo.writestr(info.filename, imdata)
+                    zfo.writestr(filename, imdata)
                 else:
-                    zfo.writestr(info.filename, zf.open(info.filename).read())
-            zf.close()
+                    zfo.writestr(filename, data)
             zfo.close()
             # Return the zip data
             return zo.getvalue()
@@ -1435,7 +1586,8 @@ def generate_animal_doc(dbo, templateid, animalid, username):
     if a is None: raise utils.ASMValidationError("%d is not a valid animal ID" % animalid)
     # Only include donations if there isn't an active movement as we'll take care
     # of them below if there is
-    tags = animal_tags(dbo, a, includeDonations=(not a["ACTIVEMOVEMENTID"] or a["ACTIVEMOVEMENTID"] == 0))
+    tags = animal_tags(dbo, a, includeDonations=(not a["ACTIVEMOVEMENTID"] or a["ACTIVEMOVEMENTID"] == 0), \
+        usedtags=get_document_template_tags(dbo, templateid))
     # Use the person info from the latest open movement for the animal
     # This will pick up future dated adoptions instead of fosterers (which are still currentowner)
     # as get_animal_movements returns them in descending order of movement date
@@ -1484,7 +1636,8 @@ def generate_clinic_doc(dbo, templateid, appointmentid, username):
     a = animal.get_animal(dbo, c.ANIMALID)
     if a is not None:
         tags = append_tags(tags, animal_tags(dbo, a, includeAdditional=True, includeCosts=False, includeDiet=False, includeDonations=False, \
-            includeFutureOwner=False, includeIsVaccinated=False, includeLogs=False, includeMedical=False))
+            includeFutureOwner=False, includeIsVaccinated=False, includeLogs=False, includeMedical=False, \
+            usedtags=get_document_template_tags(dbo, templateid)))
     tags = append_tags(tags, person_tags(dbo, person.get_person(dbo, c.OWNERID)))
     return substitute_template(dbo, templateid, tags)
 
@@ -1502,7 +1655,7 @@ def generate_person_doc(dbo, templateid, personid, username):
     m = movement.get_person_movements(dbo, personid)
     if len(m) > 0: 
         tags = append_tags(tags, movement_tags(dbo, m[0]))
-        tags = append_tags(tags, animal_tags(dbo, animal.get_animal(dbo, m[0]["ANIMALID"])))
+        tags = append_tags(tags, animal_tags(dbo, animal.get_animal(dbo, m[0]["ANIMALID"]), usedtags=get_document_template_tags(dbo, templateid)))
     return substitute_template(dbo, templateid, tags, im)
 
 def generate_donation_doc(dbo, templateid, donationids, username):
@@ -1517,7 +1670,8 @@ def generate_donation_doc(dbo, templateid, donationids, username):
     d = dons[0]
     tags = person_tags(dbo, person.get_person(dbo, d["OWNERID"]))
     if d["ANIMALID"] is not None and d["ANIMALID"] != 0:
-        tags = append_tags(tags, animal_tags(dbo, animal.get_animal(dbo, d["ANIMALID"]), includeDonations=False))
+        tags = append_tags(tags, animal_tags(dbo, animal.get_animal(dbo, d["ANIMALID"]), includeDonations=False, \
+            usedtags=get_document_template_tags(dbo, templateid)))
     if d["MOVEMENTID"] is not None and d["MOVEMENTID"] != 0:
         tags = append_tags(tags, movement_tags(dbo, movement.get_movement(dbo, d["MOVEMENTID"])))
     tags = append_tags(tags, donation_tags(dbo, dons))
@@ -1563,7 +1717,7 @@ def generate_licence_doc(dbo, templateid, licenceid, username):
         raise utils.ASMValidationError("%d is not a valid licence ID" % licenceid)
     tags = person_tags(dbo, person.get_person(dbo, l["OWNERID"]))
     if l["ANIMALID"] is not None and l["ANIMALID"] != 0:
-        tags = append_tags(tags, animal_tags(dbo, animal.get_animal(dbo, l["ANIMALID"])))
+        tags = append_tags(tags, animal_tags(dbo, animal.get_animal(dbo, l["ANIMALID"]), usedtags=get_document_template_tags(dbo, templateid)))
     tags = append_tags(tags, licence_tags(dbo, l))
     tags = append_tags(tags, org_tags(dbo, username))
     return substitute_template(dbo, templateid, tags)
@@ -1577,7 +1731,7 @@ def generate_movement_doc(dbo, templateid, movementid, username):
     m = movement.get_movement(dbo, movementid)
     if m is None:
         raise utils.ASMValidationError("%d is not a valid movement ID" % movementid)
-    tags = animal_tags(dbo, animal.get_animal(dbo, m["ANIMALID"]), includeDonations=False)
+    tags = animal_tags(dbo, animal.get_animal(dbo, m["ANIMALID"]), includeDonations=False, usedtags=get_document_template_tags(dbo, templateid))
     if m["OWNERID"] is not None and m["OWNERID"] != 0:
         tags = append_tags(tags, person_tags(dbo, person.get_person(dbo, m["OWNERID"])))
     tags = append_tags(tags, movement_tags(dbo, m))
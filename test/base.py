@@ -31,3 +31,21 @@ def today():
 def today_display():
     return time.strftime("%m/%d/%Y", datetime.datetime.today().timetuple())
 
+def insert_synthetic(dbo, table, rows):
+    """ Bulk inserts a list of dicts into table for benchmarks, filling any NOT NULL 
+        columns the rows don't supply with a default for their type (SQLite only) """
+    cols = dbo.query_tuple("PRAGMA table_info(%s)" % table)
+    defaults = {}
+    for cid, name, coltype, notnull, dflt, pk in cols:
+        if notnull == 1 and pk == 0:
+            if coltype.find("CHAR") != -1 or coltype == "TEXT": defaults[name] = ""
+            elif coltype == "TIMESTAMP": defaults[name] = dbo.now()
+            else: defaults[name] = 0
+    names = []
+    batch = []
+    for r in rows:
+        v = defaults.copy()
+        v.update(r)
+        if len(names) == 0: names = sorted(v.keys())
+        batch.append([ v[k] for k in names ])
+    dbo.execute_many("INSERT INTO %s (%s) VALUES (%s)" % (table, ",".join(names), dbo.sql_placeholders(names)), batch)
@@ -0,0 +1,93 @@
+#!/usr/bin/python env
+
+"""
+Benchmarks the batch variable data and status routines in animal.py against
+synthetic SQLite databases of increasing size to show they scale linearly
+with the number of animals and movements. The variable data is updated
+twice, the second time nothing has changed so nothing is written.
+
+Not part of the unit test suite, run it directly:
+    python benchmark_animal.py [sizes]
+eg: python benchmark_animal.py 1000,2000,4000,8000
+"""
+
+import os, sys, tempfile, time
+import base
+
+import animal
+import dbupdate
+
+MOVEMENTS_PER_ANIMAL = 3
+
+def make_db(size):
+    """ Creates a new SQLite database with size animals and
+        MOVEMENTS_PER_ANIMAL returned movements for each one """
+    dbo = base.get_dbo()
+    dbo.database = os.path.join(tempfile.gettempdir(), "asmbenchmark_%d.db" % size)
+    try:
+        os.unlink(dbo.database)
+    except:
+        pass
+    # install_db_structure echoes its DDL to stdout
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        dbupdate.install_db_structure(dbo)
+    finally:
+        sys.stdout = stdout
+    base.insert_synthetic(dbo, "animal", [ { "ID": i, "AnimalName": "Animal%d" % i, "ShelterCode": "A%d" % i,
+        "DateBroughtIn": dbo.today(offset=-900), "DateOfBirth": dbo.today(offset=-1200), "MostRecentEntryDate": dbo.today(offset=-100) }
+        for i in range(1, size + 1) ])
+    # Movement types alternate between foster (2, ignored by total days) and transfer (3)
+    moves = []
+    for i in range(1, size + 1):
+        for j in range(0, MOVEMENTS_PER_ANIMAL):
+            mid = ((i - 1) * MOVEMENTS_PER_ANIMAL) + j + 1
+            moves.append({ "ID": mid, "AdoptionNumber": str(mid), "AnimalID": i, "MovementType": 2 + (j % 2), 
+                "MovementDate": dbo.today(offset=-800 + (j * 200)), "ReturnDate": dbo.today(offset=-750 + (j * 200)) })
+    base.insert_synthetic(dbo, "adoption", moves)
+    return dbo
+
+def old_total_days(dbo):
+    """ The old batch behaviour, passing the full movements list for every animal """
+    animals = dbo.query("SELECT ID, DateBroughtIn, DeceasedDate, DiedOffShelter, Archived, ActiveMovementDate, " \
+        "MostRecentEntryDate, DateOfBirth FROM animal")
+    movements = dbo.query("SELECT ad.AnimalID, ad.MovementDate, ad.ReturnDate " \
+        "FROM adoption ad INNER JOIN animal a ON a.ID = ad.AnimalID " \
+        "WHERE ad.MovementType NOT IN (2,8) AND ad.MovementDate Is Not Null AND ad.ReturnDate Is Not Null " \
+        "ORDER BY AnimalID")
+    return [ animal.calc_total_days_on_shelter(dbo, a.id, a, movements) for a in animals ]
+
+def new_total_days(dbo):
+    """ The batch behaviour with movements grouped by animal """
+    animals = dbo.query("SELECT ID, DateBroughtIn, DeceasedDate, DiedOffShelter, Archived, ActiveMovementDate, " \
+        "MostRecentEntryDate, DateOfBirth FROM animal")
+    movements = animal.group_movements_by_animal(dbo.query("SELECT ad.AnimalID, ad.MovementDate, ad.ReturnDate " \
+        "FROM adoption ad INNER JOIN animal a ON a.ID = ad.AnimalID " \
+        "WHERE ad.MovementType NOT IN (2,8) AND ad.MovementDate Is Not Null AND ad.ReturnDate Is Not Null " \
+        "ORDER BY AnimalID"))
+    return [ animal.calc_total_days_on_shelter(dbo, a.id, a, movements.get(a.id, [])) for a in animals ]
+
+def timed(fn, dbo):
+    start = time.time()
+    rv = fn(dbo)
+    return time.time() - start, rv
+
+def run(sizes):
+    print("%8s %12s %12s %12s %12s %12s" % ("animals", "old calc", "new calc", "variable", "unchanged", "statuses"))
+    for size in sizes:
+        dbo = make_db(size)
+        told, rold = timed(old_total_days, dbo)
+        tnew, rnew = timed(new_total_days, dbo)
+        assert rold == rnew
+        tvar, dummy = timed(animal.update_all_variable_animal_data, dbo)
+        tsame, dummy = timed(animal.update_all_variable_animal_data, dbo)
+        tstat, dummy = timed(animal.update_all_animal_statuses, dbo)
+        print("%8d %11.2fs %11.2fs %11.2fs %11.2fs %11.2fs" % (size, told, tnew, tvar, tsame, tstat))
+        os.unlink(dbo.database)
+
+if __name__ == "__main__":
+    sizes = [ 1000, 2000, 4000, 8000 ]
+    if len(sys.argv) > 1: sizes = [ int(x) for x in sys.argv[1].split(",") ]
+    run(sizes)
+
@@ -0,0 +1,68 @@
+#!/usr/bin/python env
+
+"""
+Benchmarks csvimport.csvimport against synthetic SQLite databases,
+importing a file of animals with their original owners, adopters and
+vaccinations where the species, breeds, colours, locations and vaccination
+types are missing lookups that have to be created. Each size is imported
+once into an empty database and reports the rows per second and the
+number of records created.
+
+Not part of the unit test suite, run it directly:
+    python benchmark_csvimport.py [sizes]
+eg: python benchmark_csvimport.py 100,300,1000
+"""
+
+import os, random, sys, tempfile, time
+import base
+
+import csvimport
+import dbupdate
+
+HEADER = "ANIMALNAME,ANIMALSEX,ANIMALSPECIES,ANIMALBREED1,ANIMALCOLOR,ANIMALLOCATION,ANIMALCODE,ANIMALENTRYDATE," \
+    "PERSONFIRSTNAME,PERSONLASTNAME,PERSONADDRESS,PERSONCITY,MOVEMENTDATE,VACCINATIONTYPE,VACCINATIONDUEDATE"
+
+def make_db(size):
+    """ Creates a new empty SQLite database """
+    dbo = base.get_dbo()
+    dbo.database = os.path.join(tempfile.gettempdir(), "asmbenchmark_csvimport_%d.db" % size)
+    try:
+        os.unlink(dbo.database)
+    except:
+        pass
+    # install_db_structure echoes its DDL to stdout
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        dbupdate.install_db_structure(dbo)
+    finally:
+        sys.stdout = stdout
+    return dbo
+
+def make_csv(size):
+    """ Returns a CSV file with size rows """
+    r = random.Random(size)
+    rows = [ HEADER ]
+    for i in range(size):
+        rows.append("Animal%d,%s,%s,%s,%s,Kennel %d,C%05d,2019/01/%02d,First%d,Last%d,%d High St,Town%d,2019/02/01,%s,2019/03/01" % (i, 
+            r.choice([ "Male", "Female" ]), r.choice([ "Dog", "Cat", "Rabbit" ]), r.choice([ "Beagle", "Collie", "Tabby", "Lop", "Mutt%d" % r.randint(1, 30) ]),
+            r.choice([ "Black", "White", "Brown", "Ginger" ]), r.randint(1, 10), i, r.randint(1, 28), i, i, i, r.randint(1, 20),
+            r.choice([ "DHLPP", "Rabies", "FVRCP" ])))
+    return "\n".join(rows) + "\n"
+
+def run(sizes):
+    print("%8s %12s %10s %10s %10s %10s" % ("rows", "import", "rows/sec", "animals", "people", "breeds"))
+    for size in sizes:
+        dbo = make_db(size)
+        csvdata = make_csv(size)
+        start = time.time()
+        csvimport.csvimport(dbo, csvdata, createmissinglookups = True)
+        elapsed = time.time() - start
+        print("%8d %11.2fs %10.1f %10d %10d %10d" % (size, elapsed, size / max(elapsed, 0.0001), 
+            dbo.query_int("SELECT COUNT(*) FROM animal"), dbo.query_int("SELECT COUNT(*) FROM owner"), dbo.query_int("SELECT COUNT(*) FROM breed")))
+        os.unlink(dbo.database)
+
+if __name__ == "__main__":
+    sizes = [ 100, 300, 1000 ]
+    if len(sys.argv) > 1: sizes = [ int(x) for x in sys.argv[1].split(",") ]
+    run(sizes)
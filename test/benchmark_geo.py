@@ -0,0 +1,71 @@
+#!/usr/bin/python env
+
+"""
+Benchmarks geocoding the addresses of people without a geocode against a
+stub provider that takes LATENCY seconds to answer and allows RATE requests
+per second. The old approach of looking up every address one at a time and
+sleeping between them (old_lat_longs) is compared with geo.get_lat_longs,
+which looks up each distinct address once with a pool of rate limited
+threads, and then with get_lat_longs again once the addresses are in the
+geocode cache. Half the people share an address with someone else.
+
+Not part of the unit test suite, run it directly:
+    python benchmark_geo.py [sizes]
+eg: python benchmark_geo.py 50,100,200
+"""
+
+import random, sys, time
+import base
+
+import cachedisk
+import geo
+
+LATENCY = 0.1
+RATE = 20.0
+
+class StubProvider(geo.Smcom):
+    """ Answers every address after LATENCY seconds """
+    def search(self):
+        time.sleep(LATENCY)
+        self.json_response = { "lat": 53.4, "lng": -1.3 }
+
+def make_addresses(size):
+    r = random.Random(size)
+    addresses = [ ("%d High Street" % i, "Town%d" % (i % 20), "County", "S%d %dAB" % (i % 60, i % 9), "England") for i in range(size / 2) ]
+    return addresses + [ r.choice(addresses) for i in range(size - len(addresses)) ]
+
+def old_lat_longs(dbo, addresses):
+    """ The old behaviour, one lookup at a time followed by a sleep """
+    rv = []
+    for a in addresses:
+        g = StubProvider(dbo, *a)
+        g.search()
+        rv.append(g.parse())
+        time.sleep(1.0 / RATE)
+    return rv
+
+def timed(fn, *args):
+    start = time.time()
+    rv = fn(*args)
+    return time.time() - start, rv
+
+def run(sizes):
+    dbo = base.get_dbo()
+    geo.PROVIDERS["stub"] = StubProvider
+    geo.PROVIDER_RATES["stub"] = RATE
+    print("%8s %12s %12s %12s %10s" % ("people", "old", "new", "cached", "speedup"))
+    for size in sizes:
+        addresses = make_addresses(size)
+        for a in addresses: cachedisk.delete(geo.get_cache_key(*a))
+        geo.limiters.pop("stub", None)
+        told, rold = timed(old_lat_longs, dbo, addresses)
+        tnew, rnew = timed(geo.get_lat_longs, dbo, addresses, "stub")
+        tcached, rcached = timed(geo.get_lat_longs, dbo, addresses, "stub")
+        assert rold == rnew == rcached
+        print("%8d %11.2fs %11.2fs %11.2fs %9.1fx" % (size, told, tnew, tcached, told / max(tnew, 0.0001)))
+        for a in addresses: cachedisk.delete(geo.get_cache_key(*a))
+
+if __name__ == "__main__":
+    sizes = [ 50, 100, 200 ]
+    if len(sys.argv) > 1: sizes = [ int(x) for x in sys.argv[1].split(",") ]
+    run(sizes)
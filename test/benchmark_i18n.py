@@ -0,0 +1,74 @@
+#!/usr/bin/python env
+
+"""
+Benchmarks i18n startup and lookups, comparing the old approach of importing
+every locale module when i18n is imported with loading the compiled
+catalogue for a locale on first use, and the old translate() with the
+single dict lookup.
+
+Not part of the unit test suite, run it directly:
+    python benchmark_i18n.py [locale] [runs]
+eg: python benchmark_i18n.py fr 5
+"""
+
+import os, subprocess, sys, time
+import base
+
+import i18n
+
+LOOKUPS = 200000
+
+def startup(code, runs):
+    """ Returns the best time and memory used by code in runs new interpreters (after importing i18n) """
+    best = None
+    for i in range(0, runs):
+        child = "import sys, time, resource; sys.path.append('%s'); import utils, i18n; " \
+            "m = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss; t = time.time(); %s; " \
+            "print time.time() - t, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - m" % (base.PATH + "../src", code)
+        elapsed, memory = subprocess.check_output([ sys.executable, "-c", child ]).split()
+        if best is None or float(elapsed) < best[0]: best = ( float(elapsed), int(memory) )
+    return best
+
+def old_translate(english, locale, modules):
+    """ translate() as it was, looking up the locale module and checking the value every time """
+    locale = i18n.real_locale(locale)
+    if locale == "en": return english
+    try:
+        lang = modules["locale_" + locale]
+    except:
+        return english
+    if english not in lang.val: return english
+    s = lang.val[english]
+    if s is None or s == "" or s.startswith("??") or s.startswith("(??"):
+        return english
+    return lang.val[english]
+
+def lookups(fn, phrases):
+    start = time.time()
+    for i in range(0, LOOKUPS / len(phrases)):
+        for p in phrases:
+            fn(p)
+    return time.time() - start
+
+def run(locale, runs):
+    cat = i18n.get_catalogue_filename(i18n.real_locale(locale))
+    print("%-40s %10s %10s" % ("startup (best of %d)" % runs, "seconds", "memory"))
+    def show(label, rv):
+        print("%-40s %9.3fs %8dkb" % (label, rv[0], rv[1]))
+    show("all locale modules (old)", startup("from locales import *", runs))
+    if os.path.exists(cat): os.unlink(cat)
+    show("compile %s catalogue" % locale, startup("i18n._('Warnings', '%s')" % locale, 1))
+    show("load %s catalogue" % locale, startup("i18n._('Warnings', '%s')" % locale, runs))
+    exec "from locales import *" in globals()
+    phrases = i18n.load_catalogue("fr").keys()[:100] + [ "Select recommended", "Not a real phrase" ]
+    told = lookups(lambda p: old_translate(p, locale, globals()), phrases)
+    tnew = lookups(lambda p: i18n._(p, locale), phrases)
+    print("%-40s %9.3fs" % ("%d lookups, old translate" % LOOKUPS, told))
+    print("%-40s %9.3fs" % ("%d lookups, new translate" % LOOKUPS, tnew))
+
+if __name__ == "__main__":
+    locale = "fr"
+    runs = 5
+    if len(sys.argv) > 1: locale = sys.argv[1]
+    if len(sys.argv) > 2: runs = int(sys.argv[2])
+    run(locale, runs)
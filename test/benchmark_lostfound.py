@@ -0,0 +1,145 @@
+#!/usr/bin/python env
+
+"""
+Benchmarks lostfound.match against synthetic SQLite databases with the
+same number of lost, found and recent shelter animals, comparing the old
+approach of scoring every lost animal against every found and shelter
+animal (old_matches) with adding up points from the MatchIndex indexes
+that match uses now, which also includes saving the matches.
+Both must produce identical matches and points. The old approach is only
+timed up to OLD_MAX animals as it grows with the square of the size.
+
+Not part of the unit test suite, run it directly:
+    python benchmark_lostfound.py [sizes]
+eg: python benchmark_lostfound.py 500,1000,2000
+"""
+
+import os, random, sys, tempfile, time
+import base
+
+import animal
+import configuration
+import dbupdate
+import lostfound
+import utils
+from i18n import date_diff_days
+
+OLD_MAX = 4000
+
+AGEGROUPS = [ "Baby", "Young Adult", "Adult", "Senior" ]
+AREAS = [ "Fairfield", "Hillside", "Old Town", "Riverside", "Northgate", "Market Square", "Station Road",
+    "Church Lane", "Park View", "Mill Street", "Victoria Road", "Green Lane" ]
+FEATURES = [ "white", "black", "brown", "patch", "left", "right", "ear", "paw", "tail", "collar", "red", "blue",
+    "scar", "chip", "long", "short", "hair", "eye", "nose", "spotted", "tabby", "limp" ]
+POSTCODES = [ "S%d %dAB" % (i, j) for i in range(1, 60) for j in range(1, 10) ]
+
+def make_db(size):
+    """ Creates a new SQLite database with size lost, found and shelter animals """
+    r = random.Random(size)
+    dbo = base.get_dbo()
+    dbo.database = os.path.join(tempfile.gettempdir(), "asmbenchmark_lostfound_%d.db" % size)
+    try:
+        os.unlink(dbo.database)
+    except:
+        pass
+    # install_db_structure echoes its DDL to stdout
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        dbupdate.install_db_structure(dbo)
+    finally:
+        sys.stdout = stdout
+    def features():
+        return ", ".join(r.sample(FEATURES, r.randint(1, 4)))
+    def area():
+        return "%d %s" % (r.randint(1, 200), r.choice(AREAS))
+    base.insert_synthetic(dbo, "animallost", [ { "ID": i, "AnimalTypeID": r.randint(1, 3), "BreedID": r.randint(1, 50),
+        "AgeGroup": r.choice(AGEGROUPS), "Sex": r.randint(0, 1), "BaseColourID": r.randint(1, 20),
+        "AreaLost": area(), "DistFeat": features(), "AreaPostcode": r.choice(POSTCODES),
+        "DateLost": dbo.today(offset=-r.randint(0, 170)), "DateReported": dbo.today() }
+        for i in range(1, size + 1) ])
+    base.insert_synthetic(dbo, "animalfound", [ { "ID": i, "AnimalTypeID": r.randint(1, 3), "BreedID": r.randint(1, 50),
+        "AgeGroup": r.choice(AGEGROUPS), "Sex": r.randint(0, 1), "BaseColourID": r.randint(1, 20),
+        "AreaFound": area(), "DistFeat": features(), "AreaPostcode": r.choice(POSTCODES),
+        "DateFound": dbo.today(offset=-r.randint(0, 170)), "DateReported": dbo.today() }
+        for i in range(1, size + 1) ])
+    # Shelter animals each have an original owner with the address they came from
+    base.insert_synthetic(dbo, "owner", [ { "ID": i, "OwnerName": "Person%d" % i, "OwnerAddress": area(), 
+        "OwnerPostcode": r.choice(POSTCODES) } 
+        for i in range(1, size + 1) ])
+    base.insert_synthetic(dbo, "animal", [ { "ID": i, "AnimalName": "Animal%d" % i, "ShelterCode": "A%d" % i,
+        "SpeciesID": r.randint(1, 3), "BreedID": r.randint(1, 50), "Breed2ID": r.randint(1, 50),
+        "AgeGroup": r.choice(AGEGROUPS), "Sex": r.randint(0, 1), "BaseColourID": r.randint(1, 20),
+        "OriginalOwnerID": i, "Markings": features(), "DateBroughtIn": dbo.today(offset=-r.randint(0, 170)) }
+        for i in range(1, size + 1) ])
+    return dbo
+
+def get_animals(dbo):
+    """ Returns the lost, found and shelter animals as match reads them """
+    giveup = dbo.today(offset=-182)
+    lost = dbo.query(lostfound.get_lostanimal_query(dbo) + " WHERE a.DateFound Is Null AND a.DateLost > ? ORDER BY a.DateLost", [giveup])
+    oldestdate = lost[0].DATELOST
+    found = dbo.query(lostfound.get_foundanimal_query(dbo) + " WHERE a.ReturnToOwnerDate Is Null AND a.DateFound >= ? ", [oldestdate])
+    shelter = dbo.query(animal.get_animal_query(dbo) + " WHERE (a.Archived = 0 OR a.ActiveMovementType IN (3,4,7)) AND a.DateBroughtIn > ?", [oldestdate])
+    return lost, found, shelter
+
+def old_matches(dbo, lost, found, shelter):
+    """ The old behaviour, scoring every pair """
+    floor = configuration.match_point_floor(dbo)
+    def pc(matchpoints):
+        return int((float(matchpoints) / 45.0) * 100.0)
+    rv = []
+    for la in lost:
+        for fa in found:
+            matchpoints = 0
+            if la["ANIMALTYPEID"] == fa["ANIMALTYPEID"]: matchpoints += 5
+            if la["BREEDID"] == fa["BREEDID"]: matchpoints += 5
+            if la["AGEGROUP"] == fa["AGEGROUP"]: matchpoints += 5
+            if la["SEX"] == fa["SEX"]: matchpoints += 5
+            matchpoints += lostfound.words(la["AREALOST"], fa["AREAFOUND"], 5)
+            matchpoints += lostfound.words(la["DISTFEAT"], fa["DISTFEAT"], 5)
+            if la["AREAPOSTCODE"] == fa["AREAPOSTCODE"]: matchpoints += 5
+            if la["BASECOLOURID"] == fa["BASECOLOURID"]: matchpoints += 5
+            if date_diff_days(la["DATELOST"], fa["DATEFOUND"]) <= 14: matchpoints += 5
+            if matchpoints >= floor: rv.append( (la.ID, fa.ID, 0, pc(matchpoints)) )
+        for a in shelter:
+            matchpoints = 0
+            if la["ANIMALTYPEID"] == a["SPECIESID"]: matchpoints += 5
+            if la["BREEDID"] == a["BREEDID"] or la["BREEDID"] == a["BREED2ID"]: matchpoints += 5
+            if la["BASECOLOURID"] == a["BASECOLOURID"]: matchpoints += 5
+            if la["AGEGROUP"] == a["AGEGROUP"]: matchpoints += 5
+            if la["SEX"] == a["SEX"]: matchpoints += 5
+            matchpoints += lostfound.words(la["AREALOST"], a["ORIGINALOWNERADDRESS"], 5)
+            matchpoints += lostfound.words(la["DISTFEAT"], a["MARKINGS"], 5)
+            if utils.nulltostr(a["ORIGINALOWNERPOSTCODE"]).find(la["AREAPOSTCODE"]) != -1: matchpoints += 5
+            if date_diff_days(la["DATELOST"], a["DATEBROUGHTIN"]) <= 14: matchpoints += 5
+            if matchpoints >= floor: rv.append( (la.ID, 0, a.ID, pc(matchpoints)) )
+    return rv
+
+def new_matches(dbo):
+    """ lostfound.match with the default (all 5 points) configuration """
+    return [ (m.lid, m.fid, m.fanimalid, m.matchpoints) for m in lostfound.match(dbo) ]
+
+def run(sizes):
+    print("%8s %10s %12s %12s %10s" % ("animals", "matches", "old match", "new match", "speedup"))
+    for size in sizes:
+        dbo = make_db(size)
+        start = time.time()
+        rnew = new_matches(dbo)
+        tnew = time.time() - start
+        if size <= OLD_MAX:
+            lost, found, shelter = get_animals(dbo)
+            start = time.time()
+            rold = old_matches(dbo, lost, found, shelter)
+            told = time.time() - start
+            assert rold == rnew
+            print("%8d %10d %11.2fs %11.2fs %9.1fx" % (size, len(rnew), told, tnew, told / max(tnew, 0.0001)))
+        else:
+            print("%8d %10d %12s %11.2fs %10s" % (size, len(rnew), "-", tnew, "-"))
+        os.unlink(dbo.database)
+
+if __name__ == "__main__":
+    sizes = [ 500, 1000, 2000 ]
+    if len(sys.argv) > 1: sizes = [ int(x) for x in sys.argv[1].split(",") ]
+    run(sizes)
+
@@ -0,0 +1,134 @@
+#!/usr/bin/python env
+
+"""
+Benchmarks matching people's "looking for" profiles against the adoptable
+animals in person.py, comparing the old approach of running the animal
+query once per person (old_matches) with LookingForMatcher, which reads
+the animals once and matches every profile in memory. Synthetic SQLite
+databases with ANIMALS adoptable animals and an increasing number of
+people looking are used.
+
+Not part of the unit test suite, run it directly:
+    python benchmark_person.py [sizes]
+eg: python benchmark_person.py 250,500,1000,2000
+"""
+
+import os, random, sys, tempfile, time
+import base
+
+import animal
+import dbupdate
+import person
+from i18n import subtract_years, now
+
+ANIMALS = 2000
+
+WORDS = [ "friendly", "shy", "playful", "loves walks", "needs a garden", "nervous of men", "calm", "energetic", "lap cat" ]
+
+def make_db(size):
+    """ Creates a new SQLite database with ANIMALS animals and size people with match profiles """
+    r = random.Random(size)
+    dbo = base.get_dbo()
+    dbo.database = os.path.join(tempfile.gettempdir(), "asmbenchmark_person_%d.db" % size)
+    try:
+        os.unlink(dbo.database)
+    except:
+        pass
+    # install_db_structure echoes its DDL to stdout
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        dbupdate.install_db_structure(dbo)
+    finally:
+        sys.stdout = stdout
+    base.insert_synthetic(dbo, "animal", [ { "ID": i, "AnimalName": "Animal%d" % i, "ShelterCode": "A%d" % i,
+        "AnimalTypeID": r.randint(1, 5), "SpeciesID": r.randint(1, 3), "BreedID": r.randint(1, 20), "Breed2ID": r.randint(1, 20),
+        "Sex": r.randint(0, 1), "Size": r.randint(0, 3), "BaseColourID": r.randint(1, 10),
+        "IsGoodWithChildren": r.randint(0, 2), "IsGoodWithCats": r.randint(0, 2), "IsGoodWithDogs": r.randint(0, 2), "IsHouseTrained": r.randint(0, 2),
+        "AnimalComments": " ".join(r.sample(WORDS, 2)), "HiddenAnimalDetails": r.choice(WORDS),
+        "HasActiveReserve": 0, "DateBroughtIn": dbo.today(offset=-100), "DateOfBirth": dbo.today(offset=r.randint(-5000, -30)),
+        "LastChangedDate": dbo.now(offset=-r.randint(0, 1000)) }
+        for i in range(1, ANIMALS + 1) ])
+    def either(value, anyvalue = -1):
+        if r.random() < 0.6: return anyvalue
+        return value
+    base.insert_synthetic(dbo, "owner", [ { "ID": i, "OwnerName": "Person%d" % i, "MatchActive": 1,
+        "MatchAnimalType": either(r.randint(1, 5)), "MatchSpecies": either(r.randint(1, 3)), "MatchBreed": either(r.randint(1, 20)),
+        "MatchSex": either(r.randint(0, 1)), "MatchSize": either(r.randint(0, 3)), "MatchColour": either(r.randint(1, 10)),
+        "MatchGoodWithChildren": either(0, 2), "MatchGoodWithCats": either(0, 2), "MatchGoodWithDogs": either(0, 2), "MatchHouseTrained": either(0, 2),
+        "MatchAgeFrom": either(r.randint(0, 3), 0), "MatchAgeTo": either(r.randint(4, 12), 0),
+        "MatchCommentsContain": either(r.choice(WORDS).split(" ")[-1], "") }
+        for i in range(1, size + 1) ])
+    return dbo
+
+def get_people(dbo):
+    return dbo.query("SELECT * FROM owner WHERE MatchActive = 1 ORDER BY OwnerName")
+
+def old_matches(dbo):
+    """ The old behaviour, one animal query per person """
+    rv = []
+    for p in get_people(dbo):
+        ands = [ "a.Archived=0", "a.IsNotAvailableForAdoption=0", "a.HasActiveReserve=0", "a.CrueltyCase=0", "a.DeceasedDate Is Null" ]
+        v = []
+        if p.MATCHANIMALTYPE != -1:
+            ands.append("a.AnimalTypeID=?")
+            v.append(p.MATCHANIMALTYPE)
+        if p.MATCHSPECIES != -1:
+            ands.append("a.SpeciesID=?")
+            v.append(p.MATCHSPECIES)
+        if p.MATCHBREED != -1:
+            ands.append("(a.BreedID=? OR a.Breed2ID=?)")
+            v.append(p.MATCHBREED)
+            v.append(p.MATCHBREED)
+        if p.MATCHSEX != -1:
+            ands.append("a.Sex=?")
+            v.append(p.MATCHSEX)
+        if p.MATCHSIZE != -1:
+            ands.append("a.Size=?")
+            v.append(p.MATCHSIZE)
+        if p.MATCHCOLOUR != -1:
+            ands.append("a.BaseColourID=?")
+            v.append(p.MATCHCOLOUR)
+        if p.MATCHGOODWITHCHILDREN == 0: ands.append("a.IsGoodWithChildren=0")
+        if p.MATCHGOODWITHCATS == 0: ands.append("a.IsGoodWithCats=0")
+        if p.MATCHGOODWITHDOGS == 0: ands.append("a.IsGoodWithDogs=0")
+        if p.MATCHHOUSETRAINED == 0: ands.append("a.IsHouseTrained=0")
+        if p.MATCHAGEFROM >= 0 and p.MATCHAGETO > 0:
+            ands.append("a.DateOfBirth BETWEEN ? AND ?")
+            v.append(subtract_years(now(dbo.timezone), p.MATCHAGETO))
+            v.append(subtract_years(now(dbo.timezone), p.MATCHAGEFROM))
+        if p.MATCHCOMMENTSCONTAIN is not None and p.MATCHCOMMENTSCONTAIN != "":
+            for w in str(p.MATCHCOMMENTSCONTAIN).split(" "):
+                ands.append("(a.AnimalComments LIKE ? OR a.HiddenAnimalDetails LIKE ?)")
+                v.append("%%%s%%" % w)
+                v.append("%%%s%%" % w)
+        animals = dbo.query(animal.get_animal_query(dbo) + " WHERE " + " AND ".join(ands) + " ORDER BY a.LastChangedDate DESC", v)
+        rv.append(sorted([ a.ID for a in animals ]))
+    return rv
+
+def new_matches(dbo):
+    """ LookingForMatcher, one animal query in total """
+    matcher = person.LookingForMatcher(dbo)
+    return [ sorted([ a.ID for a in matcher.match(p) ]) for p in get_people(dbo) ]
+
+def timed(fn, dbo):
+    start = time.time()
+    rv = fn(dbo)
+    return time.time() - start, rv
+
+def run(sizes):
+    print("%8s %10s %12s %12s %10s %12s" % ("people", "matches", "old match", "new match", "speedup", "report"))
+    for size in sizes:
+        dbo = make_db(size)
+        told, rold = timed(old_matches, dbo)
+        tnew, rnew = timed(new_matches, dbo)
+        assert rold == rnew
+        treport, dummy = timed(person.lookingfor_report, dbo)
+        print("%8d %10d %11.2fs %11.2fs %9.1fx %11.2fs" % (size, sum([ len(x) for x in rnew ]), told, tnew, told / max(tnew, 0.0001), treport))
+        os.unlink(dbo.database)
+
+if __name__ == "__main__":
+    sizes = [ 250, 500, 1000, 2000 ]
+    if len(sys.argv) > 1: sizes = [ int(x) for x in sys.argv[1].split(",") ]
+    run(sizes)
+
@@ -0,0 +1,50 @@
+#!/usr/bin/python env
+
+"""
+Benchmarks substituting fields in report blocks, comparing replacing every
+field in turn for each row (as reports did before blocks were compiled)
+with rendering a ReportBlock compiled once for the columns.
+
+Not part of the unit test suite, run it directly:
+    python benchmark_reports.py [rows]
+eg: python benchmark_reports.py 1000,5000,20000
+"""
+
+import sys, time
+import base
+
+import reports
+from dbms.base import ResultRow
+
+FIELDS = 30
+
+BODY = "<tr>%s</tr>\n" % "".join([ "<td>$FIELD%d</td>" % i for i in range(0, FIELDS) ])
+
+def make_rows(size):
+    return [ ResultRow([ ("FIELD%d" % i, "Value %d for row %d" % (i, r)) for i in range(0, FIELDS) ]) for r in range(0, size) ]
+
+def substitute(compiled, rows):
+    r = reports.Report(base.get_dbo())
+    if compiled: r.compiled = reports.ReportTemplate("")
+    for row in rows:
+        r._OutputBody(BODY, row)
+    return r._Output()
+
+def timed(compiled, rows):
+    start = time.time()
+    rv = substitute(compiled, rows)
+    return time.time() - start, rv
+
+def run(sizes):
+    print("%8s %12s %12s %10s" % ("rows", "old", "compiled", "speedup"))
+    for size in sizes:
+        rows = make_rows(size)
+        told, rold = timed(False, rows)
+        tnew, rnew = timed(True, rows)
+        assert rold == rnew
+        print("%8d %11.3fs %11.3fs %9.1fx" % (size, told, tnew, told / max(tnew, 0.0001)))
+
+if __name__ == "__main__":
+    sizes = [ 1000, 5000, 20000 ]
+    if len(sys.argv) > 1: sizes = [ int(x) for x in sys.argv[1].split(",") ]
+    run(sizes)
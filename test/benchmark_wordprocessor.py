@@ -0,0 +1,55 @@
+#!/usr/bin/python env
+
+"""
+Benchmarks tag substitution in wordprocessor.py, comparing the old approach
+of rebuilding the document after every tag (substitute_tags_rescan) with
+tokenising it once (TagTemplate) and rendering it for many rows, as a mail
+merge does.
+
+Not part of the unit test suite, run it directly:
+    python benchmark_wordprocessor.py [sizes]
+eg: python benchmark_wordprocessor.py 500,1000,2000,4000
+"""
+
+import sys, time
+import base
+
+import wordprocessor
+
+ROWS = 20
+
+def make_document(size):
+    """ Returns an XML escaped document with size tags and some text between each """
+    para = "<text:p text:style-name=\"P1\">Some text about the animal: &lt;&lt;TAG%d&gt;&gt;</text:p>\n"
+    return "<office:document-content>\n%s</office:document-content>" % "".join([ para % i for i in range(0, size) ])
+
+def make_tags(size, row):
+    return dict([ ("TAG%d" % i, "Value %d for row %d & <others>" % (i, row)) for i in range(0, size) ])
+
+def old_merge(document, rows):
+    return [ wordprocessor.substitute_tags_rescan(document, tags, True, "&lt;&lt;", "&gt;&gt;") for tags in rows ]
+
+def new_merge(document, rows):
+    t = wordprocessor.TagTemplate(document)
+    return [ t.render(tags) for tags in rows ]
+
+def timed(fn, document, rows):
+    start = time.time()
+    rv = fn(document, rows)
+    return time.time() - start, rv
+
+def run(sizes):
+    print("%8s %10s %12s %12s %10s" % ("tags", "doc bytes", "old merge", "new merge", "speedup"))
+    for size in sizes:
+        document = make_document(size)
+        rows = [ make_tags(size, r) for r in range(0, ROWS) ]
+        told, rold = timed(old_merge, document, rows)
+        tnew, rnew = timed(new_merge, document, rows)
+        assert rold == rnew
+        print("%8d %10d %11.3fs %11.3fs %9.1fx" % (size, len(document), told, tnew, told / max(tnew, 0.0001)))
+
+if __name__ == "__main__":
+    sizes = [ 500, 1000, 2000, 4000 ]
+    if len(sys.argv) > 1: sizes = [ int(x) for x in sys.argv[1].split(",") ]
+    run(sizes)
+
@@ -22,14 +22,34 @@ import test_animal
 suitea = unittest.makeSuite(test_animal.TestAnimal, 'test')
 fullsuite.append(suitea)
 
+import test_asset
+suiteasset = unittest.makeSuite(test_asset.TestAsset, 'test')
+fullsuite.append(suiteasset)
+
+import test_cachedisk
+suitecachedisk = unittest.makeSuite(test_cachedisk.TestCacheDisk, 'test')
+fullsuite.append(suitecachedisk)
+
+import test_cachemem
+suitecachemem = unittest.makeSuite(test_cachemem.TestCacheMem, 'test')
+fullsuite.append(suitecachemem)
+
 import test_clinic
 suiteclinic = unittest.makeSuite(test_clinic.TestClinic, 'test')
 fullsuite.append(suiteclinic)
 
+import test_configuration
+suiteconfig = unittest.makeSuite(test_configuration.TestConfiguration, 'test')
+fullsuite.append(suiteconfig)
+
 import test_csvimport
 suitecsv = unittest.makeSuite(test_csvimport.TestCSVImport, 'test')
 fullsuite.append(suitecsv)
 
+import test_db
+suitedb = unittest.makeSuite(test_db.TestDb, 'test')
+fullsuite.append(suitedb)
+
 import test_dbfs
 suitedbfs = unittest.makeSuite(test_dbfs.TestDBFS, 'test')
 fullsuite.append(suitedbfs)
@@ -38,6 +58,10 @@ import test_diary
 suitediary = unittest.makeSuite(test_diary.TestDiary, 'test')
 fullsuite.append(suitediary)
 
+import test_emailqueue
+suiteemailqueue = unittest.makeSuite(test_emailqueue.TestEmailQueue, 'test')
+fullsuite.append(suiteemailqueue)
+
 import test_financial
 suitefin = unittest.makeSuite(test_financial.TestFinancial, 'test')
 fullsuite.append(suitefin)
@@ -50,6 +74,10 @@ import test_html
 suitehtml = unittest.makeSuite(test_html.TestHtml, 'test')
 fullsuite.append(suitehtml)
 
+import test_i18n
+suitei18n = unittest.makeSuite(test_i18n.TestI18n, 'test')
+fullsuite.append(suitei18n)
+
 import test_log
 suitelog = unittest.makeSuite(test_log.TestLog, 'test')
 fullsuite.append(suitelog)
@@ -122,6 +150,10 @@ import test_waitinglist
 suitewl = unittest.makeSuite(test_waitinglist.TestWaitingList, 'test')
 fullsuite.append(suitewl)
 
+import test_wordprocessor
+suitewp = unittest.makeSuite(test_wordprocessor.TestWordProcessor, 'test')
+fullsuite.append(suitewp)
+
 if __name__ == "__main__":
     base.reset_db()
     dbupdate.install(base.get_dbo())
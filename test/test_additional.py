@@ -5,6 +5,7 @@ import base
 
 import additional
 import utils
+from dbms.base import ResultRow
 
 class TestAdditional(unittest.TestCase):
  
@@ -36,6 +37,16 @@ class TestAdditional(unittest.TestCase):
     def test_get_additional_fields_ids(self):
         additional.get_additional_fields_ids(base.get_dbo(), [], "animal")
 
+    def test_append_to_results(self):
+        dbo = base.get_dbo()
+        additional.insert_additional(dbo, 0, 99998, self.nid, "testvalue")
+        rows = additional.append_to_results(dbo, [ ResultRow({ "ID": 99998 }), ResultRow({ "ID": 99999 }) ], "animal")
+        assert rows[0]["ADDNAME"] == "testvalue"
+        assert rows[1]["ADDNAME"] is None
+        for af in additional.get_additional_fields(dbo, 99998, "animal"):
+            assert rows[0][af.fieldname.upper()] == af.value
+        dbo.delete("additional", "LinkID=99998")
+
     def test_get_field_definitions(self):
         assert len(additional.get_field_definitions(base.get_dbo(), "animal")) > 0
 
@@ -56,6 +56,14 @@ class TestAnimal(unittest.TestCase):
         assert animal.calc_age_group(base.get_dbo(), self.nid) is not None
         assert animal.calc_age(base.get_dbo(), self.nid) is not None
 
+    def test_group_movements_by_animal(self):
+        dbo = base.get_dbo()
+        m = dbo.query("SELECT AnimalID, MovementDate, ReturnDate FROM adoption ORDER BY AnimalID")
+        g = animal.group_movements_by_animal(m)
+        assert sum([ len(x) for x in g.values() ]) == len(m)
+        a = dbo.query("SELECT Archived, DateBroughtIn, DeceasedDate, DiedOffShelter, ActiveMovementDate FROM animal WHERE ID = ?", [self.nid])[0]
+        assert animal.calc_total_days_on_shelter(dbo, self.nid, a, m) == animal.calc_total_days_on_shelter(dbo, self.nid, a, g.get(self.nid, []))
+
     def test_get_fields(self):
         assert True == animal.get_is_on_shelter(base.get_dbo(), self.nid)
         animal.get_comments(base.get_dbo(), self.nid)
@@ -246,6 +254,22 @@ class TestAnimal(unittest.TestCase):
         base.execute("DELETE FROM configuration WHERE ItemName LIKE 'VariableAnimalDataUpdated'")
         animal.update_all_variable_animal_data(base.get_dbo())
 
+    def test_update_variable_animal_data(self):
+        dbo = base.get_dbo()
+        animal.update_variable_animal_data(dbo, self.nid)
+        # Nothing has changed, so nothing is written
+        assert not animal.update_variable_animal_data(dbo, self.nid)
+        days = dbo.query_int("SELECT DaysOnShelter FROM animal WHERE ID = ?", [self.nid])
+        dbo.execute("UPDATE animal SET DaysOnShelter = -1, AnimalAge = 'x' WHERE ID = ?", [self.nid])
+        assert animal.update_variable_animal_data(dbo, self.nid)
+        assert days == dbo.query_int("SELECT DaysOnShelter FROM animal WHERE ID = ?", [self.nid])
+        # The batch only writes the animals that changed
+        dbo.execute("UPDATE animal SET AnimalAge = 'x' WHERE ID = ?", [self.nid])
+        animals = dbo.query(animal.get_variable_animal_data_query(dbo) + " WHERE ID = ?", [self.nid])
+        assert 1 == animal.update_variable_animal_data_batch(dbo, animals, {})
+        assert 0 == animal.update_variable_animal_data_batch(dbo, dbo.query(animal.get_variable_animal_data_query(dbo) + " WHERE ID = ?", [self.nid]), {})
+        assert "x" != dbo.query_string("SELECT AnimalAge FROM animal WHERE ID = ?", [self.nid])
+
     def test_update_all_animal_statuses(self):
         animal.update_all_animal_statuses(base.get_dbo())
 
@@ -0,0 +1,76 @@
+#!/usr/bin/python env
+
+import unittest
+import base
+
+import asset
+import gzip
+from cStringIO import StringIO
+
+CONTENT = "var x = 1;\n" * 500
+
+class TestAsset(unittest.TestCase):
+
+    def setUp(self):
+        asset.reset()
+
+    def test_variants(self):
+        a = asset.Asset(CONTENT, "text/javascript", 1555231729)
+        assert CONTENT == a.content()
+        assert CONTENT == gzip.GzipFile(fileobj=StringIO(a.content("gzip"))).read()
+        assert len(a.content("gzip")) < len(CONTENT)
+        assert "\"%s\"" % a.hash == a.etag()
+        assert "\"%s-gzip\"" % a.hash == a.etag("gzip")
+        assert "Sun, 14 Apr 2019 08:48:49 GMT" == a.last_modified()
+        # Small assets aren't compressed
+        assert [ "identity" ] == asset.Asset("var x;", "text/javascript", 0).variants.keys()
+
+    def test_select_encoding(self):
+        a = asset.Asset(CONTENT, "text/javascript", 0)
+        assert "gzip" == a.select_encoding("gzip, deflate")
+        assert "gzip" == a.select_encoding("deflate, GZIP;q=0.5")
+        assert "gzip" == a.select_encoding("*")
+        assert "identity" == a.select_encoding("")
+        assert "identity" == a.select_encoding(None)
+        assert "identity" == a.select_encoding("gzip;q=0, deflate")
+        assert "identity" == a.select_encoding("*;q=0")
+        if asset.brotli is not None:
+            assert "br" == a.select_encoding("gzip, deflate, br")
+        else:
+            assert "gzip" == a.select_encoding("gzip, deflate, br")
+
+    def test_is_not_modified(self):
+        a = asset.Asset(CONTENT, "text/javascript", 1555231729)
+        assert not a.is_not_modified()
+        assert a.is_not_modified(a.etag())
+        assert a.is_not_modified(a.etag("gzip"))
+        assert a.is_not_modified("W/%s" % a.etag("gzip"))
+        assert a.is_not_modified("\"abc\", %s" % a.etag())
+        assert a.is_not_modified("*")
+        assert not a.is_not_modified("\"abc\"")
+        assert a.is_not_modified("", "Sun, 14 Apr 2019 08:48:49 GMT")
+        assert a.is_not_modified("", "Mon, 15 Apr 2019 08:48:49 GMT")
+        assert not a.is_not_modified("", "Sat, 13 Apr 2019 08:48:49 GMT")
+        assert not a.is_not_modified("", "garbage")
+        # If-None-Match wins over If-Modified-Since
+        assert not a.is_not_modified("\"abc\"", "Mon, 15 Apr 2019 08:48:49 GMT")
+
+    def test_get_asset(self):
+        builds = []
+        def build():
+            builds.append(1)
+            return CONTENT, 100
+        a = asset.get_asset("test.js", "text/javascript", build, 100)
+        assert CONTENT == a.content()
+        assert 100 == a.lastmodified
+        assert a is asset.get_asset("test.js", "text/javascript", build, 100)
+        assert 1 == len(builds)
+        # A changed source is rebuilt
+        asset.get_asset("test.js", "text/javascript", build, 200)
+        assert 2 == len(builds)
+        # Without an mtime, it's built once
+        b = asset.get_asset("test2.js", "text/javascript", lambda: (CONTENT, None))
+        assert b.lastmodified > 0
+        assert b is asset.get_asset("test2.js", "text/javascript", build)
+        assert 2 == len(builds)
+
@@ -0,0 +1,72 @@
+#!/usr/bin/python env
+
+import unittest
+import base
+
+import cachedisk
+import os, shutil, tempfile, time
+
+class TestCacheDisk(unittest.TestCase):
+
+    def setUp(self):
+        self.diskcache = cachedisk.DISK_CACHE
+        cachedisk.DISK_CACHE = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(cachedisk.DISK_CACHE)
+        cachedisk.DISK_CACHE = self.diskcache
+
+    def test_put_get_delete(self):
+        cachedisk.put("test_cachedisk_str", "value", 60)
+        assert "value" == cachedisk.get("test_cachedisk_str")
+        cachedisk.put("test_cachedisk_obj", ("text/plain", 60, 60, "value"), 60)
+        assert ("text/plain", 60, 60, "value") == cachedisk.get("test_cachedisk_obj")
+        cachedisk.delete("test_cachedisk_str")
+        cachedisk.delete("test_cachedisk_obj")
+        assert None == cachedisk.get("test_cachedisk_str")
+        assert None == cachedisk.get("test_cachedisk_obj")
+        # Deleting something that isn't there is fine
+        cachedisk.delete("test_cachedisk_str")
+
+    def test_large_value(self):
+        v = "x" * (cachedisk.MMAP_THRESHOLD * 2)
+        cachedisk.put("test_cachedisk_large", v, 60)
+        assert v == cachedisk.get("test_cachedisk_large")
+        cachedisk.delete("test_cachedisk_large")
+
+    def test_expiry(self):
+        cachedisk.put("test_cachedisk_expired", "value", -1)
+        assert None == cachedisk.get("test_cachedisk_expired")
+        assert not os.path.exists(cachedisk._getfilename("test_cachedisk_expired"))
+
+    def test_touch(self):
+        cachedisk.put("test_cachedisk_touch", "value", 10)
+        assert "value" == cachedisk.touch("test_cachedisk_touch", 60, 3600)
+        with open(cachedisk._getfilename("test_cachedisk_touch"), "rb") as f:
+            fmt, expires = cachedisk._read_header(f)
+        assert expires > time.time() + 3000
+        cachedisk.delete("test_cachedisk_touch")
+
+    def test_remove_expired(self):
+        cachedisk.put("test_cachedisk_r1", "x" * 1000, -1)
+        cachedisk.put("test_cachedisk_r2", "x" * 1000, 60)
+        cachedisk.put("test_cachedisk_r3", "x" * 1000, 60)
+        f2 = cachedisk._getfilename("test_cachedisk_r2")
+        os.utime(f2, (time.time() - 60, time.time() - 60))
+        # Files that the cache didn't write are left alone, entries from the old flat layout aren't
+        foreign = [ os.path.join(cachedisk.DISK_CACHE, "test_cachedisk_foreign"), os.path.join(os.path.dirname(f2), "test_cachedisk_foreign") ]
+        legacy = os.path.join(cachedisk.DISK_CACHE, "0" * 32)
+        for fname in foreign + [ legacy ]:
+            with open(fname, "w") as f:
+                f.write("x" * 1000)
+        cachedisk.remove_expired(0)
+        for fname in foreign:
+            assert os.path.exists(fname)
+        assert not os.path.exists(legacy)
+        assert not os.path.exists(cachedisk._getfilename("test_cachedisk_r1"))
+        assert os.path.exists(f2)
+        # Size cap, r2 is least recently used
+        cachedisk.remove_expired(1)
+        assert not os.path.exists(f2)
+        assert not os.path.exists(cachedisk._getfilename("test_cachedisk_r3"))
+
@@ -0,0 +1,66 @@
+#!/usr/bin/python env
+
+import unittest
+import base
+
+import cachemem
+
+class TestCacheMem(unittest.TestCase):
+
+    def test_put_get_delete(self):
+        cachemem.put("test_cachemem", "value", 60)
+        assert "value" == cachemem.get("test_cachemem")
+        cachemem.delete("test_cachemem")
+        assert None == cachemem.get("test_cachemem")
+
+    def test_lru_expiry(self):
+        c = cachemem.LRUCache(10, 100000, 60)
+        c.put("a", 1, -1)
+        assert None == c.get("a")
+        c.put("b", 1, 60)
+        assert 2 == c.increment("b")
+        assert 2 == c.get("b")
+        assert 1 == c.stats()["expirations"]
+
+    def test_lru_max_entries(self):
+        c = cachemem.LRUCache(3, 100000, 60)
+        c.put("a", 1, 60)
+        c.put("b", 2, 60)
+        c.put("c", 3, 60)
+        c.get("a")
+        c.put("d", 4, 60)
+        # b was least recently used
+        assert None == c.get("b")
+        assert 1 == c.get("a")
+        assert 3 == c.get("c")
+        assert 4 == c.get("d")
+        s = c.stats()
+        assert 3 == s["entries"]
+        assert 1 == s["evictions"]
+        assert 4 == s["hits"]
+        assert 1 == s["misses"]
+
+    def test_lru_max_bytes(self):
+        c = cachemem.LRUCache(100, 2500, 60)
+        for i in range(0, 5):
+            c.put("k%d" % i, "x" * 1000, 60)
+        assert 2 == c.stats()["entries"]
+        assert c.stats()["bytes"] <= 2500
+        assert None == c.get("k0")
+        assert "x" * 1000 == c.get("k4")
+
+    def test_lru_sweep(self):
+        c = cachemem.LRUCache(100, 100000, 0)
+        c.put("a", 1, -1)
+        c.put("b", 1, 60)
+        assert 1 == c.stats()["entries"]
+
+
+    def test_lru_size(self):
+        c = cachemem.LRUCache(100, 1000000, 60)
+        c.put("s", "x" * 1000, 60)
+        assert 1001 == c.stats()["bytes"]
+        # Query results are estimated from a sample of their rows
+        rows = [ { "ID": i, "NAME": "x" * 100 } for i in range(0, 1000) ]
+        c.put("rows", rows, 60)
+        assert 100000 < c.stats()["bytes"] < 1000000
@@ -0,0 +1,36 @@
+#!/usr/bin/python env
+
+import unittest
+import base
+
+import configuration
+
+class TestConfiguration(unittest.TestCase):
+
+    def test_map_fetched_once_per_request(self):
+        dbo = base.get_dbo()
+        configuration.begin_request()
+        configuration.organisation(dbo)
+        configuration.cboolean(dbo, "AdvancedFindAnimal")
+        configuration.cint(dbo, "DefaultShelterView")
+        assert 1 == configuration.get_fetch_count()
+        configuration.begin_request()
+        assert 0 == configuration.get_fetch_count()
+        configuration.organisation(dbo)
+        assert 1 == configuration.get_fetch_count()
+
+    def test_cset_refreshes_map(self):
+        dbo = base.get_dbo()
+        configuration.begin_request()
+        configuration.cset(dbo, "TestConfigurationItem", "one")
+        assert "one" == configuration.cstring(dbo, "TestConfigurationItem")
+        configuration.cset(dbo, "TestConfigurationItem", "two")
+        assert "two" == configuration.cstring(dbo, "TestConfigurationItem")
+        assert 2 == configuration.get_fetch_count()
+
+    def test_map_read_only(self):
+        dbo = base.get_dbo()
+        cmap = configuration.get_map(dbo)
+        self.assertRaises(TypeError, cmap.__setitem__, "Organisation", "x")
+        self.assertRaises(TypeError, cmap.update, { "Organisation": "x" })
+
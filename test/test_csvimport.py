@@ -3,14 +3,88 @@
 import unittest
 import base
 
+import additional
+import animal
+import configuration
 import csvimport
+import utils
 
 class TestCSVImport(unittest.TestCase):
 
     def tearDown(self):
         base.execute("DELETE FROM animal WHERE AnimalName = 'TestioCSV'")
+        base.execute("DELETE FROM breed WHERE BreedName = 'TestioBreed'")
+        base.execute("DELETE FROM species WHERE SpeciesName = 'TestioSpecies'")
 
     def test_csvimport(self):
         csvdata = "ANIMALNAME,ANIMALSEX,ANIMALAGE\n\"TestioCSV\",\"Male\",\"2\"\n"
         csvimport.csvimport(base.get_dbo(), csvdata)
 
+    def test_create_additional_fields(self):
+        dbo = base.get_dbo()
+        for n in ( "testiogood", "testiobad" ):
+            additional.insert_field_from_form(dbo, "test", utils.PostedData({ "name": n, "label": n, "tooltip": "", "lookupvalues": "",
+                "defaultvalue": "", "type": "0", "link": str(additional.ANIMAL), "displayindex": "0" }, "en"))
+        # A value that the database rejects only loses its own field
+        def insert_many(table, rows, **kwargs):
+            raise Exception("bulk insert failed")
+        def insert(table, values, **kwargs):
+            if values["Value"] == "bad": raise Exception("bad value")
+            return base.get_dbo().insert(table, values, **kwargs)
+        dbo.insert_many = insert_many
+        dbo.insert = insert
+        errors = []
+        try:
+            csvimport.create_additional_fields(dbo, { "ANIMALADDITIONALTESTIOGOOD": "good", "ANIMALADDITIONALTESTIOBAD": "bad" }, errors, 1, linkid = 99999)
+            assert len(errors) == 1
+            assert base.get_dbo().query_string("SELECT Value FROM additional WHERE LinkID = 99999") == "good"
+        finally:
+            base.execute("DELETE FROM additional WHERE LinkID = 99999")
+            base.execute("DELETE FROM additionalfield WHERE FieldName LIKE 'testio%'")
+
+    def test_csvimport_lookups(self):
+        dbo = base.get_dbo()
+        csvdata = "ANIMALNAME,ANIMALSPECIES,ANIMALBREED1\n" \
+            "TestioCSV,TestioSpecies,TestioBreed\n" \
+            "TestioCSV,testiospecies,TestioBreed\n"
+        csvimport.csvimport(dbo, csvdata, createmissinglookups = True)
+        speciesid = dbo.query_int("SELECT ID FROM species WHERE SpeciesName = 'TestioSpecies'")
+        breed = dbo.query("SELECT ID, SpeciesID FROM breed WHERE BreedName = 'TestioBreed'")
+        assert 1 == len(breed)
+        assert speciesid == breed[0].SPECIESID
+        assert 2 == dbo.query_int("SELECT COUNT(*) FROM animal WHERE AnimalName = 'TestioCSV' AND SpeciesID = ? AND BreedID = ?", (speciesid, breed[0].ID))
+
+    def test_csvimport_error_in_chunk(self):
+        dbo = base.get_dbo()
+        csvdata = "ANIMALNAME,ANIMALCODE\nTestioCSV,TESTIOCSV1\nTestioCSV,TESTIOCSV1\n"
+        rv = csvimport.csvimport(dbo, csvdata)
+        assert rv.startswith("<p>1 success, 1 errors</p>")
+        assert 1 == dbo.query_int("SELECT COUNT(*) FROM animal WHERE AnimalName = 'TestioCSV'")
+
+    def test_csvimport_failed_chunk(self):
+        dbo = base.get_dbo()
+        csvdata = "ANIMALNAME,ANIMALCODE\nTestioCSV,TESTIOCSV1\nTestioCSV,TESTIOCSV2\n"
+        # A statement error that's swallowed inside the chunk's transaction
+        insert_animal_from_form = animal.insert_animal_from_form
+        def insert_failing(*args, **kwargs):
+            if dbo.get_transaction() is not None:
+                try:
+                    dbo.execute("UPDATE nosuchtable SET X=1")
+                except:
+                    pass
+            return insert_animal_from_form(*args, **kwargs)
+        animal.insert_animal_from_form = insert_failing
+        try:
+            rv = csvimport.csvimport(dbo, csvdata)
+        finally:
+            animal.insert_animal_from_form = insert_animal_from_form
+        assert rv.startswith("<p>2 success, 0 errors</p>")
+        assert 2 == dbo.query_int("SELECT COUNT(*) FROM animal WHERE AnimalName = 'TestioCSV'")
+
+    def test_csvimport_resume(self):
+        dbo = base.get_dbo()
+        csvdata = "ANIMALNAME,ANIMALCODE\nTestioCSV,TESTIOCSV1\nTestioCSV,TESTIOCSV2\n"
+        configuration.csv_import_progress(dbo, "%s:1" % utils.md5_hash(csvdata))
+        csvimport.csvimport(dbo, csvdata)
+        assert [ "TESTIOCSV2" ] == [ r.SHELTERCODE for r in dbo.query("SELECT ShelterCode FROM animal WHERE AnimalName = 'TestioCSV'") ]
+        assert "" == configuration.csv_import_progress(dbo)
@@ -0,0 +1,186 @@
+#!/usr/bin/python env
+
+import unittest
+import base
+
+import audit
+import db
+import dbms.base
+import dbms.pool
+import dbupdate
+
+class TestDb(unittest.TestCase):
+
+    def get_pooled_dbo(self, size):
+        dbo = base.get_dbo()
+        dbo.pool_size = size
+        return dbo
+
+    def tearDown(self):
+        dbms.pool.close_all()
+
+    def test_pool_reuse(self):
+        dbo = self.get_pooled_dbo(2)
+        for i in range(0, 10):
+            assert dbo.query_int("SELECT COUNT(*) FROM animal") >= 0
+        stats = db.get_pool_stats()[0]
+        assert stats["checkouts"] == 10
+        assert stats["misses"] == 1
+        assert stats["hits"] == 9
+        assert stats["inuse"] == 0
+        assert stats["idle"] == 1
+
+    def test_pool_write_and_error(self):
+        dbo = self.get_pooled_dbo(1)
+        dbo.execute("UPDATE configuration SET ItemValue = ItemValue WHERE ItemName = 'DBV'")
+        self.assertRaises(Exception, dbo.query, "SELECT * FROM nosuchtable")
+        # The connection should still be usable after the failure
+        assert dbo.query_int("SELECT COUNT(*) FROM configuration") > 0
+        assert db.get_pool_stats()[0]["misses"] == 1
+
+    def test_pool_timeout(self):
+        dbo = self.get_pooled_dbo(1)
+        p = dbms.pool.get_pool(dbo)
+        p.waittimeout = 0.1
+        c = p.checkout(dbo)
+        self.assertRaises(dbms.pool.PoolTimeoutError, p.checkout, dbo)
+        p.checkin(c)
+        assert p.stats()["timeouts"] == 1
+        assert p.checkout(dbo) is c
+
+    def test_pool_health_check(self):
+        dbo = self.get_pooled_dbo(1)
+        p = dbms.pool.get_pool(dbo)
+        p.checkafter = 0
+        c = p.checkout(dbo)
+        p.checkin(c)
+        c.close()
+        assert p.checkout(dbo) is not c
+        assert p.stats()["failedchecks"] == 1
+
+    def test_clone(self):
+        dbo = base.get_dbo()
+        dbo.connection = dbo.connect()
+        try:
+            c = dbo.clone()
+            assert c.connection is None
+            assert c.database == dbo.database
+            assert c.query_int("SELECT COUNT(*) FROM configuration") > 0
+        finally:
+            dbo.connection.close()
+
+    def test_transaction_commit(self):
+        dbo = base.get_dbo()
+        with dbo.transaction():
+            nid = dbo.insert("diet", { "DietName": "TransactionTest", "DietDescription": "" })
+            dbo.update("diet", nid, { "DietDescription": "Updated" })
+            assert dbo.get_transaction().depth == 1
+        assert dbo.get_transaction() is None
+        assert dbo.query_string("SELECT DietDescription FROM diet WHERE ID=?", [nid]) == "Updated"
+        dbo.delete("diet", nid)
+
+    def test_transaction_rollback(self):
+        dbo = base.get_dbo()
+        try:
+            with dbo.transaction():
+                with dbo.transaction():
+                    nid = dbo.insert("diet", { "DietName": "TransactionTest", "DietDescription": "" })
+                raise Exception("rollback")
+        except:
+            pass
+        assert dbo.get_transaction() is None
+        assert dbo.query_int("SELECT COUNT(*) FROM diet WHERE ID=?", [nid]) == 0
+
+    def test_transaction_failed(self):
+        dbo = base.get_dbo()
+        failed = False
+        try:
+            with dbo.transaction():
+                nid = dbo.insert("diet", { "DietName": "TransactionTest", "DietDescription": "" })
+                try:
+                    dbo.execute("UPDATE nosuchtable SET X=1")
+                except:
+                    pass
+        except dbms.base.TransactionFailedError:
+            failed = True
+        assert failed
+        assert dbo.get_transaction() is None
+        assert dbo.query_int("SELECT COUNT(*) FROM diet WHERE ID=?", [nid]) == 0
+
+    def test_transaction_pooled(self):
+        dbo = self.get_pooled_dbo(1)
+        with dbo.transaction():
+            nid = dbo.insert("diet", { "DietName": "TransactionTest", "DietDescription": "" })
+            assert dbo.query_int("SELECT COUNT(*) FROM diet WHERE ID=?", [nid]) == 1
+        dbo.delete("diet", nid)
+        stats = db.get_pool_stats()[0]
+        assert stats["misses"] == 1
+        assert stats["inuse"] == 0
+
+    def test_query_stream(self):
+        dbo = base.get_dbo()
+        sql = "SELECT * FROM lksmovementtype ORDER BY ID"
+        rows = dbo.query(sql)
+        streamed = list(dbo.query_stream(sql, batchsize=3))
+        assert streamed == rows
+        assert streamed[0].id == rows[0]["ID"]
+        assert len(list(dbo.query_stream("SELECT ID FROM lksmovementtype WHERE ID=?", [-1]))) == 0
+        assert len(list(dbo.query_stream("SELECT 1 AS ID FROM lksmovementtype", distincton="ID"))) == 1
+
+    def test_query_stream_pooled(self):
+        dbo = self.get_pooled_dbo(2)
+        for r in dbo.query_stream("SELECT * FROM lksmovementtype", batchsize=2):
+            # The stream holds its connection until it is finished with
+            assert db.get_pool_stats()[0]["inuse"] == 1
+            assert dbo.query_int("SELECT COUNT(*) FROM lksmovementtype") > 0
+            break
+        stats = db.get_pool_stats()[0]
+        assert stats["inuse"] == 0
+        assert stats["misses"] == 2
+
+    def test_schema_verified(self):
+        dbo = base.get_dbo()
+        assert dbo.has_structure()
+        dbupdate.clear_schema_verified(dbo)
+        assert not dbupdate.is_schema_verified(dbo)
+        dbupdate.set_schema_verified(dbo)
+        assert dbupdate.is_schema_verified(dbo)
+        # Running updates means the database needs checking again
+        dbupdate.perform_updates(dbo)
+        assert not dbupdate.is_schema_verified(dbo)
+
+    def test_insert_many(self):
+        dbo = base.get_dbo()
+        rows = [ { "AnimalID": 0, "DietID": 1, "DateStarted": dbo.today(), "Comments": "It's <b>%d</b>" % i } for i in range(0, 1200) ]
+        rows.append({ "AnimalID": 0, "DietID": 2, "DateStarted": dbo.today() })
+        auditsql = "SELECT COUNT(*) FROM audittrail WHERE TableName='animaldiet'"
+        audited = dbo.query_int(auditsql)
+        ids = dbo.insert_many("animaldiet", rows, "test", batchsize=100)
+        try:
+            assert len(ids) == 1201
+            assert ids == range(ids[0], ids[0] + 1201)
+            assert dbo.query_int("SELECT COUNT(*) FROM animaldiet WHERE AnimalID=0") == 1201
+            assert dbo.query_int(auditsql) == audited + 1201
+            # Values are encoded the same way as insert does it
+            nid = dbo.insert("animaldiet", { "AnimalID": 0, "DietID": 1, "DateStarted": dbo.today(), "Comments": "It's <b>5</b>" }, "test")
+            assert dbo.query_string("SELECT Comments FROM animaldiet WHERE ID=?", [ids[5]]) == \
+                dbo.query_string("SELECT Comments FROM animaldiet WHERE ID=?", [nid])
+            assert dbo.query_string("SELECT CreatedBy FROM animaldiet WHERE ID=?", [ids[-1]]) == "test"
+            assert dbo.insert_many("animaldiet", []) == []
+        finally:
+            dbo.execute("DELETE FROM animaldiet WHERE AnimalID=0")
+
+    def test_update_many(self):
+        dbo = base.get_dbo()
+        ids = dbo.insert_many("animaldiet", [ { "AnimalID": 0, "DietID": 1, "DateStarted": dbo.today(), "Comments": "" } for i in range(0, 5) ], "test")
+        try:
+            assert dbo.update_many("animaldiet", [ (ids[0], { "Comments": "First" }), 
+                (ids[1], { "Comments": "Second" }), (ids[2], { "DietID": 2 }) ], "test") == 3
+            assert dbo.query_string("SELECT Comments FROM animaldiet WHERE ID=?", [ids[1]]) == "Second"
+            assert dbo.query_int("SELECT DietID FROM animaldiet WHERE ID=?", [ids[2]]) == 2
+            assert dbo.query_string("SELECT Comments FROM animaldiet WHERE ID=?", [ids[3]]) == ""
+            assert dbo.query_string("SELECT LastChangedBy FROM animaldiet WHERE ID=?", [ids[0]]) == "test"
+            desc = dbo.query_string("SELECT Description FROM audittrail WHERE TableName='animaldiet' AND LinkID=? AND Action=? ORDER BY AuditDate DESC", (ids[0], audit.EDIT))
+            assert desc.find("COMMENTS") != -1 and desc.find("First") != -1
+        finally:
+            dbo.execute("DELETE FROM animaldiet WHERE AnimalID=0")
@@ -0,0 +1,84 @@
+#!/usr/bin/python env
+
+import unittest
+import base
+
+import emailqueue
+import smtplib
+import utils
+
+class FakeSender(object):
+    """ Stands in for utils.EmailSender, recording what it sends """
+    instances = 0
+    sent = []
+    error = None
+    def __init__(self, dbo):
+        FakeSender.instances += 1
+    def send(self, fromadd, tolist, msg, bccadd = ""):
+        if FakeSender.error is not None: raise FakeSender.error
+        FakeSender.sent.append(tolist)
+    def close(self):
+        pass
+
+class TestEmailQueue(unittest.TestCase):
+
+    def setUp(self):
+        base.execute("DELETE FROM emailqueue")
+        self.sender = utils.EmailSender
+        utils.EmailSender = FakeSender
+        FakeSender.instances = 0
+        FakeSender.sent = []
+        FakeSender.error = None
+
+    def tearDown(self):
+        utils.EmailSender = self.sender
+        base.execute("DELETE FROM emailqueue")
+
+    def test_process(self):
+        dbo = base.get_dbo()
+        for i in range(0, 3):
+            emailqueue.queue_email(dbo, "test@example.com", "to%d@example.com" % i, "", "", "Subject %d" % i, "Body", "plain")
+        assert 3 == emailqueue.get_queue_count(dbo)
+        assert 3 == emailqueue.process(dbo)
+        assert 1 == FakeSender.instances
+        assert [ [ "to0@example.com" ], [ "to1@example.com" ], [ "to2@example.com" ] ] == FakeSender.sent
+        assert 0 == emailqueue.get_queue_count(dbo)
+        assert 3 == dbo.query_int("SELECT COUNT(*) FROM emailqueue WHERE Status = ?", [emailqueue.SENT])
+        # Nothing left to send
+        assert 0 == emailqueue.process(dbo)
+
+    def test_retry(self):
+        dbo = base.get_dbo()
+        mid = emailqueue.queue_email(dbo, "test@example.com", "to@example.com", "", "", "Subject", "Body", "plain")
+        FakeSender.error = Exception("connection refused")
+        assert 0 == emailqueue.process(dbo)
+        m = dbo.query("SELECT * FROM emailqueue WHERE ID = ?", [mid])[0]
+        assert emailqueue.QUEUED == m.status
+        assert 1 == m.attempts
+        assert m.nextattemptdatetime > dbo.now()
+        # Not due again yet
+        FakeSender.error = None
+        assert 0 == emailqueue.process(dbo)
+        dbo.execute("UPDATE emailqueue SET NextAttemptDateTime = ? WHERE ID = ?", ( dbo.now(), mid ))
+        assert 1 == emailqueue.process(dbo)
+
+    def test_refused(self):
+        dbo = base.get_dbo()
+        mid = emailqueue.queue_email(dbo, "test@example.com", "bad@example.com", "", "", "Subject", "Body", "plain")
+        FakeSender.error = smtplib.SMTPRecipientsRefused({ "bad@example.com": (550, "No such user") })
+        emailqueue.process(dbo)
+        assert emailqueue.FAILED == dbo.query_int("SELECT Status FROM emailqueue WHERE ID = ?", [mid])
+
+    def test_claim(self):
+        dbo = base.get_dbo()
+        mid = emailqueue.queue_email(dbo, "test@example.com", "to@example.com", "", "", "Subject", "Body", "plain")
+        assert emailqueue.claim(dbo, mid)
+        assert not emailqueue.claim(dbo, mid)
+        assert 0 == emailqueue.process(dbo)
+
+    def test_build_email(self):
+        fromadd, tolist, msg = utils.build_email(base.get_dbo(), "Test <test@example.com>", "a@example.com, B <b@example.com>", "", "c@example.com", "Subject", "Body")
+        assert [ "a@example.com", "b@example.com", "c@example.com" ] == tolist
+        assert "Subject" == msg["Subject"]
+        assert msg["Bcc"] is None
+
@@ -3,10 +3,86 @@
 import unittest
 import base
 
+import cachedisk
 import geo
+import threading
+import time
+
+ADDRESSES = [ ("1 Test Street", "Testville", "Testshire", "T1 1AA", "England"),
+    ("2 Test Street", "Testville", "Testshire", "T1 1AB", "England"),
+    ("1 test street", "TESTVILLE", "Testshire", "T11AA", "England"),
+    ("", "Testville", "Testshire", "T1 1AA", "England") ]
+
+class StubProvider(geo.Smcom):
+    """ Answers every address with the same location, counting the lookups """
+    calls = 0
+    lock = threading.Lock()
+    def search(self):
+        with StubProvider.lock:
+            StubProvider.calls += 1
+        self.json_response = { "lat": 53.4, "lng": -1.3 }
 
 class TestGeo(unittest.TestCase):
+
+    def setUp(self):
+        geo.PROVIDERS["stub"] = StubProvider
+        geo.PROVIDER_RATES["stub"] = 1000.0
+        StubProvider.calls = 0
+        self.clear_cache()
+
+    def tearDown(self):
+        self.clear_cache()
+        del geo.PROVIDERS["stub"]
+        del geo.PROVIDER_RATES["stub"]
+        geo.limiters.pop("stub", None)
+
+    def clear_cache(self):
+        for a in ADDRESSES:
+            cachedisk.delete(geo.get_cache_key(*a))
  
     def test_get_lat_long(self):
         assert geo.get_lat_long(base.get_dbo(), "109 Greystones Road", "Rotherham", "South Yorkshire", "S60 2AH", "England") is not None
 
+    def test_lookup_cache(self):
+        dbo = base.get_dbo()
+        assert "53.4,-1.3,1TestStreetTestvilleTestshireT11AA" == geo.lookup(dbo, "stub", *ADDRESSES[0])
+        assert 1 == StubProvider.calls
+        # The same address written differently is found in the cache, but gets its own hash
+        assert "53.4,-1.3,1teststreetTESTVILLETestshireT11AA" == geo.lookup(dbo, "stub", *ADDRESSES[2])
+        assert 1 == StubProvider.calls
+
+    def test_get_lat_longs(self):
+        dbo = base.get_dbo()
+        rv = geo.get_lat_longs(dbo, ADDRESSES * 5, "stub", 3)
+        assert 20 == len(rv)
+        assert 2 == StubProvider.calls
+        assert "53.4,-1.3,2TestStreetTestvilleTestshireT11AB" == rv[1]
+        assert "53.4,-1.3,1teststreetTESTVILLETestshireT11AA" == rv[6]
+        assert None == rv[3]
+        # Everything is in the cache now
+        geo.get_lat_longs(dbo, ADDRESSES, "stub")
+        assert 2 == StubProvider.calls
+
+    def test_rate_limiter(self):
+        limiter = geo.RateLimiter(0.05)
+        start = time.time()
+        threads = [ threading.Thread(target=limiter.wait) for i in range(5) ]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        assert time.time() - start >= 0.19
+
+
+    def test_get_limiter(self):
+        # Each provider is limited to its own rate unless geo_sleep_after is set
+        for p in ( "nominatim", "google", "smcom" ):
+            geo.limiters.pop(p, None)
+            assert 1.0 / geo.PROVIDER_RATES[p] == geo.get_limiter(p).interval
+        assert geo.get_limiter("google") is geo.get_limiter("google")
+        sleepafter = geo.GEO_SLEEP_AFTER
+        geo.GEO_SLEEP_AFTER = 0.5
+        try:
+            geo.limiters.pop("google", None)
+            assert 0.5 == geo.get_limiter("google").interval
+        finally:
+            geo.GEO_SLEEP_AFTER = sleepafter
+            geo.limiters.pop("google", None)
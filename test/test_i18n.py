@@ -0,0 +1,36 @@
+#!/usr/bin/python env
+
+import unittest
+import base
+
+import i18n
+import os
+
+class TestI18n(unittest.TestCase):
+
+    def test_translate(self):
+        assert "Avertissements" == i18n._("Warnings", "fr")
+        # Untranslated and unknown phrases come back in English
+        assert "Select recommended" == i18n._("Select recommended", "fr")
+        assert "Not a real phrase" == i18n._("Not a real phrase", "fr")
+        assert "Warnings" == i18n._("Warnings", "en")
+        assert "Warnings" == i18n._("Warnings", "xx")
+        assert "Warnings" == i18n._("Warnings", None)
+
+    def test_shared_catalogue(self):
+        assert i18n._("Warnings", "fr_BE") == i18n._("Warnings", "fr")
+        assert i18n.load_catalogue("fr_BE") is i18n.load_catalogue("fr")
+
+    def test_compiled_catalogue(self):
+        cat = i18n.compile_catalogue("fr")
+        assert os.path.exists(i18n.get_catalogue_filename("fr"))
+        assert "" not in cat
+        assert "Select recommended" not in cat
+        # Loading from the compiled catalogue gives the same thing
+        i18n.catalogues.pop("fr", None)
+        i18n.catalogues.pop("fr_BE", None)
+        assert cat == i18n.load_catalogue("fr")
+
+    def test_i18nstringsjs(self):
+        assert i18n.i18nstringsjs("fr").find("Avertissements") != -1
+
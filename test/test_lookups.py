@@ -6,6 +6,12 @@ import base
 import lookups
 
 class TestLookups(unittest.TestCase):
+
+    def setUp(self):
+        lookups.CACHE_COMMON_QUERIES = True
+
+    def tearDown(self):
+        lookups.CACHE_COMMON_QUERIES = False
  
     def test_message_crud(self):
         mid = lookups.add_message(base.get_dbo(), "test", "", "Test")
@@ -23,6 +29,43 @@ class TestLookups(unittest.TestCase):
         lookups.update_lookup(base.get_dbo(), nid, "vaccinationtype", "Test")
         lookups.delete_lookup(base.get_dbo(), "vaccinationtype", nid)
              
+    def test_lookup_cache(self):
+        dbo = base.get_dbo()
+        species = lookups.get_species(dbo)
+        # Served from the cache, as copies
+        species[0].SPECIESNAME = "Changed"
+        assert lookups.get_species(dbo)[0].SPECIESNAME != "Changed"
+        # Writes through the lookup functions invalidate the table
+        nid = lookups.insert_lookup(dbo, "species", "Test")
+        assert len(lookups.get_species(dbo)) == len(species) + 1
+        assert lookups.get_species_name(dbo, nid) == "Test"
+        assert any([ b.SPECIESNAME == "Test" for b in lookups.get_breeds_by_species(dbo) ]) == False
+        lookups.update_lookup(dbo, nid, "species", "Test2")
+        assert lookups.get_species_name(dbo, nid) == "Test2"
+        assert lookups.get_species_name(dbo, str(nid)) == "Test2"
+        lookups.delete_lookup(dbo, "species", nid)
+        assert lookups.get_species_name(dbo, nid) == ""
+        assert lookups.get_species_name(dbo, None) == ""
+        assert len(lookups.get_species(dbo)) == len(species)
+        # Location filters are applied to the cached rows
+        locations = lookups.get_internal_locations(dbo)
+        filtered = lookups.get_internal_locations(dbo, str(locations[0].ID))
+        assert len(filtered) == 1 and filtered[0].ID == locations[0].ID
+
+    def test_lookup_versions(self):
+        dbo = base.get_dbo()
+        lookups.flush_lookup(dbo, "species")
+        lookups.flush_lookups(dbo)
+        species = lookups.get_species(dbo)
+        # A write by another process is seen once it has issued a new version
+        nid = dbo.insert("species", { "SpeciesName": "Test", "SpeciesDescription": "", "PetFinderSpecies": "", "IsRetired": 0 })
+        assert len(lookups.get_species(dbo)) == len(species)
+        dbo.execute("UPDATE configuration SET ItemValue = 'other' WHERE ItemName = 'LookupVersion.species'")
+        assert len(lookups.get_species(dbo)) == len(species) + 1
+        dbo.delete("species", nid)
+        dbo.execute("UPDATE configuration SET ItemValue = 'other' WHERE ItemName = 'LookupVersion'")
+        assert len(lookups.get_species(dbo)) == len(species)
+
     def test_get(self):
         assert lookups.get_account_types(base.get_dbo()) > 0
         assert lookups.get_additionalfield_links(base.get_dbo()) > 0
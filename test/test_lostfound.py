@@ -4,6 +4,7 @@ import unittest
 import base
 
 import animal, lostfound, waitinglist
+import datetime
 import utils
 
 class TestLostFound(unittest.TestCase):
@@ -92,3 +93,20 @@ class TestLostFound(unittest.TestCase):
         aid = lostfound.create_waitinglist_from_found(base.get_dbo(), "test", self.faid)
         waitinglist.delete_waitinglist(base.get_dbo(), "test", aid)
 
+    def test_match_index(self):
+        d = datetime.datetime(2020, 6, 1)
+        rows = [
+            { "TYPE": 1, "FEAT": "white paw", "PC": "S1 1AB", "DATE": d + datetime.timedelta(days=3) },
+            { "TYPE": 2, "FEAT": "black, white", "PC": "", "DATE": d + datetime.timedelta(days=40) },
+            { "TYPE": 1, "FEAT": "", "PC": None, "DATE": None }
+        ]
+        terms = (
+            ( lostfound.EQUALS, "TYPE", ( "TYPE", ), 5 ),
+            ( lostfound.WORDS, "FEAT", ( "FEAT", ), 5 ),
+            ( lostfound.POSTCODE, "PC", ( "PC", ), 5 ),
+            ( lostfound.WITHIN2WEEKS, "DATE", ( "DATE", ), 5 )
+        )
+        la = { "TYPE": 1, "FEAT": "white tail", "PC": "S1", "DATE": d }
+        m = lostfound.MatchIndex(rows, terms, 10)
+        assert [ (rows[0], 17), (rows[2], 10) ] == m.matches(la)
+        assert 2 == lostfound.words(la["FEAT"], rows[1]["FEAT"], 5)
@@ -3,7 +3,7 @@
 import unittest
 import base, base64
 
-import animal, media
+import animal, cachedisk, media
 import utils
 
 class TestMedia(unittest.TestCase):
@@ -28,3 +28,27 @@ class TestMedia(unittest.TestCase):
     def test_remove_expired_media(self):
         media.remove_expired_media(base.get_dbo())
 
+    def test_image_derivatives(self):
+        dbo = base.get_dbo()
+        data = {
+            "animalname": "Testio",
+            "estimatedage": "1",
+            "animaltype": "1",
+            "entryreason": "1",
+            "species": "1"
+        }
+        post = utils.PostedData(data, "en")
+        nid, code = animal.insert_animal_from_form(dbo, post, "test")
+        f = open(base.PATH + "../src/media/reports/nopic.jpg", "rb")
+        data = f.read()
+        f.close()
+        post = utils.PostedData({ "filename": "image.jpg", "filetype": "image/jpeg", "filedata": "data:image/jpeg;base64," + base64.b64encode(data) }, "en")
+        mid = media.attach_file_from_form(dbo, "test", media.ANIMAL, nid, post)
+        mr = dbo.first_row(media.get_media_by_id(dbo, mid))
+        key = media.get_derivative_key(dbo, mr, media.THUMBNAIL_SIZE)
+        d, thumb = media.get_image_file_data(dbo, "animalthumb", nid)
+        assert thumb == cachedisk.get(key)
+        media.rotate_media(dbo, "test", mid)
+        assert None == cachedisk.get(key)
+        media.delete_media(dbo, "test", mid)
+        animal.delete_animal(dbo, "test", nid)
@@ -3,6 +3,7 @@
 import unittest
 import base
 
+import animal
 import person
 import utils
 
@@ -123,6 +124,45 @@ class TestPerson(unittest.TestCase):
     def test_update_lookingfor_report(self):
         person.update_lookingfor_report(base.get_dbo())
 
+    def test_lookingfor_matcher(self):
+        dbo = base.get_dbo()
+        data = {
+            "animalname": "Testio",
+            "estimatedage": "2",
+            "animaltype": "1",
+            "entryreason": "1",
+            "species": "1",
+            "comments": "Loves long walks"
+        }
+        aid, code = animal.insert_animal_from_form(dbo, utils.PostedData(data, "en"), "test")
+        try:
+            dbo.execute("UPDATE animal SET IsGoodWithCats=0, IsGoodWithDogs=1 WHERE ID=?", [aid])
+            dbo.execute("UPDATE owner SET MatchActive=1, MatchExpires=Null, MatchAnimalType=-1, MatchSpecies=1, MatchBreed=-1, " \
+                "MatchSex=-1, MatchSize=-1, MatchColour=-1, MatchGoodWithChildren=2, MatchGoodWithCats=0, MatchGoodWithDogs=2, " \
+                "MatchHouseTrained=2, MatchAgeFrom=1, MatchAgeTo=3, MatchCommentsContain='WALK long' WHERE ID=?", [self.nid])
+            def matches(sql = ""):
+                if sql != "": dbo.execute("UPDATE owner SET %s WHERE ID=%d" % (sql, self.nid))
+                p = dbo.first_row(dbo.query("SELECT * FROM owner WHERE ID=?", [self.nid]))
+                return aid in [ a.ID for a in person.LookingForMatcher(dbo).match(p) ]
+            assert matches()
+            assert not matches("MatchCommentsContain='walks cats'")
+            assert matches("MatchCommentsContain=''")
+            # % and _ are wildcards and case is ignored only if LIKE ignores it, like the query used to
+            for word in ( "l_ng", "walks%", "Lo%ks", "s%ng", "WALKS", "lo_", "_", "long\twalks" ):
+                insql = dbo.query_int("SELECT COUNT(*) FROM animal WHERE ID=? AND AnimalComments LIKE ?", (aid, "%%%s%%" % word)) == 1
+                assert matches("MatchCommentsContain='%s'" % word) == insql
+            dbo.like_ignores_case = False
+            assert not matches("MatchCommentsContain='WALKS'")
+            assert matches("MatchCommentsContain='Loves walks'")
+            assert not matches("MatchGoodWithDogs=0")
+            assert not matches("MatchGoodWithDogs=2, MatchSpecies=2")
+            assert not matches("MatchSpecies=-1, MatchAgeFrom=3, MatchAgeTo=5")
+            assert matches("MatchAgeFrom=0, MatchAgeTo=0")
+            person.update_lookingfor_report(dbo)
+            assert dbo.query_int("SELECT COUNT(*) FROM ownerlookingfor WHERE OwnerID=? AND AnimalID=?", (self.nid, aid)) == 1
+        finally:
+            animal.delete_animal(dbo, "test", aid)
+
     def test_update_anonymise_personal_data(self):
         person.update_anonymise_personal_data(base.get_dbo(), 1)
 
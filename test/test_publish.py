@@ -2,13 +2,57 @@
 
 import unittest
 import base
+import base64
 
 import animal
+import asynctask
 import configuration
+import dbfs
+import media
 import publish
 import publishers
+import time
 import utils
 
+class CountingPublisher(publishers.base.AbstractPublisher):
+    """ Publishes nothing, just counts the animals it would have sent """
+    locked = False
+    def run(self):
+        self.successes = len(self.getMatchingAnimals())
+        self.resetPublisherProgress()
+        CountingPublisher.locked = asynctask.is_task_running(self.dbo)
+
+class StallingPublisher(publishers.base.AbstractPublisher):
+    """ Waits until it is asked to stop """
+    def run(self):
+        while not self.shouldStopPublishing():
+            time.sleep(0.05)
+
+class FakeFTP(object):
+    """ Records the files stored instead of sending them anywhere """
+    stored = []
+    def cwd(self, d):
+        pass
+    def storbinary(self, cmd, f, callback=None):
+        FakeFTP.stored.append(cmd.split(" ")[1])
+    def quit(self):
+        pass
+
+class FakeFTPPublisher(publishers.base.FTPPublisher):
+    def __init__(self, dbo, pc):
+        publishers.base.FTPPublisher.__init__(self, dbo, pc, "ftp.example.com", "user", "pass")
+        self.publisherKey = "testftp"
+    def openFTPConnection(self):
+        return FakeFTP()
+
+class EarlyReturnFTPPublisher(FakeFTPPublisher):
+    """ Queues the images for an animal and returns without calling cleanup """
+    animal = None
+    def run(self):
+        self.makePublishDirectory()
+        self.uploadImages(self.animal)
+        self.pipeline = self.imagePipeline
+
 class TestPublish(unittest.TestCase):
  
     def setUp(self):
@@ -78,3 +122,69 @@ class TestPublish(unittest.TestCase):
         f.flush()
         f.close()
 
+    def test_run_publishers(self):
+        dbo = base.get_dbo()
+        publish.PUBLISHER_LIST["testcount"] = { "label": "Count", "class": CountingPublisher }
+        publish.PUBLISHER_LIST["teststall"] = { "label": "Stall", "class": StallingPublisher }
+        try:
+            rv = publish.run_publishers(dbo, [ "testcount", "testcount2", "teststall" ], timeout=0)
+            assert rv["testcount"] == "completed"
+            assert rv["teststall"] == "timedout"
+            assert "testcount2" not in rv
+            log = dbo.query("SELECT * FROM publishlog WHERE Name='3pty' ORDER BY ID DESC")[0]
+            assert log.success == len(publishers.base.get_animal_data(dbo))
+            assert log.logdata.find("teststall: timedout") != -1
+            # The lock is held until the run ends, not until the first publisher does
+            assert CountingPublisher.locked
+            assert not asynctask.is_task_running(dbo)
+        finally:
+            del publish.PUBLISHER_LIST["testcount"]
+            del publish.PUBLISHER_LIST["teststall"]
+
+    def test_animal_data_snapshot(self):
+        dbo = base.get_dbo()
+        s = publishers.base.AnimalDataSnapshot(dbo, publishers.base.PublishCriteria(configuration.publisher_presets(dbo)))
+        rows = s.get()
+        assert len(rows) > 0
+        rows[0].animalname = "Changed"
+        assert s.get()[0].animalname != "Changed"
+
+    def test_upload_images(self):
+        dbo = base.get_dbo()
+        f = open(base.PATH + "../src/media/reports/nopic.jpg", "rb")
+        data = f.read()
+        f.close()
+        post = utils.PostedData({ "filename": "image.jpg", "filetype": "image/jpeg", "filedata": "data:image/jpeg;base64," + base64.b64encode(data) }, "en")
+        mid = media.attach_file_from_form(dbo, "test", media.ANIMAL, self.nid, post)
+        medianame = dbo.query_string("SELECT MediaName FROM media WHERE ID = ?", [mid])
+        a = { "ID": self.nid, "SHELTERCODE": self.code, "WEBSITEMEDIANAME": medianame, "RECENTLYCHANGEDIMAGES": 0 }
+        pc = publishers.base.PublishCriteria("uploaddirectly thumbnails")
+        def publish_images():
+            FakeFTP.stored = []
+            p = FakeFTPPublisher(dbo, pc)
+            p.makePublishDirectory()
+            try:
+                p.uploadImages(a)
+                p.finishImageUploads()
+            finally:
+                p.deletePublishDirectory()
+            return sorted(FakeFTP.stored)
+        try:
+            assert publish_images() == [ self.code + ".jpg", "tn_" + self.code + ".jpg" ]
+            # Unchanged since the last run
+            assert publish_images() == []
+            # Changed since the last run
+            dbo.execute("UPDATE media SET MediaSize = MediaSize + 1 WHERE ID = ?", [mid])
+            assert publish_images() == [ self.code + ".jpg", "tn_" + self.code + ".jpg" ]
+            # The upload threads are stopped when run returns without calling cleanup
+            p = EarlyReturnFTPPublisher(dbo, publishers.base.PublishCriteria("uploaddirectly thumbnails forcereupload"))
+            p.animal = a
+            try:
+                publish.run_publisher(p)
+                assert p.pipeline.started
+                assert not p.pipeline.fetcher.is_alive()
+                assert p.imagePipeline is None
+            finally:
+                p.deletePublishDirectory()
+        finally:
+            dbfs.delete(dbo, "testftp_images.json", publishers.base.IMAGE_MANIFEST_PATH)
@@ -56,6 +56,60 @@ class TestReports(unittest.TestCase):
     def test_execute(self):
         reports.execute(base.get_dbo(), self.nid)
 
+    def test_execute_streamed(self):
+        dbo = base.get_dbo()
+        ids = [ str(r.id) for r in dbo.query(TEST_QUERY) ]
+        # No groups or calculations, so the rows are streamed and the
+        # header still gets field values from the last row
+        out = reports.execute_sql(dbo, "Stream", TEST_QUERY, "$$HEADER <h1>$ID</h1> HEADER$$ $$BODY <p>$ID</p> BODY$$ $$FOOTER <h2>$ID</h2> FOOTER$$")
+        assert out.find("<h1>%s</h1>  <p>%s</p> " % (ids[-1], ids[0])) != -1
+        assert out.find("<p>%s</p>  <h2>%s</h2>" % (ids[-1], ids[-1])) != -1
+        out = reports.execute_sql(dbo, "Stream", TEST_QUERY, "$$HEADER {COUNT.ID} HEADER$$ $$BODY <p>$ID</p> BODY$$ $$FOOTER FOOTER$$")
+        assert out.find(" %d  <p>%s</p>" % (len(ids), ids[0])) != -1
+
+    def test_compile_block(self):
+        keys = ( "ID", "ANIMALNAME", "NAME" )
+        b = reports.compile_block("<p>$ID $animalname, $Name $ID</p>$ID", keys)
+        assert b.segments == [ "<p>", " ", ", ", " ", "</p>$ID" ]
+        assert b.fields == [ "ID", "ANIMALNAME", "NAME", "ID" ]
+        # Values straight after a $ or field token can't be compiled
+        assert reports.compile_block("$$ID ", keys) is None
+        assert reports.compile_block("$ID$NAME ", ( "NAME", "ID" )) is None
+
+    def test_compiled_output(self):
+        dbo = base.get_dbo()
+        rows = dbo.query("SELECT ID, MovementType, '$x{y}' AS Other, 'movementtype' AS Cascade FROM lksmovementtype ORDER BY ID")
+        blocks = [ "<p>$ID $MOVEMENTTYPE</p>", "$id$MovementType $Other. $$Cascade {SQL.SELECT $ID} $ID", "$$TITLE$$ $OTHER$ID" ]
+        r = reports.Report(dbo)
+        t = reports.ReportTemplate("")
+        for block in blocks:
+            for row in rows:
+                r.compiled = None
+                expected = r._SubstituteFields(block, row)
+                r.compiled = t
+                assert expected == r._SubstituteFields(block, row)
+        # Compiled templates are cached by report ID until the html changes
+        html = "$$HEADER HEADER$$ $$BODY <p>$ID</p> BODY$$ $$FOOTER FOOTER$$"
+        t = reports.get_report_template(dbo, self.nid, html)
+        assert t is reports.get_report_template(dbo, self.nid, html)
+        assert t is not reports.get_report_template(dbo, self.nid, html + " ")
+        out = reports.execute_sql(dbo, "Compiled", TEST_QUERY + " ORDER BY ID", "$$HEADER HEADER$$ $$GROUP_ID $$HEAD <h1>$ID</h1> $$FOOT </h1> GROUP$$ $$BODY <p>$ID</p> BODY$$ $$FOOTER FOOTER$$")
+        assert out.find("<h1>%s</h1>  <p>%s</p>  </h1>" % (rows[0].id, rows[0].id)) != -1
+
+    def test_execute_subreports(self):
+        dbo = base.get_dbo()
+        ids = [ str(r.id) for r in dbo.query(TEST_QUERY) ]
+        out = reports.execute_sql(dbo, "Subreports", TEST_QUERY, "$$HEADER HEADER$$ $$BODY <p>$ID {SUBREPORT.test report.ID} {SUBREPORT.test report.ID}</p> BODY$$ $$FOOTER FOOTER$$")
+        assert out.count("<p>%s</p>" % ids[0]) >= 2 * len(ids)
+        assert out.find("doesn't exist") == -1
+
+    def test_execute_query_stream(self):
+        rows, cols = reports.execute_query(base.get_dbo(), self.nid)
+        srows, scols = reports.execute_query(base.get_dbo(), self.nid, stream=True)
+        assert cols == scols
+        assert rows == list(srows)
+        assert utils.csv("en", rows, cols) == "".join(utils.csv_stream("en", iter(rows), cols))
+
     def test_smcom_reports(self):
         reports.install_smcom_reports(base.get_dbo(), "test", [1]) # Calls get_reports to do the install
 
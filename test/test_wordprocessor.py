@@ -0,0 +1,64 @@
+#!/usr/bin/python env
+
+import unittest
+import base
+import base64
+
+import animal
+import template
+import utils
+import wordprocessor
+
+class TestWordProcessor(unittest.TestCase):
+
+    def test_substitute_tags(self):
+        tags = { "NAME": "Fluffy & <Bob>", "IMG": "<img src=\"x\" />", "EMPTY": None }
+        s = "<p>&lt;&lt;Name&gt;&gt; &lt;&lt;IMG&gt;&gt; &lt;&lt;Empty&gt;&gt; &lt;&lt;Unknown&gt;&gt; &lt;&lt;Name</p>"
+        assert "<p>Fluffy &amp; &lt;Bob&gt; <img src=\"x\" /> None  &lt;&lt;Name</p>" == wordprocessor.substitute_tags(s, tags)
+        assert "Dear Fluffy & <Bob>" == wordprocessor.substitute_tags_plain("Dear <<name>>", tags)
+        assert "$ Fluffy &amp; &lt;Bob&gt; $" == wordprocessor.substitute_tags("$ $$NAME$$ $", tags, True, "$$", "$$")
+
+    def test_substitute_tags_nested(self):
+        # Tags inside substituted values are substituted as well
+        tags = { "A": "<<B>>", "B": "b", "C": "<" }
+        assert "xbx" == wordprocessor.substitute_tags_plain("x<<A>>x", tags)
+        assert "xb" == wordprocessor.substitute_tags_plain("x<<C>><B>>", tags)
+
+    def test_tag_template(self):
+        t = wordprocessor.TagTemplate("&lt;&lt;A&gt;&gt;-&lt;&lt;B&gt;&gt;")
+        assert [ "A", "B" ] == t.tags
+        assert "1-2" == t.render({ "A": 1, "B": 2 })
+        assert "3-4" == t.render({ "A": 3, "B": 4 })
+
+    def test_substitute_template(self):
+        dbo = base.get_dbo()
+        nid = template.create_document_template(dbo, "test", "testwp", ".html", "<p>&lt;&lt;Name&gt;&gt;</p>")
+        assert "<p>Fluffy</p>" == wordprocessor.substitute_template(dbo, nid, { "NAME": "Fluffy" })
+        template.update_document_template_content(dbo, nid, "<b>&lt;&lt;Name&gt;&gt;</b>")
+        assert "<b>Fluffy</b>" == wordprocessor.substitute_template(dbo, nid, { "NAME": "Fluffy" })
+        # A change made by another process, which only touches the database
+        dbo.update("templatedocument", nid, { "Content": base64.b64encode("<i>&lt;&lt;Name&gt;&gt;</i>") }, setRecordVersion=False, setLastChanged=False, writeAudit=False)
+        dbo.execute("UPDATE configuration SET ItemValue = ? WHERE ItemName = 'DocumentTemplateVersion'", [ "otherprocess" ])
+        assert "<i>Fluffy</i>" == wordprocessor.substitute_template(dbo, nid, { "NAME": "Fluffy" })
+        template.delete_document_template(dbo, "test", nid)
+
+    def test_animal_tags_usedtags(self):
+        dbo = base.get_dbo()
+        data = {
+            "animalname": "Testio",
+            "estimatedage": "1",
+            "animaltype": "1",
+            "entryreason": "1",
+            "species": "1"
+        }
+        post = utils.PostedData(data, "en")
+        nid, code = animal.insert_animal_from_form(dbo, post, "test")
+        a = animal.get_animal(dbo, nid)
+        s = "&lt;&lt;AnimalName&gt;&gt; &lt;&lt;TotalCosts&gt;&gt; &lt;&lt;AnimalIsVaccinated&gt;&gt; &lt;&lt;LogName1&gt;&gt;"
+        assert wordprocessor.substitute_tags(s, wordprocessor.animal_tags(dbo, a)) == \
+            wordprocessor.substitute_tags(s, wordprocessor.animal_tags(dbo, a, usedtags=wordprocessor.get_used_tags(s)))
+        tags = wordprocessor.animal_tags(dbo, a, usedtags=set(["ANIMALNAME"]))
+        assert "Testio" == tags["ANIMALNAME"]
+        assert not "TOTALCOSTS" in tags
+        assert not "ANIMALISVACCINATED" in tags
+        animal.delete_animal(dbo, "test", nid)